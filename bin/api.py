@@ -8,14 +8,17 @@
 
 # generic imports
 import os
+import sys
 import configparser
+import subprocess
 import jwt
 
 # ideal imports
 import ideal_module as idm
 import utils.condor_utils as cndr 
 import utils.api_utils as ap 
-import impl.dicom_functions as dcm
+from utils.result_transfer import result_transfer_manager
+from impl.dicom_verifier import dicom_verifier
 # api imports
 from flask import Flask, request, jsonify, Response 
 from flask_sqlalchemy import SQLAlchemy
@@ -51,6 +54,11 @@ max_queue_size = 50
 jobs_list = dict()
 queue = ap.preload_status_overview(ideal_history_cfg,max_size=max_queue_size)
 
+# results are sent to the receiver in background threads
+transfer_manager = result_transfer_manager(api_cfg)
+verifier = dicom_verifier(nprocesses=api_cfg['server'].getint('dicom verification processes',fallback=4),
+                          check_pixels=api_cfg['server'].getboolean('verify dicom pixel data',fallback=False))
+
 # register database 
 db = SQLAlchemy(app)
 
@@ -146,8 +154,9 @@ def start_new_job(data):
     rd_file.save(os.path.join(datadir,secure_filename(rd_file.filename)))
     rds = ap.unzip_file(datadir,rd_file.filename)
     
-    # check dicom
-    ok, missing_keys = dcm.verify_all_dcm_keys(datadir,rp,rs,cts,rds)
+    # check dicom (imported here, pydicom and itk are slow to import)
+    import impl.dicom_functions as dcm
+    ok, missing_keys = dcm.verify_all_dcm_keys(datadir,rp,rs,cts,rds,verifier=verifier)
     if not ok:
         #return Response(str(missing_keys), status=422, mimetype='application/json')
         return jsonify(missing_keys), 422
@@ -222,23 +231,23 @@ def stop_job(jobId):
         if cancellation_type=='soft':
             simulation = jobs_list[jobId]
             simulation.soft_stop_simulation(simulation.cfg)
-            # kill job control daemon
+            # stop the monitoring of the job (job control daemon or job monitor service)
             try:
-                daemons = cndr.get_job_daemons('job_control_daemon.py')
-                cndr.kill_process(daemons[simulation.workdir])
-            except:
-                print('Looks like daemon is not running, not possible to kill it')
+                if not simulation.stop_job_control_daemon(soft=True):
+                    print('Looks like daemon is not running, no need to stop it')
+            except Exception as e:
+                print('Could not stop the daemon of job {}: {}'.format(jobId,e))
             
         if cancellation_type=='hard':
             simulation = jobs_list[jobId]
             condorId = jobs_list[jobId].condor_id
             cndr.remove_condor_job(condorId)
-            # kill job control daemon
+            # stop the monitoring of the job (job control daemon or job monitor service)
             try:
-                daemons = cndr.get_job_daemons('job_control_daemon.py')
-                cndr.kill_process(daemons[simulation.workdir])
-            except:
-                print('Looks like daemon is not running, not possible to kill it')
+                if not simulation.stop_job_control_daemon(soft=False):
+                    print('Looks like daemon is not running, no need to stop it')
+            except Exception as e:
+                print('Could not stop the daemon of job {}: {}'.format(jobId,e))
         
         
         
@@ -262,11 +271,9 @@ def stop_job(jobId):
         username = 'admin'
         server = Server.query.filter_by(username=username).first()
         login_data = {'account-login': server.username_b64, 'account-pwd': server.password}
-        r = ap.transfer_files_to_server(outputdir,api_cfg,login_data)
-        if r.status_code == 200:
-            return Response('The results will be sent', status=200, mimetype='text/plain')
-        else:
-            return Response('Failed to transfer results', status=r.status_code, mimetype='text/plain')
+        # the upload runs in the background, the progress can be followed with /v1/jobs/<jobId>/status
+        jobs_list[jobId].transfer_state = transfer_manager.submit(jobId,outputdir,login_data)
+        return Response('The results will be sent', status=202, mimetype='text/plain')
 
 @app.route("/v1/jobs/<jobId>/status", methods=['GET'])
 @app.auth_required(auth)
@@ -278,7 +285,10 @@ def get_status(jobId):
     
     cfg_settings = jobs_list[jobId].settings
     status = ap.read_ideal_job_status(cfg_settings)
-    return jsonify({'status': status})
+    transfer = transfer_manager.state(jobId)
+    if transfer is None:
+        return jsonify({'status': status})
+    return jsonify({'status': status, 'transfer': transfer.as_dict()})
 
 
 if __name__ == '__main__':
@@ -286,6 +296,11 @@ if __name__ == '__main__':
     cert = api_cfg['server']['ssl cert']
     key = api_cfg['server']['ssl key']
     context = (cert, key)
+    # generate missing HLUT caches in the background, so that the first jobs do not have to;
+    # in a separate process, which (unlike a daemon thread) is not killed halfway when the API stops
+    with open(os.path.join(log_dir,"warm_hlut_cache.log"),"a") as warm_log:
+        subprocess.Popen([sys.executable,os.path.join(os.path.dirname(os.path.abspath(__file__)),"warm_hlut_cache.py"),"-s",sysconfig['sysconfig']],
+                         stdout=warm_log,stderr=subprocess.STDOUT,start_new_session=True)
     app.run(host=host_IP,port=5000,ssl_context=context)
     
 
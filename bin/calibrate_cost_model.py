@@ -0,0 +1,42 @@
+#!/usr/bin/env python3
+# -----------------------------------------------------------------------------
+#   Copyright (C): MedAustron GmbH, ACMIT Gmbh and Medical University Vienna
+#   This software is distributed under the terms
+#   of the GNU Lesser General  Public Licence (LGPL)
+#   See LICENSE for further details
+# -----------------------------------------------------------------------------
+
+"""
+Fit the cost model of the dose grid settings (RAM usage per subjob and post
+processing time) to the history of previous jobs, as recorded in the
+user_logs_*.cfg files in the job output directories. The fitted settings are
+printed in the syntax of the system configuration file, for the
+[condor memory] and [dose grid cost] sections.
+"""
+
+import sys
+import argparse
+from impl.system_configuration import get_sysconfig
+from impl.dose_grid_cost import read_job_history, fit_cost_model, format_linear_fit
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='fit the dose grid cost model to previous jobs')
+    parser.add_argument('paths',nargs='*',help="user logs files and/or directories to search for them (default: the first output directory of the system configuration)")
+    parser.add_argument('-s','--sysconfig',default='',help="alternative system configuration file")
+    parser.add_argument('-m','--min-samples',type=int,default=10,help="minimum number of beams for each fit")
+    parser.add_argument('-v','--verbose',default=False,action='store_true',help="be verbose")
+    args = parser.parse_args()
+    paths = args.paths
+    if not paths:
+        syscfg = get_sysconfig(filepath=args.sysconfig,verbose=args.verbose,username="",want_logfile="")
+        paths = [syscfg['first output dicom']]
+    observations = read_job_history(paths)
+    print("# {} beams with cost model data in {}".format(len(observations)," ".join(paths)))
+    fits = fit_cost_model(observations,min_samples=args.min_samples)
+    if not fits:
+        print("# not enough data for any fit")
+        sys.exit(1)
+    for key,fit in fits.items():
+        print("{} = {}".format(key,format_linear_fit(fit)))
+
+# vim: set et softtabstop=4 sw=4 smartindent:
@@ -11,9 +11,7 @@ import sys,os
 import logging
 from glob import glob
 from impl.system_configuration import get_sysconfig
-from impl.idc_details import IDC_details
 from impl.idc_enum_types import MCStatType
-from impl.job_executor import job_executor
 from impl.hlut_conf import hlut_conf
 from impl.version import version_info
 
@@ -226,6 +224,9 @@ if __name__ == '__main__':
     matdb = os.path.join(sysconfig['commissioning'], sysconfig['materials database'])
     logger.debug("material database is {}".format(matdb))
     ##############################################################################################################
+    # only import the itk/pydicom/matplotlib dependent modules when we actually need to read a plan
+    from impl.idc_details import IDC_details
+    from impl.job_executor import job_executor
     current_details = IDC_details()
     rp = str(args.dicom_planfile)
     current_details.SetPlanFilePath(str(args.dicom_planfile))
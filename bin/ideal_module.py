@@ -13,13 +13,12 @@ from glob import glob
 
 import impl.dual_logging as duall
 from impl.system_configuration import get_sysconfig, system_configuration
-from impl.idc_details import IDC_details
 from impl.idc_enum_types import MCStatType
-from impl.job_executor import job_executor
 from impl.hlut_conf import hlut_conf
 from impl.version import version_info
-import impl.dicom_functions as dcm
-from job_control_daemon import check_accuracy_for_beam, dose_monitoring_config, update_user_logs, periodically_check_statistical_accuracy
+# The modules that depend on itk, pydicom and matplotlib (IDC_details, job_executor,
+# dicom_functions and the job control daemon) are imported in the methods that need them,
+# so that importing this module (e.g. by the API server) and simple queries stay fast.
 
 #global logger
 
@@ -72,6 +71,7 @@ class ideal_simulation():
     
     def create_sim_object(self):
         #want_logfile = "default"
+        from impl.idc_details import IDC_details
         prefix="\n * "
         sysconfig = system_configuration.getInstance()
         self.sysconfig = sysconfig
@@ -210,6 +210,8 @@ class ideal_simulation():
         
         
     def start_simulation(self):
+        from impl.job_executor import job_executor
+        from job_control_daemon import dose_monitoring_config
         logger = self.sysconfig.logger
         jobexec = job_executor.create_condor_job_executor(self.current_details)
         ret, condor_id =jobexec.launch_subjobs()
@@ -225,6 +227,7 @@ class ideal_simulation():
                                           minimum_number_of_primaries=self.number_of_primaries_per_beam,time_out_minutes=self.time_limit_in_minutes)
     
     def check_accuracy(self,sim_time_minutes,input_stop=False):
+        from job_control_daemon import check_accuracy_for_beam, find_dose_files, stopping_criteria, update_user_logs
         cfg = self.cfg
         current_dict = dict()
         stop = False
@@ -232,7 +235,7 @@ class ideal_simulation():
             status = f"RUNNING GATE FOR BEAM={beamname}"
             current_dict[beamname]=dict()
             print(f"checking {dosemhd} for beam={beamname}")
-            dose_files = glob(os.path.join(cfg.workdir,"tmp","output.*.*",dosemhd))
+            dose_files = find_dose_files(cfg.workdir,dosemhd)
             if len(dose_files) == 0:
                 print(f"looks like simulation for {dosemhd} did not start yet (zero dose files)")
                 continue
@@ -243,39 +246,7 @@ class ideal_simulation():
             current_dict['simulation time in minutes'] = sim_time_minutes
             self.stats.append(current_dict)
             
-            tmsg = f"Tsim = {sim_time_minutes} minutes (timeout = {cfg.time_out_minutes} minutes)"
-            nmsg = f"Nsim = {dc.tot_n_primaries} primaries (minimum = {cfg.min_num_primaries})"
-            umsg = f"Average Uncertainty = {dc.mean_unc_pct} pct (goal = {dc.cfg.unc_goal_pct} pct)"
-            msg = ""
-            # Maybe the following logic tree can be compactified, but for now I prefer to spell it out very explicitly
-            if sim_time_minutes > cfg.time_out_minutes > 0:
-                stop = True
-                msg = "STOP: time is up: " + tmsg
-            elif cfg.min_num_primaries > 0:
-                if dc.tot_n_primaries < cfg.min_num_primaries:
-                    stop = False
-                    msg = "CONTINUE: not yet enough primaries: " + nmsg
-                elif dc.cfg.unc_goal_pct > 0:
-                    if dc.mean_unc_pct < dc.cfg.unc_goal_pct:
-                        stop = True
-                        msg = "STOP: uncertainty goal reached: " + umsg
-                    else:
-                        stop = False
-                        msg = "CONTINUE: uncertainty goal NOT YET reached: " + umsg
-                else:
-                    stop = True
-                    msg = "STOP: desired number of primaries reached: " + nmsg
-            elif dc.cfg.unc_goal_pct > 0:
-                if dc.mean_unc_pct < dc.cfg.unc_goal_pct:
-                    stop = True
-                    msg = "STOP: uncertainty goal reached: " + umsg
-                else:
-                    stop = False
-                    msg = "CONTINUE: uncertainty goal NOT YET reached: " + umsg
-            else:
-                stop = False
-                msg = "CONTINUE: time out not yet reached: " + tmsg
-            print(f"{dosemhd} {tmsg} {nmsg} {umsg}")
+            stop,msg = stopping_criteria(cfg,dc,sim_time_minutes,dosemhd)
             print(msg)
             update_user_logs(cfg.user_cfg,status,section=beamname,changes={"job control daemon status":msg})
             if stop:
@@ -297,19 +268,42 @@ class ideal_simulation():
     
     def start_job_control_daemon(self):
         syscfg = system_configuration.getInstance()
-        ret=os.system( "{bindir}/job_control_daemon.py -l {username} -t {timeout} -n {minprim} -u {uncgoal} -p {poll} -d -w '{workdir}'".format(
+        timeout=self.current_details.mc_stat_thr[MCStatType.Nminutes_per_job]
+        minprim=self.current_details.mc_stat_thr[MCStatType.Nions_per_beam]
+        uncgoal=self.current_details.mc_stat_thr[MCStatType.Xpct_unc_in_target]
+        if syscfg['job monitor service']:
+            # one service monitors all jobs, see bin/job_monitor_daemon.py
+            from utils.daemon_control import request
+            try:
+                request(syscfg['job monitor socket'],"start",workdir=os.path.realpath(self.workdir),username=syscfg['username'],
+                        uncertainty_goal_percent=uncgoal,minimum_number_of_primaries=minprim,time_out_minutes=timeout)
+                return
+            except (OSError,RuntimeError) as e:
+                self.sysconfig.logger.warning("could not register job {} with the job monitor service ({}), starting a job control daemon for it".format(self.workdir,e))
+        # the polling interval is taken from the job configuration (snapshot interval)
+        ret=os.system( "{bindir}/job_control_daemon.py -l {username} -t {timeout} -n {minprim} -u {uncgoal} -d -w '{workdir}'".format(
         bindir=syscfg['bindir'],
         username=syscfg['username'],
         # DONE: change this into Nprim, Unc, TimeOut settings
         #goal=self.details.mc_stat_thr,
-        timeout=self.current_details.mc_stat_thr[MCStatType.Nminutes_per_job],
-        minprim=self.current_details.mc_stat_thr[MCStatType.Nions_per_beam],
-        uncgoal=self.current_details.mc_stat_thr[MCStatType.Xpct_unc_in_target],
-        poll=syscfg['stop on script actor time interval [s]'],  # 300s
+        timeout=timeout,
+        minprim=minprim,
+        uncgoal=uncgoal,
         workdir=self.workdir))
-        
-    
+
+    def stop_job_control_daemon(self,soft=True):
+        """
+        Stops the monitoring of this job, by its job control daemon or by the
+        job monitor service, with a "soft-stop" (the STOP files are written,
+        the simulations end gracefully) or a "hard-stop" (e.g. after the
+        HTCondor job was removed), see `utils.daemon_control`.
+        Returns False if no daemon was monitoring the job.
+        """
+        from utils.daemon_control import stop_daemon
+        return stop_daemon(self.workdir,"soft-stop" if soft else "hard-stop")
+
     def periodically_check_accuracy(self,frequency):
+        from job_control_daemon import periodically_check_statistical_accuracy
         cfg = self.cfg
         cfg.polling_interval_seconds = frequency
         periodically_check_statistical_accuracy(cfg)
@@ -327,6 +321,7 @@ def initialize_sysconfig(filepath = '', username = '', debug=False):
             
 # Functions to enable queries
 def verify_dicom_input_files(dicom_planfile):
+    import impl.dicom_functions as dcm
     return dcm.dicom_files(dicom_planfile).check_all_dcm()
 
 def get_version():
@@ -12,6 +12,7 @@ import os
 import sys
 import logging
 import configparser
+import threading
 from glob import glob
 from datetime import datetime
 
@@ -19,13 +20,17 @@ from datetime import datetime
 import daemon
 import itk
 import numpy as np
-from filelock import Timeout, SoftFileLock
 
 # IDEAL stuff
 from impl.system_configuration import get_sysconfig, system_configuration
 from impl.version import version_info
 from utils.resample_dose import mass_weighted_resampling
+from utils.dose_accumulator import dose_accumulator
+from utils.top_dose_estimator import top_dose_estimator
+from utils.dose_snapshot import manifest_path, dose_file_from_manifest, read_snapshot, sparse_dose
+from utils.daemon_control import job_control_endpoint
 import impl.dual_logging as dl
+from impl.dual_logging import span
 
 def update_user_logs(user_cfg,status,section="DEFAULT",changes=dict()):
     if bool(user_cfg):
@@ -82,6 +87,7 @@ class dose_monitoring_config:
             self.sim_dose_nxyz = np.array([float(w) for w in cparser.defaults().get("sim dose resolution").split()])
             self.dose_mhd_list=list()
             self.beamname_list=list()
+            self.snapshot_intervals=list()
             for beamname in cparser.sections():
                 if beamname.lower() =='default' or beamname.lower() =='user logs file':
                     print("skipping section '{}'".format(beamname))
@@ -92,6 +98,9 @@ class dose_monitoring_config:
                 dosemhd=cparser.get(beamname,"dosemhd")
                 dose2water=cparser.getboolean(beamname,"dose2water")
                 self.dose_mhd_list.append(dosemhd.replace(".mhd","-DoseToWater.mhd" if dose2water else "-Dose.mhd"))
+                # jobs from older IDEAL versions do not have the snapshot interval
+                if cparser.has_option(beamname,"snapshotinterval"):
+                    self.snapshot_intervals.append(cparser.getint(beamname,"snapshotinterval"))
                 print("added dose file '{}'".format(self.dose_mhd_list[-1]))
 
 
@@ -99,7 +108,7 @@ class dose_collector:
     """
     The dose collector adds up the dose from all subjobs and if necessary computes the statistical ("Type A") uncertainty.
     """
-    def __init__(self,cfg):
+    def __init__(self,cfg,estimator=None):
         self.out_dose_nxyz = cfg.out_dose_nxyz.astype(int) #np.int
         self.sim_dose_nxyz = cfg.sim_dose_nxyz.astype(int) #np.int
 
@@ -129,12 +138,15 @@ class dose_collector:
         syscfg = system_configuration.getInstance()
         self.ntop = syscfg["n top voxels for mean dose max"]
         self.toppct = syscfg["dose threshold as fraction in percent of mean dose max"]
+        self.precision = syscfg["dose accumulation precision"]
+        # the estimator keeps track of the voxels near the top dose threshold, reuse it in the next poll
+        self.estimator = top_dose_estimator(self.ntop,self.toppct) if estimator is None else estimator
         self.reset()
     def reset(self):
         # the sums
-        self.dosesum = np.zeros(self.out_dose_nxyz[::-1],dtype=float)
+        self.dosesum = dose_accumulator(self.out_dose_nxyz[::-1],self.precision)
         # the sums of the squares
-        self.dose2sum = np.zeros(self.out_dose_nxyz[::-1],dtype=float)
+        self.dose2sum = dose_accumulator(self.out_dose_nxyz[::-1],self.precision)
         self.weightsum = 0
         self.wmin = np.inf
         self.wmax = -np.inf
@@ -155,45 +167,61 @@ class dose_collector:
     @property
     def tot_n_primaries(self):
         return int(self.weightsum)
+    @span("dose_collector.add")
     def add(self,dose_file):
-        lockfile = dose_file+".lock"
+        """
+        Add the dose of one subjob. For a running subjob `dose_file` is the
+        dose in the `tmp/` copy of the output directory, which is published
+        atomically by the GATE flag script (see `utils.dose_snapshot`): the
+        dose and the number of primaries are read from the latest snapshot,
+        without any lock. For a finished subjob it is the final dose file.
+        Snapshots in the sparse format are accumulated directly, without a
+        full size copy, unless the dose needs to be resampled.
+        """
         dose = None
         n_primaries=0
-        t0=datetime.now()
-        logger.debug("lockfile exists" if os.path.exists(lockfile) else "lockfile does not exist")
-        lock = SoftFileLock(lockfile)
-        try:
-            # TODO: the length of the timeout should maybe be configured in the system configuration
-            with lock.acquire(timeout=3):
-                t1=datetime.now()
-                logger.info("acquiring lock file took {} seconds".format((t1-t0).total_seconds()))
-                ##########################
-                n_primaries = self.get_nprimaries(dose_file)
-                if n_primaries<1:
-                    logger.warn(f"dose file seems to be based on too few primaries ({n_primaries})")
-                elif bool(self.mass) and bool(self.mask):
-                    tick = time.time()
-                    simdose=itk.imread(dose_file)
-                    logger.debug("Time to read dose file: "+str(time.time()-tick)+"s")
-                    logger.debug("resampling dose with size {} using mass file of size {} to target size {}".format(itk.size(simdose),itk.size(self.mass),itk.size(self.mask)))
-                    tick = time.time()
-                    dose = mass_weighted_resampling(simdose,self.mass,self.mask)
-                    logger.debug("Time for resampling: "+str(time.time()-tick)+"s")
-                    del simdose
+        t1=datetime.now()
+        snapshot = os.path.exists(manifest_path(dose_file))
+        if snapshot:
+            tick = time.time()
+            simdose,n_primaries = read_snapshot(dose_file,itk.imread)
+            logger.debug("Time to read dose snapshot: "+str(time.time()-tick)+"s")
+        else:
+            n_primaries = self.get_nprimaries(dose_file)
+        if n_primaries<1:
+            logger.warn(f"dose file seems to be based on too few primaries ({n_primaries})")
+        else:
+            if not snapshot:
+                tick = time.time()
+                simdose=itk.imread(dose_file)
+                logger.debug("Time to read dose file: "+str(time.time()-tick)+"s")
+            if isinstance(simdose,sparse_dose):
+                if bool(self.mass) and bool(self.mask):
+                    sparse = simdose
+                    simdose = itk.image_from_array(sparse.dense())
+                    simdose.SetSpacing(sparse.spacing.tolist())
+                    simdose.SetOrigin(sparse.origin.tolist())
+                    del sparse
                 else:
-                    tick = time.time()
-                    dose=itk.imread(dose_file)
-                    logger.debug("Time to read dose file: "+str(time.time()-tick)+"s")
-                    logger.debug("read dose with size {}".format(itk.size(dose)))
-                t2=datetime.now()
-                logger.info("acquiring dose data {} file took {} seconds".format(os.path.basename(dose_file),(t2-t1).total_seconds()))
-                if self.wmin>n_primaries:
-                    self.wmin = n_primaries
-                if self.wmax<n_primaries:
-                    self.wmax = n_primaries
-        except Timeout:
-            logger.warn("failed to acquire lock for {} for 3 seconds, giving up for now".format(dose_file))
-            return
+                    self.add_sparse(simdose,n_primaries,dose_file)
+                    t2=datetime.now()
+                    logger.info("acquiring sparse dose data {} ({} nonzero voxels) took {} seconds".format(os.path.basename(dose_file),simdose.nnz,(t2-t1).total_seconds()))
+                    return
+            if bool(self.mass) and bool(self.mask):
+                logger.debug("resampling dose with size {} using mass file of size {} to target size {}".format(itk.size(simdose),itk.size(self.mass),itk.size(self.mask)))
+                tick = time.time()
+                dose = mass_weighted_resampling(simdose,self.mass,self.mask,copy=False)
+                logger.debug("Time for resampling: "+str(time.time()-tick)+"s")
+                del simdose
+            else:
+                dose = simdose
+                logger.debug("read dose with size {}".format(itk.size(dose)))
+        t2=datetime.now()
+        logger.info("acquiring dose data {} file took {} seconds".format(os.path.basename(dose_file),(t2-t1).total_seconds()))
+        if self.wmin>n_primaries:
+            self.wmin = n_primaries
+        if self.wmax<n_primaries:
+            self.wmax = n_primaries
         if not bool(dose):
             logger.warn("skipping {}".format(dose_file))
             return
@@ -203,54 +231,68 @@ class dose_collector:
         if adose.shape != self.dosesum.shape:
             raise RuntimeError("PROGRAMMING ERROR: dose shape {} differs from expected shape {}".format(adose.shape,self.dosesum.shape))
         tick = time.time()
-        self.dosesum += adose # n_primaries * (adose / n_primaries)
-        self.dose2sum += adose**2 / n_primaries # n_primaries * (adose / n_primaries)**2
+        adose2 = adose**2
+        adose2 /= n_primaries
+        self.dosesum.add(adose) # n_primaries * (adose / n_primaries)
+        self.dose2sum.add(adose2) # n_primaries * (adose / n_primaries)**2
+        self.weightsum += n_primaries
+        self.n += 1
+        logger.debug("Time increment variables: "+str(time.time()-tick)+"s")
+    def add_sparse(self,sdose,n_primaries,dose_file):
+        """
+        Add a dose snapshot in the sparse format (see `utils.dose_snapshot`),
+        only the nonzero voxels of the sums are updated.
+        """
+        if self.wmin>n_primaries:
+            self.wmin = n_primaries
+        if self.wmax<n_primaries:
+            self.wmax = n_primaries
+        if sdose.shape != self.dosesum.shape:
+            raise RuntimeError("PROGRAMMING ERROR: dose shape {} of {} differs from expected shape {}".format(sdose.shape,dose_file,self.dosesum.shape))
+        tick = time.time()
+        values2 = sdose.values**2
+        values2 /= n_primaries
+        self.dosesum.add_sparse(sdose.indices,sdose.values)
+        self.dose2sum.add_sparse(sdose.indices,values2)
         self.weightsum += n_primaries
         self.n += 1
         logger.debug("Time increment variables: "+str(time.time()-tick)+"s")
     def estimate_uncertainty(self):
         if self.n < 2:
             return
+        dosesum = self.dosesum.result()
+        dose2sum = self.dose2sum.result()
         if self.mask:
             amask = itk.array_view_from_image(self.mask)
-            logger.info("applying mask with {} voxels enabled out of {}".format(np.sum(amask>0),np.prod(amask.shape)))
-            self.dosesum *= amask
-            self.dose2sum *= amask
-        logger.info("dose sum is nonzero in {} voxels".format(np.sum(self.dosesum>0)))
-        logger.info("dose**2 sum is nonzero in {} voxels".format(np.sum(self.dose2sum>0)))
+            logger.info("applying mask with {} voxels enabled out of {}".format(np.count_nonzero(amask),np.prod(amask.shape)))
+            dosesum *= amask
+            dose2sum *= amask
+        logger.info("dose sum is nonzero in {} voxels".format(np.count_nonzero(dosesum)))
+        logger.info("dose**2 sum is nonzero in {} voxels".format(np.count_nonzero(dose2sum)))
         logger.info("sum of weights is {}, wmin={}, wmax={}".format(self.weightsum,self.wmin,self.wmax))
-        amean = self.dosesum/self.weightsum
-        amean2 = self.dose2sum/self.weightsum
-        avariance = amean2 - amean**2
-        m0 = avariance<0
-        logger.info("negative variance in {} voxels".format(np.sum(m0)))
-        avariance[m0] = 0.
-        m0 = amean<0
-        logger.info("negative mean in {} voxels".format(np.sum(m0)))
-        amean[m0] = 0.
-        m0 = amean>0
-        m00 = amean2>0
-        logger.info("positive mean in {} voxels".format(np.sum(m0)))
-        logger.info("positive mean of squares in {} voxels".format(np.sum(m00)))
-        logger.info("positive mean and mean of squares masks are different in {} voxels".format(np.sum(m0!=m00)))
-        logger.info("average/median of nonzero variance in is {}/{}".format(np.mean(avariance[m0]),np.median(avariance[m0])))
-        logger.info("average/median of nonzero mean in is {}/{}".format(np.mean(amean[m0]),np.median(amean[m0])))
-        logger.info("average/median of nonzero mean of squares in is {}/{}".format(np.mean(amean2[m0]),np.median(amean2[m0])))
-        logger.info("average/median of nonzero square of the mean in is {}/{}".format(np.mean(amean[m0]**2),np.median(amean[m0]**2)))
-        std_pct = np.full_like(avariance,100.)
-        std_pct[m0] = np.sqrt(avariance[m0]/self.n)*100./amean[m0]
-        dmax = np.mean(np.partition(amean.flat,-self.ntop)[-self.ntop:])
-        dthr = dmax * self.toppct / 100.0
-        mask = (amean>dthr)
-        logger.info("{} voxels have more than {} percent of the 'max dose'".format(np.sum(mask),self.toppct))
-        self.mean_unc_pct = np.mean(std_pct[mask])
+        # only the voxels above the threshold are needed, no full volume mean/variance arrays
+        self.mean_unc_pct = self.estimator.estimate(dosesum,dose2sum,self.weightsum,self.n)
+        logger.info("'max dose' is {}, {} voxels have more than {} percent of it".format(self.estimator.dmax,self.estimator.nthr,self.toppct))
         # if no goal is specified, this will never converge
         converged = self.mean_unc_pct < self.cfg.unc_goal_pct
         logger.info("'mean uncertainty' = {0:.2f} pct, goal = {1} pct, => {2}".format(self.mean_unc_pct,self.cfg.unc_goal_pct,"CONVERGED" if converged else "CONTINUE"))
 
-def check_accuracy_for_beam(cfg,beamname,dosemhd,dose_files):
+def find_dose_files(workdir,dosemhd):
+    """
+    Dose files of the running subjobs of a beam, in the `tmp/` copies of the
+    output directories. Normally they are announced by their snapshot
+    manifests (see `utils.dose_snapshot`). Jobs that were started before the
+    snapshots had manifests have plain copies of the dose file instead; these
+    are used for the output directories without a manifest.
+    """
+    pattern = os.path.join(workdir,"tmp","output.*.*",dosemhd)
+    dose_files = set([dose_file_from_manifest(m) for m in glob(manifest_path(pattern))])
+    dose_files.update(glob(pattern))
+    return sorted(dose_files)
+
+def check_accuracy_for_beam(cfg,beamname,dosemhd,dose_files,estimator=None):
     tick = time.time()
-    dc=dose_collector(cfg)
+    dc=dose_collector(cfg,estimator)
     logger.debug("Time to create dose collector: "+str(time.time()-tick)+ "s")
     ndosefiles=0
     nfinished=0
@@ -287,6 +329,137 @@ def check_accuracy_for_beam(cfg,beamname,dosemhd,dose_files):
             
     return dc
 
+def stopping_criteria(cfg,dc,sim_time_minutes,label=""):
+    """
+    Decides whether the simulation of a beam should stop, given the dose
+    collected so far (`dc`, a `dose_collector`) and the simulation time.
+    Returns a boolean (stop or not) and a message that explains why.
+    """
+    tmsg = f"Tsim = {sim_time_minutes} minutes (timeout = {cfg.time_out_minutes} minutes)"
+    nmsg = f"Nsim = {dc.tot_n_primaries} primaries (minimum = {cfg.min_num_primaries})"
+    umsg = f"Average Uncertainty = {dc.mean_unc_pct} pct (goal = {dc.cfg.unc_goal_pct} pct)"
+    stop = False
+    msg = ""
+    # Maybe the following logic tree can be compactified, but for now I prefer to spell it out very explicitly
+    if sim_time_minutes > cfg.time_out_minutes > 0:
+        stop = True
+        msg = "STOP: time is up: " + tmsg
+    elif cfg.min_num_primaries > 0:
+        if dc.tot_n_primaries < cfg.min_num_primaries:
+            stop = False
+            msg = "CONTINUE: not yet enough primaries: " + nmsg
+        elif dc.cfg.unc_goal_pct > 0:
+            if dc.mean_unc_pct < dc.cfg.unc_goal_pct:
+                stop = True
+                msg = "STOP: uncertainty goal reached: " + umsg
+            else:
+                stop = False
+                msg = "CONTINUE: uncertainty goal NOT YET reached: " + umsg
+        else:
+            stop = True
+            msg = "STOP: desired number of primaries reached: " + nmsg
+    elif dc.cfg.unc_goal_pct > 0:
+        if dc.mean_unc_pct < dc.cfg.unc_goal_pct:
+            stop = True
+            msg = "STOP: uncertainty goal reached: " + umsg
+        else:
+            stop = False
+            msg = "CONTINUE: uncertainty goal NOT YET reached: " + umsg
+    else:
+        stop = False
+        msg = "CONTINUE: time out not yet reached: " + tmsg
+    logger.info(f"{label} {tmsg} {nmsg} {umsg}")
+    logger.info(msg)
+    return stop,msg
+
+class job_monitor:
+    """
+    Monitoring state of one job: the beams that are still running, the clock
+    and the top dose estimators (reused from one poll to the next). Each call
+    of `poll` checks all running beams once; a beam for which the stopping
+    criteria are met gets its STOP file and is removed from the configuration.
+    The monitor does not change the working directory of the process, so
+    that several jobs can be monitored in one process (see
+    `bin/job_monitor_daemon.py`).
+    """
+    def __init__(self,cfg):
+        self.cfg = cfg
+        syscfg = system_configuration.getInstance()
+        if cfg.polling_interval_seconds<0:
+            # poll as often as the subjobs of the most frequently checked beam save their snapshots (see impl.snapshot_cadence)
+            cfg.polling_interval_seconds = min(cfg.snapshot_intervals) if cfg.snapshot_intervals else syscfg['stop on script actor time interval [s]']
+        self.precision = syscfg['dose accumulation precision']
+        self.t0 = None
+        self.estimators = dict()
+        self.messages = dict()
+        self.npolls = 0
+        self.stopped = ""
+    @property
+    def active(self):
+        return not self.stopped and len(self.cfg.dose_mhd_list)>0
+    def stop(self,soft=True):
+        """
+        Stops the monitoring of the job (see `utils.daemon_control`). With
+        `soft`, the STOP files are written for the beams that are still
+        running, so that their simulations end gracefully.
+        """
+        if soft:
+            for dosemhd in list(self.cfg.dose_mhd_list):
+                with open(os.path.join(self.cfg.workdir,"STOP_"+dosemhd),"w") as stopfd:
+                    stopfd.write("{msg}\n")
+        self.stopped = "soft-stop" if soft else "hard-stop"
+        logger.info("{} requested for job {}".format(self.stopped,self.cfg.workdir))
+    def status(self):
+        return dict(workdir=self.cfg.workdir,beams=list(self.cfg.beamname_list),messages=dict(self.messages),
+                    npolls=self.npolls,polling_interval_seconds=self.cfg.polling_interval_seconds,stopped=self.stopped)
+    def memory_estimate(self):
+        """
+        Rough estimate of the memory (in bytes) needed to check one beam: the
+        two dose sums (and residuals) and the mask on the output grid, the
+        mass, one subjob dose and its resampled copy.
+        """
+        nout = int(np.prod(self.cfg.out_dose_nxyz))
+        nsim = int(np.prod(self.cfg.sim_dose_nxyz))
+        # float64, or float32 with an int8 residual (see utils.dose_accumulator)
+        sums = 2*nout*(5 if self.precision == "float32" else 8)
+        if bool(self.cfg.mass_mhd):
+            return sums + nout*4 + nsim*4 + nsim*4 + nout*8
+        return sums + nsim*4
+    def poll(self):
+        # the configuration lists shrink while we go through them
+        for beamname,dosemhd in list(zip(self.cfg.beamname_list,self.cfg.dose_mhd_list)):
+            if self.stopped:
+                break
+            self.check_beam(beamname,dosemhd)
+        self.npolls += 1
+    def check_beam(self,beamname,dosemhd):
+        cfg = self.cfg
+        logger.info(f"checking {dosemhd} for beam={beamname}")
+        tmpdir = os.path.join(cfg.workdir,"tmp")
+        dose_files = find_dose_files(cfg.workdir,dosemhd)
+        if len(dose_files) == 0:
+            logger.info(f"looks like simulation for {dosemhd} did not start yet (zero dose files)")
+            return
+        if self.t0 is None:
+            # as starting time we take the creation time of the tmp directory
+            # TODO: maybe I should include the path of 'tmp' in syscfg instead of hardcoding it everywhere
+            self.t0 = datetime.fromtimestamp(os.stat(tmpdir).st_ctime)
+            logger.info(f"starting the clock at t0={self.t0}")
+        status = f"RUNNING GATE FOR BEAM={beamname}"
+        dc = check_accuracy_for_beam(cfg,beamname,dosemhd,dose_files,self.estimators.get(beamname))
+        self.estimators[beamname] = dc.estimator
+        sim_time_minutes = (datetime.now()-self.t0).total_seconds()/60.
+        stop,msg = stopping_criteria(cfg,dc,sim_time_minutes,dosemhd)
+        del dc
+        self.messages[beamname] = msg
+        update_user_logs(cfg.user_cfg,status,section=beamname,changes={"job control daemon status":msg})
+        if stop:
+            with open(os.path.join(cfg.workdir,"STOP_"+dosemhd),"w") as stopfd:
+                stopfd.write("{msg}\n")
+            cfg.dose_mhd_list.remove(dosemhd)
+            cfg.beamname_list.remove(beamname)
+            self.estimators.pop(beamname,None)
+
 def periodically_check_statistical_accuracy(cfg):
     # Get/Create the system config only now, AFTER (possibly) daemonizing.
     # Because the system config creation also initializes the logging system,
@@ -300,79 +473,31 @@ def periodically_check_statistical_accuracy(cfg):
     global logger
     logfilename = os.path.join(cfg.workdir,"job_control_daemon.log")
     logger = dl.create_logger('job_daemon',logfilename)
+    dl.set_span_file(os.path.join(cfg.workdir,dl.span_file_name),stage="DAEMON")
     #logger = logging.getLogger()
-    cfg.polling_interval_seconds = syscfg['stop on script actor time interval [s]'] if cfg.polling_interval_seconds<0 else cfg.polling_interval_seconds
-    t0 = None
-    save_curdir=os.path.realpath(os.curdir)
     try:
-        #config_logging(cfg)
-        os.chdir(cfg.workdir)
-        if len(cfg.dose_mhd_list)==0:
+        monitor = job_monitor(cfg)
+        if not monitor.active:
             logger.error("zero dose files configured?!")
-        while len(cfg.dose_mhd_list)>0:
-            logger.debug(f"going to sleep for {cfg.polling_interval_seconds} seconds")
-            time.sleep(cfg.polling_interval_seconds)
-            logger.debug("waking up from polling interval sleep")
-            for beamname,dosemhd in zip(cfg.beamname_list,cfg.dose_mhd_list):
-                logger.info(f"checking {dosemhd} for beam={beamname}")
-                dose_files = glob(os.path.join(cfg.workdir,"tmp","output.*.*",dosemhd))
-                if len(dose_files) == 0:
-                    logger.info(f"looks like simulation for {dosemhd} did not start yet (zero dose files)")
-                    continue
-                if t0 is None:
-                    # as starting time we take the creation time of the tmp directory
-                    # TODO: maybe I should include the path of 'tmp' in syscfg instead of hardcoding it everywhere
-                    t0 = datetime.fromtimestamp(os.stat('tmp').st_ctime)
-                    logger.info(f"starting the clock at t0={t0}")
-                    
-                status = f"RUNNING GATE FOR BEAM={beamname}"   
-                dc = check_accuracy_for_beam(cfg,beamname,dosemhd,dose_files)
-        
-                sim_time_minutes = (datetime.now()-t0).total_seconds()/60.
-                tmsg = f"Tsim = {sim_time_minutes} minutes (timeout = {cfg.time_out_minutes} minutes)"
-                nmsg = f"Nsim = {dc.tot_n_primaries} primaries (minimum = {cfg.min_num_primaries})"
-                umsg = f"Average Uncertainty = {dc.mean_unc_pct} pct (goal = {dc.cfg.unc_goal_pct} pct)"
-                stop = False
-                msg = ""
-                # Maybe the following logic tree can be compactified, but for now I prefer to spell it out very explicitly
-                if sim_time_minutes > cfg.time_out_minutes > 0:
-                    stop = True
-                    msg = "STOP: time is up: " + tmsg
-                elif cfg.min_num_primaries > 0:
-                    if dc.tot_n_primaries < cfg.min_num_primaries:
-                        stop = False
-                        msg = "CONTINUE: not yet enough primaries: " + nmsg
-                    elif dc.cfg.unc_goal_pct > 0:
-                        if dc.mean_unc_pct < dc.cfg.unc_goal_pct:
-                            stop = True
-                            msg = "STOP: uncertainty goal reached: " + umsg
-                        else:
-                            stop = False
-                            msg = "CONTINUE: uncertainty goal NOT YET reached: " + umsg
-                    else:
-                        stop = True
-                        msg = "STOP: desired number of primaries reached: " + nmsg
-                elif dc.cfg.unc_goal_pct > 0:
-                    if dc.mean_unc_pct < dc.cfg.unc_goal_pct:
-                        stop = True
-                        msg = "STOP: uncertainty goal reached: " + umsg
-                    else:
-                        stop = False
-                        msg = "CONTINUE: uncertainty goal NOT YET reached: " + umsg
-                else:
-                    stop = False
-                    msg = "CONTINUE: time out not yet reached: " + tmsg
-                logger.info(f"{dosemhd} {tmsg} {nmsg} {umsg}")
-                logger.info(msg)
-                update_user_logs(cfg.user_cfg,status,section=beamname,changes={"job control daemon status":msg})
-                if stop:
-                    with open(os.path.join(cfg.workdir,"STOP_"+dosemhd),"w") as stopfd:
-                        stopfd.write("{msg}\n")
-                    cfg.dose_mhd_list.remove(dosemhd)
-                    cfg.beamname_list.remove(beamname)
+        # the API server and the log daemon find this daemon through its pidfile and stop it through its control socket
+        wakeup = threading.Event()
+        def handle_request(request):
+            if request["command"] in ("soft-stop","hard-stop"):
+                monitor.stop(soft=request["command"]=="soft-stop")
+                wakeup.set()
+                return monitor.status()
+            if request["command"] == "status":
+                return monitor.status()
+            raise RuntimeError("unknown command '{}'".format(request["command"]))
+        with job_control_endpoint(cfg.workdir,handle_request):
+            while monitor.active:
+                logger.debug(f"going to sleep for {cfg.polling_interval_seconds} seconds")
+                wakeup.wait(cfg.polling_interval_seconds)
+                logger.debug("waking up from polling interval sleep")
+                if monitor.active:
+                    monitor.poll()
     except Exception as e:
         logger.error(f"job control daemon failed: {e}")
-    os.chdir(save_curdir)
 
 if __name__ == '__main__':
 
@@ -399,9 +524,9 @@ been reached, or earlier if at least the minimum of primaries was simulated and
 the statistical uncertainty shrank below the threshold.
 """,
 epilog="""
-Do NOT manually start a second daemon if one is still running for a job!
-The script is not protected against such incorrect usage and the results are
-undefined.
+The daemon writes a pidfile (job_control_daemon.pid) in the working directory
+and listens on a control socket, see utils/daemon_control.py. A second daemon
+for the same job refuses to start while the first one is still listening.
 """, formatter_class=argparse.RawDescriptionHelpFormatter)
     aparser.add_argument("-s","--sysconfig",default="",help="alternative system configuration file (default is <installdir>/cfg/system.cfg)")
     aparser.add_argument("-w","--workdir",default=os.curdir,help="path to workdir of simulation to interact with")
@@ -409,7 +534,7 @@ undefined.
     aparser.add_argument("-V","--version",default=False,action='store_true', help="Print version label and exit.")
     aparser.add_argument("-d","--daemonize",default=False,action='store_true',help="run as daemon in the background")
     aparser.add_argument("-l","--username",help="Your user name (default: your login name).")
-    aparser.add_argument("-p","--polling_interval_seconds",type=int, default=-1,help="Override polling interval (in seconds) from the system config file.")
+    aparser.add_argument("-p","--polling_interval_seconds",type=int, default=-1,help="Override polling interval (in seconds); by default the daemon polls with the snapshot interval of the job (see the snapshot cadence settings in the system config file).")
     aparser.add_argument("-u","--uncertainty_goal_percent",type=float,default=0.,help="Uncertainty level (in percent) at which the simulations should stop (default: 0 percent).")
     aparser.add_argument("-n","--minimum_number_of_primaries",type=int,default=0,help="If nonzero: minimum number of primaries for a simulation (default: 0).")
     aparser.add_argument("-t","--time_out_minutes",type=int,default=0, help="If nonzero: time-out, maximum of time that a job is allowed to run, apart from pre- and post-processing (default: 0 minutes).")
@@ -442,4 +567,34 @@ else:
     logger = logging.getLogger()
 
 
+###############################################################################################
+# UNIT TESTING
+###############################################################################################
+
+import unittest
+
+class test_find_dose_files(unittest.TestCase):
+    def test_manifests_and_plain_copies(self):
+        import tempfile
+        from utils.dose_snapshot import publish_snapshot
+        with tempfile.TemporaryDirectory() as workdir:
+            dosemhd = "idc-B1-DoseToWater.mhd"
+            expected = []
+            for i in range(3):
+                outputdir = os.path.join(workdir,"output.1.{}".format(i))
+                destdir = os.path.join(workdir,"tmp","output.1.{}".format(i))
+                os.makedirs(outputdir)
+                os.makedirs(destdir)
+                itk.imwrite(itk.image_from_array(np.full((2,3,4),i+1.,dtype=np.float32)),os.path.join(outputdir,dosemhd))
+                if i < 2:
+                    # published snapshots, the tmp directory has only generation stamped files and the manifest
+                    publish_snapshot(os.path.join(outputdir,dosemhd),destdir,nevents=100)
+                    publish_snapshot(os.path.join(outputdir,dosemhd),destdir,nevents=200)
+                else:
+                    # a job that was started before the snapshots had manifests: a plain copy
+                    itk.imwrite(itk.imread(os.path.join(outputdir,dosemhd)),os.path.join(destdir,dosemhd))
+                expected.append(os.path.join(destdir,dosemhd))
+            self.assertEqual(find_dose_files(workdir,dosemhd),expected)
+            self.assertEqual(find_dose_files(workdir,"idc-B2-DoseToWater.mhd"),[])
+
 # vim: set et softtabstop=4 sw=4 smartindent:
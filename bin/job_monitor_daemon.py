@@ -0,0 +1,443 @@
+#!/usr/bin/env python3
+# -----------------------------------------------------------------------------
+#   Copyright (C): MedAustron GmbH, ACMIT Gmbh and Medical University Vienna
+#   This software is distributed under the terms
+#   of the GNU Lesser General  Public Licence (LGPL)
+#   See LICENSE for further details
+# -----------------------------------------------------------------------------
+
+"""
+One service that monitors all active IDEAL jobs, instead of one job control
+daemon (`job_control_daemon.py`) per job.
+
+The service keeps a registry of the monitored jobs. Each job is checked with
+its own polling interval, by a small pool of worker threads (see
+`job_control_daemon.job_monitor`). A check reads and sums the dose of the
+subjobs of a beam, which for large dose grids takes a lot of memory, so the
+checks reserve their estimated memory from a shared budget (`memory_budget`)
+before they start: with many jobs the checks wait for each other, instead of
+all holding their dose arrays at the same time.
+
+Jobs are registered and removed through a Unix domain socket, with the
+protocol of `utils.daemon_control` (one JSON object per line as request and
+as reply):
+
+* {"command": "start", "workdir": ..., "username": ..., "uncertainty_goal_percent": ...,
+  "minimum_number_of_primaries": ..., "time_out_minutes": ...}
+* {"command": "stop", "workdir": ...}: stop monitoring the job (the simulation is not stopped)
+* {"command": "soft-stop" or "hard-stop", "workdir": ...}: as for a job control daemon
+* {"command": "status"}: the monitored jobs and the memory usage (with a
+  "workdir": the status of that job)
+* {"command": "shutdown"}
+
+For each monitored job the service writes a pidfile in the work directory of
+the job, so that the job is found (and stopped) in the same way as a job
+with its own job control daemon.
+"""
+
+# standard stuff
+import os
+import sys
+import json
+import time
+import threading
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+# IDEAL stuff
+from impl.system_configuration import get_sysconfig, system_configuration
+from impl.version import version_info
+import impl.dual_logging as dl
+from impl.dual_logging import span
+from utils.daemon_control import control_server, request, write_pidfile, remove_pidfile, check_not_monitored, JOB_MONITOR_SERVICE
+import job_control_daemon as jcd
+
+logger = logging.getLogger()
+
+class memory_budget:
+    """
+    Counts the (estimated) bytes in use by the running checks. `reserve`
+    waits until the requested number of bytes fits in the budget. A request
+    that is larger than the whole budget is granted when nothing else is
+    reserved, so that it runs alone instead of never.
+    """
+    def __init__(self,nbytes):
+        self.nbytes = int(nbytes)
+        self.reserved = 0
+        self.peak = 0
+        self._cond = threading.Condition()
+    def acquire(self,nbytes):
+        with self._cond:
+            self._cond.wait_for(lambda: self.reserved == 0 or self.reserved+nbytes <= self.nbytes)
+            self.reserved += nbytes
+            self.peak = max(self.peak,self.reserved)
+    def release(self,nbytes):
+        with self._cond:
+            self.reserved -= nbytes
+            self._cond.notify_all()
+    def reserve(self,nbytes):
+        return _reservation(self,nbytes)
+
+class _reservation:
+    def __init__(self,budget,nbytes):
+        self.budget = budget
+        self.nbytes = nbytes
+    def __enter__(self):
+        self.budget.acquire(self.nbytes)
+        return self
+    def __exit__(self,*exc):
+        self.budget.release(self.nbytes)
+        return False
+
+class monitored_job:
+    """
+    Registry entry of the job monitor service: the `job_monitor` of a job,
+    when it should be checked next and what happened so far.
+    """
+    def __init__(self,monitor):
+        self.monitor = monitor
+        self.workdir = monitor.cfg.workdir
+        self.registered = time.time()
+        self.next_poll = time.monotonic() + monitor.cfg.polling_interval_seconds
+        self.busy = False
+        self.state = "waiting"
+        self.error = ""
+    def as_dict(self):
+        status = self.monitor.status()
+        status.update(state=self.state,error=self.error,memory_estimate_mb=self.monitor.memory_estimate()/1024.**2)
+        return status
+
+class job_monitor_service:
+    """
+    Monitors many jobs in one process, see the module documentation.
+    `nworkers` jobs are checked at the same time, if their estimated memory
+    (see `job_monitor.memory_estimate`) fits in `memory_budget_mb`.
+    """
+    def __init__(self,socket_path,nworkers=2,memory_budget_mb=4096.,tick_seconds=1.):
+        self.socket_path = socket_path
+        self.nworkers = nworkers
+        self.budget = memory_budget(memory_budget_mb*1024**2)
+        self.tick_seconds = tick_seconds
+        self.jobs = dict()
+        self.finished = dict()
+        self._lock = threading.Lock()
+        self._shutdown = threading.Event()
+        self._executor = ThreadPoolExecutor(max_workers=nworkers,thread_name_prefix="job_monitor")
+        self._server = None
+    def start_job(self,workdir,username="",uncertainty_goal_percent=0.,minimum_number_of_primaries=0,time_out_minutes=0,polling_interval_seconds=-1):
+        workdir = os.path.realpath(workdir)
+        with self._lock:
+            if workdir in self.jobs:
+                raise RuntimeError("job {} is already being monitored".format(workdir))
+        check_not_monitored(workdir)
+        cfg = jcd.dose_monitoring_config(workdir,username,uncertainty_goal_percent=uncertainty_goal_percent,
+                                         minimum_number_of_primaries=minimum_number_of_primaries,
+                                         time_out_minutes=time_out_minutes,polling_interval_seconds=polling_interval_seconds)
+        monitor = jcd.job_monitor(cfg)
+        if not monitor.active:
+            raise RuntimeError("something is wrong: zero dose files to look at in {}".format(workdir))
+        job = monitored_job(monitor)
+        with self._lock:
+            if workdir in self.jobs:
+                raise RuntimeError("job {} is already being monitored".format(workdir))
+            self.jobs[workdir] = job
+            self.finished.pop(workdir,None)
+        write_pidfile(workdir,self.socket_path,JOB_MONITOR_SERVICE)
+        logger.info("started monitoring job {} (polling every {} s, estimated {:.1f} MB per check)".format(
+                    workdir,cfg.polling_interval_seconds,monitor.memory_estimate()/1024.**2))
+        return job
+    def stop_job(self,workdir,soft=None):
+        """
+        Stops monitoring the job in `workdir`. With `soft` True or False, the
+        job is stopped like with a "soft-stop" or "hard-stop" request (see
+        `job_control_daemon.job_monitor.stop`).
+        """
+        workdir = os.path.realpath(workdir)
+        with self._lock:
+            job = self.jobs.pop(workdir,None)
+        if job is None:
+            raise RuntimeError("job {} is not being monitored".format(workdir))
+        if soft is not None:
+            job.monitor.stop(soft)
+        # a check that is running now finishes, but its job is not polled again
+        job.state = "stopped"
+        self._retire(job)
+        logger.info("stopped monitoring job {}".format(workdir))
+        return job
+    def status(self):
+        with self._lock:
+            jobs = [job.as_dict() for job in self.jobs.values()]
+            finished = [job.as_dict() for job in self.finished.values()]
+        return dict(jobs=jobs,finished=finished,pid=os.getpid(),rss_mb=dl._rss_mb(),
+                    memory_budget_mb=self.budget.nbytes/1024.**2,
+                    memory_reserved_mb=self.budget.reserved/1024.**2,
+                    memory_reserved_peak_mb=self.budget.peak/1024.**2)
+    def handle(self,request):
+        command = request.get("command","")
+        if command == "start":
+            kwargs = {k:v for k,v in request.items() if k != "command"}
+            return self.start_job(**kwargs).as_dict()
+        if command == "stop":
+            return self.stop_job(request["workdir"]).as_dict()
+        if command in ("soft-stop","hard-stop"):
+            return self.stop_job(request["workdir"],soft=command=="soft-stop").as_dict()
+        if command == "status":
+            if "workdir" in request:
+                workdir = os.path.realpath(request["workdir"])
+                with self._lock:
+                    job = self.jobs.get(workdir,self.finished.get(workdir))
+                if job is None:
+                    raise RuntimeError("job {} is not being monitored".format(workdir))
+                return job.as_dict()
+            return self.status()
+        if command == "shutdown":
+            self._shutdown.set()
+            return dict()
+        raise RuntimeError("unknown command '{}'".format(command))
+    def _retire(self,job):
+        remove_pidfile(job.workdir)
+        # keep the last state of the jobs that are no longer monitored, for the status requests
+        with self._lock:
+            self.finished[job.workdir] = job
+            while len(self.finished) > 100:
+                self.finished.pop(next(iter(self.finished)))
+    def _check(self,job):
+        monitor = job.monitor
+        try:
+            with self.budget.reserve(monitor.memory_estimate()):
+                job.state = "checking"
+                with span("job_monitor.poll",path=os.path.join(job.workdir,dl.span_file_name),stage="DAEMON"):
+                    monitor.poll()
+            state = "waiting" if monitor.active else "finished"
+        except Exception as e:
+            logger.error("checking job {} failed: {}".format(job.workdir,e))
+            state = "failed"
+            job.error = str(e)
+        with self._lock:
+            if self.jobs.get(job.workdir) is not job:
+                # stopped while it was being checked
+                return
+            job.state = state
+            job.next_poll = time.monotonic() + monitor.cfg.polling_interval_seconds
+            job.busy = False
+            if state != "waiting":
+                self.jobs.pop(job.workdir)
+        if state != "waiting":
+            self._retire(job)
+            logger.info("job {} is no longer monitored: {}".format(job.workdir,state))
+    def poll_due(self):
+        """
+        Submits the checks of the jobs that are due. Returns the futures.
+        """
+        now = time.monotonic()
+        futures = list()
+        with self._lock:
+            due = [job for job in self.jobs.values() if not job.busy and job.next_poll <= now]
+            for job in due:
+                job.busy = True
+        # earliest first: with a full pool the jobs that waited longest get their turn first
+        for job in sorted(due,key=lambda job: job.next_poll):
+            futures.append(self._executor.submit(self._check,job))
+        return futures
+    def listen(self):
+        """
+        Starts serving the control socket in a background thread.
+        """
+        self._server = control_server(self.socket_path,self.handle).start()
+        logger.info("job monitor service (pid {}) listening on {}".format(os.getpid(),self.socket_path))
+    def serve_forever(self):
+        self.listen()
+        try:
+            while not self._shutdown.wait(self.tick_seconds):
+                self.poll_due()
+        finally:
+            self.close()
+    def shutdown(self):
+        self._shutdown.set()
+    def close(self):
+        if self._server is not None:
+            self._server.close()
+            self._server = None
+        self._executor.shutdown(wait=True)
+        with self._lock:
+            for workdir in self.jobs:
+                remove_pidfile(workdir)
+        logger.info("job monitor service stopped")
+
+###############################################################################################
+# UNIT TESTING
+###############################################################################################
+
+import unittest
+import tempfile
+import contextlib
+import io
+import copy
+import math
+from utils.daemon_control import find_daemon, read_pidfile, send, stop_daemon
+
+class test_memory_budget(unittest.TestCase):
+    def test_reserve(self):
+        budget = memory_budget(100)
+        order = list()
+        def worker(name,nbytes,hold):
+            with budget.reserve(nbytes):
+                order.append(name)
+                time.sleep(hold)
+        with budget.reserve(80):
+            t = threading.Thread(target=worker,args=("b",40,0.))
+            t.start()
+            time.sleep(0.2)
+            # does not fit yet
+            self.assertEqual(order,[])
+        t.join(5.)
+        self.assertEqual(order,["b"])
+        self.assertEqual(budget.reserved,0)
+        self.assertEqual(budget.peak,80)
+        # larger than the whole budget: runs alone, does not wait forever
+        with budget.reserve(500):
+            self.assertEqual(budget.reserved,500)
+        self.assertEqual(budget.reserved,0)
+
+class test_job_monitor_service(unittest.TestCase):
+    njobs = 30
+    def setUp(self):
+        from benchmarks import synthetic
+        from utils.dose_snapshot import publish_sparse_snapshot
+        try:
+            system_configuration.getInstance()
+        except RuntimeError:
+            system_configuration({"n top voxels for mean dose max":100,
+                                  "dose threshold as fraction in percent of mean dose max":50.,
+                                  "dose accumulation precision":"float64",
+                                  "stop on script actor time interval [s]":300})
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.workdirs = list()
+        for i in range(self.njobs):
+            workdir = os.path.join(self.tmpdir.name,"rungate.{}".format(i))
+            os.makedirs(workdir)
+            dose_files = synthetic.write_job_directory(workdir,(8,24,32),(2.,2.,3.),njobs=3,seed=i)
+            # the subjobs are still running: no exit value yet, and a published snapshot
+            for dose_file in dose_files:
+                outputdir = os.path.dirname(dose_file)
+                os.remove(os.path.join(outputdir,"gate_exit_value.txt"))
+                destdir = os.path.join(workdir,"tmp",os.path.basename(outputdir))
+                os.makedirs(destdir)
+                publish_sparse_snapshot(dose_file,destdir,stat_file=os.path.join(outputdir,"statActor-B1.txt"))
+            self.workdirs.append(workdir)
+        self.socket_path = os.path.join(self.tmpdir.name,"job_monitor.sock")
+    def tearDown(self):
+        self.tmpdir.cleanup()
+    def test_many_jobs(self):
+        # memory budget for only a few checks at the same time
+        service = job_monitor_service(self.socket_path,nworkers=4,memory_budget_mb=0.5,tick_seconds=0.05)
+        thread = threading.Thread(target=service.serve_forever)
+        thread.start()
+        try:
+            for i in range(100):
+                if os.path.exists(self.socket_path):
+                    break
+                time.sleep(0.05)
+            with contextlib.redirect_stdout(io.StringIO()):
+                for i,workdir in enumerate(self.workdirs):
+                    # job 0 reaches its goal (any number of primaries), the others continue
+                    request(self.socket_path,"start",workdir=workdir,username="tester",
+                            minimum_number_of_primaries=1 if i==0 else 0,
+                            uncertainty_goal_percent=0.,time_out_minutes=0,polling_interval_seconds=0)
+            with self.assertRaises(RuntimeError):
+                request(self.socket_path,"start",workdir=self.workdirs[1])
+            rss_mb = dl._rss_mb()
+            deadline = time.monotonic()+60.
+            while time.monotonic() < deadline:
+                status = request(self.socket_path,"status")
+                if all(job["npolls"]>=2 for job in status["jobs"]) and len(status["finished"])==1:
+                    break
+                time.sleep(0.1)
+            rss_mb = max(rss_mb,status["rss_mb"] or 0.)
+            self.assertEqual(len(status["jobs"]),self.njobs-1)
+            self.assertTrue(all(job["npolls"]>=2 for job in status["jobs"]))
+            self.assertTrue(all(job["messages"]["B1"].startswith("CONTINUE") for job in status["jobs"]))
+            self.assertEqual(status["finished"][0]["workdir"],os.path.realpath(self.workdirs[0]))
+            self.assertEqual(status["finished"][0]["state"],"finished")
+            self.assertTrue(os.path.exists(os.path.join(self.workdirs[0],"STOP_idc-B1-DoseToWater.mhd")))
+            self.assertFalse(os.path.exists(os.path.join(self.workdirs[1],"STOP_idc-B1-DoseToWater.mhd")))
+            # the budget allows less checks at the same time than there are workers
+            estimate = service.jobs[os.path.realpath(self.workdirs[1])].monitor.memory_estimate()
+            self.assertLessEqual(service.budget.peak,max(service.budget.nbytes,estimate))
+            # float32 sums take 5 bytes per voxel (with the int8 residual) instead of 8
+            monitor = copy.copy(service.jobs[os.path.realpath(self.workdirs[1])].monitor)
+            monitor.precision = "float32"
+            nout = math.prod(int(n) for n in monitor.cfg.out_dose_nxyz)
+            self.assertEqual(estimate-monitor.memory_estimate(),2*3*nout)
+            # the jobs are found through their pidfiles, like jobs with their own job control daemon
+            self.assertIsNone(find_daemon(self.workdirs[0]))
+            self.assertEqual(find_daemon(self.workdirs[1])["name"],JOB_MONITOR_SERVICE)
+            self.assertEqual(send(self.workdirs[1],"status")["workdir"],os.path.realpath(self.workdirs[1]))
+            reply = request(self.socket_path,"stop",workdir=self.workdirs[1])
+            self.assertEqual(reply["state"],"stopped")
+            self.assertIsNone(find_daemon(self.workdirs[1]))
+            self.assertFalse(os.path.exists(os.path.join(self.workdirs[1],"STOP_idc-B1-DoseToWater.mhd")))
+            self.assertTrue(stop_daemon(self.workdirs[2],"soft-stop"))
+            self.assertTrue(os.path.exists(os.path.join(self.workdirs[2],"STOP_idc-B1-DoseToWater.mhd")))
+            self.assertTrue(stop_daemon(self.workdirs[3],"hard-stop"))
+            self.assertFalse(os.path.exists(os.path.join(self.workdirs[3],"STOP_idc-B1-DoseToWater.mhd")))
+            self.assertEqual(len(request(self.socket_path,"status")["jobs"]),self.njobs-4)
+            self.assertIsNotNone(find_daemon(self.workdirs[4]))
+            print("\n{} jobs monitored by one process, resident memory {:.1f} MB".format(self.njobs,rss_mb))
+            request(self.socket_path,"shutdown")
+        finally:
+            service.shutdown()
+            thread.join(60.)
+        self.assertFalse(thread.is_alive())
+        self.assertFalse(os.path.exists(self.socket_path))
+        self.assertIsNone(read_pidfile(self.workdirs[4]))
+        with self.assertRaises(OSError):
+            request(self.socket_path,"status")
+
+###############################################################################################
+# MAIN
+###############################################################################################
+
+if __name__ == '__main__':
+    import argparse
+    aparser = argparse.ArgumentParser(description="""
+Service that monitors all active IDEAL jobs and determines when their
+simulations should stop, like one `job_control_daemon.py` per job, but in one
+process, with a bounded amount of memory. Jobs are registered with the service
+when they are submitted, if the job monitor service is enabled in the system
+configuration (section "job monitor").
+""", formatter_class=argparse.RawDescriptionHelpFormatter)
+    aparser.add_argument("-s","--sysconfig",default="",help="alternative system configuration file (default is <installdir>/cfg/system.cfg)")
+    aparser.add_argument("-v","--verbose",default=False,action='store_true',help="be verbose")
+    aparser.add_argument("-V","--version",default=False,action='store_true', help="Print version label and exit.")
+    aparser.add_argument("-d","--daemonize",default=False,action='store_true',help="run as daemon in the background")
+    aparser.add_argument("-l","--username",help="Your user name (default: your login name).")
+    aparser.add_argument("-q","--query",default=False,action='store_true',help="print the status of a running service and exit")
+    aparser.add_argument("-x","--shutdown",default=False,action='store_true',help="stop a running service and exit")
+    args = aparser.parse_args()
+    if args.version:
+        print(version_info)
+        sys.exit(0)
+    syscfg = get_sysconfig(filepath=args.sysconfig,verbose=args.verbose,debug=False,username=args.username,want_logfile="")
+    socket_path = syscfg['job monitor socket']
+    if args.query or args.shutdown:
+        try:
+            reply = request(socket_path,"shutdown" if args.shutdown else "status")
+        except (OSError,RuntimeError) as e:
+            print("no job monitor service at {}: {}".format(socket_path,e))
+            sys.exit(1)
+        print(json.dumps(reply,indent=2))
+        sys.exit(0)
+    logfile = os.path.join(syscfg['logdir'],"job_monitor_daemon.log")
+    service = job_monitor_service(socket_path,nworkers=syscfg['job monitor workers'],memory_budget_mb=syscfg['job monitor memory budget [mb]'])
+    if args.daemonize:
+        import daemon
+        print("running as daemon, log file should be {}".format(logfile))
+        with daemon.DaemonContext():
+            logger = dl.create_logger('job_monitor',logfile)
+            jcd.logger = logger
+            service.serve_forever()
+    else:
+        service.serve_forever()
+
+# vim: set et softtabstop=4 sw=4 smartindent:
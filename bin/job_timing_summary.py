@@ -0,0 +1,38 @@
+#!/usr/bin/env python3
+# -----------------------------------------------------------------------------
+#   Copyright (C): MedAustron GmbH, ACMIT Gmbh and Medical University Vienna
+#   This software is distributed under the terms
+#   of the GNU Lesser General  Public Licence (LGPL)
+#   See LICENSE for further details
+# -----------------------------------------------------------------------------
+
+"""
+Summarize where IDEAL jobs spent their time, based on the timing spans that
+the job submission (SUBMIT), the CT preprocessing (PRE), the post processing
+(POST, including the GATE subjob timing from the stat actor files) and the
+job control daemon (DAEMON) write to the spans.jsonl file in the job work
+directory. For each job the critical path (SUBMIT, PRE, GATE, POST) is broken
+down per stage and per step.
+"""
+
+import sys
+import json
+import argparse
+from impl.dual_logging import read_spans, summarize_spans, format_span_summary
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='per job critical path breakdown of the IDEAL timing spans')
+    parser.add_argument('paths',nargs='+',help="job work directories and/or span files")
+    parser.add_argument('-j','--json',default=False,action='store_true',help="print the summary as JSON")
+    args = parser.parse_args()
+    records = read_spans(args.paths)
+    if not records:
+        print("no timing spans found in {}".format(" ".join(args.paths)))
+        sys.exit(1)
+    summary = summarize_spans(records)
+    if args.json:
+        print(json.dumps(summary,indent=2))
+    else:
+        print(format_span_summary(summary))
+
+# vim: set et softtabstop=4 sw=4 smartindent:
@@ -6,6 +6,7 @@ import configparser
 import re
 #from impl.dual_logging import get_last_log_ID
 from utils.condor_utils import *
+from utils.daemon_control import stop_daemon
 import utils.api_utils as ap
 import requests
 from filelock import Timeout, SoftFileLock
@@ -82,7 +83,7 @@ class log_manager:
 
         # Get daemons. Read daemons before updating config!
         self.log.info("Get job daemons")
-        self.daemons = get_job_daemons("job_control_daemon.py")
+        self.daemons = get_job_daemons(self.syscfg['directories']['tmpdir jobs'])
             
         # Create new sections for the newly added IDs
         if last_ID_log > last_ID_cfg:
@@ -222,9 +223,10 @@ class log_manager:
         if self.is_daemon_to_kill(pars_sec):
             pid = pars_sec['Job control daemon'].split(" ")[-1]
             if not test:
-                ret = kill_process(pid)
-                if ret != 0:
-                    self.log.warning(f"Could not kill daemon with pid {pid}")
+                try:
+                    stop_daemon(pars_sec['Work_dir'],"hard-stop")
+                except Exception as e:
+                    self.log.warning(f"Could not stop daemon with pid {pid}: {e}")
             pars_sec['Job control daemon'] = 'Daemon killed'
             self.log.info("Daemon for job {} killed by program".format(pars_sec['Condor id']))
             
@@ -239,8 +241,11 @@ class log_manager:
             if d[0] not in workdirs:
                 pid = d[1]
                 if not test:
-                    ret = kill_process(pid)
-                    self.log.info("Daemon killed because not connected to any tracked job.\nWorkdir: {}".format(d[0]))
+                    try:
+                        stop_daemon(d[0],"hard-stop")
+                        self.log.info("Daemon killed because not connected to any tracked job.\nWorkdir: {}".format(d[0]))
+                    except Exception as e:
+                        self.log.warning("Could not stop daemon with pid {} for untracked job in {}: {}".format(pid,d[0],e))
                 else: a.append(pid)
                     
         if test: return a
@@ -284,15 +289,13 @@ class log_manager:
         fname =  workdir.split(data)[1]  # name that will be used for the .zip file
         self.log.debug("Working dir: {}".format(workdir))
         if pars_sec['Status'] == 'FINISHED':
-            os.chdir(data)
             name = os.path.join(completed_dir,fname)
-            zip_and_clean_folder(name,workdir)
-            self.log.info("Archiving BOTH in {}".format(name+'.zip'))
+            archive = zip_and_clean_folder(name,workdir)
+            self.log.info("Archiving BOTH in {}".format(archive))
         else:
-            os.chdir(data)
             name = os.path.join(failed_dir,fname)
-            zip_and_clean_folder(name,workdir)
-            self.log.info("Archiving in {}".format(name+'.zip')) 
+            archive = zip_and_clean_folder(name,workdir)
+            self.log.info("Archiving in {}".format(archive))
         pars_sec['Status'] = 'ARCHIVED'
 #        # get output dir
 #        fname =  workdir.split("work")[1]
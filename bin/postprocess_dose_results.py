@@ -7,7 +7,6 @@
 # -----------------------------------------------------------------------------
 
 import os, sys, re
-import pydicom
 import configparser
 import itk
 import numpy as np
@@ -31,7 +30,12 @@ else:
     fh.setFormatter(formatter)
     logger.addHandler(fh)
 
-from utils.resample_dose import mass_weighted_resampling
+from utils.resample_dose import mass_weighted_resampling, mass_weighted_resampling_chunked
+from utils.job_archiver import job_archiver, default_nthreads
+from utils.dose_accumulator import dose_accumulator
+from utils.dose_volume import dose_volume
+from utils.condor_utils import subjob_memory_usage_mb
+from impl.dual_logging import span, span_step, record_span, set_span_file, span_file_name
 
 def update_user_logs(user_cfg,status,section="DEFAULT",changes=dict()):
     if bool(user_cfg):
@@ -51,74 +55,17 @@ def update_user_logs(user_cfg,status,section="DEFAULT",changes=dict()):
 ######################################################################################
 # Write MHD image to DICOM (this should probably go to "utils")
 ######################################################################################
-def image_2_dicom_dose(img_dose,dose_dcm_template,my_dose_dcm,physical=True):
+def image_2_dicom_dose(dose,dose_dcm_template,my_dose_dcm,physical=True):
+    # 'dose' is a dose_volume
+    # imported here: pydicom is a slow import, not needed if no DICOM output is requested
+    from impl.dicom_dose_writer import write_dicom_dose
     try:
-        dose_dcm = pydicom.dcmread(dose_dcm_template)
-        aimg_dose = itk.GetArrayFromImage(img_dose)
-        img_size = img_dose.GetLargestPossibleRegion().GetSize()
-        img_spacing = img_dose.GetSpacing()
-        img_origin = img_dose.GetOrigin()
-        logger.debug("template dose shape is {}".format(dose_dcm.pixel_array.shape))
-        logger.debug("Gate output dose shape is {}".format(aimg_dose.shape))
-        maxdose = np.max(aimg_dose)
-        logger.debug("max dose in IDC image is {}, max dose in template DICOM is {}".format(maxdose,float(dose_dcm.DoseGridScaling)*np.max(dose_dcm.pixel_array)))
-        nbitA = int(dose_dcm.BitsAllocated)
-        nbitS = int(dose_dcm.BitsStored)
-        if not nbitA == nbitS:
-            raise RuntimeError("inconsistent template dicom dose file {}: nbitA={}, nbitS={}".format(dose_dcm_template,nbitA,nbitS))
-        if maxdose > 0.:
-            logger.debug("max dose in image is positive, good!")
-        else:
-            logger.error("max dose in image is NOT positive, BAD!")
-            raise RuntimeError("max dose in image is NOT positive, BAD!")
-        logger.debug("check that these are 16: nbitA={}, nbitS={}".format(nbitA,nbitS))
-        dose_grid_scaling = maxdose/(2**nbitS-1)
-        aimg_dose_int = np.round(aimg_dose / dose_grid_scaling).astype('uint16')
-        #logger.debug("computed dose grid scale factor is {}, input DICOM DGSF is {}".format(dose_grid_scaling,float(dose_dcm.DoseGridScaling)))
-        #logger.debug("{} nonzero voxels in input image, max is {}".format(np.sum(aimg_dose_int>0),np.max(aimg_dose_int)))
-        #logger.debug("{} nonzero voxels in DICOM template, max is {}".format(np.sum(dose_dcm.pixel_array>0),np.max(dose_dcm.pixel_array)))
-        dose_dcm.PixelData = aimg_dose_int.tobytes()
-        dose_dcm.DoseGridScaling = dose_grid_scaling
-        dose_dcm.DoseType = 'PHYSICAL' if physical else 'EFFECTIVE'
-        dose_dcm.Rows = img_size[1]
-        dose_dcm.Columns = img_size[0]
-        dose_dcm.NumberOfFrames = img_size[2]
-        dose_dcm.PixelSpacing[0] = img_spacing[1]
-        dose_dcm.PixelSpacing[1] = img_spacing[0]
-        dose_dcm.SliceThickness = img_spacing[2]
-        logger.debug("going to resize grid frame offset vector")
-        logger.debug("offset vector size is {} in the DICOM template".format(len(dose_dcm.GridFrameOffsetVector)))
-        #dose_dcm.GridFrameOffsetVector.clear()
-        #logger.debug("after the clearning, size is {}".format(len(dose_dcm.GridFrameOffsetVector)))
-        logger.debug("going to create a new vector with grid offsets with spacing {} and size {}".format(float(img_spacing[2]),int(img_size[2])))
-        new_gfov=pydicom.multival.MultiValue(pydicom.valuerep.DSfloat,np.arange(int(img_size[2]))*float(img_spacing[2]))
-        logger.debug("going to override the old offset vector with the new vector")
-        dose_dcm.GridFrameOffsetVector = new_gfov
-        logger.debug("after the override, size is {}".format(len(dose_dcm.GridFrameOffsetVector)))
-        dose_dcm.ImagePositionPatient = list(img_origin)
-        #dose_dcm.InstanceNumber = ""
-        #logger.debug("generating DCM names")
-        #logger.debug("writing DICOM file with same UID like template, with minimal changes: {}".format(dcmA))
-        #pydicom.write_file(my_dose_dcm.replace(".dcm","A.dcm"),dose_dcm,False)
-        #logger.debug("writing DICOM file with same UID like template, with some DICOM standard compliance changes: {}".format(dcmB))
-        #pydicom.write_file(my_dose_dcm.replace(".dcm","B.dcm"),dose_dcm,True)
-        logger.debug("assigning new UID for this dose file. Old UID={}".format(dose_dcm.SOPInstanceUID))
-        dose_dcm.SOPInstanceUID = pydicom.uid.generate_uid() # create a new unique UID
-        logger.debug("new UID is: {}".format(dose_dcm.SOPInstanceUID))
-        dose_dcm.SeriesInstanceUID = pydicom.uid.generate_uid()
-        logger.debug("new SeriesInstanceUID is: {}".format(dose_dcm.SeriesInstanceUID))
-        #logger.debug("writing DICOM file with new UID, with minimal changes: {}".format(dcmC))
-        #pydicom.write_file(my_dose_dcm.replace(".dcm","C.dcm"),dose_dcm,True)
-        #logger.debug("writing DICOM file with new UID, and with some DICOM standard compliance changes: {}".format(dcmD))
-        #pydicom.write_file(my_dose_dcm.replace(".dcm","D.dcm"),dose_dcm,False)
-        #logger.info("wrote A,B,C,D DICOM file: {}".format(my_dose_dcm))
-        logger.debug("going to write to file: {}".format(my_dose_dcm))
-        pydicom.write_file(my_dose_dcm,dose_dcm,False)
-        logger.info("wrote DICOM file: {}".format(my_dose_dcm))
+        write_dicom_dose(dose.array,dose.spacing,dose.origin,dose_dcm_template,my_dose_dcm,physical=physical)
     except Exception as e:
         logger.info("something went wrong: {}".format(e))
 
 def run_gamma_analysis(ref_dose_path,gamma_parameters,dose_sum_final,mhd_dose_final):
+    import pydicom
     ushort_imgref=itk.imread(ref_dose_path)
     aimgref=itk.array_from_image(ushort_imgref)*float(pydicom.dcmread(ref_dose_path).DoseGridScaling)
     imgref=itk.image_from_array(np.float32(aimgref))
@@ -139,24 +86,15 @@ def run_gamma_analysis(ref_dose_path,gamma_parameters,dose_sum_final,mhd_dose_fi
     itk.imwrite(g,mhd_dose_final.replace(".mhd","_gamma.mhd"))
     itk.imwrite(imgref,mhd_dose_final.replace(".mhd","_tpsdose.mhd"))
 
-def update_plan_dose(pdd,label,beam_dose_image):
-    # 'pdd' is plan dose dictionary
+def update_plan_dose(pdd,label,beam_dose):
+    # 'pdd' is plan dose dictionary, with dose_volume values
     # label will be "unresampled", "Physical" or "RBE"
     if label in pdd:
-        # add dose image to dose image in the dict
-        a_plandose = itk.array_from_image(pdd[label])
-        a_beamdose = itk.array_view_from_image(beam_dose_image)
-        assert(a_plandose.shape==a_beamdose.shape)
-        a_plandose += a_beamdose
-        img_plandose = itk.image_from_array(a_plandose)
-        img_plandose.CopyInformation(pdd[label])
-        pdd[label] = img_plandose
+        # add beam dose to the plan dose in the dict, in place
+        pdd[label] += beam_dose
     else:
-        # copy dose image into dict
-        a_plandose = itk.array_from_image(beam_dose_image)
-        img_plandose = itk.image_from_array(a_plandose)
-        img_plandose.CopyInformation(beam_dose_image)
-        pdd[label] = img_plandose
+        # copy beam dose into dict (the beam dose array may still be modified)
+        pdd[label] = beam_dose.copy()
 
 def get_job_stats(mhd):
     """
@@ -187,51 +125,43 @@ def get_job_stats(mhd):
             return stats_dict,gate_exit_value
     raise RuntimeError("N primaries not found for {}".format(mhd))
 
-def compress_jobdata(cfg,outputdirs,statfiles):
-        try:
-            logger.debug("start logging of tarball compression of {} output directories".format(len(outputdirs)))
-            dir_tot=0
-            tgz_tot=0
-            basenames=set([os.path.basename(txt) for txt in statfiles])
-            if len(basenames)!=1:
-                logger.error("the statistics actor files all should have the same basename, but I got {} different ones: {}".format(len(basenames),basenames))
+def compress_jobdata(cfg,outputdirs,statfiles,archiver):
+    """
+    Archive the statistics actor files and (in debug mode) the output directories of the subjobs,
+    then remove the output directories. The actual work is scheduled on the `archiver` (a
+    `job_archiver` object), the caller should wait for it to finish. The output directories are
+    archived with explicit archive member names, we never change the working directory here.
+    """
+    try:
+        logger.debug("start logging of tarball compression of {} output directories".format(len(outputdirs)))
+        basenames=set([os.path.basename(txt) for txt in statfiles])
+        if len(basenames)!=1:
+            logger.error("the statistics actor files all should have the same basename, but I got {} different ones: {}".format(len(basenames),basenames))
+        else:
+            # should we be paranoid and check that they have a .txt suffix?
+            tgz_stats_name=basenames.pop().replace("txt","tar.gz")
+            with tarfile.open(tgz_stats_name,"w:gz") as tgz_stats:
+                for s in statfiles:
+                    tgz_stats.add(s)
+        for d in outputdirs:
+            if not os.path.isdir(d):
+                logger.debug("compression request for {} which is not a directory!".format(d))
+                continue
+            if cfg.debug:
+                logger.debug("going to compress {}".format(d))
+                archiver.submit(d)
             else:
-                # should we be paranoid and check that they have a .txt suffix?
-                tgz_stats_name=basenames.pop().replace("txt","tar.gz")
-                with tarfile.open(tgz_stats_name,"w:gz") as tgz_stats:
-                    for s in statfiles:
-                        tgz_stats.add(s)
-            for d in outputdirs:
-                cwd=os.path.realpath(os.curdir)
-                dbase=os.path.basename(os.path.realpath(d))
-                logger.debug("cwd={} d={}".format(cwd,d))
-                if not os.path.isdir(d):
-                    logger.debug("compression request for {} which is not a directory!".format(d))
-                    continue
-                if cfg.debug:
-                    dtgz=dbase+".tar.gz"
-                    logger.debug("going to change directory")
-                    os.chdir(os.path.dirname(os.path.realpath(d)))
-                    dir_size=sum([os.stat(os.path.join(dbase,f)).st_size for f in os.listdir(dbase)])
-                    dir_tot+=dir_size
-                    logger.debug("going to compress {}".format(dbase))
-                    with tarfile.open(dtgz,"w:gz") as tgz:
-                        logger.debug("created {}".format(dtgz))
-                        tgz.add(dbase)
-                        logger.debug("contents:\n"+"\n".join(tgz.getnames()))
-                    tgz_size=os.stat(dtgz).st_size
-                    tgz_tot+=tgz_size
-                    logger.debug("directory size was approx {}, tar ball size is {}, saved {} bytes".format(dir_size,tgz_size,dir_size-tgz_size))
-                    logger.debug("finished compressing {}".format(dbase))
-                    MiB=1024.**2
-                    GiB=1024.**3
-                    logger.info("directories: {0} bytes = {1:.2f} GiB; tar balls: {2} bytes = {3:.1f} MiB; saved: {4} bytes = {5:.2f} GiB".format(
-                                              dir_tot,    dir_tot/GiB,            tgz_tot,    tgz_tot/MiB, dir_tot-tgz_tot,(dir_tot-tgz_tot)/GiB))
-                shutil.rmtree(dbase)
-                logger.debug("removed directory {}".format(dbase))
-                os.chdir(cwd)
-        except Exception as e:
-            logger.error("oopsie: '{}'".format(e))
+                archiver.submit_removal(d)
+    except Exception as e:
+        logger.error("oopsie: '{}'".format(e))
+
+def log_compression_results(results):
+    dir_tot=sum([r[1] for r in results if r is not None])
+    tgz_tot=sum([r[2] for r in results if r is not None])
+    MiB=1024.**2
+    GiB=1024.**3
+    logger.info("directories: {0} bytes = {1:.2f} GiB; tar balls: {2} bytes = {3:.1f} MiB; saved: {4} bytes = {5:.2f} GiB".format(
+                              dir_tot,    dir_tot/GiB,            tgz_tot,    tgz_tot/MiB, dir_tot-tgz_tot,(dir_tot-tgz_tot)/GiB))
 
 
 
@@ -266,12 +196,14 @@ def post_processing(cfg,pdd,cul):
         logger.error("did not find any dose files named '{}' for beam '{}'".format(cfg.dosemhd,cfg.origname))
         return False
     # sum
+    span_step("sum subjob doses")
     logger.debug("going to sum all {} doses and do some rescaling".format(len(mhdlist)))
     logger.debug("first dose file is {}".format(mhdlist[0]))
     logger.debug("type first dose file is {}".format(type(mhdlist[0])))
     dose0=itk.imread(mhdlist[0])
     logger.debug("dose distribution has orig={} spacing={} size={}".format(dose0.GetOrigin(),dose0.GetSpacing(),dose0.GetLargestPossibleRegion().GetSize()))
-    adose=itk.GetArrayFromImage(dose0)
+    dosesum = dose_accumulator(itk.GetArrayViewFromImage(dose0).shape,cfg.dose_accumulation_precision)
+    dosesum.add(itk.GetArrayViewFromImage(dose0))
     statdict,retval=get_job_stats(mhdlist[0])
     nMC=int(statdict['NumberOfEvents'])
     nBADretval=0
@@ -279,6 +211,8 @@ def post_processing(cfg,pdd,cul):
     tCPUbrutto=0.
     tCPUnetto=0.
     statfiles=[statdict['StatsFile']]
+    # (end time, elapsed time) of the successful GATE subjobs
+    gate_timing=list()
     logger.debug("adding dose from {} primaries, Gate return value was {}".format(nMC,retval))
     if retval != 0:
         logger.error("return value {} means that something went WRONG, Gate did not terminate normally".format(retval))
@@ -289,6 +223,7 @@ def post_processing(cfg,pdd,cul):
     else:
         tCPUbrutto += float(statdict['ElapsedTime'])
         tCPUnetto += float(statdict['ElapsedTimeWoInit'])
+        gate_timing.append((os.path.getmtime(statdict['StatsFile']),float(statdict['ElapsedTime'])))
     for mhd in mhdlist[1:]:
         logger.debug("next dose file is {}".format(mhd))
         try:
@@ -310,11 +245,14 @@ def post_processing(cfg,pdd,cul):
             nMC += nMCjob
             tCPUbrutto += float(statdict['ElapsedTime'])
             tCPUnetto += float(statdict['ElapsedTimeWoInit'])
+            gate_timing.append((os.path.getmtime(statdict['StatsFile']),float(statdict['ElapsedTime'])))
             assert bool(tuple(dose0.GetLargestPossibleRegion().GetSize()) == tuple(dose.GetLargestPossibleRegion().GetSize())), str("sizes {} and {} don't match".format(dose0.GetLargestPossibleRegion().GetSize(),dose.GetLargestPossibleRegion().GetSize()))
             assert bool(np.allclose(tuple(dose0.GetOrigin()), tuple(dose.GetOrigin()))), str("origins don't match")  # TODO: check that this sufficiently allows rounding differences
             assert bool(np.allclose(tuple(dose0.GetSpacing()),tuple(dose.GetSpacing()))), str("spacings don't match") # TODO: check that this sufficiently allows rounding differences
-            adose += itk.GetArrayViewFromImage(dose)
-            logger.debug("max dose (unscaled) is now {}".format(np.max(adose)))
+            adose = itk.GetArrayFromImage(dose)
+            logger.debug("max dose (unscaled) of this job is {}".format(np.max(adose)))
+            dosesum.add(adose)
+            del adose
         except Exception as e:
             # FIXME: such errors should be reported in the final result
             logger.error("something went wrong while processing {}: {}".format(mhd,e))
@@ -322,37 +260,51 @@ def post_processing(cfg,pdd,cul):
         logger.error("failed to find any primaries for beam '{}', cannot scale any dose.".format(cfg.origname))
         return False
     logger.info("total simulated number of primaries is {}".format(nMC))
-    # now make an image
-    dose_sum = itk.GetImageFromArray(np.float32(adose))
-    dose_sum.CopyInformation(dose0)
+    if gate_timing:
+        # the GATE subjobs, as far as we can tell from the stat actor files: written at the end of each subjob
+        record_span("GATE subjobs",start=min([t-dt for t,dt in gate_timing]),end=max([t for t,dt in gate_timing]),
+                    cpu_s=tCPUbrutto,stage="GATE",beam=cfg.origname,njobs=len(gate_timing))
+    # from here on the dose is a dose_volume, scaled and masked in place, converted to ITK only for I/O and resampling
+    adose = dosesum.result()
+    logger.debug("max dose (unscaled) is {}".format(np.max(adose)))
+    dose_sum = dose_volume(adose.astype(np.float32,copy=False),dose0.GetOrigin(),dose0.GetSpacing(),itk.array_from_matrix(dose0.GetDirection()))
+    del adose
+    span_step("scale")
     if cfg.write_mhd_unscaled_dose:
-        itk.imwrite(dose_sum,mhd_dose_sum)
+        dose_sum.write(mhd_dose_sum)
     # rescaling: get physical dose
     logger.info("scaling with number of fractions = {}".format(cfg.nFractions))
-    adose *= cfg.nFractions
     scale_factor = cfg.dosecorrfactor*float(cfg.nTPS)/float(nMC)
     logger.info("scaling with number dose_correction_factor*nTPS/nMC = {}*{}/{} = {}".format(cfg.dosecorrfactor,cfg.nTPS,nMC,scale_factor))
-    adose*=scale_factor
-    dose_sum_rescaled = itk.GetImageFromArray(np.float32(adose))
-    dose_sum_rescaled.CopyInformation(dose0)
+    # the unscaled dose is not needed anymore
+    dose_sum_rescaled = dose_sum
+    dose_sum_rescaled *= cfg.nFractions
+    dose_sum_rescaled *= scale_factor
     if cfg.write_mhd_scaled_dose:
-        itk.imwrite(dose_sum_rescaled,mhd_dose_rescaled)
+        dose_sum_rescaled.write(mhd_dose_rescaled)
     if cfg.write_unresampled_dose:
         image_2_dicom_dose(dose_sum_rescaled,str(cfg.dcm_beam_in),str(dcm_dose_full_ct),physical=True)
         if cfg.dicom_plan_dose or cfg.mhd_plan_dose:
             update_plan_dose(pdd,"unresampled",dose_sum_rescaled)
     # override
+    span_step("resample")
     dose_spacing = cfg.dose_size/cfg.dose_nvoxels
     if cfg.mass_mhd:
         try:
             dose_resampled_ref = itk.GetImageFromArray(np.zeros(cfg.dose_nvoxels[::-1],dtype=np.float32))
             dose_resampled_ref.SetOrigin(cfg.dose_origin)
             dose_resampled_ref.SetSpacing(dose_spacing)
-            mass_img=itk.imread(cfg.mass_mhd)
-            logger.debug("dose_sum has dimsize={} mass has dimsize={}".format(np.array(itk.size(dose_sum_rescaled)),np.array(itk.size(mass_img))))
-            logger.debug("going to resample from voxels with spacing {} to voxels with spacing {}".format(dose_sum_rescaled.GetSpacing(),dose_resampled_ref.GetSpacing()))
+            logger.debug("going to resample from voxels with spacing {} to voxels with spacing {}".format(dose_sum_rescaled.spacing,dose_resampled_ref.GetSpacing()))
             t0=datetime.now()
-            dose_physical = mass_weighted_resampling(dose_sum_rescaled,mass_img,dose_resampled_ref)
+            if cfg.resampling_memory_budget_mb > 0:
+                # the mass image is memory mapped, not read
+                logger.debug("resampling in slabs with a memory budget of {} MB".format(cfg.resampling_memory_budget_mb))
+                budget = int(cfg.resampling_memory_budget_mb*1024**2)
+                dose_physical = dose_volume.from_image(mass_weighted_resampling_chunked(dose_sum_rescaled.to_image(view=True),cfg.mass_mhd,dose_resampled_ref,budget_bytes=budget),view=True)
+            else:
+                mass_img=itk.imread(cfg.mass_mhd)
+                logger.debug("dose_sum has dimsize={} mass has dimsize={}".format(dose_sum_rescaled.size,np.array(itk.size(mass_img))))
+                dose_physical = dose_volume.from_image(mass_weighted_resampling(dose_sum_rescaled.to_image(view=True),mass_img,dose_resampled_ref,copy=False),view=True)
             t1=datetime.now()
             logger.debug("resampling took {} seconds".format((t1-t0).total_seconds()))
         except Exception as e:
@@ -360,18 +312,19 @@ def post_processing(cfg,pdd,cul):
             logger.error(f"something when wrong during resampling: {e}")
             raise
     else:
-        logger.debug("check: size=size {}".format("TRUE" if (cfg.dose_nvoxels==np.array(dose_sum_rescaled.GetLargestPossibleRegion().GetSize())).all() else "FALSE"))
-        logger.debug("check: spacing=spacing {}".format("TRUE" if np.allclose(dose_spacing,dose_sum_rescaled.GetSpacing()) else "FALSE"))
-        logger.debug("check: origin=origin {}".format("TRUE" if np.allclose(cfg.dose_origin,dose_sum_rescaled.GetOrigin()) else "FALSE"))
+        logger.debug("check: size=size {}".format("TRUE" if (cfg.dose_nvoxels==dose_sum_rescaled.size).all() else "FALSE"))
+        logger.debug("check: spacing=spacing {}".format("TRUE" if np.allclose(dose_spacing,dose_sum_rescaled.spacing) else "FALSE"))
+        logger.debug("check: origin=origin {}".format("TRUE" if np.allclose(cfg.dose_origin,dose_sum_rescaled.origin) else "FALSE"))
+        # the rescaled dose was already added to the plan dose (copied), so we can modify it in place
         dose_physical = dose_sum_rescaled
-        dose_physical.SetOrigin(cfg.dose_origin)
-    adose = itk.GetArrayFromImage(dose_physical)
+        dose_physical.origin = np.array(cfg.dose_origin,dtype=float)
     if cfg.apply_external_dose_mask:
+        span_step("mask")
         logger.debug("going to apply ROI mask from file {}".format(cfg.external_dose_mask))
         mask=itk.imread(str(cfg.external_dose_mask))
         logger.debug("succeeded reading mask image from file {}".format(cfg.external_dose_mask))
         amask=itk.GetArrayViewFromImage(mask)>0
-        logger.debug("got mask as array: shape dose={} shape ROI mask = {}".format(adose.shape,amask.shape))
+        logger.debug("got mask as array: shape dose={} shape ROI mask = {}".format(dose_physical.shape,amask.shape))
         amask_not = np.logical_not(amask)
         for iz in range(amask.shape[0]):
             logger.debug("iz={} #enables(iz)={} #disables(iz)={}".format(iz,np.sum(amask[iz,:,:]),np.sum(amask_not[iz,:,:])))
@@ -379,12 +332,10 @@ def post_processing(cfg,pdd,cul):
         n_in=np.sum(amask)
         n_out=np.sum(amask_not)
         logger.debug("total: mask enables/disables {0}/{1} voxels ({2:.2f}/{3:.2f} percent of the image)".format(n_in,n_out,n_in/one_percent,n_out/one_percent))
-        adose*=amask
-    new_dose_physical=itk.GetImageFromArray(np.float32(adose))
-    new_dose_physical.CopyInformation(dose_physical)
-    dose_physical = new_dose_physical
+        dose_physical *= amask
+    span_step("write")
     if cfg.write_mhd_physical_dose:
-        itk.imwrite(dose_physical,mhd_dose_physical)
+        dose_physical.write(mhd_dose_physical)
     if cfg.write_dicom_physical_dose:
         image_2_dicom_dose(dose_physical,str(cfg.dcm_beam_in),str(dcm_dose_physical),physical=True)
         if cfg.dicom_plan_dose or cfg.mhd_plan_dose:
@@ -396,23 +347,24 @@ def post_processing(cfg,pdd,cul):
         mhd_dose_final = mhd_dose_physical
     else:
         logger.debug("multiplying dose with RBE factor = {}".format(cfg.RBE_factor))
-        adose*=cfg.RBE_factor
-        dose_rbe = itk.GetImageFromArray(np.float32(adose))
-        dose_rbe.CopyInformation(dose_physical)
+        # the physical dose is not needed anymore (the plan dose has its own copy)
+        dose_rbe = dose_physical
+        dose_rbe *= cfg.RBE_factor
         dose_sum_final = dose_rbe
         mhd_dose_final = mhd_dose_rbe
         if cfg.write_mhd_rbe_dose:
-            itk.imwrite(dose_rbe,mhd_dose_rbe)
+            dose_rbe.write(mhd_dose_rbe)
         if cfg.write_dicom_rbe_dose:
             image_2_dicom_dose(dose_rbe,str(cfg.dcm_beam_in),str(dcm_dose_rbe),physical=False)
             if cfg.dicom_plan_dose or cfg.mhd_plan_dose:
                 update_plan_dose(pdd,"RBE",dose_rbe)
     if cfg.ref_dose_path:
         if cfg.gamma_analysis:
+            span_step("gamma index")
             try:
                 logger.debug("going to run gamma analysis, using ref dose = {}".format(cfg.ref_dose_path))
                 t0=datetime.now()
-                run_gamma_analysis(cfg.ref_dose_path,cfg.gamma_parameters,dose_sum_final,mhd_dose_final)
+                run_gamma_analysis(cfg.ref_dose_path,cfg.gamma_parameters,dose_sum_final.to_image(view=True),mhd_dose_final)
                 #ushort_imgref=itk.imread(cfg.ref_dose_path)
                 #aimgref=itk.GetArrayFromImage(ushort_imgref)*float(pydicom.dcmread(cfg.ref_dose_path).DoseGridScaling)
                 #imgref=itk.GetImageFromArray(np.float32(aimgref))
@@ -475,6 +427,10 @@ class post_proc_config:
         # MFA 11/16/22
         self.gamma_analysis = sec.getboolean("run gamma analysis")
         self.debug = sec.getboolean("debug")
+        self.archive_threads = sec.getint("archive threads",fallback=default_nthreads())
+        self.archive_format = sec.get("archive format",fallback="gztar")
+        self.dose_accumulation_precision = sec.get("dose accumulation precision",fallback="float64")
+        self.resampling_memory_budget_mb = sec.getfloat("resampling memory budget [mb]",fallback=0.)
         
         self.write_mhd_unscaled_dose = sec.getboolean("write mhd unscaled dose")
         self.write_mhd_scaled_dose = sec.getboolean("write mhd scaled dose")
@@ -518,6 +474,7 @@ if __name__ == '__main__':
     with open("postprocessor.cfg","r") as fp:
         parser.read_file(fp)
     ok = True
+    set_span_file(span_file_name,stage="POST")
     plan_dose_dict = dict()
     cleanup_list = list()
     # MFA 11/21/22
@@ -525,17 +482,28 @@ if __name__ == '__main__':
 #    with open("/opt/IDEAL-1.1test/cfg/api.cfg","r") as fp:
 #        api_cfg.read_file(fp)
         
+    # memory usage per subjob, for the calibration of the cost model (see impl.dose_grid_cost)
+    memory_usage = subjob_memory_usage_mb("logs")
+    iprocess = 0
     for beamname in parser.sections():
         if beamname=='default' or beamname=='user logs file':
             continue
         t0 = datetime.now()
         cfg = post_proc_config(parser,beamname)
+        # the subjobs of the beams are queued in the order of the sections
+        beam_memory_usage = [memory_usage[p] for p in range(iprocess,iprocess+cfg.nJobs) if p in memory_usage]
+        iprocess += cfg.nJobs
         # TODO: the post_processing now also includes the archiving (making a tarball of) the output directories of all subjobs. Maybe this needs to be separated.
-        success = post_processing(cfg,plan_dose_dict,cleanup_list)
+        with span("post_processing",beam=cfg.origname):
+            success = post_processing(cfg,plan_dose_dict,cleanup_list)
         t1 = datetime.now()
         dt = (t1-t0).total_seconds()
         if success:
             logger.info('SUCCESSFUL post processing (including the archiving of job data) of beam "{}" took {} seconds'.format(cfg.origname,dt))
+            changes = {"post processing time [seconds]":str(dt)}
+            if beam_memory_usage:
+                changes["maximum memory usage per subjob [MB]"] = str(max(beam_memory_usage))
+            update_user_logs(cfg.user_cfg,status=f"FINISHED POSTPROCESSING beam '{cfg.origname}'",section=cfg.origname,changes=changes)
         else:
             logger.error('post processing of beam "{}" FAILED after {} seconds'.format(cfg.origname,dt))
             ok = False
@@ -552,19 +520,19 @@ if __name__ == '__main__':
             if cfg.mhd_plan_dose != "":
                 logger.debug(f"going to write {label} PLAN dose to MHD")
                 plan_dose_mhd = str(os.path.join(str(cfg.output_dicom1), cfg.mhd_plan_dose.replace("PLAN.mhd",f"PLAN-{label}.mhd")))
-                itk.imwrite(img_dose,plan_dose_mhd)
+                img_dose.write(plan_dose_mhd)
                 mhd_gamma = plan_dose_mhd
                 logger.debug(f"finished writing {label} PLAN dose to MHD")
             if cfg.ref_physical_plan_dose_path != "" and label.upper() == "PHYSICAL" and cfg.gamma_analysis:
                 logger.debug("start gamma index calculation PHYSICAL PLAN DOSE")
                 t0=datetime.now()
-                run_gamma_analysis(cfg.ref_physical_plan_dose_path,cfg.gamma_parameters,img_dose,mhd_gamma)
+                run_gamma_analysis(cfg.ref_physical_plan_dose_path,cfg.gamma_parameters,img_dose.to_image(view=True),mhd_gamma)
                 t1=datetime.now()
                 logger.debug("gamma index calculation PHYSICAL PLAN DOSE took {} seconds".format((t1-t0).total_seconds()))
             elif cfg.ref_effective_plan_dose_path != "" and label.upper() == "RBE" and cfg.gamma_analysis:
                 logger.debug("start gamma index calculation EFFECTIVE PLAN DOSE")
                 t0=datetime.now()
-                run_gamma_analysis(cfg.ref_effective_plan_dose_path,cfg.gamma_parameters,img_dose,mhd_gamma)
+                run_gamma_analysis(cfg.ref_effective_plan_dose_path,cfg.gamma_parameters,img_dose.to_image(view=True),mhd_gamma)
                 t1=datetime.now()
                 logger.debug("gamma index calculation EFFECTIVE PLAN DOSE took {} seconds".format((t1-t0).total_seconds()))
         if cfg.output_dicom2:
@@ -584,10 +552,11 @@ if __name__ == '__main__':
         shutil.rmtree(tmp)
         t1=datetime.now()
         logger.info("cleaning up the 'tmp' directory {} successful and took {} seconds".format("was NOT" if os.path.exists(tmp) else "was", (t1-t0).total_seconds()))
+        # the output directories are archived in parallel, the job is reported as finished
+        # only after all archives have been written
+        archiver = job_archiver(nthreads=cfg.archive_threads,form=cfg.archive_format,remove=True)
         for outputdirs,statfiles in cleanup_list:
-            compress_jobdata(cfg,outputdirs,statfiles)
-        t2=datetime.now()
-        logger.info("compressing all output directories took {} seconds".format((t2-t1).total_seconds()))
+            compress_jobdata(cfg,outputdirs,statfiles,archiver)
         # TODO i'm trying to send the files (i.e. put them on a specific folder for now)
 #        if api_cfg['receiver'].getboolean('send result'):
 #            try:
@@ -608,7 +577,22 @@ if __name__ == '__main__':
 #                logger.warn("failed to transfer zipped output to server: '{}'".format(e))
 #                
         # TODO end
-        update_user_logs(cfg.user_cfg,status=f"FINISHED")
+        with span("archive subjob output"):
+            results = archiver.shutdown()
+        log_compression_results(results)
+        t2=datetime.now()
+        logger.info("compressing all output directories took {} seconds".format((t2-t1).total_seconds()))
+        # the doses are fine, but (some of) the subjob output may be lost, or not cleaned up
+        changes = dict()
+        nfailed = len(archiver.errors)
+        if nfailed > 0:
+            logger.error("failed to archive {} out of {} output directories".format(nfailed,archiver.narchives))
+            changes["archiving errors"] = str(nfailed)
+        nfailed = len(archiver.removal_errors)
+        if nfailed > 0:
+            logger.error("failed to remove {} output directories".format(nfailed))
+            changes["removal errors"] = str(nfailed)
+        update_user_logs(cfg.user_cfg,status=f"FINISHED",changes=changes)
     else:
         update_user_logs(cfg.user_cfg,status=f"BEAM DOSE POST PROCESSING FAILED")
         logger.warn("NOT going to clean up the 'tmp' directory, to allow debugging of the reported errors")
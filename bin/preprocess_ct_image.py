@@ -29,11 +29,12 @@ import numpy as np
 #import SimpleITK as sitk
 import itk
 from datetime import datetime
-from utils.roi_utils import region_of_interest, list_roinames
+from utils.roi_utils import region_of_interest, list_roinames, structure_set_contours
 from utils.bounding_box import bounding_box
 from utils.ct_dicom_to_img import ct_image_from_dicom
 from utils.crop import crop_and_pad_image
 from utils.mass_image import create_mass_image
+from impl.dual_logging import span, span_step, set_span_file, span_file_name
 
 current_action=""
 
@@ -57,10 +58,12 @@ def update_user_logs(user_cfg,status,section="DEFAULT",changes=dict()):
 
 def GetMCPatientCTImage(rpdir,ssdcm,ctuid,HUoverride,HU_override_density,hlut_path, #mhd_resized,
                         mhd_orig_ct, mhd_overrides, ct_bb,
-                        dose_grid_center,dose_grid_size,dose_grid_nvoxels,mhd_dose_grid_mask):
+                        dose_grid_center,dose_grid_size,dose_grid_nvoxels,mhd_dose_grid_mask,
+                        rs_contours=None):
 
     global current_action
     current_action="initializing preprocessing"
+    span_step(current_action)
     logger.debug("rpdir={}".format(rpdir))
     logger.debug("ctuid={}".format(ctuid))
     logger.debug("ssdcm={}".format(ssdcm))
@@ -70,15 +73,22 @@ def GetMCPatientCTImage(rpdir,ssdcm,ctuid,HUoverride,HU_override_density,hlut_pa
 
     # step 1: obtain original CT and structure set from DICOM
     current_action="reading original CT"
+    span_step(current_action)
     ct_orig = itk.imread(mhd_orig_ct)
     act_orig = itk.GetArrayFromImage(ct_orig)
     current_action="reading structure set"
-    structure_set = pydicom.dcmread(os.path.join(str(rpdir),str(ssdcm)))
+    span_step(current_action)
+    if rs_contours and os.path.exists(rs_contours):
+        # contours parsed during the job submission
+        structure_set = structure_set_contours.load(rs_contours)
+    else:
+        structure_set = pydicom.dcmread(os.path.join(str(rpdir),str(ssdcm)))
     logger.debug("roinames={}".format(",".join(list_roinames(structure_set))))
 
     # step 2: apply material overrides
     # step 2a: get name of external ROI, get HU value of air
     current_action="reading material overrides"
+    span_step(current_action)
     tmp = [(k[1:],v) for k,v in HUoverride.items() if k[0]=="!" and k!="!HUMAX" and k!="!DOSEPAD"]
     if not len(tmp)==1:
         raise RuntimeError("PROGRAMMING ERROR: external ROI entry missing from HU overrides list.")
@@ -87,6 +97,7 @@ def GetMCPatientCTImage(rpdir,ssdcm,ctuid,HUoverride,HU_override_density,hlut_pa
     if not "!HUMAX" in HUoverride:
         raise RuntimeError("PROGRAMMING ERROR: '!HUMAX' entry missing from HU overrides list.")
     current_action="applying max HU filter"
+    span_step(current_action)
     hu_max = HUoverride["!HUMAX"]
     hu_dosepad = HUoverride.get("!DOSEPAD",hu_air) # optional
     mask = act_orig>hu_max
@@ -95,6 +106,7 @@ def GetMCPatientCTImage(rpdir,ssdcm,ctuid,HUoverride,HU_override_density,hlut_pa
 
     # step 2c: enforce air outside of external
     current_action="overriding voxels outside external ROI with G4_AIR"
+    span_step(current_action)
     ext_roi = region_of_interest(ds=structure_set,roi_id=external)
     ext_mask = ext_roi.get_mask(ct_orig,corrected=False)
     ext_array = itk.GetArrayViewFromImage(ext_mask)>0
@@ -107,6 +119,7 @@ def GetMCPatientCTImage(rpdir,ssdcm,ctuid,HUoverride,HU_override_density,hlut_pa
 
     # step 2d: apply other HU overrides
     current_action="overriding materials inside given ROIs"
+    span_step(current_action)
     n_override=0
     n_rois=0
     for roiname,huval in HUoverride.items():
@@ -137,6 +150,7 @@ def GetMCPatientCTImage(rpdir,ssdcm,ctuid,HUoverride,HU_override_density,hlut_pa
 
     # step 3: apply padding with dose padding HU (typically water)
     current_action="padding CT image (if dose image is not contained in it)"
+    span_step(current_action)
     logger.debug("getting bounding box")
     bb_ct_hu_overrides = bounding_box(img=ct_hu_overrides)
     bb_dose = bounding_box(xyz=np.stack((dose_grid_center-0.5*dose_grid_size,dose_grid_center+0.5*dose_grid_size)))
@@ -158,6 +172,7 @@ def GetMCPatientCTImage(rpdir,ssdcm,ctuid,HUoverride,HU_override_density,hlut_pa
 
     # step 4: apply cropping/padding with out-of-external padding HU (typically air)
     current_action="cropping/padding CT image"
+    span_step(current_action)
     logger.debug("starting crop and pad")
     #ibbmin = np.array(ct_padded.TransformPhysicalPointToIndex(ct_bb.mincorner+0.01))
     #ibbmax = np.array(ct_padded.TransformPhysicalPointToIndex(ct_bb.maxcorner-0.01))+1
@@ -170,6 +185,7 @@ def GetMCPatientCTImage(rpdir,ssdcm,ctuid,HUoverride,HU_override_density,hlut_pa
 
     # step 5: produce external dose mask (to enable the "set all dose outside of exernal equal to zero").
     current_action="creating dose mask"
+    span_step(current_action)
     logger.debug("going to create dose mask for performing 'no dose outside of external' filter")
     dose_grid_dummy = itk.GetImageFromArray(np.zeros(dose_grid_nvoxels[::-1],dtype=np.float32))
     spacing = dose_grid_size / dose_grid_nvoxels
@@ -183,19 +199,23 @@ def GetMCPatientCTImage(rpdir,ssdcm,ctuid,HUoverride,HU_override_density,hlut_pa
 
     # step 6: write output
     current_action="writing preprocessed CT image"
+    span_step(current_action)
     logger.debug("writing cropped, padded and overridden CT image to {}".format(mhd_overrides))
     itk.imwrite(ct_overrides,mhd_overrides)
     mhd_mass=mhd_overrides.replace(".mhd","_mass.mhd")
     current_action="creating mass file"
+    span_step(current_action)
     mass_image = create_mass_image(ct_overrides,hlut_path,overrides=HU_override_density)
     logger.debug("writing corresponding mass image to {}".format(mhd_mass))
     current_action="writing mass file"
+    span_step(current_action)
     itk.imwrite(mass_image,mhd_mass)
     update_user_logs(user_logs,"PREPROCESSING COMPLETE")
 
 if __name__ == '__main__':
     parser=configparser.RawConfigParser()
     parser.optionxform = lambda option : option
+    set_span_file(span_file_name,stage="PRE")
     logger.debug('going to read CT and dose grid specs from preprocesssing config file')
     try:
         with open("preprocessor.cfg","r") as fp:
@@ -225,20 +245,22 @@ if __name__ == '__main__':
         update_user_logs(user_logs,"PREPROCESSING STARTED")
         #sys.exit(0)
         logger.debug('finished parsing config file, now going to do the preprocessing')
-        GetMCPatientCTImage(dicom["directory"],
-                            dicom["RSfile"],
-                            dicom["CTuid"],
-                            HUoverride,
-                            HU_override_density,
-                            hlut_path,
-                            #mhd_resized,
-                            mhd_orig_ct,
-                            mhd_overrides,
-                            ct_bb,
-                            dose_grid_center,
-                            dose_grid_size,
-                            dose_grid_nvoxels,
-                            mhd_dose_grid_mask)
+        with span("GetMCPatientCTImage"):
+            GetMCPatientCTImage(dicom["directory"],
+                                dicom["RSfile"],
+                                dicom["CTuid"],
+                                HUoverride,
+                                HU_override_density,
+                                hlut_path,
+                                #mhd_resized,
+                                mhd_orig_ct,
+                                mhd_overrides,
+                                ct_bb,
+                                dose_grid_center,
+                                dose_grid_size,
+                                dose_grid_nvoxels,
+                                mhd_dose_grid_mask,
+                                dicom.get("RScontours",None))
         update_user_logs(user_logs,"PREPROCESSING FINISHED, JOB QUEUED")
     except Exception as e:
         logger.error("something went wrong: {}".format(e))
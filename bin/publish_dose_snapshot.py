@@ -0,0 +1,33 @@
+#!/usr/bin/env python3
+# -----------------------------------------------------------------------------
+#   Copyright (C): MedAustron GmbH, ACMIT Gmbh and Medical University Vienna
+#   This software is distributed under the terms
+#   of the GNU Lesser General  Public Licence (LGPL)
+#   See LICENSE for further details
+# -----------------------------------------------------------------------------
+
+"""
+Publish an intermediate dose snapshot of a GATE subjob in the compact sparse
+format, for the job control daemon. This is run by the flag script of the
+stop-on-script actor, see `utils.dose_snapshot`.
+"""
+
+import sys
+import argparse
+from utils.dose_snapshot import publish_sparse_snapshot
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='publish a sparse dose snapshot')
+    parser.add_argument('mhd',help="dose MHD file saved by GATE")
+    parser.add_argument('stat',help="stat actor file with the number of events")
+    parser.add_argument('destdir',help="directory in which the snapshot is published")
+    args = parser.parse_args()
+    try:
+        manifest = publish_sparse_snapshot(args.mhd,args.destdir,stat_file=args.stat)
+    except (OSError,RuntimeError) as e:
+        print("failed to publish sparse snapshot of {}: {}".format(args.mhd,e))
+        sys.exit(1)
+    print("published sparse snapshot {}".format(manifest))
+    sys.exit(0)
+
+# vim: set et softtabstop=4 sw=4 smartindent:
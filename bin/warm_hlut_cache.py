@@ -0,0 +1,34 @@
+#!/usr/bin/env python3
+# -----------------------------------------------------------------------------
+#   Copyright (C): MedAustron GmbH, ACMIT Gmbh and Medical University Vienna
+#   This software is distributed under the terms
+#   of the GNU Lesser General  Public Licence (LGPL)
+#   See LICENSE for further details
+# -----------------------------------------------------------------------------
+
+"""
+Generate the HU-to-material tables for all Schneider type CT protocols in the
+hlut.conf file of the commissioning data, if they are not yet in the cache.
+Run this after installation and after every change of the HLUT configuration,
+then no user job has to wait for the cache generation.
+"""
+
+import sys
+import argparse
+from impl.system_configuration import get_sysconfig
+from impl.hlut_conf import hlut_conf
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='pre-generate the HLUT cache for all CT protocols')
+    parser.add_argument('-s','--sysconfig',default='',help="alternative system configuration file")
+    parser.add_argument('-n','--nthreads',type=int,default=4,help="how many caches to generate in parallel")
+    parser.add_argument('-t','--hutol',type=float,nargs='*',default=[],help="extra density tolerance values [g/cm3]")
+    parser.add_argument('-v','--verbose',default=False,action='store_true',help="be verbose")
+    args = parser.parse_args()
+    syscfg = get_sysconfig(filepath=args.sysconfig,verbose=args.verbose,username="",want_logfile="")
+    results = hlut_conf.getInstance().warm_caches(nthreads=args.nthreads,hutols=args.hutol)
+    for cache_dir,ok in results.items():
+        print("{} {}".format("OK    " if ok else "FAILED",cache_dir))
+    sys.exit(0 if all(results.values()) else 1)
+
+# vim: set et softtabstop=4 sw=4 smartindent:
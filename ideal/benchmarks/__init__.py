@@ -0,0 +1,21 @@
+# -----------------------------------------------------------------------------
+#   Copyright (C): MedAustron GmbH, ACMIT Gmbh and Medical University Vienna
+#   This software is distributed under the terms
+#   of the GNU Lesser General  Public Licence (LGPL)
+#   See LICENSE for further details
+# -----------------------------------------------------------------------------
+
+"""
+Performance benchmarks for the compute heavy parts of IDEAL, on deterministic
+synthetic input data (see `benchmarks.synthetic`), so that the results of
+different commits and machines can be compared without any patient data.
+
+Run from the `ideal` directory, for instance::
+
+    python -m benchmarks.suite -S small -o before.json
+    (checkout/patch)
+    python -m benchmarks.suite -S small -o after.json
+    python -m benchmarks.suite --compare before.json after.json
+"""
+
+# vim: set et softtabstop=4 sw=4 smartindent:
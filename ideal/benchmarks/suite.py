@@ -0,0 +1,591 @@
+# -----------------------------------------------------------------------------
+#   Copyright (C): MedAustron GmbH, ACMIT Gmbh and Medical University Vienna
+#   This software is distributed under the terms
+#   of the GNU Lesser General  Public Licence (LGPL)
+#   See LICENSE for further details
+# -----------------------------------------------------------------------------
+
+"""
+Benchmark suite for the compute heavy steps of IDEAL: mass weighted dose
+resampling, gamma index, ROI masks, DVHs, mass images, reading CT series, the post
+processing of a beam and the dose collection of the job control daemon.
+
+Each benchmark has a setup function that creates the (synthetic) input data
+in a temporary directory, for a given problem size, and returns the function
+to time. The results are written as JSON, together with the git commit and
+the versions of python/numpy/ITK, such that the results of two commits can be
+compared with `--compare`.
+"""
+
+import os
+import sys
+import io
+import json
+import time
+import socket
+import platform
+import tempfile
+import subprocess
+import contextlib
+import configparser
+from datetime import datetime
+import numpy as np
+import itk
+import pydicom
+from benchmarks import synthetic
+import logging
+logger=logging.getLogger(__name__)
+
+# the post processing and job control daemon scripts live in the bin directory
+_bin_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))),"bin")
+_ideal_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# problem sizes: CT shape (nz,ny,nx) with spacing (x,y,z) = (2,2,3) mm, number of subjobs,
+# number of spots (for the plan), the dose grid has twice the CT spacing. The out-of-core
+# resampling uses a separate, larger CT shape (with 0.5 mm voxels) and memory budget.
+# The ROI benchmarks use a structure set with `roi_norgans` organs (plus 3 standard ROIs)
+# on `roi_nslices` slices, with the in-plane size of the CT.
+sizes = {
+    "tiny"   : dict(ct_shape=(8,24,32),    njobs=3,  nlayers=5,  nspots=20,  ooc_ct_shape=(40,128,128),   ooc_budget_mb=2,
+                    roi_norgans=5,  roi_nslices=20),
+    "small"  : dict(ct_shape=(40,96,96),   njobs=10, nlayers=20, nspots=100, ooc_ct_shape=(100,256,256),  ooc_budget_mb=16,
+                    roi_norgans=47, roi_nslices=200),
+    "medium" : dict(ct_shape=(80,160,160), njobs=20, nlayers=40, nspots=200, ooc_ct_shape=(200,512,512),  ooc_budget_mb=128,
+                    roi_norgans=47, roi_nslices=200),
+    "large"  : dict(ct_shape=(160,256,256),njobs=50, nlayers=60, nspots=400, ooc_ct_shape=(400,1024,1024),ooc_budget_mb=512,
+                    roi_norgans=97, roi_nslices=300),
+}
+ct_spacing = (2.,2.,3.)
+
+_registry = dict()
+
+def benchmark(name):
+    """
+    Decorator that registers a benchmark setup function. The setup function
+    is called with the work directory and the size parameters, and returns the
+    function to time (without arguments) and a dictionary with the relevant
+    problem parameters.
+    """
+    def register(setup):
+        _registry[name] = setup
+        return setup
+    return register
+
+def benchmark_names():
+    return list(_registry.keys())
+
+def _ct_and_mass(workdir,size):
+    from utils.mass_image import create_mass_image
+    ct = synthetic.ct_image(size["ct_shape"],ct_spacing)
+    hlut = synthetic.write_hlut(os.path.join(workdir,"hlut.txt"))
+    return ct,hlut,create_mass_image(ct,hlut)
+
+@benchmark("mass_weighted_resampling")
+def setup_mass_weighted_resampling(workdir,size):
+    from utils.resample_dose import mass_weighted_resampling
+    ct,hlut,mass = _ct_and_mass(workdir,size)
+    dose = synthetic.dose_image(size["ct_shape"],ct_spacing,seed=1,noise=0.1)
+    newgrid = synthetic.dose_grid(ct)
+    params = dict(input_voxels=int(np.prod(size["ct_shape"])),output_voxels=int(np.prod(itk.size(newgrid))))
+    return lambda: mass_weighted_resampling(dose,mass,newgrid),params
+
+@benchmark("mass_weighted_resampling_general")
+def setup_mass_weighted_resampling_general(workdir,size):
+    """
+    Same as "mass_weighted_resampling", but the dose grid is shifted by half a
+    CT voxel, so that the integer downsampling shortcut does not apply.
+    """
+    from utils.resample_dose import mass_weighted_resampling
+    ct,hlut,mass = _ct_and_mass(workdir,size)
+    dose = synthetic.dose_image(size["ct_shape"],ct_spacing,seed=1,noise=0.1)
+    newgrid = synthetic.dose_grid(ct,shift=0.5)
+    params = dict(input_voxels=int(np.prod(size["ct_shape"])),output_voxels=int(np.prod(itk.size(newgrid))))
+    return lambda: mass_weighted_resampling(dose,mass,newgrid),params
+
+# run in a separate process, such that the peak RSS is that of the resampling only
+_chunked_resampling_script = """
+import sys, json
+import itk
+from utils.resample_dose import mass_weighted_resampling_chunked
+from impl.dual_logging import _rss_mb, _peak_rss_mb
+dose_mhd,mass_mhd,grid,budget = json.loads(sys.argv[1])
+newgrid = itk.Image[itk.F,3].New()
+newgrid.SetRegions(grid["size"])
+newgrid.SetSpacing(grid["spacing"])
+newgrid.SetOrigin(grid["origin"])
+rss0 = _rss_mb()
+mass_weighted_resampling_chunked(dose_mhd,mass_mhd,newgrid,budget_bytes=budget)
+print(json.dumps(dict(rss_before_mb=rss0,peak_rss_mb=_peak_rss_mb())))
+"""
+
+@benchmark("mass_weighted_resampling_chunked")
+def setup_mass_weighted_resampling_chunked(workdir,size):
+    """
+    Out-of-core resampling of a large dose and mass (MHD files, 0.5 mm
+    voxels) to a dose grid with 1 mm voxels, shifted by half a CT voxel, with
+    the memory budget of the problem size. The timing includes the start of
+    the python process; the peak RSS of that process is reported.
+    """
+    shape = size["ooc_ct_shape"]
+    spacing = (0.5,0.5,0.5)
+    dose_mhd,mass_mhd = synthetic.write_dose_and_mass_mhd(workdir,shape,spacing,seed=1)
+    origin,_ = synthetic.image_geometry(shape,spacing)
+    nxyz = np.array(shape[::-1])//2-1
+    grid = dict(size=nxyz.tolist(),spacing=[2*s for s in spacing],origin=(np.array(origin)+np.array(spacing)).tolist())
+    budget = size["ooc_budget_mb"]*1024**2
+    params = dict(input_voxels=int(np.prod(shape)),output_voxels=int(np.prod(nxyz)),budget_mb=size["ooc_budget_mb"])
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join([_ideal_dir]+[p for p in env.get("PYTHONPATH","").split(os.pathsep) if p])
+    def run():
+        out = subprocess.run([sys.executable,"-c",_chunked_resampling_script,json.dumps([dose_mhd,mass_mhd,grid,budget])],
+                             env=env,capture_output=True,text=True,check=True).stdout
+        rss = json.loads(out.strip().splitlines()[-1])
+        params.update(rss)
+        params.update(resampling_rss_mb=rss["peak_rss_mb"]-rss["rss_before_mb"] if rss["rss_before_mb"] is not None else None)
+    return run,params
+
+@benchmark("gamma_index")
+def setup_gamma_index(workdir,size):
+    from utils.gamma_index import get_gamma_index
+    grid = synthetic.dose_grid(synthetic.ct_image(size["ct_shape"],ct_spacing))
+    shape = tuple(itk.size(grid))[::-1]
+    ref = synthetic.dose_image(shape,grid.GetSpacing())
+    target = synthetic.dose_image(shape,grid.GetSpacing(),seed=2,noise=0.05)
+    params = dict(voxels=int(np.prod(shape)),dta=3.,dd=3.,threshold_percent=10.)
+    return lambda: get_gamma_index(ref=ref,target=target,dta=3.,dd=3.,ddpercent=True,threshold=10.,defvalue=-1.,verbose=False,threshold_percent=True),params
+
+@benchmark("roi_mask")
+def setup_roi_mask(workdir,size):
+    from utils.roi_utils import region_of_interest
+    ct = synthetic.ct_image(size["ct_shape"],ct_spacing)
+    rs = synthetic.structure_set(ct,npoints=128)
+    roi = region_of_interest(ds=rs,roi_id="External")
+    params = dict(voxels=int(np.prod(size["ct_shape"])),contours=roi.ncontours,points=roi.npoints_total)
+    # the preprocessing of the CT (the only user of ROI masks in production) uses binary masks
+    return lambda: roi.get_mask(ct,corrected=False),params
+
+@benchmark("roi_geometry")
+def setup_roi_geometry(workdir,size):
+    from utils.roi_utils import region_of_interest, list_roinames, get_intersection_volume
+    norgans,nslices = size["roi_norgans"],size["roi_nslices"]
+    ct = synthetic.ct_image((nslices,)+tuple(size["ct_shape"][1:]),ct_spacing)
+    rs = synthetic.structure_set(ct,npoints=128,norgans=norgans)
+    names = list_roinames(rs)
+    # convert the contour data of the dataset once (pydicom does that lazily on first access)
+    for roi in rs.ROIContourSequence:
+        for contour in roi.ContourSequence:
+            contour.ContourData
+    params = dict(rois=len(names),slices=nslices,points=128)
+    def run():
+        rois = [region_of_interest(ds=rs,roi_id=name) for name in names]
+        volumes = [roi.get_volume() for roi in rois]
+        overlaps = [get_intersection_volume([rois[1],roi],2.,2.) for roi in rois[3:]]
+        return volumes,overlaps
+    return run,params
+
+def _roi_construction(workdir,size,source):
+    from utils.roi_utils import region_of_interest, list_roinames, structure_set_contours, get_structure_set_contours, clear_structure_set_cache
+    norgans,nslices = size["roi_norgans"],size["roi_nslices"]
+    ct = synthetic.ct_image((nslices,)+tuple(size["ct_shape"][1:]),ct_spacing)
+    rspath = os.path.join(workdir,"RS.dcm")
+    npzpath = os.path.join(workdir,"structure_set_contours.npz")
+    names = list_roinames(synthetic.write_structure_set(rspath,ct,npoints=128,norgans=norgans))
+    get_structure_set_contours(pydicom.dcmread(rspath)).save(npzpath)
+    def run():
+        # like the preprocessing: a new process, with an empty cache
+        clear_structure_set_cache()
+        ds = pydicom.dcmread(rspath) if source=="dicom" else structure_set_contours.load(npzpath)
+        return [region_of_interest(ds=ds,roi_id=name) for name in names]
+    params = dict(rois=len(names),slices=nslices,points=128,npz_bytes=os.path.getsize(npzpath),dicom_bytes=os.path.getsize(rspath))
+    return run,params
+
+@benchmark("roi_construction_dicom")
+def setup_roi_construction_dicom(workdir,size):
+    return _roi_construction(workdir,size,"dicom")
+
+@benchmark("roi_construction_npz")
+def setup_roi_construction_npz(workdir,size):
+    return _roi_construction(workdir,size,"npz")
+
+def _roi_bounding_boxes(workdir,size,batched):
+    from utils.roi_utils import region_of_interest, list_roinames, get_structure_set_contours, clear_structure_set_cache
+    from utils.bounding_box import bounding_box, union_of_boxes, box_indices_in_image
+    # the ROIs of a plan (for the HU overrides, up to 100 for "large"), as in IDC_details.GetROIBoundingBox, plus the voxel index ranges in the CT
+    norgans,nslices = size["roi_norgans"],size["roi_nslices"]
+    ct = synthetic.ct_image((nslices,)+tuple(size["ct_shape"][1:]),ct_spacing)
+    rs = synthetic.structure_set(ct,npoints=128,norgans=norgans)
+    names = list_roinames(rs)
+    params = dict(rois=len(names),slices=nslices,points=128)
+    def run():
+        # the contours are parsed in both cases: the parsing is shared, what differs is what is done with them
+        clear_structure_set_cache()
+        if batched:
+            contours = get_structure_set_contours(rs)
+            limits = contours.bounding_boxes([contours.find_roi(name)[0] for name in names])
+            return union_of_boxes(limits),box_indices_in_image(limits,ct)
+        roi_bb = bounding_box()
+        indices = []
+        for name in names:
+            roi = region_of_interest(ds=rs,roi_id=name)
+            roi_bb.should_contain(roi.bb.mincorner)
+            roi_bb.should_contain(roi.bb.maxcorner)
+            indices.append(roi.bb.indices_in_image(ct))
+        return roi_bb,indices
+    return run,params
+
+@benchmark("roi_bounding_boxes_objects")
+def setup_roi_bounding_boxes_objects(workdir,size):
+    return _roi_bounding_boxes(workdir,size,False)
+
+@benchmark("roi_bounding_boxes_batched")
+def setup_roi_bounding_boxes_batched(workdir,size):
+    return _roi_bounding_boxes(workdir,size,True)
+
+@benchmark("dvh")
+def setup_dvh(workdir,size,nrois=40):
+    from utils.roi_utils import get_dvhs_from_masks
+    adose = synthetic.dose_array(size["ct_shape"],ct_spacing,seed=3,noise=0.05)
+    # nested isodose ROIs, each cut in half along x by turns, so that they also overlap partially
+    nx = adose.shape[2]
+    masks = [adose>level for level in np.linspace(0.05,0.9,nrois)*np.max(adose)]
+    for i,amask in enumerate(masks):
+        amask[:,:,(i%2)*nx//2:(i%2+1)*nx//2] = False
+    params = dict(voxels=int(adose.size),rois=nrois)
+    return lambda: get_dvhs_from_masks(adose,masks,doses=(1.,2.)),params
+
+@benchmark("mass_image")
+def setup_mass_image(workdir,size):
+    from utils.mass_image import create_mass_image
+    ct = synthetic.ct_image(size["ct_shape"],ct_spacing)
+    hlut = synthetic.write_hlut(os.path.join(workdir,"hlut.txt"))
+    params = dict(voxels=int(np.prod(size["ct_shape"])),hlut_entries=len(np.loadtxt(hlut)))
+    return lambda: create_mass_image(ct,hlut),params
+
+@benchmark("ct_from_dicom")
+def setup_ct_from_dicom(workdir,size):
+    from utils.ct_dicom_to_img import ct_image_from_dicom
+    ctdir = os.path.join(workdir,"ct")
+    ct = synthetic.ct_image(size["ct_shape"],ct_spacing)
+    synthetic.write_ct_series(ctdir,ct)
+    params = dict(slices=size["ct_shape"][0],voxels=int(np.prod(size["ct_shape"])))
+    return lambda: ct_image_from_dicom(ctdir),params
+
+def import_post_processing(workdir):
+    """
+    Imports the post processing script (bin/postprocess_dose_results.py) as a
+    module. The import configures debug logging to a file in the current
+    directory, so we import it in `workdir`, and we detach that log file
+    again: we measure the computation, not the logging.
+    """
+    cwd = os.getcwd()
+    root = logging.getLogger()
+    level = root.level
+    os.chdir(workdir)
+    try:
+        if _bin_dir not in sys.path:
+            sys.path.append(_bin_dir)
+        import postprocess_dose_results as ppdr
+    finally:
+        os.chdir(cwd)
+    root.removeHandler(ppdr.fh)
+    root.setLevel(level)
+    return ppdr
+
+@benchmark("post_processing")
+def setup_post_processing(workdir,size):
+    synthetic.write_job_directory(workdir,size["ct_shape"],ct_spacing,size["njobs"])
+    ppdr = import_post_processing(workdir)
+    cwd = os.getcwd()
+    parser = configparser.ConfigParser()
+    with open(os.path.join(workdir,"postprocessor.cfg"),"r") as fp:
+        parser.read_file(fp)
+    def run():
+        os.chdir(workdir)
+        try:
+            cfg = ppdr.post_proc_config(parser,"B1")
+            if not ppdr.post_processing(cfg,dict(),list()):
+                raise RuntimeError("post processing failed in {}".format(workdir))
+        finally:
+            os.chdir(cwd)
+    params = dict(njobs=size["njobs"],sim_voxels=int(np.prod(size["ct_shape"])))
+    return run,params
+
+def _system_configuration():
+    """
+    The system configuration singleton, with the settings that the job control
+    benchmarks need (the same for all of them, whichever creates it first).
+    """
+    from impl.system_configuration import system_configuration
+    try:
+        return system_configuration.getInstance()
+    except RuntimeError:
+        return system_configuration({"n top voxels for mean dose max":100,
+                                     "dose threshold as fraction in percent of mean dose max":50.,
+                                     "dose accumulation precision":"float64",
+                                     "stop on script actor time interval [s]":300})
+
+@benchmark("dose_collector")
+def setup_dose_collector(workdir,size):
+    dose_files = synthetic.write_job_directory(workdir,size["ct_shape"],ct_spacing,size["njobs"])
+    if _bin_dir not in sys.path:
+        sys.path.append(_bin_dir)
+    import job_control_daemon as jcd
+    _system_configuration()
+    with contextlib.redirect_stdout(io.StringIO()):
+        cfg = jcd.dose_monitoring_config(workdir,"benchmark",uncertainty_goal_percent=1.)
+    dosemhd = cfg.dose_mhd_list[0]
+    def run():
+        with contextlib.redirect_stdout(io.StringIO()):
+            dc = jcd.check_accuracy_for_beam(cfg,"B1",dosemhd,dose_files)
+        if dc.n != len(dose_files):
+            raise RuntimeError("dose collector used {} out of {} dose files".format(dc.n,len(dose_files)))
+    params = dict(njobs=size["njobs"],sim_voxels=int(np.prod(size["ct_shape"])))
+    return run,params
+
+def _dose_snapshots(workdir,size,fmt,nonzero_fraction=0.1):
+    """
+    Subjob doses of a phantom job (no resampling) in which only a fraction of
+    the voxels gets dose, published as snapshots in the given format (see
+    `utils.dose_snapshot`). Returns the publish function, the snapshot dose
+    files, the job control configuration and the problem parameters,
+    including the average number of bytes written per snapshot.
+    """
+    from types import SimpleNamespace
+    from utils.dose_snapshot import publish_snapshot, publish_sparse_snapshot, read_manifest, manifest_path, snapshot_formats
+    publish_func = dict(mhd=publish_snapshot,sparse=publish_sparse_snapshot)[fmt]
+    geometry = synthetic.ct_image(size["ct_shape"],ct_spacing)
+    dose_files = synthetic.write_gate_output(workdir,geometry,njobs=size["njobs"],nonzero_fraction=nonzero_fraction)
+    def publish():
+        snapshot_files = list()
+        for dose_file in dose_files:
+            outputdir = os.path.basename(os.path.dirname(dose_file))
+            destdir = os.path.join(workdir,"tmp",outputdir)
+            os.makedirs(destdir,exist_ok=True)
+            publish_func(dose_file,destdir,stat_file=os.path.join(os.path.dirname(dose_file),"statActor-B1.txt"))
+            snapshot_files.append(os.path.join(destdir,os.path.basename(dose_file)))
+        return snapshot_files
+    snapshot_files = publish()
+    nbytes = 0
+    for snapshot_file in snapshot_files:
+        snapshot = read_manifest(manifest_path(snapshot_file))
+        nbytes += sum(os.path.getsize(snapshot[key]) for key in snapshot_formats[fmt])
+    shape = np.array(size["ct_shape"][::-1],dtype=float)
+    cfg = SimpleNamespace(workdir=workdir,out_dose_nxyz=shape,sim_dose_nxyz=shape,mask_mhd=None,mass_mhd=None)
+    params = dict(njobs=size["njobs"],sim_voxels=int(np.prod(size["ct_shape"])),nonzero_fraction=nonzero_fraction,
+                  format=fmt,bytes_per_snapshot=nbytes//len(snapshot_files))
+    return publish,snapshot_files,cfg,params
+
+def _dose_snapshot_ingest(workdir,size,fmt):
+    if _bin_dir not in sys.path:
+        sys.path.append(_bin_dir)
+    import job_control_daemon as jcd
+    _system_configuration()
+    publish,snapshot_files,cfg,params = _dose_snapshots(workdir,size,fmt)
+    def run():
+        with contextlib.redirect_stdout(io.StringIO()):
+            dc = jcd.dose_collector(cfg)
+            for snapshot_file in snapshot_files:
+                dc.add(snapshot_file)
+        if dc.n != len(snapshot_files):
+            raise RuntimeError("dose collector used {} out of {} dose snapshots".format(dc.n,len(snapshot_files)))
+    return run,params
+
+@benchmark("dose_snapshot_publish_mhd")
+def setup_dose_snapshot_publish_mhd(workdir,size):
+    publish,snapshot_files,cfg,params = _dose_snapshots(workdir,size,"mhd")
+    return publish,params
+
+@benchmark("dose_snapshot_publish_sparse")
+def setup_dose_snapshot_publish_sparse(workdir,size):
+    publish,snapshot_files,cfg,params = _dose_snapshots(workdir,size,"sparse")
+    return publish,params
+
+@benchmark("dose_snapshot_ingest_mhd")
+def setup_dose_snapshot_ingest_mhd(workdir,size):
+    return _dose_snapshot_ingest(workdir,size,"mhd")
+
+@benchmark("dose_snapshot_ingest_sparse")
+def setup_dose_snapshot_ingest_sparse(workdir,size):
+    return _dose_snapshot_ingest(workdir,size,"sparse")
+
+@benchmark("job_monitor_service")
+def setup_job_monitor_service(workdir,size,njobs=30):
+    """
+    One round of checks of `njobs` running jobs by the job monitor service
+    (bin/job_monitor_daemon.py), with a memory budget for two checks at a time.
+    """
+    from utils.dose_snapshot import publish_sparse_snapshot
+    from impl.dual_logging import _rss_mb
+    if _bin_dir not in sys.path:
+        sys.path.append(_bin_dir)
+    import job_monitor_daemon as jmd
+    _system_configuration()
+    rss0 = _rss_mb()
+    service = None
+    with contextlib.redirect_stdout(io.StringIO()):
+        for ijob in range(njobs):
+            jobdir = os.path.join(workdir,"rungate.{}".format(ijob))
+            os.makedirs(jobdir)
+            for dose_file in synthetic.write_job_directory(jobdir,size["ct_shape"],ct_spacing,size["njobs"],seed=ijob):
+                outputdir = os.path.dirname(dose_file)
+                os.remove(os.path.join(outputdir,"gate_exit_value.txt"))
+                destdir = os.path.join(jobdir,"tmp",os.path.basename(outputdir))
+                os.makedirs(destdir)
+                publish_sparse_snapshot(dose_file,destdir,stat_file=os.path.join(outputdir,"statActor-B1.txt"))
+            if service is None:
+                estimate = jmd.jcd.job_monitor(jmd.jcd.dose_monitoring_config(jobdir,"benchmark")).memory_estimate()
+                service = jmd.job_monitor_service(os.path.join(workdir,"job_monitor.sock"),nworkers=4,memory_budget_mb=2*estimate/1024.**2)
+            service.start_job(jobdir,"benchmark",time_out_minutes=60,polling_interval_seconds=0)
+    params = dict(jobs=njobs,subjobs=size["njobs"],sim_voxels=int(np.prod(size["ct_shape"])),
+                  memory_estimate_mb=estimate/1024.**2,memory_budget_mb=service.budget.nbytes/1024.**2)
+    def run():
+        with contextlib.redirect_stdout(io.StringIO()):
+            for future in service.poll_due():
+                future.result()
+        if len(service.jobs) != njobs:
+            raise RuntimeError("{} out of {} jobs are still monitored".format(len(service.jobs),njobs))
+        rss = _rss_mb()
+        params.update(memory_reserved_peak_mb=service.budget.peak/1024.**2,
+                      rss_mb=rss,rss_growth_mb=rss-rss0 if rss is not None and rss0 is not None else None)
+    return run,params
+
+@benchmark("beamset_info")
+def setup_beamset_info(workdir,size):
+    from utils.beamset_info import beamset_info
+    rpfp = os.path.join(workdir,"RP.dcm")
+    synthetic.write_ion_plan(rpfp,nbeams=2,nlayers=size["nlayers"],nspots=size["nspots"])
+    params = dict(beams=2,spots=2*size["nlayers"]*size["nspots"])
+    return lambda: beamset_info(rpfp),params
+
+def _git_commit():
+    try:
+        srcdir = os.path.dirname(os.path.abspath(__file__))
+        commit = subprocess.run(["git","rev-parse","HEAD"],cwd=srcdir,capture_output=True,text=True,check=True).stdout.strip()
+        dirty = bool(subprocess.run(["git","status","--porcelain","--untracked-files=no"],cwd=srcdir,capture_output=True,text=True,check=True).stdout.strip())
+        return commit,dirty
+    except Exception as e:
+        logger.warning("could not determine the git commit: {}".format(e))
+        return "",False
+
+def time_function(func,repeat=5):
+    """
+    Calls `func` once to warm up (lazy imports, caches), then `repeat` times
+    with timing. Returns the list of wall times in seconds.
+    """
+    func()
+    times = list()
+    for i in range(repeat):
+        t0 = time.perf_counter()
+        func()
+        times.append(time.perf_counter()-t0)
+    return times
+
+def run_benchmarks(size="small",names=None,repeat=5,verbose=False):
+    """
+    Runs the benchmarks with the given names (default: all) for one of the
+    problem `sizes`, returns the report as a dictionary.
+    """
+    if size not in sizes:
+        raise RuntimeError("unknown benchmark size '{}', choose from {}".format(size,", ".join(sizes.keys())))
+    names = benchmark_names() if not names else names
+    unknown = [name for name in names if name not in _registry]
+    if unknown:
+        raise RuntimeError("unknown benchmark(s) {}, choose from {}".format(", ".join(unknown),", ".join(benchmark_names())))
+    commit,dirty = _git_commit()
+    report = dict(commit=commit,dirty=dirty,date=datetime.now().isoformat(timespec="seconds"),
+                  host=socket.gethostname(),platform=platform.platform(),ncpu=os.cpu_count(),
+                  python=platform.python_version(),numpy=np.__version__,itk=itk.Version.GetITKVersion(),
+                  pydicom=pydicom.__version__,size=size,size_parameters=sizes[size],repeat=repeat,results=dict())
+    for name in names:
+        with tempfile.TemporaryDirectory(prefix="ideal_benchmark_") as workdir:
+            func,params = _registry[name](workdir,sizes[size])
+            times = time_function(func,repeat)
+        report["results"][name] = dict(params=params,times=times,min=min(times),median=float(np.median(times)))
+        if verbose:
+            print("{:26s} min {:9.4f} s  median {:9.4f} s  {}".format(name,min(times),np.median(times),params))
+    return report
+
+def compare(base,new,threshold=1.1):
+    """
+    Compares the minimum wall times of the benchmarks in two reports. Returns a
+    list of (name, base time, new time, ratio, verdict) tuples; the verdict is
+    "slower" if the ratio new/base exceeds `threshold`, "faster" if it is less
+    than 1/threshold, otherwise "same".
+    """
+    rows = list()
+    for name,res in new["results"].items():
+        if name not in base["results"]:
+            continue
+        tbase = base["results"][name]["min"]
+        tnew = res["min"]
+        ratio = tnew/tbase if tbase > 0 else np.inf
+        verdict = "slower" if ratio > threshold else "faster" if ratio < 1./threshold else "same"
+        rows.append((name,tbase,tnew,ratio,verdict))
+    return rows
+
+###############################################################################################
+# UNIT TESTING
+###############################################################################################
+
+import unittest
+
+class test_benchmark_suite(unittest.TestCase):
+    def test_all_benchmarks_run(self):
+        report = run_benchmarks("tiny",repeat=1)
+        self.assertEqual(set(report["results"].keys()),set(benchmark_names()))
+        for name,res in report["results"].items():
+            self.assertEqual(len(res["times"]),1)
+            self.assertGreater(res["min"],0.)
+        # the ROI benchmarks scale with the size too
+        for name in ("roi_geometry","roi_construction_dicom","roi_construction_npz","roi_bounding_boxes_objects","roi_bounding_boxes_batched"):
+            self.assertEqual(report["results"][name]["params"]["rois"],sizes["tiny"]["roi_norgans"]+3)
+            self.assertEqual(report["results"][name]["params"]["slices"],sizes["tiny"]["roi_nslices"])
+        # JSON round trip
+        self.assertEqual(json.loads(json.dumps(report))["results"].keys(),report["results"].keys())
+    def test_unknown(self):
+        with self.assertRaises(RuntimeError):
+            run_benchmarks("tiny",names=["no such benchmark"])
+        with self.assertRaises(RuntimeError):
+            run_benchmarks("huge")
+    def test_compare(self):
+        base = dict(results=dict(a=dict(min=1.),b=dict(min=1.),c=dict(min=1.),d=dict(min=1.)))
+        new = dict(results=dict(a=dict(min=1.05),b=dict(min=1.5),c=dict(min=0.5),e=dict(min=1.)))
+        rows = compare(base,new,threshold=1.1)
+        self.assertEqual([(r[0],r[4]) for r in rows],[("a","same"),("b","slower"),("c","faster")])
+        self.assertAlmostEqual(rows[1][3],1.5)
+
+###############################################################################################
+# MAIN
+###############################################################################################
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='run the IDEAL benchmark suite on synthetic data, or compare two benchmark reports')
+    parser.add_argument('-S','--size',choices=list(sizes.keys()),default='small',help='problem size')
+    parser.add_argument('-b','--benchmark',action='append',choices=benchmark_names(),help='run only this benchmark (may be given several times)')
+    parser.add_argument('-r','--repeat',type=int,default=5,help='number of timed repetitions (after one warm-up run)')
+    parser.add_argument('-o','--output',default='',help='write the report to this JSON file')
+    parser.add_argument('-c','--compare',nargs=2,metavar=('BASE','NEW'),help='compare two JSON reports; the exit code is 1 if any benchmark got slower')
+    parser.add_argument('-t','--threshold',type=float,default=1.1,help='ratio of the new/base minimum wall time above which a benchmark counts as slower')
+    args = parser.parse_args()
+    if args.compare:
+        reports = list()
+        for path in args.compare:
+            with open(path,"r") as fp:
+                reports.append(json.load(fp))
+        base,new = reports
+        print("base: commit {} ({}), size {}".format(base["commit"][:10],base["date"],base["size"]))
+        print("new:  commit {} ({}), size {}".format(new["commit"][:10],new["date"],new["size"]))
+        if base["size"] != new["size"] or base["host"] != new["host"]:
+            print("WARNING: different sizes and/or hosts, the comparison may be meaningless")
+        rows = compare(base,new,args.threshold)
+        for name,tbase,tnew,ratio,verdict in rows:
+            print("{:26s} {:9.4f} s -> {:9.4f} s  ratio {:6.3f}  {}".format(name,tbase,tnew,ratio,verdict))
+        sys.exit(1 if any([row[4]=="slower" for row in rows]) else 0)
+    report = run_benchmarks(args.size,args.benchmark,args.repeat,verbose=True)
+    if args.output:
+        with open(args.output,"w") as fp:
+            json.dump(report,fp,indent=2)
+        print("wrote report to {}".format(args.output))
+
+# vim: set et softtabstop=4 sw=4 smartindent:
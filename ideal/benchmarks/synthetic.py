@@ -0,0 +1,592 @@
+# -----------------------------------------------------------------------------
+#   Copyright (C): MedAustron GmbH, ACMIT Gmbh and Medical University Vienna
+#   This software is distributed under the terms
+#   of the GNU Lesser General  Public Licence (LGPL)
+#   See LICENSE for further details
+# -----------------------------------------------------------------------------
+
+"""
+Deterministic synthetic input data for the benchmarks and tests: CT images and
+CT DICOM series, RT structure sets, RT ion plans, RT doses and GATE output
+directories (dose MHD files, stat actor files and exit values), with the same
+layout and the same DICOM attributes as IDEAL gets from a TPS and from GATE.
+
+The same arguments (in particular the same `seed`) always yield the same data,
+including the DICOM UIDs.
+"""
+
+import os
+import numpy as np
+import itk
+import pydicom
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.sequence import Sequence
+from pydicom.uid import ExplicitVRLittleEndian, generate_uid
+import logging
+logger=logging.getLogger(__name__)
+
+CT_IMAGE_STORAGE = pydicom.uid.UID("1.2.840.10008.5.1.4.1.1.2")
+RT_DOSE_STORAGE = pydicom.uid.UID("1.2.840.10008.5.1.4.1.1.481.2")
+RT_STRUCTURE_SET_STORAGE = pydicom.uid.UID("1.2.840.10008.5.1.4.1.1.481.3")
+RT_ION_PLAN_STORAGE = pydicom.uid.UID("1.2.840.10008.5.1.4.1.1.481.8")
+
+# HU values of the phantom materials
+HU_AIR = -1000
+HU_LUNG = -750
+HU_TISSUE = 0
+HU_BONE = 1000
+
+def uid(*labels):
+    """
+    Deterministic DICOM UID, different for each combination of labels.
+    """
+    return generate_uid(entropy_srcs=["IDEAL synthetic"]+[str(label) for label in labels])
+
+def image_geometry(shape,spacing):
+    """
+    Origin (x,y,z) of an image with `shape` (nz,ny,nx) and `spacing` (x,y,z),
+    such that the image is centered around the coordinate origin, and the
+    voxel center coordinates along each axis.
+    """
+    nxyz = np.array(shape[::-1])
+    spacing = np.array(spacing,dtype=float)
+    origin = -0.5*(nxyz-1)*spacing
+    centers = [o+d*np.arange(n) for o,d,n in zip(origin,spacing,nxyz)]
+    return origin,centers
+
+def _image(array,origin,spacing):
+    img = itk.image_from_array(np.ascontiguousarray(array))
+    img.SetOrigin(tuple(float(o) for o in origin))
+    img.SetSpacing(tuple(float(s) for s in spacing))
+    return img
+
+def ct_array(shape=(60,128,128),spacing=(2.,2.,3.),seed=0):
+    """
+    HU values (int16, indices z,y,x) of a simple thorax-like phantom: an
+    elliptic body (tissue) in air, with two lungs and a spine, plus some noise.
+    """
+    act = np.repeat(_ct_slice(shape,spacing)[np.newaxis,:,:],shape[0],axis=0)
+    rng = np.random.default_rng(seed)
+    act += rng.normal(0.,10.,shape).astype(np.int16)
+    # like a scanner: nothing below -1024
+    np.clip(act,-1024,None,out=act)
+    return act
+
+def _ct_slice(shape,spacing):
+    # HU values (int16, indices y,x) of one slice of the phantom, without noise
+    origin,(x,y,z) = image_geometry(shape,spacing)
+    width,height = x[-1]-x[0], y[-1]-y[0]
+    xx,yy = np.meshgrid(x,y)
+    ahu = np.full(shape[1:],HU_AIR,dtype=np.int16)
+    ahu[(xx/(0.45*width))**2+(yy/(0.35*height))**2<1] = HU_TISSUE
+    for xlung in (-0.2*width,0.2*width):
+        ahu[((xx-xlung)/(0.12*width))**2+(yy/(0.2*height))**2<1] = HU_LUNG
+    ahu[(xx/(0.05*width))**2+((yy-0.22*height)/(0.05*height))**2<1] = HU_BONE
+    return ahu
+
+def ct_image(shape=(60,128,128),spacing=(2.,2.,3.),seed=0):
+    """
+    The phantom of `ct_array` as an ITK image (int16), centered around the origin.
+    """
+    origin,_ = image_geometry(shape,spacing)
+    return _image(ct_array(shape,spacing,seed),origin,spacing)
+
+def _save(ds,fpath,sop_class,sop_uid):
+    meta = FileMetaDataset()
+    meta.MediaStorageSOPClassUID = sop_class
+    meta.MediaStorageSOPInstanceUID = sop_uid
+    meta.TransferSyntaxUID = ExplicitVRLittleEndian
+    ds.file_meta = meta
+    ds.is_little_endian = True
+    ds.is_implicit_VR = False
+    ds.SOPClassUID = sop_class
+    ds.SOPInstanceUID = sop_uid
+    ds.save_as(fpath,write_like_original=False)
+
+def _patient_and_study(ds,seed):
+    ds.PatientID = "SYNTH{}".format(seed)
+    ds.PatientName = "Synthetic^Phantom"
+    ds.PatientBirthDate = "19700101"
+    ds.PatientSex = "O"
+    ds.StudyInstanceUID = uid("study",seed)
+    ds.FrameOfReferenceUID = uid("frame of reference",seed)
+    ds.StudyDate = "20240101"
+    ds.StudyTime = "120000"
+
+def ct_slice_uids(nslices,seed=0):
+    return [uid("ct slice",seed,i) for i in range(nslices)]
+
+def write_ct_series(dirpath,ct,seed=0):
+    """
+    Writes the ITK image `ct` as a CT DICOM series, one file per slice. The
+    pixel values are stored as unsigned integers with a rescale intercept,
+    like most scanners do. Returns the series UID and the list of file paths.
+    """
+    os.makedirs(dirpath,exist_ok=True)
+    act = itk.array_view_from_image(ct)
+    origin = np.array(ct.GetOrigin())
+    spacing = np.array(ct.GetSpacing())
+    series_uid = uid("ct series",seed)
+    flist = list()
+    for i,sop_uid in enumerate(ct_slice_uids(act.shape[0],seed)):
+        ds = Dataset()
+        _patient_and_study(ds,seed)
+        ds.Modality = "CT"
+        ds.SeriesInstanceUID = series_uid
+        ds.InstanceNumber = i+1
+        ds.ImagePositionPatient = [float(origin[0]),float(origin[1]),float(origin[2]+i*spacing[2])]
+        ds.ImageOrientationPatient = [1,0,0,0,1,0]
+        ds.PixelSpacing = [float(spacing[1]),float(spacing[0])]
+        ds.SliceThickness = float(spacing[2])
+        ds.RescaleIntercept = -1024
+        ds.RescaleSlope = 1
+        ds.Rows,ds.Columns = act.shape[1:]
+        ds.BitsAllocated = ds.BitsStored = 16
+        ds.HighBit = 15
+        ds.PixelRepresentation = 0
+        ds.SamplesPerPixel = 1
+        ds.PhotometricInterpretation = "MONOCHROME2"
+        ds.PixelData = (act[i].astype(np.int32)+1024).clip(0,65535).astype(np.uint16).tobytes()
+        fpath = os.path.join(dirpath,"CT.{:04d}.dcm".format(i+1))
+        _save(ds,fpath,CT_IMAGE_STORAGE,sop_uid)
+        flist.append(fpath)
+    return series_uid,flist
+
+def _ellipse(cx,cy,ax,ay,z,npoints):
+    phi = np.linspace(0.,2*np.pi,npoints,endpoint=False)
+    return np.stack([cx+ax*np.cos(phi),cy+ay*np.sin(phi),np.full(npoints,z)],axis=1)
+
+def structure_set(ct,seed=0,npoints=64,norgans=0):
+    """
+    RT structure set (a `pydicom` dataset, not saved) for the phantom of
+    `ct_image`, with an 'External' ROI (the body outline, on every slice), a
+    spherical 'PTV' ROI in the center and a 'Spine' ROI, and `norgans`
+    elliptic cylinders 'Organ1', 'Organ2', ... with random positions and
+    sizes inside the body. Each contour has `npoints` points and refers to the
+    CT slice UIDs of `write_ct_series`.
+    """
+    nxyz = np.array(itk.size(ct))
+    origin = np.array(ct.GetOrigin())
+    spacing = np.array(ct.GetSpacing())
+    width,height = (nxyz[:2]-1)*spacing[:2]
+    zslices = origin[2]+spacing[2]*np.arange(nxyz[2])
+    slice_uids = ct_slice_uids(nxyz[2],seed)
+    rptv = 0.15*min(width,height,(nxyz[2]-1)*spacing[2])
+    rois = [("External","EXTERNAL",lambda z: (0.,0.,0.45*width,0.35*height)),
+            ("PTV","PTV",lambda z: (0.,0.,np.sqrt(rptv**2-z**2),np.sqrt(rptv**2-z**2)) if abs(z)<0.99*rptv else None),
+            ("Spine","ORGAN",lambda z: (0.,0.22*height,0.05*width,0.05*height))]
+    rng = np.random.default_rng(seed)
+    for i in range(norgans):
+        cx,cy = rng.uniform(-0.25,0.25,2)*(width,height)
+        ax,ay = rng.uniform(0.02,0.1,2)*(width,height)
+        rois.append(("Organ{}".format(i+1),"ORGAN",lambda z,e=(cx,cy,ax,ay): e))
+    ds = Dataset()
+    _patient_and_study(ds,seed)
+    ds.Modality = "RTSTRUCT"
+    ds.SOPClassUID = RT_STRUCTURE_SET_STORAGE
+    ds.SOPInstanceUID = uid("rs",seed)
+    ds.SeriesInstanceUID = uid("rs series",seed)
+    ds.StructureSetLabel = "SYNTHETIC"
+    ds.StructureSetROISequence = Sequence()
+    ds.ROIContourSequence = Sequence()
+    ds.RTROIObservationsSequence = Sequence()
+    for roinr,(name,roitype,shape) in enumerate(rois,start=1):
+        ssroi = Dataset()
+        ssroi.ROINumber = roinr
+        ssroi.ROIName = name
+        ssroi.ReferencedFrameOfReferenceUID = ds.FrameOfReferenceUID
+        ssroi.ROIGenerationAlgorithm = "MANUAL"
+        ds.StructureSetROISequence.append(ssroi)
+        obs = Dataset()
+        obs.ObservationNumber = roinr
+        obs.ReferencedROINumber = roinr
+        obs.RTROIInterpretedType = roitype
+        ds.RTROIObservationsSequence.append(obs)
+        roic = Dataset()
+        roic.ReferencedROINumber = roinr
+        roic.ContourSequence = Sequence()
+        for z,slice_uid in zip(zslices,slice_uids):
+            ellipse = shape(z)
+            if ellipse is None:
+                continue
+            ref = Dataset()
+            ref.ReferencedSOPClassUID = CT_IMAGE_STORAGE
+            ref.ReferencedSOPInstanceUID = slice_uid
+            contour = Dataset()
+            contour.ContourImageSequence = Sequence([ref])
+            contour.ContourGeometricType = "CLOSED_PLANAR"
+            contour.NumberOfContourPoints = npoints
+            contour.ContourData = [round(float(c),3) for c in _ellipse(*ellipse,z,npoints).flat]
+            roic.ContourSequence.append(contour)
+        ds.ROIContourSequence.append(roic)
+    return ds
+
+def write_structure_set(fpath,ct,seed=0,npoints=64,norgans=0):
+    ds = structure_set(ct,seed,npoints,norgans)
+    _save(ds,fpath,RT_STRUCTURE_SET_STORAGE,uid("rs",seed))
+    return ds
+
+def ion_plan(nbeams=2,nlayers=20,nspots=100,seed=0,radiation_type="PROTON",machine="IR2HBL"):
+    """
+    RT ion plan (a `pydicom` dataset, not saved) with `nbeams` beams, each
+    with `nlayers` energy layers of `nspots` spots on a square grid, with
+    random weights. The number of spots per beam is `nlayers*nspots`.
+    """
+    rng = np.random.default_rng(seed)
+    ds = Dataset()
+    _patient_and_study(ds,seed)
+    ds.Modality = "RTPLAN"
+    ds.SeriesInstanceUID = uid("rp series",seed)
+    ds.RTPlanLabel = "SYNTHETIC"
+    ds.RTPlanName = "SYNTHETIC"
+    ds.ReferringPhysicianName = "Synthetic^Physician"
+    ds.PlanIntent = "RESEARCH"
+    ds.OperatorsName = "Synthetic^Operator"
+    refrs = Dataset()
+    refrs.ReferencedSOPClassUID = RT_STRUCTURE_SET_STORAGE
+    refrs.ReferencedSOPInstanceUID = uid("rs",seed)
+    ds.ReferencedStructureSetSequence = Sequence([refrs])
+    fraction_group = Dataset()
+    fraction_group.FractionGroupNumber = 1
+    fraction_group.NumberOfFractionsPlanned = 1
+    fraction_group.NumberOfBeams = nbeams
+    fraction_group.ReferencedBeamSequence = Sequence()
+    ds.IonBeamSequence = Sequence()
+    nside = int(np.ceil(np.sqrt(nspots)))
+    grid = 5.*(np.arange(nside)-0.5*(nside-1))
+    xy = np.stack(np.meshgrid(grid,grid),axis=-1).reshape(-1,2)[:nspots]
+    for ibeam in range(nbeams):
+        beam = Dataset()
+        beam.BeamNumber = ibeam+1
+        beam.BeamName = "B{}".format(ibeam+1)
+        beam.BeamType = "STATIC"
+        beam.RadiationType = radiation_type
+        beam.TreatmentMachineName = machine
+        beam.TreatmentDeliveryType = "TREATMENT"
+        beam.PrimaryDosimeterUnit = "MU"
+        beam.ScanMode = "MODULATED"
+        beam.NumberOfRangeShifters = 0
+        beam.NumberOfRangeModulators = 0
+        beam.NumberOfCompensators = 0
+        beam.NumberOfBoli = 0
+        beam.NumberOfBlocks = 0
+        beam.NumberOfWedges = 0
+        beam.IonControlPointSequence = Sequence()
+        cumulative = 0.
+        for ilayer in range(nlayers):
+            weights = np.round(rng.uniform(0.01,1.,nspots),4)
+            cp = Dataset()
+            cp.ControlPointIndex = ilayer
+            cp.NominalBeamEnergy = round(150.-ilayer*(100./max(nlayers,1)),2)
+            cp.NumberOfScanSpotPositions = nspots
+            cp.ScanSpotPositionMap = [float(v) for v in xy.flat]
+            cp.ScanSpotMetersetWeights = [float(w) for w in weights]
+            cp.CumulativeMetersetWeight = round(cumulative,6)
+            cp.ScanSpotTuneID = "3.0"
+            cp.NumberOfPaintings = 1
+            if ilayer == 0:
+                cp.GantryAngle = float((90*ibeam)%360)
+                cp.PatientSupportAngle = 0.
+                cp.IsocenterPosition = [0.,0.,0.]
+            beam.IonControlPointSequence.append(cp)
+            cumulative += float(np.sum(weights))
+        beam.NumberOfControlPoints = len(beam.IonControlPointSequence)
+        beam.FinalCumulativeMetersetWeight = round(cumulative,6)
+        ds.IonBeamSequence.append(beam)
+        refbeam = Dataset()
+        refbeam.ReferencedBeamNumber = ibeam+1
+        refbeam.BeamMeterset = round(cumulative,6)
+        fraction_group.ReferencedBeamSequence.append(refbeam)
+    ds.FractionGroupSequence = Sequence([fraction_group])
+    return ds
+
+def write_ion_plan(fpath,seed=0,**kwargs):
+    ds = ion_plan(seed=seed,**kwargs)
+    _save(ds,fpath,RT_ION_PLAN_STORAGE,uid("rp",seed))
+    return ds
+
+def dose_array(shape,spacing,seed=None,noise=0.,nonzero_fraction=1.):
+    """
+    Dose distribution (float32, indices z,y,x) of a single field, entering
+    from the -y side: a plateau followed by a Bragg peak around the center of
+    the image, with a Gaussian lateral profile. With a `seed`, Gaussian noise
+    with relative standard deviation `noise` is added. With a `nonzero_fraction`
+    below 1, only that fraction of the voxels (those with the highest dose)
+    is kept and the rest is zero, like in the mostly empty dose grids of
+    real treatment fields.
+    """
+    lz,dd,lx = _dose_profiles(shape,spacing)
+    adose = (lz[:,np.newaxis,np.newaxis]*dd[np.newaxis,:,np.newaxis]*lx[np.newaxis,np.newaxis,:]).astype(np.float32)
+    if seed is not None and noise > 0:
+        rng = np.random.default_rng(seed)
+        adose *= (1.+noise*rng.standard_normal(shape,dtype=np.float32)).clip(0.,None)
+    if nonzero_fraction < 1.:
+        adose[adose < np.quantile(adose,1.-nonzero_fraction)] = 0.
+    return adose
+
+def _dose_profiles(shape,spacing):
+    # longitudinal and lateral profiles of the dose of `dose_array`, along z, y and x
+    origin,(x,y,z) = image_geometry(shape,spacing)
+    height = y[-1]-y[0]
+    sigma = 0.05*height
+    depth = y-y[0]
+    peak = 0.55*height
+    dd = np.where(depth<peak,1.+3.*np.exp(-0.5*((depth-peak)/sigma)**2),4.*np.exp(-0.5*((depth-peak)/(0.3*sigma))**2))
+    width = 0.15*max(x[-1]-x[0],z[-1]-z[0],1.)
+    lx = np.exp(-0.5*(x/width)**2)
+    lz = np.exp(-0.5*(z/width)**2)
+    return lz,dd,lx
+
+def dose_image(shape,spacing,seed=None,noise=0.):
+    origin,_ = image_geometry(shape,spacing)
+    return _image(dose_array(shape,spacing,seed,noise),origin,spacing)
+
+def write_rt_dose(fpath,dose,rpuid,beamnr=None,seed=0,dose_type="PHYSICAL"):
+    """
+    Writes the ITK dose image `dose` as an RT dose file that refers to the
+    plan with UID `rpuid`: a beam dose if a beam number is given, otherwise
+    a plan dose.
+    """
+    adose = itk.array_view_from_image(dose)
+    dmax = float(np.max(adose))
+    scaling = dmax/60000. if dmax > 0 else 1.
+    origin = np.array(dose.GetOrigin())
+    spacing = np.array(dose.GetSpacing())
+    ds = Dataset()
+    _patient_and_study(ds,seed)
+    ds.Modality = "RTDOSE"
+    ds.SeriesInstanceUID = uid("rd series",seed,beamnr,dose_type)
+    refrp = Dataset()
+    refrp.ReferencedSOPClassUID = RT_ION_PLAN_STORAGE
+    refrp.ReferencedSOPInstanceUID = rpuid
+    if beamnr is not None:
+        refbeam = Dataset()
+        refbeam.ReferencedBeamNumber = beamnr
+        reffg = Dataset()
+        reffg.ReferencedFractionGroupNumber = 1
+        reffg.ReferencedBeamSequence = Sequence([refbeam])
+        refrp.ReferencedFractionGroupSequence = Sequence([reffg])
+    ds.ReferencedRTPlanSequence = Sequence([refrp])
+    ds.DoseUnits = "GY"
+    ds.DoseType = dose_type
+    ds.DoseSummationType = "PLAN" if beamnr is None else "BEAM"
+    ds.DoseGridScaling = scaling
+    ds.NumberOfFrames = adose.shape[0]
+    ds.GridFrameOffsetVector = [float(spacing[2]*i) for i in range(adose.shape[0])]
+    ds.ImagePositionPatient = [float(v) for v in origin]
+    ds.ImageOrientationPatient = [1,0,0,0,1,0]
+    ds.PixelSpacing = [float(spacing[1]),float(spacing[0])]
+    ds.SliceThickness = float(spacing[2])
+    ds.Rows,ds.Columns = adose.shape[1:]
+    ds.BitsAllocated = ds.BitsStored = 32
+    ds.HighBit = 31
+    ds.PixelRepresentation = 0
+    ds.SamplesPerPixel = 1
+    ds.PhotometricInterpretation = "MONOCHROME2"
+    ds.PixelData = np.round(adose/scaling).astype(np.uint32).tobytes()
+    _save(ds,fpath,RT_DOSE_STORAGE,uid("rd",seed,beamnr,dose_type))
+    return ds
+
+def write_hlut(fpath):
+    """
+    Two column (HU, density in g/cm3) lookup table for `create_mass_image`.
+    """
+    table = np.array([[-1024.,0.00121],[-1000.,0.00121],[-750.,0.26],[-100.,0.93],[0.,1.0],[100.,1.07],[1000.,1.6],[3000.,2.8]])
+    np.savetxt(fpath,table,fmt="%.5g")
+    return fpath
+
+def write_gate_output(workdir,geometry,njobs=10,label="B1",nprimaries=10000,clusterid=1,seed=0,dose2water=True,noise=0.3,nonzero_fraction=1.):
+    """
+    Output directories of `njobs` GATE subjobs of one beam, with the names
+    used by IDEAL (`output.<cluster>.<process>`), each with a dose MHD file,
+    a stat actor file and the GATE exit value. The dose grid is the grid of
+    the ITK image `geometry` (e.g. the CT image), see `dose_array` for the
+    `noise` and `nonzero_fraction`. Returns the list of dose files.
+    """
+    shape = tuple(itk.size(geometry))[::-1]
+    spacing = np.array(geometry.GetSpacing())
+    origin = np.array(geometry.GetOrigin())
+    dosemhd = "idc-{}-{}.mhd".format(label,"DoseToWater" if dose2water else "Dose")
+    rng = np.random.default_rng(seed)
+    dose_files = list()
+    for ijob in range(njobs):
+        outputdir = os.path.join(workdir,"output.{}.{}".format(clusterid,ijob))
+        os.makedirs(outputdir,exist_ok=True)
+        nprim = int(nprimaries*rng.uniform(0.8,1.2))
+        adose = dose_array(shape,spacing,seed=int(rng.integers(2**31)),noise=noise,nonzero_fraction=nonzero_fraction)
+        adose *= nprim*1e-6
+        fpath = os.path.join(outputdir,dosemhd)
+        itk.imwrite(_image(adose,origin,spacing),fpath)
+        dose_files.append(fpath)
+        telapsed = 0.01*nprim*rng.uniform(0.9,1.1)
+        with open(os.path.join(outputdir,"statActor-{}.txt".format(label)),"w") as fp:
+            fp.write("# NumberOfRun    = 1\n")
+            fp.write("# NumberOfEvents = {}\n".format(nprim))
+            fp.write("# NumberOfTracks = {}\n".format(20*nprim))
+            fp.write("# NumberOfSteps  = {}\n".format(400*nprim))
+            fp.write("# PPS (Primary per sec)      = {:.1f}\n".format(nprim/telapsed))
+            fp.write("# ElapsedTime           = {:.3f}\n".format(telapsed+30.))
+            fp.write("# ElapsedTimeWoInit     = {:.3f}\n".format(telapsed))
+        with open(os.path.join(outputdir,"gate_exit_value.txt"),"w") as fp:
+            fp.write("0\n")
+    return dose_files
+
+def dose_grid(ct,factor=2,shift=0.):
+    """
+    Empty (float32) image with `factor` times the CT spacing, aligned with the
+    lower corner of the CT, e.g. for the output dose grid. With a nonzero
+    `shift` (in units of the CT spacing) the grid is moved away from the lower
+    corner and has one voxel less along each axis, so that it stays inside
+    the CT.
+    """
+    nxyz = np.array(itk.size(ct))//factor - (1 if shift else 0)
+    spacing = factor*np.array(ct.GetSpacing())
+    origin = np.array(ct.GetOrigin())+(shift-0.5)*np.array(ct.GetSpacing())+0.5*spacing
+    return _image(np.zeros(nxyz[::-1],dtype=np.float32),origin,spacing)
+
+def write_dose_and_mass_mhd(workdir,shape,spacing,seed=0,noise=0.1,slab=16):
+    """
+    Writes the dose of `dose_array` (with noise) and a mass density image of
+    the CT phantom of `ct_array` as float32 MHD/raw files "dose.mhd" and
+    "mass.mhd" in `workdir`, `slab` z-slices at a time, such that also
+    volumes that do not fit in memory can be created. Returns the two paths.
+    """
+    origin,_ = image_geometry(shape,spacing)
+    lz,dd,lx = _dose_profiles(shape,spacing)
+    # rough mass density [g/cm3] for the HU values of the phantom
+    density = np.interp(_ct_slice(shape,spacing),[HU_AIR,HU_LUNG,HU_TISSUE,HU_BONE],[0.0012,0.26,1.0,1.6]).astype(np.float32)
+    rng = np.random.default_rng(seed)
+    paths = list()
+    for name in ("dose","mass"):
+        mhd = os.path.join(workdir,name+".mhd")
+        with open(mhd,"w") as fp:
+            fp.write("ObjectType = Image\nNDims = 3\nBinaryData = True\nBinaryDataByteOrderMSB = False\nCompressedData = False\n")
+            fp.write("Offset = {}\nElementSpacing = {}\nDimSize = {}\n".format(" ".join([str(float(o)) for o in origin])," ".join([str(float(s)) for s in spacing])," ".join([str(n) for n in shape[::-1]])))
+            fp.write("ElementType = MET_FLOAT\nElementDataFile = {}.raw\n".format(name))
+        with open(os.path.join(workdir,name+".raw"),"wb") as fp:
+            for iz0 in range(0,shape[0],slab):
+                iz1 = min(shape[0],iz0+slab)
+                if name == "dose":
+                    a = (lz[iz0:iz1,np.newaxis,np.newaxis]*dd[np.newaxis,:,np.newaxis]*lx[np.newaxis,np.newaxis,:]).astype(np.float32)
+                    a *= (1.+noise*rng.standard_normal(a.shape,dtype=np.float32)).clip(0.,None)
+                else:
+                    a = np.repeat(density[np.newaxis,:,:],iz1-iz0,axis=0)
+                fp.write(a.tobytes())
+        paths.append(mhd)
+    return tuple(paths)
+
+def write_job_directory(workdir,ct_shape=(60,128,128),spacing=(2.,2.,3.),njobs=10,label="B1",seed=0):
+    """
+    Work directory of a CT job for one beam after all subjobs have finished:
+    GATE outputs (see `write_gate_output`) on the CT grid, mass image, an
+    external dose mask on a dose grid with twice the CT spacing and the post
+    processing configuration file, as used by the post processing and by
+    the job control daemon. Returns the list of dose files.
+    """
+    from utils.mass_image import create_mass_image
+    import configparser
+    ct = ct_image(ct_shape,spacing,seed)
+    mass = create_mass_image(ct,write_hlut(os.path.join(workdir,"hlut.txt")))
+    itk.imwrite(mass,os.path.join(workdir,"mass.mhd"))
+    grid = dose_grid(ct)
+    mask = _image(np.ones(tuple(itk.size(grid))[::-1],dtype=np.float32),grid.GetOrigin(),grid.GetSpacing())
+    itk.imwrite(mask,os.path.join(workdir,"mask.mhd"))
+    dose_files = write_gate_output(workdir,ct,njobs=njobs,label=label,nprimaries=100000,seed=seed)
+    os.makedirs(os.path.join(workdir,"results"),exist_ok=True)
+    nxyz = np.array(itk.size(grid))
+    parser=configparser.RawConfigParser()
+    parser.optionxform = lambda option : option
+    parser['DEFAULT'].update({
+        "run gamma analysis":"False", "debug":"False", "dose accumulation precision":"float64",
+        "first output dicom":os.path.join(workdir,"results"), "second output dicom":"",
+        "nFractions":"1", "write mhd unscaled dose":"False", "write mhd scaled dose":"False",
+        "write mhd physical dose":"True", "write mhd rbe dose":"True",
+        "write dicom physical dose":"False", "write dicom rbe dose":"False", "write unresampled dose":"no",
+        "dose grid size":" ".join([str(v) for v in nxyz*np.array(grid.GetSpacing())]),
+        "dose grid resolution":" ".join([str(v) for v in nxyz]),
+        "sim dose resolution":" ".join([str(v) for v in itk.size(ct)]),
+        "mhd plan dose":"", "dicom plan dose":"", "plan dcm template":"",
+        "mass mhd":"mass.mhd", "apply external dose mask":"yes", "external dose mask":"mask.mhd", "RBE":"1.1"})
+    parser.add_section(label)
+    parser[label].update({"nJobs":str(njobs), "origname":label, "dosecorrfactor":"1.0",
+                          "dosemhd":"idc-{}.mhd".format(label), "dose2water":"True",
+                          "nTPS":"1e9", "dcm template":"",
+                          "dose grid origin":" ".join([str(v) for v in grid.GetOrigin()])})
+    parser.add_section("user logs file")
+    parser["user logs file"]["path"] = ""
+    with open(os.path.join(workdir,"postprocessor.cfg"),"w") as fp:
+        parser.write(fp)
+    return dose_files
+
+###############################################################################################
+# UNIT TESTING
+###############################################################################################
+
+import unittest
+import tempfile
+
+class test_synthetic(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.ct = ct_image((12,40,48),(2.5,2.,3.),seed=3)
+    def tearDown(self):
+        self.tmpdir.cleanup()
+    def test_deterministic(self):
+        self.assertTrue(np.array_equal(itk.array_view_from_image(self.ct),itk.array_view_from_image(ct_image((12,40,48),(2.5,2.,3.),seed=3))))
+        self.assertEqual(ion_plan(seed=4).IonBeamSequence[1].IonControlPointSequence[3].ScanSpotMetersetWeights,
+                         ion_plan(seed=4).IonBeamSequence[1].IonControlPointSequence[3].ScanSpotMetersetWeights)
+        self.assertEqual(uid("a",1),uid("a",1))
+        self.assertNotEqual(uid("a",1),uid("a",2))
+    def test_ct_series(self):
+        from utils.ct_dicom_to_img import ct_image_from_dicom
+        ctdir = os.path.join(self.tmpdir.name,"ct")
+        series_uid,flist = write_ct_series(ctdir,self.ct,seed=3)
+        self.assertEqual(len(flist),12)
+        ct = ct_image_from_dicom(ctdir)
+        self.assertEqual(ct.uid,series_uid)
+        self.assertTrue(np.array_equal(itk.array_view_from_image(ct.img),itk.array_view_from_image(self.ct)))
+        self.assertTrue(np.allclose(ct.img.GetOrigin(),self.ct.GetOrigin()))
+        self.assertTrue(np.allclose(ct.img.GetSpacing(),self.ct.GetSpacing()))
+    def test_structure_set(self):
+        from utils.roi_utils import region_of_interest, list_roinames
+        rs = write_structure_set(os.path.join(self.tmpdir.name,"RS.dcm"),self.ct,seed=3)
+        self.assertEqual(list_roinames(pydicom.dcmread(os.path.join(self.tmpdir.name,"RS.dcm"))),["External","PTV","Spine"])
+        act = itk.array_view_from_image(self.ct)
+        external = itk.array_view_from_image(region_of_interest(ds=rs,roi_id="External").get_mask(self.ct,corrected=False))>0
+        # the body outline, up to the voxels on the border
+        self.assertGreater(np.mean(act[external]>-900),0.98)
+        self.assertGreater(np.mean(external[act>-900]),0.95)
+        spine = itk.array_view_from_image(region_of_interest(ds=rs,roi_id="Spine").get_mask(self.ct,corrected=False))>0
+        self.assertGreater(np.mean(act[spine]>500),0.8)
+        ptv = itk.array_view_from_image(region_of_interest(ds=rs,roi_id="PTV").get_mask(self.ct,corrected=False))>0
+        self.assertTrue(ptv.any())
+        self.assertTrue(np.all(external[ptv]))
+    def test_plan_and_dose(self):
+        from utils.beamset_info import beamset_info
+        from utils.dose_info import dose_info
+        rpfp = os.path.join(self.tmpdir.name,"RP.dcm")
+        rp = write_ion_plan(rpfp,seed=5,nbeams=3,nlayers=4,nspots=10)
+        dose = dose_image((12,40,48),(2.5,2.,3.))
+        write_rt_dose(os.path.join(self.tmpdir.name,"RD1.dcm"),dose,str(rp.SOPInstanceUID),beamnr=1,seed=5)
+        write_rt_dose(os.path.join(self.tmpdir.name,"RD.dcm"),dose,str(rp.SOPInstanceUID),seed=5)
+        bs = beamset_info(rpfp)
+        self.assertEqual(len(bs.beams),3)
+        self.assertEqual(bs[0].nspots,40)
+        self.assertEqual(sorted(dose_info.get_dose_files(self.tmpdir.name,str(rp.SOPInstanceUID)).keys()),["1","PLAN"])
+    def test_gate_output(self):
+        from utils.mass_image import create_mass_image
+        dose_files = write_gate_output(self.tmpdir.name,self.ct,njobs=3,label="B1",nprimaries=1000,seed=6)
+        self.assertEqual(len(dose_files),3)
+        for f in dose_files:
+            outputdir = os.path.dirname(f)
+            self.assertTrue(os.path.exists(os.path.join(outputdir,"statActor-B1.txt")))
+            self.assertTrue(os.path.exists(os.path.join(outputdir,"gate_exit_value.txt")))
+            dose = itk.imread(f)
+            self.assertEqual(tuple(itk.size(dose)),tuple(itk.size(self.ct)))
+            self.assertTrue(np.allclose(dose.GetOrigin(),self.ct.GetOrigin()))
+        mass = create_mass_image(self.ct,write_hlut(os.path.join(self.tmpdir.name,"hlut.txt")))
+        amass = itk.array_view_from_image(mass)
+        self.assertTrue(np.all(amass>0))
+        self.assertLess(np.max(amass),2.)
+
+# vim: set et softtabstop=4 sw=4 smartindent:
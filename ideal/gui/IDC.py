@@ -14,10 +14,13 @@ from impl.idc_enum_types import MCPriorityType
 from impl.job_executor import job_executor
 from impl.hlut_conf import hlut_conf
 from impl.system_configuration import system_configuration
+from impl.dose_grid_cost import cost_summary
 import os
 import numpy as np
 
 class IDCDoseGridSettings( QtWidgets.QWidget ):
+    # emitted when the preview mode changes the statistics goals
+    previewToggled = QtCore.pyqtSignal(bool)
     def __init__(self,details):
         QtWidgets.QWidget.__init__(self)
         self.details = details
@@ -61,8 +64,15 @@ class IDCDoseGridSettings( QtWidgets.QWidget ):
             for r in range(1,4):
                 self.gridSettingsTable.item(r,c).setFlags(flag)
         self.vBoxLayoutIDCGridSettings.addWidget(self.gridSettingsTable)
+        self.checkboxPreview = QtWidgets.QCheckBox("Preview (coarse dose grid, fewer primaries)")
+        self.checkboxPreview.setToolTip("Quick job to check the setup: the dose grid and the statistics goals are reduced as configured in the [dose grid cost] section of the system configuration.")
+        self.vBoxLayoutIDCGridSettings.addWidget(self.checkboxPreview)
+        self.labelCost = QtWidgets.QLabel("")
+        self.labelCost.setToolTip("Estimate based on the memory and post processing time fits in the system configuration.")
+        self.vBoxLayoutIDCGridSettings.addWidget(self.labelCost)
         self.setLayout(self.vBoxLayoutIDCGridSettings)
         self.buttonDefault.clicked.connect(self.SetDoseGridBackToDefault)
+        self.checkboxPreview.toggled.connect(self.SetPreview)
     def PlanUpdate(self):
         if not self.details.have_dose_grid:
             return
@@ -113,7 +123,25 @@ class IDCDoseGridSettings( QtWidgets.QWidget ):
         for r in range(1,self.gridSettingsTable.rowCount()):
             for c in [self.iRL,self.iIS,self.iAP]:
                 self.gridSettingsTable.item(r,c).setFlags(flag)
+        if self.checkboxPreview.isChecked() != self.details.preview:
+            # e.g. the default settings were restored
+            self.checkboxPreview.blockSignals(True)
+            self.checkboxPreview.setChecked(self.details.preview)
+            self.checkboxPreview.blockSignals(False)
+            self.previewToggled.emit(self.details.preview)
+        self.UpdateCostEstimate()
         #QtWidgets.QWidget.update(self)
+    def UpdateCostEstimate(self):
+        try:
+            self.labelCost.setText(cost_summary(self.details.GetCostEstimate()))
+        except Exception as e:
+            logger.warning("could not compute cost estimate: {}".format(e))
+            self.labelCost.setText("(no cost estimate available)")
+    def SetPreview(self,on):
+        logger.debug("preview mode {}".format("ON" if on else "OFF"))
+        self.details.SetPreviewMode(on)
+        self.previewToggled.emit(on)
+        self.PlanUpdate()
     def update_ctphantom(self):
         self._assume_CT = self.details.run_with_CT_geometry
         self.PlanUpdate()
@@ -209,6 +237,15 @@ class IDCMCStatistics( QtWidgets.QWidget ):
 
         self.quantityButtonGroup.buttonClicked[int].connect(self.UpdateSelectedQuantity)
 
+    def ShowStatistics(self,preview=False):
+        """
+        Show the statistics goals of the details object, e.g. after switching the preview mode.
+        """
+        for imc,value in enumerate(self.details.mc_stat_thr):
+            if value > 0:
+                self.spinboxes[imc].blockSignals(True)
+                self.spinboxes[imc].setValue(value)
+                self.spinboxes[imc].blockSignals(False)
     def UpdateNJobs(self,val):
         logger.debug("update njobs value to {}".format(val))
         self.details.SetNJobs(val)
@@ -277,6 +314,7 @@ class IDCUserParameters( QtWidgets.QWidget ):
         self.hBoxLayoutIDCUserParameters = QtWidgets.QHBoxLayout()
         self.idcDoseGridSettings = IDCDoseGridSettings(details)
         self.idcMCStatistics = IDCMCStatistics(details)
+        self.idcDoseGridSettings.previewToggled.connect(self.idcMCStatistics.ShowStatistics)
         self.hBoxLayoutIDCUserParameters.addWidget(self.idcDoseGridSettings)
         self.hBoxLayoutIDCUserParameters.addWidget(self.idcMCStatistics)
         self.setLayout(self.hBoxLayoutIDCUserParameters)
@@ -18,6 +18,7 @@ from gui.PatientModel import TabPatientModel
 from gui.TreatmentPlanDescription import TabTPdescription
 from gui.IDC import TabIDC
 from gui.JobManagement import TabJobManagement
+from gui.PlanLoader import PlanLoader
 
 class MainWindow(QtWidgets.QMainWindow):
     def __init__(self,details):
@@ -29,7 +30,8 @@ class MainWindow(QtWidgets.QMainWindow):
         self.resize(1250, 600)
         # Add tabs
         self.tabs = QtWidgets.QTabWidget()
-        self.tabs.addTab(TabPatientIO(self,self.current_details),"Patient I/O")
+        self.tabPatientIO = TabPatientIO(self,self.current_details)
+        self.tabs.addTab(self.tabPatientIO,"Patient I/O")
         self.tabs.addTab(TabPatientModel(self.current_details),"Model")
         self.tabs.addTab(TabTPdescription(self.current_details),"Plan description")
         self.tabs.addTab(TabIDC(self.current_details),"IDC Specs && Submit")
@@ -84,6 +86,15 @@ class MainWindow(QtWidgets.QMainWindow):
         self.help_window = QtWidgets.QMessageBox(QtWidgets.QMessageBox.Information,"Help","TO DO: write helpful text here.",QtWidgets.QMessageBox.Ok)
         self.help_window.accepted.connect(self.help_window.hide)
 
+        # plans are read in a worker thread, with progress in the status bar
+        self.threadpool = QtCore.QThreadPool()
+        self._loader = None
+        self.progressBar = QtWidgets.QProgressBar()
+        self.progressBar.setRange(0,len(self.current_details.load_stages))
+        self.progressBar.setMaximumWidth(200)
+        self.progressBar.hide()
+        self.statusBar().addPermanentWidget(self.progressBar)
+
     def ShowVersion(self):
         self.version_info_window.show()
     def ShowHelp(self):
@@ -94,22 +105,62 @@ class MainWindow(QtWidgets.QMainWindow):
         if newfile:
             newfile = str(newfile)
             logger.debug("file dialog returned {}".format(newfile))
-            try:
-                self.current_details.SetPlanFilePath(newfile)
-                self._warnings = self.current_details.GetAndClearWarnings()
-                if self._warnings:
-                    nw=len(self._warnings)
-                    logger.debug("got {} warnings".format(nw))
-                    for iw,w in enumerate(self._warnings):
-                        QtWidgets.QMessageBox.warning(self,"WARNING {}/{}".format(iw+1,nw),w)
-                else:
-                    logger.debug("looks like we read the plan successfully, no serious errors/warnings")
-                self._warnings = list()
-            except Exception as e:
-                logger.error("got exception '{}'".format(str(e)))
-                QtWidgets.QMessageBox.critical(self,"Unrecoverable error while reading {}".format(newfile),str(e))
+            self.LoadPlanFile(newfile)
         else:
             logger.debug("file dialog returned nothing; try again!")
+    def LoadPlanFile(self,newfile):
+        """
+        Start reading a new plan in the background. The tabs are disabled
+        until the plan is read; the patient and plan info are shown as soon
+        as the plan file itself has been read.
+        """
+        if self._loader is not None:
+            logger.warning("still reading {}, ignoring {}".format(self._loader.rpfilepath,newfile))
+            return
+        self._loader = PlanLoader(self.current_details,newfile)
+        self._loader.signals.progress.connect(self.PlanLoadProgress)
+        self._loader.signals.finished.connect(self.PlanLoadFinished)
+        self._loader.signals.failed.connect(self.PlanLoadFailed)
+        self.tabs.setEnabled(False)
+        self.actionNewPlan.setEnabled(False)
+        self.progressBar.setValue(0)
+        self.progressBar.show()
+        self.statusBar().showMessage("reading {} ...".format(newfile))
+        self.threadpool.start(self._loader)
+    def PlanLoadProgress(self,stage):
+        logger.debug("plan loading: got {}".format(stage))
+        self.progressBar.setValue(self.progressBar.value()+1)
+        self.statusBar().showMessage("reading {}: got {}".format(self._loader.rpfilepath,stage))
+        if stage == "plan":
+            self.tabPatientIO.PlanInfoUpdate()
+    def PlanLoadFinished(self,warnings):
+        newfile = self._loader.rpfilepath
+        self._PlanLoadDone()
+        try:
+            self.current_details.PublishPlan()
+        except Exception as e:
+            logger.error("got exception '{}'".format(str(e)))
+            QtWidgets.QMessageBox.critical(self,"Unrecoverable error while reading {}".format(newfile),str(e))
+            return
+        self._warnings = warnings
+        if self._warnings:
+            nw=len(self._warnings)
+            logger.debug("got {} warnings".format(nw))
+            for iw,w in enumerate(self._warnings):
+                QtWidgets.QMessageBox.warning(self,"WARNING {}/{}".format(iw+1,nw),w)
+        else:
+            logger.debug("looks like we read the plan successfully, no serious errors/warnings")
+        self._warnings = list()
+    def PlanLoadFailed(self,msg):
+        newfile = self._loader.rpfilepath
+        self._PlanLoadDone()
+        QtWidgets.QMessageBox.critical(self,"Unrecoverable error while reading {}".format(newfile),msg)
+    def _PlanLoadDone(self):
+        self._loader = None
+        self.progressBar.hide()
+        self.statusBar().clearMessage()
+        self.tabs.setEnabled(True)
+        self.actionNewPlan.setEnabled(True)
     def Quit(self):
         logger.debug("goodbye!")
         sys.exit(0)
@@ -40,5 +40,12 @@ class TabPatientIO( QtWidgets.QWidget ):
         self.bsInfo.SetValues(      *self.current.GetBeamSetInfo() )
         self.repaint()
         #self.parentWidget().update()
+    def PlanInfoUpdate(self):
+        # the plan has been read, the CT is still being read
+        self.patientInfo.SetValues( *self.current.GetPatientInfo() )
+        self.planInfo.SetValues(    *self.current.GetPlanInfo()    )
+        self.ctInfo.SetValues(      ["reading..."], ["CT"]         )
+        self.bsInfo.SetValues(      *self.current.GetBeamSetInfo() )
+        self.repaint()
 
 # vim: set et softtabstop=4 sw=4 smartindent:
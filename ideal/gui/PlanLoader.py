@@ -0,0 +1,123 @@
+# -----------------------------------------------------------------------------
+#   Copyright (C): MedAustron GmbH, ACMIT Gmbh and Medical University Vienna
+#   This software is distributed under the terms
+#   of the GNU Lesser General  Public Licence (LGPL)
+#   See LICENSE for further details
+# -----------------------------------------------------------------------------
+
+from PyQt5 import QtCore
+import logging
+logger = logging.getLogger(__name__)
+
+class PlanLoaderSignals( QtCore.QObject ):
+    """
+    A QRunnable is not a QObject, so it cannot have signals of its own.
+    Signals emitted from the worker thread are delivered on the main thread.
+    """
+    progress = QtCore.pyqtSignal(str)
+    finished = QtCore.pyqtSignal(list)
+    failed = QtCore.pyqtSignal(str)
+
+class PlanLoader( QtCore.QRunnable ):
+    """
+    Reads a new plan (plan file, plan dose, structure set and CT) with the
+    `LoadPlanFile` method of the details object, outside of the main thread,
+    so that the GUI remains responsive. The name of each finished stage is
+    emitted with the `progress` signal. When everything has been read, the
+    `finished` signal is emitted with the list of warnings; the receiver
+    should then call `PublishPlan` (on the main thread) to update the tabs.
+    """
+    def __init__(self,details,rpfilepath):
+        QtCore.QRunnable.__init__(self)
+        self.details = details
+        self.rpfilepath = rpfilepath
+        self.signals = PlanLoaderSignals()
+    def run(self):
+        try:
+            self.details.LoadPlanFile(self.rpfilepath,progress=self.signals.progress.emit)
+            warnings = self.details.GetAndClearWarnings()
+        except Exception as e:
+            logger.error("got exception '{}' while reading {}".format(str(e),self.rpfilepath))
+            self.signals.failed.emit(str(e))
+            return
+        self.signals.finished.emit(list(warnings))
+
+###############################################################################################
+# UNIT TESTING
+###############################################################################################
+
+import unittest
+import time
+import numpy as np
+
+class synthetic_details:
+    """
+    Stand-in for IDC_details: the "plan loading" is numerical work that
+    takes a while, in the same stages as the real thing.
+    """
+    load_stages = ("plan","plan dose","structure set","CT","ROIs")
+    def __init__(self,seconds_per_stage=0.3,fail=False):
+        self.seconds_per_stage = seconds_per_stage
+        self.fail = fail
+        self.loaded = None
+        self.thread = None
+    def LoadPlanFile(self,rpfilepath,progress=None):
+        self.thread = QtCore.QThread.currentThread()
+        for stage in self.load_stages:
+            t0 = time.time()
+            while time.time()-t0 < self.seconds_per_stage:
+                np.sort(np.random.random(100000))
+            if self.fail and stage == "CT":
+                raise RuntimeError("no CT image found")
+            progress(stage)
+        self.loaded = rpfilepath
+    def GetAndClearWarnings(self):
+        return ["synthetic warning"]
+
+class test_plan_loader(unittest.TestCase):
+    def setUp(self):
+        import os
+        os.environ.setdefault("QT_QPA_PLATFORM","offscreen")
+        from PyQt5 import QtWidgets
+        self.app = QtWidgets.QApplication.instance() or QtWidgets.QApplication([])
+        self.pool = QtCore.QThreadPool()
+    def run_loader(self,details):
+        """
+        Runs the loader and a 20 ms timer on the main thread; returns the
+        emitted signals and the longest interval between two timer ticks,
+        which is the longest time that the GUI would have been frozen.
+        """
+        loop = QtCore.QEventLoop()
+        events = list()
+        ticks = list()
+        loader = PlanLoader(details,"RP.dcm")
+        loader.signals.progress.connect(lambda stage: events.append(("progress",stage)))
+        loader.signals.finished.connect(lambda warnings: (events.append(("finished",warnings)),loop.quit()))
+        loader.signals.failed.connect(lambda msg: (events.append(("failed",msg)),loop.quit()))
+        timer = QtCore.QTimer()
+        timer.timeout.connect(lambda: ticks.append(time.time()))
+        timer.start(20)
+        QtCore.QTimer.singleShot(30000,loop.quit)
+        t0 = time.time()
+        self.pool.start(loader)
+        loop.exec_()
+        timer.stop()
+        self.pool.waitForDone()
+        gaps = np.diff([t0]+ticks)
+        return events,time.time()-t0,np.max(gaps)
+    def test_responsive(self):
+        details = synthetic_details()
+        events,duration,maxgap = self.run_loader(details)
+        self.assertEqual(events[:-1],[("progress",stage) for stage in details.load_stages])
+        self.assertEqual(events[-1],("finished",["synthetic warning"]))
+        self.assertEqual(details.loaded,"RP.dcm")
+        self.assertNotEqual(details.thread,self.app.thread())
+        self.assertGreater(duration,1.)
+        # numpy releases the GIL only part of the time; a few 100 ms would still be OK for a GUI
+        self.assertLess(maxgap,0.25)
+    def test_failure(self):
+        events,duration,maxgap = self.run_loader(synthetic_details(0.05,fail=True))
+        self.assertEqual(events[-1],("failed","no CT image found"))
+        self.assertEqual([e for e,_ in events].count("progress"),3)
+
+# vim: set et softtabstop=4 sw=4 smartindent:
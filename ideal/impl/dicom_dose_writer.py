@@ -0,0 +1,311 @@
+# -----------------------------------------------------------------------------
+#   Copyright (C): MedAustron GmbH, ACMIT Gmbh and Medical University Vienna
+#   This software is distributed under the terms
+#   of the GNU Lesser General  Public Licence (LGPL)
+#   See LICENSE for further details
+# -----------------------------------------------------------------------------
+
+"""
+Export of dose distributions to DICOM, using the dose templates written by
+`impl.dicom_dose_template`.
+
+The post processing writes several DICOM dose files from the same template
+(physical and RBE dose, for every beam and for the plan). The header of each
+template is read only once, without the dummy pixel data. The dose is
+quantized slab by slab, so that no full size floating point temporaries are
+needed, and the pixel data element is written directly from the integer
+array after the header, instead of first converting it to a bytes object.
+"""
+
+import os
+import copy
+import threading
+import numpy as np
+import pydicom
+from pydicom.tag import Tag
+import logging
+logger=logging.getLogger(__name__)
+
+_template_cache = dict()
+_template_lock = threading.Lock()
+
+def read_dose_template(template_path):
+    """
+    Returns a (deep) copy of the header of the dose template, without pixel data.
+    The parsed header is cached, until the template file changes.
+    """
+    st = os.stat(template_path)
+    key = os.path.realpath(template_path)
+    with _template_lock:
+        cached = _template_cache.get(key)
+        if cached is None or cached[0] != (st.st_mtime_ns,st.st_size):
+            ds = pydicom.dcmread(template_path,stop_before_pixels=True)
+            cached = ((st.st_mtime_ns,st.st_size),ds)
+            _template_cache[key] = cached
+            logger.debug("read and cached DICOM dose template {}".format(template_path))
+    return copy.deepcopy(cached[1])
+
+def clear_template_cache():
+    with _template_lock:
+        _template_cache.clear()
+
+def quantize_dose(adose,nbits=16,slab_size=16):
+    """
+    Returns the dose as unsigned integers, and the dose grid scaling.
+    Same result as `np.round(adose/scaling).astype(uint)`, computed per slab
+    of `slab_size` frames, so that the only full size array that is
+    allocated is the integer output array.
+    If the maximum dose is not positive, all pixels are zero and the dose
+    grid scaling is 1.
+    """
+    maxdose = np.max(adose)
+    if not maxdose > 0.:
+        return np.zeros(adose.shape,dtype=np.uint16 if nbits<=16 else np.uint32),1.
+    dose_grid_scaling = maxdose/(2**nbits-1)
+    aint = np.empty(adose.shape,dtype=np.uint16 if nbits<=16 else np.uint32)
+    for k in range(0,adose.shape[0],slab_size):
+        slab = np.divide(adose[k:k+slab_size],dose_grid_scaling)
+        np.round(slab,out=slab)
+        aint[k:k+slab_size] = slab
+    return aint,dose_grid_scaling
+
+def _ensure_file_meta(ds):
+    """
+    Make sure that the dataset has file meta information with a transfer
+    syntax, e.g. for a template that was written without it.
+    """
+    from pydicom.dataset import FileMetaDataset
+    if getattr(ds,'file_meta',None) is None:
+        ds.file_meta = FileMetaDataset()
+    if 'TransferSyntaxUID' not in ds.file_meta:
+        explicit = getattr(ds,'is_implicit_VR',True) is False
+        ds.file_meta.TransferSyntaxUID = pydicom.uid.ExplicitVRLittleEndian if explicit else pydicom.uid.ImplicitVRLittleEndian
+    if 'MediaStorageSOPClassUID' not in ds.file_meta and 'SOPClassUID' in ds:
+        ds.file_meta.MediaStorageSOPClassUID = ds.SOPClassUID
+
+def _pixel_data_header(ds,nbytes):
+    """
+    Element header (tag, VR, length) of the PixelData element, for the
+    transfer syntax of the dataset.
+    """
+    file_meta = getattr(ds,'file_meta',None)
+    if file_meta is None or 'TransferSyntaxUID' not in file_meta:
+        return None
+    tag = np.array([0x7FE0,0x0010],dtype='<u2').tobytes()
+    if ds.file_meta.TransferSyntaxUID == pydicom.uid.ImplicitVRLittleEndian:
+        return tag + np.array([nbytes],dtype='<u4').tobytes()
+    if ds.file_meta.TransferSyntaxUID == pydicom.uid.ExplicitVRLittleEndian:
+        return tag + b'OW\x00\x00' + np.array([nbytes],dtype='<u4').tobytes()
+    return None
+
+def write_dicom_dose(adose,spacing,origin,template_path,output_path,physical=True):
+    """
+    Write dose array `adose` (numpy array, indices z,y,x) with the given voxel
+    `spacing` and `origin` (both x,y,z) to a DICOM dose file, based on the
+    template.
+    """
+    ds = read_dose_template(template_path)
+    nz,ny,nx = adose.shape
+    logger.debug("template dose shape is {}".format((int(ds.NumberOfFrames),int(ds.Rows),int(ds.Columns))))
+    logger.debug("Gate output dose shape is {}".format(adose.shape))
+    nbitA = int(ds.BitsAllocated)
+    nbitS = int(ds.BitsStored)
+    if not nbitA == nbitS:
+        raise RuntimeError("inconsistent template dicom dose file {}: nbitA={}, nbitS={}".format(template_path,nbitA,nbitS))
+    logger.debug("check that these are 16: nbitA={}, nbitS={}".format(nbitA,nbitS))
+    aint,dose_grid_scaling = quantize_dose(adose,nbitS)
+    if not aint.any():
+        logger.error("max dose in image is NOT positive, BAD!")
+        raise RuntimeError("max dose in image is NOT positive, BAD!")
+    logger.debug("max dose in image is {}".format(dose_grid_scaling*(2**nbitS-1)))
+    ds.DoseGridScaling = dose_grid_scaling
+    ds.DoseType = 'PHYSICAL' if physical else 'EFFECTIVE'
+    ds.Rows = ny
+    ds.Columns = nx
+    ds.NumberOfFrames = nz
+    ds.PixelSpacing = [spacing[1],spacing[0]]
+    ds.SliceThickness = spacing[2]
+    ds.GridFrameOffsetVector = [k*float(spacing[2]) for k in range(nz)]
+    ds.ImagePositionPatient = list(origin)
+    ds.SOPInstanceUID = pydicom.uid.generate_uid() # create a new unique UID
+    ds.SeriesInstanceUID = pydicom.uid.generate_uid()
+    logger.debug("new SOPInstanceUID={} SeriesInstanceUID={}".format(ds.SOPInstanceUID,ds.SeriesInstanceUID))
+    _ensure_file_meta(ds)
+    ds.file_meta.MediaStorageSOPInstanceUID = ds.SOPInstanceUID
+    pixel_header = _pixel_data_header(ds,aint.nbytes)
+    if pixel_header is None:
+        # not a little endian uncompressed transfer syntax, let pydicom handle it
+        ds.PixelData = aint.tobytes()
+        pydicom.dcmwrite(output_path,ds,write_like_original=False)
+    else:
+        # PixelData is the last element: write the header with pydicom, then the pixels directly from the array
+        with open(output_path,'wb') as fp:
+            pydicom.dcmwrite(fp,ds,write_like_original=False)
+            fp.write(pixel_header)
+            fp.write(memoryview(np.ascontiguousarray(aint,dtype=aint.dtype.newbyteorder('<'))).cast('B'))
+    logger.info("wrote DICOM file: {}".format(output_path))
+
+###############################################################################################
+# UNIT TESTING
+###############################################################################################
+
+import unittest
+
+def _make_template(path,implicit=True):
+    from pydicom.dataset import Dataset, FileMetaDataset
+    file_meta = FileMetaDataset()
+    file_meta.MediaStorageSOPClassUID = '1.2.840.10008.5.1.4.1.1.481.2'
+    file_meta.MediaStorageSOPInstanceUID = pydicom.uid.generate_uid()
+    file_meta.TransferSyntaxUID = pydicom.uid.ImplicitVRLittleEndian if implicit else pydicom.uid.ExplicitVRLittleEndian
+    ds = Dataset()
+    ds.file_meta = file_meta
+    ds.SOPClassUID = file_meta.MediaStorageSOPClassUID
+    ds.SOPInstanceUID = file_meta.MediaStorageSOPInstanceUID
+    ds.SeriesInstanceUID = pydicom.uid.generate_uid()
+    ds.Modality = 'RTDOSE'
+    ds.SamplesPerPixel = 1
+    ds.PhotometricInterpretation = 'MONOCHROME2'
+    ds.NumberOfFrames = 9
+    ds.FrameIncrementPointer = Tag(0x3004000c)
+    ds.Rows = 9
+    ds.Columns = 9
+    ds.PixelSpacing = [1.,1.]
+    ds.SliceThickness = 1.
+    ds.ImagePositionPatient = [0.,0.,0.]
+    ds.BitsAllocated = 16
+    ds.BitsStored = 16
+    ds.HighBit = 15
+    ds.PixelRepresentation = 0
+    ds.DoseUnits = 'GY'
+    ds.DoseType = 'PHYSICAL'
+    ds.DoseSummationType = 'BEAM'
+    ds.GridFrameOffsetVector = [str(c) for c in range(9)]
+    ds.DoseGridScaling = 1.
+    ds.PixelData = np.ones((9,9,9),dtype=np.uint16).tobytes()
+    ds.is_implicit_VR = implicit
+    ds.is_little_endian = True
+    ds.save_as(path,write_like_original=False)
+
+class test_dicom_dose_writer(unittest.TestCase):
+    def setUp(self):
+        import tempfile
+        self.tmpdir = tempfile.TemporaryDirectory()
+        rng = np.random.default_rng(7)
+        self.adose = rng.gamma(2.,1.,(21,17,13)).astype(np.float32)
+        self.spacing = (2.,2.5,3.)
+        self.origin = (-10.,-20.,-30.)
+        clear_template_cache()
+    def tearDown(self):
+        self.tmpdir.cleanup()
+    def check(self,implicit):
+        template = os.path.join(self.tmpdir.name,"template.dcm")
+        out = os.path.join(self.tmpdir.name,"dose.dcm")
+        _make_template(template,implicit)
+        write_dicom_dose(self.adose,self.spacing,self.origin,template,out,physical=False)
+        ds = pydicom.dcmread(out)
+        tmpl = pydicom.dcmread(template)
+        self.assertEqual(ds.pixel_array.shape,self.adose.shape)
+        scaling = float(ds.DoseGridScaling)
+        self.assertTrue(np.allclose(ds.pixel_array*scaling,self.adose,atol=0.51*scaling,rtol=0))
+        # same result as the old implementation
+        dgs = np.max(self.adose)/(2**16-1)
+        self.assertTrue(np.array_equal(ds.pixel_array,np.round(self.adose/dgs).astype('uint16')))
+        self.assertEqual(ds.DoseType,'EFFECTIVE')
+        self.assertEqual((ds.Rows,ds.Columns,ds.NumberOfFrames),(17,13,21))
+        self.assertTrue(np.allclose([float(v) for v in ds.GridFrameOffsetVector],np.arange(21)*3.))
+        self.assertTrue(np.allclose([float(v) for v in ds.PixelSpacing],[2.5,2.]))
+        self.assertTrue(np.allclose([float(v) for v in ds.ImagePositionPatient],self.origin))
+        self.assertNotEqual(ds.SOPInstanceUID,tmpl.SOPInstanceUID)
+        self.assertEqual(ds.file_meta.MediaStorageSOPInstanceUID,ds.SOPInstanceUID)
+    def test_implicit(self):
+        self.check(True)
+    def test_explicit(self):
+        self.check(False)
+    def test_template_cache(self):
+        template = os.path.join(self.tmpdir.name,"template.dcm")
+        _make_template(template)
+        ds1 = read_dose_template(template)
+        self.assertNotIn('PixelData',ds1)
+        ds1.DoseType = 'EFFECTIVE'
+        # the cached header is not affected by changes in the copy
+        self.assertEqual(read_dose_template(template).DoseType,'PHYSICAL')
+        self.assertEqual(len(_template_cache),1)
+        # a changed template is read again
+        st = os.stat(template)
+        os.utime(template,ns=(st.st_atime_ns,st.st_mtime_ns+1000000000))
+        self.assertEqual(read_dose_template(template).DoseType,'PHYSICAL')
+        self.assertEqual(len(_template_cache),1)
+    def test_zero_dose(self):
+        template = os.path.join(self.tmpdir.name,"template.dcm")
+        _make_template(template)
+        with self.assertRaises(RuntimeError):
+            write_dicom_dose(np.zeros((3,4,5),dtype=np.float32),self.spacing,self.origin,template,os.path.join(self.tmpdir.name,"zero.dcm"))
+    def test_quantize_zero_dose(self):
+        import warnings
+        with warnings.catch_warnings():
+            warnings.simplefilter("error")
+            aint,scaling = quantize_dose(np.zeros((3,4,5),dtype=np.float32))
+        self.assertEqual(scaling,1.)
+        self.assertFalse(aint.any())
+        self.assertEqual(aint.shape,(3,4,5))
+    def test_missing_file_meta(self):
+        from pydicom.dataset import Dataset
+        ds = Dataset()
+        ds.SOPClassUID = '1.2.840.10008.5.1.4.1.1.481.2'
+        self.assertIsNone(_pixel_data_header(ds,8))
+        _ensure_file_meta(ds)
+        self.assertEqual(ds.file_meta.TransferSyntaxUID,pydicom.uid.ImplicitVRLittleEndian)
+        self.assertEqual(ds.file_meta.MediaStorageSOPClassUID,ds.SOPClassUID)
+        self.assertEqual(len(_pixel_data_header(ds,8)),8)
+
+###############################################################################################
+# BENCHMARK
+###############################################################################################
+
+def _write_dicom_dose_full_read(adose,spacing,origin,template_path,output_path,physical=True):
+    """
+    The previous implementation, for comparison: full template read for
+    every output, full size temporaries and a bytes copy of the pixels.
+    """
+    ds = pydicom.dcmread(template_path)
+    logger.debug("template dose shape is {}".format(ds.pixel_array.shape))
+    maxdose = np.max(adose)
+    logger.debug("max dose in template DICOM is {}".format(float(ds.DoseGridScaling)*np.max(ds.pixel_array)))
+    dose_grid_scaling = maxdose/(2**int(ds.BitsStored)-1)
+    ds.PixelData = np.round(adose/dose_grid_scaling).astype('uint16').tobytes()
+    ds.DoseGridScaling = dose_grid_scaling
+    ds.DoseType = 'PHYSICAL' if physical else 'EFFECTIVE'
+    ds.Rows,ds.Columns,ds.NumberOfFrames = adose.shape[1],adose.shape[2],adose.shape[0]
+    ds.GridFrameOffsetVector = pydicom.multival.MultiValue(pydicom.valuerep.DSfloat,np.arange(adose.shape[0])*float(spacing[2]))
+    ds.ImagePositionPatient = list(origin)
+    ds.SOPInstanceUID = pydicom.uid.generate_uid()
+    pydicom.dcmwrite(output_path,ds,write_like_original=False)
+
+if __name__ == '__main__':
+    import argparse
+    import tempfile
+    import time
+    parser = argparse.ArgumentParser(description='time the export of dose distributions to DICOM')
+    parser.add_argument('-s','--shape',type=int,nargs=3,default=[300,400,400],help='dose grid shape (nz ny nx)')
+    parser.add_argument('-n','--nfiles',type=int,default=8,help='number of dose files to write')
+    args = parser.parse_args()
+    shape = tuple(args.shape)
+    rng = np.random.default_rng(3)
+    adose = rng.random(shape,dtype=np.float32)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        # the template has full size pixel data, like the plan dose templates of real TPS doses
+        template = os.path.join(tmpdir,"template.dcm")
+        _make_template(template)
+        tds = pydicom.dcmread(template)
+        tds.Rows,tds.Columns,tds.NumberOfFrames = shape[1],shape[2],shape[0]
+        tds.PixelData = np.ones(shape,dtype=np.uint16).tobytes()
+        tds.save_as(template,write_like_original=False)
+        del tds
+        for label,func in [("previous",_write_dicom_dose_full_read),("new",write_dicom_dose)]:
+            t0 = time.perf_counter()
+            for i in range(args.nfiles):
+                func(adose,(1.,1.,1.),(0.,0.,0.),template,os.path.join(tmpdir,"dose{}.dcm".format(i)),physical=bool(i%2))
+            t = time.perf_counter()-t0
+            print("{:8s}: {} files with shape {}: {:.2f} s ({:.2f} s per file)".format(label,args.nfiles,shape,t,t/args.nfiles))
+
+# vim: set et softtabstop=4 sw=4 smartindent:
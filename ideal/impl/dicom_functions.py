@@ -7,6 +7,7 @@ from impl.hlut_conf import hlut_conf
 from impl.system_configuration import system_configuration
 from utils.dose_info import dose_info
 from utils.beamset_info import beam_info
+from impl.dicom_verifier import dicom_verifier
 from glob import glob
 
 class dicom_files:
@@ -163,50 +164,29 @@ class dicom_files:
                 flist = dcmseries_reader.GetFileNames(uid)
                 return flist
 
-def verify_all_dcm_keys(dcm_dir,rp_name,rs_name,ct_names,rd_names):
-    ok = True 
-    missing_keys = {}
-    
-    #print("Checking RP file")
-    rp = os.path.join(dcm_dir,rp_name[0])
-    
-    ok_rp, mk = check_RP(rp)
-    ok = ok and ok_rp
-    if mk:
-        missing_keys['dicomRtPlan'] = mk
-    
-    #print("Checking RS file")
-    rs  = os.path.join(dcm_dir,rs_name[0])
-    
-    ok_rs, mk = check_RS(rs)
-    ok = ok and ok_rs
-    if mk:
-        missing_keys['dicomStructureSet'] = mk
+def verify_all_dcm_keys(dcm_dir,rp_name,rs_name,ct_names,rd_names,verifier=None):
+    # the checks run on the headers only, in parallel, see impl/dicom_verifier.py
+    if verifier is None:
+        verifier = dicom_verifier(nprocesses=1)
+    files = [("RP",os.path.join(dcm_dir,rp_name[0])), ("RS",os.path.join(dcm_dir,rs_name[0]))]
+    files += [("RD",os.path.join(dcm_dir,rd_n)) for rd_n in rd_names]
+    files += [("CT",os.path.join(dcm_dir,ct_n)) for ct_n in ct_names]
+    report = verifier.verify(files)
+    return report.ok, report.missing_keys
 
-    for rd_n in rd_names:
-        rd = os.path.join(dcm_dir,rd_n)
-        ok_rd, mk = check_RD(rd)
-        ok = ok and ok_rd
-        if mk:
-            missing_keys['dicomRDose'] = mk
-            break
-    i = 0   
-
-    for ct_n in ct_names:
-        ct = os.path.join(dcm_dir,ct_n)
-        i+=1
-        #print("CT file nr ",i)
-        ok_ct, mk = check_CT(ct)
-        ok = ok and ok_ct
-        if mk:
-            missing_keys['dicomCTs'] = mk
-            
-    return ok, missing_keys        
+def read_header(filepath):
+    """
+    Returns the dataset without pixel data for DICOM file `filepath`.
+    If `filepath` is already a dataset, it is returned as is.
+    """
+    if isinstance(filepath,pydicom.Dataset):
+        return filepath
+    return pydicom.dcmread(filepath,stop_before_pixels=True)
        
 def check_RP(filepath):
     
 	ok = True
-	data = pydicom.read_file(filepath)
+	data = read_header(filepath)
 	dp = IDEAL_RP_dictionary()
 	
 	# keys used by IDEAL from RP file (maybe keys are enought?)
@@ -282,7 +262,7 @@ def check_RS(filepath):
     # bool for correctness of file content
 	ok = True 
     
-	data = pydicom.read_file(filepath) 
+	data = read_header(filepath) 
 	ds = IDEAL_RS_dictionary()
 	
 	# keys and tags used by IDEAL from RS file
@@ -322,7 +302,7 @@ def check_RS(filepath):
 def check_RD(filepath):
 	ok = True
     
-	data = pydicom.read_file(filepath) 
+	data = read_header(filepath) 
 	dd = IDEAL_RD_dictionary()
 	
 	# keys and tags used by IDEAL from RD file
@@ -360,7 +340,7 @@ def check_RD(filepath):
 def check_CT(filepath):
 	ok = True
     
-	data = pydicom.read_file(filepath) 
+	data = read_header(filepath) 
 	dct = IDEAL_CT_dictionary()
 	
 	# keys and tags used by IDEAL from CT file
@@ -0,0 +1,335 @@
+# -----------------------------------------------------------------------------
+#   Copyright (C): MedAustron GmbH, ACMIT Gmbh and Medical University Vienna
+#   This software is distributed under the terms
+#   of the GNU Lesser General  Public Licence (LGPL)
+#   See LICENSE for further details
+# -----------------------------------------------------------------------------
+
+"""
+Verification of the DICOM input files (RP, RS, RD and CT) of a job: check
+that all the attributes that IDEAL uses are present.
+
+The checks themselves are the `check_RP`, `check_RS`, `check_RD` and
+`check_CT` functions in `impl.dicom_functions`. The `dicom_verifier` runs
+them on the headers only (the pixel data are not read, unless the pixel
+level check is enabled), distributes the files over a process pool, does
+not stop at the first failure, and remembers the results per SOP Instance
+UID and file modification time, so that files that were already verified
+do not need to be read again.
+"""
+
+import os
+import time
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+logger=logging.getLogger(__name__)
+
+# categories, as used in the response of the API
+categories = {"RP":"dicomRtPlan", "RS":"dicomStructureSet", "RD":"dicomRDose", "CT":"dicomCTs"}
+
+def check_pixel_data(data):
+    """
+    Checks that the (uncompressed) pixel data of dataset `data` has the size
+    that is implied by the image attributes. Returns a list of problems.
+    """
+    if "PixelData" not in data:
+        return ["PixelData"]
+    if data.file_meta.TransferSyntaxUID.is_compressed:
+        return []
+    try:
+        nbytes = int(data.Rows)*int(data.Columns)*int(data.get("NumberOfFrames",1) or 1) \
+                 * int(data.get("SamplesPerPixel",1))*int(data.BitsAllocated)//8
+    except AttributeError as ae:
+        return ["PixelData (cannot compute the expected size: {})".format(ae)]
+    nread = len(data.PixelData)
+    # pixel data are padded to an even length
+    if nread not in (nbytes,nbytes+1):
+        return ["PixelData (expected {} bytes, got {})".format(nbytes,nread)]
+    return []
+
+def verify_file(kind,filepath,check_pixels=False):
+    """
+    Checks one DICOM file of type `kind` ("RP", "RS", "RD" or "CT").
+    Returns (ok, missing_keys, SOPInstanceUID, modification time).
+    This is the function that runs in the worker processes.
+    """
+    import pydicom
+    from impl.dicom_functions import check_RP, check_RS, check_RD, check_CT
+    checks = {"RP":check_RP, "RS":check_RS, "RD":check_RD, "CT":check_CT}
+    mtime = os.stat(filepath).st_mtime_ns
+    try:
+        data = pydicom.dcmread(filepath,stop_before_pixels=not check_pixels)
+    except Exception as e:
+        return False, ["unreadable DICOM file: {}".format(e)], None, mtime
+    ok,missing_keys = checks[kind](data)
+    if check_pixels and kind in ("RD","CT"):
+        missing_keys += check_pixel_data(data)
+        ok = not missing_keys
+    return ok, missing_keys, str(data.get("SOPInstanceUID","")) or None, mtime
+
+def _verify_chunk(tasks,check_pixels):
+    return [verify_file(kind,filepath,check_pixels) for kind,filepath in tasks]
+
+class verification_report:
+    """
+    Result of the verification of a set of DICOM files.
+    `missing_keys` has, per category (see `categories`) with failures, the
+    list of missing keys of all the files in that category. `failures` has
+    the missing keys per file path, for all files that failed.
+    """
+    def __init__(self):
+        self.missing_keys = dict()
+        self.failures = dict()
+        self.nfiles = 0
+        self.ncached = 0
+    @property
+    def ok(self):
+        return not self.failures
+    def add(self,kind,filepath,ok,missing_keys):
+        self.nfiles += 1
+        if ok:
+            return
+        self.failures[filepath] = list(missing_keys)
+        keys = self.missing_keys.setdefault(categories[kind],list())
+        keys += [k for k in missing_keys if k not in keys]
+
+class dicom_verifier:
+    """
+    Verifies the DICOM input files of jobs, see the module documentation.
+    With `nprocesses` <= 1 everything runs in the calling process.
+    The process pool is created on first use and reused for later jobs; the
+    worker processes are started with "spawn", since the verifier is used
+    in a multi-threaded server.
+    """
+    def __init__(self,nprocesses=4,check_pixels=False,chunk_size=50):
+        self.nprocesses = int(nprocesses)
+        self.check_pixels = bool(check_pixels)
+        self.chunk_size = int(chunk_size)
+        self._pool = None
+        # (kind, SOPInstanceUID, mtime) -> (ok, missing keys)
+        self._results = dict()
+        # (kind, path) -> (mtime, SOPInstanceUID), to find the cached results without reading the file
+        self._uids = dict()
+    def _cached(self,kind,filepath):
+        try:
+            mtime = os.stat(filepath).st_mtime_ns
+        except OSError:
+            return None
+        mtime_uid = self._uids.get((kind,filepath),None)
+        if mtime_uid is None or mtime_uid[0] != mtime:
+            return None
+        return self._results.get((kind,mtime_uid[1],mtime),None)
+    def _store(self,kind,filepath,ok,missing_keys,uid,mtime):
+        if uid is None:
+            return
+        self._uids[(kind,filepath)] = (mtime,uid)
+        self._results[(kind,uid,mtime)] = (ok,list(missing_keys))
+    def _get_pool(self):
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(self.nprocesses,mp_context=multiprocessing.get_context("spawn"))
+        return self._pool
+    def verify(self,files):
+        """
+        `files` is a list of (kind, filepath) tuples, with kind "RP", "RS",
+        "RD" or "CT". Returns a `verification_report`.
+        """
+        t0 = time.time()
+        report = verification_report()
+        todo = list()
+        for kind,filepath in files:
+            if kind not in categories:
+                raise RuntimeError("PROGRAMMING ERROR: unknown DICOM file type '{}' for {}".format(kind,filepath))
+            cached = self._cached(kind,filepath)
+            if cached is None:
+                todo.append((kind,filepath))
+            else:
+                report.add(kind,filepath,*cached)
+                report.ncached += 1
+        chunks = [todo[i:i+self.chunk_size] for i in range(0,len(todo),self.chunk_size)]
+        if self.nprocesses > 1 and len(chunks) > 1:
+            pool = self._get_pool()
+            results = pool.map(_verify_chunk,chunks,[self.check_pixels]*len(chunks))
+        else:
+            results = [_verify_chunk(chunk,self.check_pixels) for chunk in chunks]
+        for chunk,chunk_results in zip(chunks,results):
+            for (kind,filepath),(ok,missing_keys,uid,mtime) in zip(chunk,chunk_results):
+                self._store(kind,filepath,ok,missing_keys,uid,mtime)
+                report.add(kind,filepath,ok,missing_keys)
+        for filepath,missing_keys in report.failures.items():
+            logger.warning("{}: missing {}".format(os.path.basename(filepath),", ".join(missing_keys)))
+        logger.info("verified {} DICOM files ({} cached) in {:.2f} seconds, {} failed".format(
+            report.nfiles,report.ncached,time.time()-t0,len(report.failures)))
+        return report
+    def shutdown(self):
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+
+###############################################################################################
+# UNIT TESTING
+###############################################################################################
+
+import unittest
+
+def _write_test_file(fpath,sop_class,pixels=None,**attrs):
+    import numpy as np
+    from pydicom.dataset import Dataset, FileMetaDataset
+    from pydicom.uid import ExplicitVRLittleEndian, generate_uid
+    meta = FileMetaDataset()
+    meta.MediaStorageSOPClassUID = sop_class
+    meta.MediaStorageSOPInstanceUID = generate_uid()
+    meta.TransferSyntaxUID = ExplicitVRLittleEndian
+    ds = Dataset()
+    ds.file_meta = meta
+    ds.is_little_endian = True
+    ds.is_implicit_VR = False
+    ds.SOPClassUID = sop_class
+    ds.SOPInstanceUID = meta.MediaStorageSOPInstanceUID
+    for k,v in attrs.items():
+        setattr(ds,k,v)
+    if pixels is not None:
+        ds.Rows,ds.Columns = pixels.shape[-2:]
+        ds.BitsAllocated = ds.BitsStored = 8*pixels.itemsize
+        ds.HighBit = ds.BitsStored - 1
+        ds.PixelRepresentation = 1 if pixels.dtype.kind == 'i' else 0
+        ds.SamplesPerPixel = 1
+        ds.PhotometricInterpretation = "MONOCHROME2"
+        ds.PixelData = pixels.tobytes()
+    ds.save_as(fpath,write_like_original=False)
+
+def _make_test_directory(dirpath,nct,ct_shape=(64,64),ct_missing=()):
+    """
+    Writes a synthetic CT series with `nct` slices, an RD file that passes
+    the checks and RP and RS files that do not. The CT slices with index in
+    `ct_missing` lack the "SeriesDescription" attribute.
+    Returns the (kind,filepath) list.
+    """
+    import numpy as np
+    from pydicom.dataset import Dataset
+    from pydicom.sequence import Sequence
+    from pydicom.uid import generate_uid
+    files = list()
+    series_uid = generate_uid()
+    ct = np.zeros(ct_shape,dtype=np.int16)
+    for i in range(nct):
+        attrs = dict(Modality="CT",InstanceCreationDate="20230101",InstanceCreationTime="120000",
+                     SeriesInstanceUID=series_uid,SeriesDescription="test series",
+                     ImagePositionPatient=[0.,0.,2.*i],PixelSpacing=[1.,1.],RescaleIntercept=-1024,RescaleSlope=1)
+        if i in ct_missing:
+            del attrs["SeriesDescription"]
+        fpath = os.path.join(dirpath,"CT{:04d}.dcm".format(i))
+        _write_test_file(fpath,"1.2.840.10008.5.1.4.1.1.2",ct,**attrs)
+        files.append(("CT",fpath))
+    refrp = Dataset()
+    refrp.ReferencedSOPInstanceUID = generate_uid()
+    rd = np.zeros((10,20,30),dtype=np.uint32)
+    fpath = os.path.join(dirpath,"RD.dcm")
+    _write_test_file(fpath,"1.2.840.10008.5.1.4.1.1.481.2",rd,Modality="RTDOSE",NumberOfFrames=10,
+                     ReferencedRTPlanSequence=Sequence([refrp]),DoseGridScaling=1e-4,PixelSpacing=[2.,2.],
+                     SliceThickness=2.,ImagePositionPatient=[0.,0.,0.],DoseType="PHYSICAL",
+                     DoseSummationType="PLAN",DoseUnits="GY")
+    files.append(("RD",fpath))
+    fpath = os.path.join(dirpath,"RP.dcm")
+    _write_test_file(fpath,"1.2.840.10008.5.1.4.1.1.481.8",Modality="RTPLAN",PatientID="test",RTPlanLabel="test")
+    files.append(("RP",fpath))
+    fpath = os.path.join(dirpath,"RS.dcm")
+    _write_test_file(fpath,"1.2.840.10008.5.1.4.1.1.481.3",Modality="RTSTRUCT",SeriesInstanceUID=generate_uid())
+    files.append(("RS",fpath))
+    return files
+
+class test_dicom_verifier(unittest.TestCase):
+    def setUp(self):
+        import tempfile
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.files = _make_test_directory(self.tmpdir.name,20,ct_missing=(3,7))
+    def tearDown(self):
+        self.tmpdir.cleanup()
+    def check_report(self,report):
+        self.assertFalse(report.ok)
+        self.assertEqual(report.nfiles,len(self.files))
+        # all failures are reported, not only the first
+        ct3,ct7,rp,rs = [os.path.join(self.tmpdir.name,s) for s in ["CT0003.dcm","CT0007.dcm","RP.dcm","RS.dcm"]]
+        self.assertEqual(sorted(report.failures.keys()),sorted([ct3,ct7,rp,rs]))
+        self.assertEqual(report.missing_keys["dicomCTs"],["SeriesDescription"])
+        self.assertNotIn("dicomRDose",report.missing_keys)
+        self.assertIn("IonBeamSequence",report.missing_keys["dicomRtPlan"])
+        self.assertIn("StructureSetROISequence",report.missing_keys["dicomStructureSet"])
+    def test_verify(self):
+        verifier = dicom_verifier(nprocesses=1,chunk_size=7)
+        self.check_report(verifier.verify(self.files))
+    def test_process_pool(self):
+        verifier = dicom_verifier(nprocesses=2,chunk_size=5)
+        try:
+            self.check_report(verifier.verify(self.files))
+        finally:
+            verifier.shutdown()
+    def test_cache(self):
+        verifier = dicom_verifier(nprocesses=1)
+        report = verifier.verify(self.files)
+        self.assertEqual(report.ncached,0)
+        report = verifier.verify(self.files)
+        self.assertEqual(report.ncached,len(self.files))
+        self.check_report(report)
+        # a modified file is verified again
+        ct3 = os.path.join(self.tmpdir.name,"CT0003.dcm")
+        # overwrites CT slices 0-3 (without missing keys) and the RD, RP and RS files
+        _make_test_directory(self.tmpdir.name,4)
+        report = verifier.verify(self.files)
+        self.assertEqual(report.ncached,len(self.files)-7)
+        self.assertNotIn(ct3,report.failures)
+        self.assertEqual(len(report.failures),3)
+    def test_pixels(self):
+        import pydicom
+        rd = os.path.join(self.tmpdir.name,"RD.dcm")
+        data = pydicom.dcmread(rd)
+        data.PixelData = data.PixelData[:-4000]
+        data.save_as(rd)
+        report = dicom_verifier(nprocesses=1).verify([("RD",rd)])
+        self.assertTrue(report.ok)
+        report = dicom_verifier(nprocesses=1,check_pixels=True).verify([("RD",rd)])
+        self.assertFalse(report.ok)
+        self.assertTrue(report.missing_keys["dicomRDose"][0].startswith("PixelData"))
+
+###############################################################################################
+# BENCHMARK
+###############################################################################################
+
+def _verify_sequentially_full(files):
+    """
+    The previous way: read each complete file and check it, one by one.
+    """
+    import pydicom
+    from impl.dicom_functions import check_RP, check_RS, check_RD, check_CT
+    checks = {"RP":check_RP, "RS":check_RS, "RD":check_RD, "CT":check_CT}
+    return [checks[kind](pydicom.dcmread(filepath)) for kind,filepath in files]
+
+if __name__ == '__main__':
+    import argparse
+    import tempfile
+    parser = argparse.ArgumentParser(description='time to verify a synthetic CT series with RP, RS and RD files')
+    parser.add_argument('-n','--nslices',type=int,default=600)
+    parser.add_argument('-s','--shape',type=int,nargs=2,default=[512,512],help='CT slice shape')
+    parser.add_argument('-p','--nprocesses',type=int,default=os.cpu_count())
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as tmpdir:
+        files = _make_test_directory(tmpdir,args.nslices,tuple(args.shape))
+        t0 = time.perf_counter()
+        _verify_sequentially_full(files)
+        t1 = time.perf_counter()
+        verifier = dicom_verifier(nprocesses=args.nprocesses)
+        verifier.verify(files)
+        t2 = time.perf_counter()
+        verifier.verify(files)
+        t3 = time.perf_counter()
+        verifier.shutdown()
+        verifier = dicom_verifier(nprocesses=1)
+        verifier.verify(files)
+        t4 = time.perf_counter()
+        print("{} CT slices {}x{} + RP/RS/RD:".format(args.nslices,*args.shape))
+        print("  sequential, full files:   {:.3f} s".format(t1-t0))
+        print("  headers, {} process(es): {:.3f} s (including pool start up)".format(args.nprocesses,t2-t1))
+        print("  headers, 1 process:       {:.3f} s".format(t4-t3))
+        print("  cached:                   {:.3f} s".format(t3-t2))
+
+# vim: set et softtabstop=4 sw=4 smartindent:
@@ -0,0 +1,323 @@
+# -----------------------------------------------------------------------------
+#   Copyright (C): MedAustron GmbH, ACMIT Gmbh and Medical University Vienna
+#   This software is distributed under the terms
+#   of the GNU Lesser General  Public Licence (LGPL)
+#   See LICENSE for further details
+# -----------------------------------------------------------------------------
+
+"""
+Cost estimate for the dose grid (and beam) settings of a job, before it is
+submitted: number of voxels, RAM per subjob, RAM of all subjobs together and
+the time needed for post processing.
+
+The estimates are linear models, with coefficients from the system
+configuration: the existing ``condor memory fit ...`` settings for the RAM
+usage of a subjob, and the ``post processing time fit`` setting in the
+``[dose grid cost]`` section. The coefficients can be fitted to the history of
+previous jobs, which is recorded in the ``user_logs_*.cfg`` files in the job
+output directories, with ``bin/calibrate_cost_model.py``.
+"""
+
+import os
+import configparser
+import numpy as np
+import logging
+logger=logging.getLogger(__name__)
+
+def evaluate_linear_fit(fit,**values):
+    """
+    `fit` is a dictionary with the coefficients, e.g. ``{'offset':500.,'dosegrid':2e-5}``,
+    the keyword arguments give the values of the variables. Variables that are
+    not in the fit are ignored.
+    """
+    result = 0.
+    for k,c in fit.items():
+        if k == 'offset':
+            result += c
+        elif k in values:
+            result += c*values[k]
+        else:
+            raise RuntimeError("no value given for variable '{}' of linear fit {}".format(k,fit))
+    return result
+
+def format_linear_fit(fit):
+    """
+    Text representation of a fit, in the syntax of the system configuration file.
+    """
+    return " ".join(["{} {:.6g}".format(k,v) for k,v in fit.items()])
+
+class dose_grid_cost:
+    def __init__(self,ram_fits,ram_min_mb,ram_max_mb,time_fit):
+        """
+        `ram_fits` is a dictionary with a fit per (radiation type,geometry),
+        e.g. ``ram_fits[('proton','ct')]``; the radiation type is "proton" or
+        "carbon", the geometry "ct" or "phantom".
+        """
+        self.ram_fits = ram_fits
+        self.ram_min_mb = ram_min_mb
+        self.ram_max_mb = ram_max_mb
+        self.time_fit = time_fit
+    @classmethod
+    def from_syscfg(cls,syscfg):
+        ram_fits = dict()
+        for radtype in ["proton","carbon"]:
+            for geo in ["ct","phantom"]:
+                ram_fits[(radtype,geo)] = syscfg['condor memory fit {} {}'.format(radtype,geo)]
+        return cls(ram_fits,
+                   syscfg['condor memory request minimum [MB]'],
+                   syscfg['condor memory request maximum [MB]'],
+                   syscfg['post processing time fit'])
+    def ram_per_subjob_mb(self,radtype,geo,sim_nvoxels,nspots):
+        """
+        Estimated RAM usage of one Gate subjob. `sim_nvoxels` is the number of
+        voxels of the simulated dose: in a CT simulation this is the cropped
+        CT, with a phantom it is the dose grid.
+        """
+        ct_nvoxels = sim_nvoxels if geo == "ct" else 0
+        mb = evaluate_linear_fit(self.ram_fits[(radtype,geo)],dosegrid=sim_nvoxels,ct=ct_nvoxels,nspots=nspots)
+        return min(self.ram_max_mb,max(self.ram_min_mb,mb))
+    def post_processing_seconds(self,dose_nvoxels,sim_nvoxels,njobs):
+        """
+        Estimated post processing time for one beam: the subjob doses are read
+        and added (`njobs` dose files with `sim_nvoxels` voxels), the sum is
+        resampled to the dose grid and written (`dose_nvoxels` voxels).
+        """
+        return max(0.,evaluate_linear_fit(self.time_fit,dosegrid=dose_nvoxels,subjobdose=sim_nvoxels*njobs))
+    def estimate(self,geo,dose_nvoxels,sim_nvoxels,beams):
+        """
+        Cost estimate for a job. `beams` is a list of (radiation type, number
+        of spots, number of subjobs) tuples, one for each selected beam.
+        """
+        ram = [self.ram_per_subjob_mb(radtype,geo,sim_nvoxels,nspots) for radtype,nspots,njobs in beams]
+        return {"dose grid voxels": int(dose_nvoxels),
+                "simulated dose voxels": int(sim_nvoxels),
+                "number of subjobs": int(sum([njobs for radtype,nspots,njobs in beams])),
+                "RAM per subjob [MB]": max(ram,default=0.),
+                "RAM of all subjobs [MB]": sum([mb*njobs for mb,(radtype,nspots,njobs) in zip(ram,beams)]),
+                "post processing time [s]": sum([self.post_processing_seconds(dose_nvoxels,sim_nvoxels,njobs) for radtype,nspots,njobs in beams])}
+
+def cost_summary(estimate):
+    """
+    Short text version of an estimate from `dose_grid_cost.estimate`, for the GUI.
+    """
+    lines = ["dose grid: {:.2f} M voxels (simulated: {:.2f} M voxels)".format(estimate["dose grid voxels"]/1e6,estimate["simulated dose voxels"]/1e6),
+             "RAM: {:.1f} GB per subjob, {:.1f} GB for {} subjobs".format(estimate["RAM per subjob [MB]"]/1024.,estimate["RAM of all subjobs [MB]"]/1024.,estimate["number of subjobs"]),
+             "post processing: ~{:.0f} s".format(estimate["post processing time [s]"])]
+    return "\n".join(lines)
+
+######################################################################################
+# CALIBRATION
+######################################################################################
+
+def find_user_logs(paths):
+    """
+    All ``user_logs_*.cfg`` files in (the subdirectories of) the given
+    directories, plus the files that are given directly.
+    """
+    found = list()
+    for path in paths:
+        if os.path.isfile(path):
+            found.append(path)
+            continue
+        for dirpath,dirnames,filenames in os.walk(path):
+            found += [os.path.join(dirpath,f) for f in sorted(filenames) if f.startswith("user_logs_") and f.endswith(".cfg")]
+    return found
+
+def read_job_history(paths):
+    """
+    Reads the per beam records of finished jobs from the user logs files.
+    Returns a list of dictionaries, one for each beam. Beams without the
+    inputs of the cost model (jobs from older IDEAL versions) are skipped,
+    missing results (e.g. failed post processing) are None.
+    """
+    observations = list()
+    for fpath in find_user_logs(paths):
+        # the post processing rewrites the file with lowercase keys
+        parser = configparser.RawConfigParser()
+        try:
+            with open(fpath,"r") as fp:
+                parser.read_file(fp)
+        except (OSError,configparser.Error) as e:
+            logger.warning("skipping {}: {}".format(fpath,e))
+            continue
+        dose_nvoxels = np.prod([int(v) for v in parser.defaults().get("dose grid resolution","0").split()])
+        for section in parser.sections():
+            sec = parser[section]
+            if sec.get("origname") != section or "simulated dose voxels" not in sec:
+                continue
+            def getfloat(key):
+                return sec.getfloat(key) if key in sec else None
+            observations.append(dict(path=fpath, beam=section,
+                                     radtype=sec["radiation type"],
+                                     geo=sec["geometry"],
+                                     nspots=sec.getint("number of spots"),
+                                     njobs=sec.getint("njobs"),
+                                     dose_nvoxels=int(dose_nvoxels),
+                                     sim_nvoxels=sec.getint("simulated dose voxels"),
+                                     ram_mb=getfloat("maximum memory usage per subjob [mb]"),
+                                     post_processing_seconds=getfloat("post processing time [seconds]")))
+    logger.debug("read {} beam records from {} user logs files".format(len(observations),len(set([o["path"] for o in observations]))))
+    return observations
+
+def fit_linear(columns,y):
+    """
+    Least squares fit of `y` with an offset and one coefficient per column
+    (a dictionary of arrays). Variables that get a negative coefficient are
+    dropped and the fit is repeated, because a larger grid or more spots
+    should never make a job cheaper.
+    """
+    names = list(columns.keys())
+    while True:
+        A = np.stack([np.ones(len(y))]+[np.asarray(columns[k],dtype=float) for k in names],axis=1)
+        coef = np.linalg.lstsq(A,np.asarray(y,dtype=float),rcond=None)[0]
+        negative = [k for k,c in zip(names,coef[1:]) if c < 0]
+        if not negative:
+            return dict([('offset',float(coef[0]))]+[(k,float(c)) for k,c in zip(names,coef[1:])])
+        logger.debug("dropping variable(s) {} with negative coefficients".format(negative))
+        names = [k for k in names if k not in negative]
+
+def fit_cost_model(observations,min_samples=3):
+    """
+    Fits the RAM model (per radiation type and geometry) and the post
+    processing time model. Returns a dictionary with the fits, using the keys
+    of the system configuration; models with fewer than `min_samples`
+    observations are not fitted.
+    """
+    fits = dict()
+    for radtype in ["proton","carbon"]:
+        for geo in ["ct","phantom"]:
+            obs = [o for o in observations if o["radtype"]==radtype and o["geo"]==geo and o["ram_mb"] is not None]
+            if len(obs) < min_samples:
+                logger.info("not enough data ({} beams) for the RAM fit for {} {}".format(len(obs),radtype,geo))
+                continue
+            # with CT geometry, the simulated dose grid is the (cropped) CT, there is no separate dose grid
+            nvox = 'ct' if geo == "ct" else 'dosegrid'
+            columns = {nvox:[o["sim_nvoxels"] for o in obs], 'nspots':[o["nspots"] for o in obs]}
+            fits['condor memory fit {} {}'.format(radtype,geo)] = fit_linear(columns,[o["ram_mb"] for o in obs])
+    obs = [o for o in observations if o["post_processing_seconds"] is not None]
+    if len(obs) < min_samples:
+        logger.info("not enough data ({} beams) for the post processing time fit".format(len(obs)))
+    else:
+        columns = {'dosegrid':[o["dose_nvoxels"] for o in obs], 'subjobdose':[o["sim_nvoxels"]*o["njobs"] for o in obs]}
+        fits['post processing time fit'] = fit_linear(columns,[o["post_processing_seconds"] for o in obs])
+    return fits
+
+###############################################################################################
+# UNIT TESTING
+###############################################################################################
+
+import unittest
+import tempfile
+
+class test_dose_grid_cost(unittest.TestCase):
+    true_ram = {('proton','ct'):dict(offset=1200.,ct=1.8e-5,nspots=0.01),
+                ('carbon','phantom'):dict(offset=1000.,dosegrid=8e-5,nspots=0.02)}
+    true_time = dict(offset=20.,dosegrid=2e-6,subjobdose=1e-7)
+    def write_history(self,tmpdir,njobs=8,rng=None):
+        """
+        Synthetic job history: user logs files as written by `IDC_details.WriteUserSettings`
+        and updated by the post processing, with results from the "true" model plus noise.
+        """
+        rng = rng or np.random.default_rng(3)
+        for i in range(njobs):
+            geo = "ct" if i%2 == 0 else "phantom"
+            radtype = "proton" if geo == "ct" else "carbon"
+            nxyz = rng.integers(50,300,size=3)
+            sim_nvoxels = int(np.prod(nxyz)*(3 if geo=="ct" else 1))
+            parser = configparser.RawConfigParser()
+            parser['DEFAULT']["status"] = "FINISHED"
+            parser['DEFAULT']["dose grid resolution"] = " ".join([str(n) for n in nxyz])
+            for b in range(2):
+                name = "Beam {}".format(b+1)
+                nspots = int(rng.integers(500,5000))
+                nsubjobs = int(rng.integers(10,50))
+                parser.add_section(name)
+                parser[name].update({"nJobs":str(nsubjobs), "origname":name,
+                                     "radiation type":radtype, "geometry":geo,
+                                     "number of spots":str(nspots),
+                                     "simulated dose voxels":str(sim_nvoxels)})
+                if i == njobs-1 and b == 1:
+                    continue # failed before post processing
+                ram = evaluate_linear_fit(self.true_ram[(radtype,geo)],dosegrid=sim_nvoxels,ct=sim_nvoxels,nspots=nspots)
+                pptime = evaluate_linear_fit(self.true_time,dosegrid=np.prod(nxyz),subjobdose=sim_nvoxels*nsubjobs)
+                parser[name]["maximum memory usage per subjob [MB]"] = str(ram*(1+0.01*rng.normal()))
+                parser[name]["post processing time [seconds]"] = str(pptime*(1+0.01*rng.normal()))
+            jobdir = os.path.join(tmpdir,"job{}".format(i))
+            os.makedirs(jobdir)
+            with open(os.path.join(jobdir,"user_logs_2024_01_{:02d}.cfg".format(i+1)),"w") as fp:
+                parser.write(fp)
+        # older job, without the cost model inputs, and a file that is not a user log
+        with open(os.path.join(tmpdir,"user_logs_old.cfg"),"w") as fp:
+            fp.write("[DEFAULT]\nstatus = FINISHED\n\n[Beam 1]\nnJobs = 10\norigname = Beam 1\n")
+        with open(os.path.join(tmpdir,"postprocessor.cfg"),"w") as fp:
+            fp.write("[DEFAULT]\n")
+    def test_history(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            self.write_history(tmpdir)
+            obs = read_job_history([tmpdir])
+            self.assertEqual(len(obs),16)
+            self.assertEqual(len([o for o in obs if o["ram_mb"] is None]),1)
+            self.assertEqual(set([(o["radtype"],o["geo"]) for o in obs]),set(self.true_ram.keys()))
+            self.assertEqual(len(read_job_history([os.path.join(tmpdir,"job0","user_logs_2024_01_01.cfg")])),2)
+    def test_fit(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            self.write_history(tmpdir,njobs=20)
+            fits = fit_cost_model(read_job_history([tmpdir]))
+        self.assertEqual(set(fits.keys()),{"condor memory fit proton ct","condor memory fit carbon phantom","post processing time fit"})
+        for (radtype,geo),truth in self.true_ram.items():
+            fit = fits["condor memory fit {} {}".format(radtype,geo)]
+            self.assertEqual(set(fit.keys()),set(truth.keys()))
+            for k,v in truth.items():
+                self.assertAlmostEqual(fit[k]/v,1.,delta=0.1)
+        for k,v in self.true_time.items():
+            self.assertAlmostEqual(fits["post processing time fit"][k]/v,1.,delta=0.1)
+        # the fitted model reproduces the history
+        model = dose_grid_cost({k:fits["condor memory fit {} {}".format(*k)] for k in self.true_ram},0.,1e6,fits["post processing time fit"])
+        self.assertAlmostEqual(model.ram_per_subjob_mb("proton","ct",1000000,2000)/(1200+18+20),1.,delta=0.05)
+    def test_not_enough_data(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            self.write_history(tmpdir,njobs=4)
+            fits = fit_cost_model(read_job_history([tmpdir]),min_samples=5)
+        self.assertEqual(list(fits.keys()),["post processing time fit"])
+    def test_no_negative_coefficients(self):
+        rng = np.random.default_rng(7)
+        x = rng.random(20)*1e6
+        spots = rng.random(20)*1000
+        y = 500 + 1e-3*x - 1e-6*spots
+        fit = fit_linear({'dosegrid':x,'nspots':spots},y)
+        self.assertEqual(list(fit.keys()),['offset','dosegrid'])
+        self.assertAlmostEqual(fit['dosegrid'],1e-3,places=6)
+    def test_condor_memory_usage(self):
+        from utils.condor_utils import subjob_memory_usage_mb
+        log = ["006 (012.{:03d}.000) 01/01 12:00:00 Image size of job updated: 1234",
+               "\t{} - MemoryUsage of job (MB)",
+               "005 (012.{:03d}.000) 01/01 12:10:00 Job terminated.",
+               "\tPartitionable Resources :    Usage  Request Allocated",
+               "\t   Disk (KB)            :       75       75   1234",
+               "\t   Memory (MB)          :      {}     2000      2048"]
+        with tempfile.TemporaryDirectory() as tmpdir:
+            for process,(mb1,mb2) in enumerate([(812,950),(1300,1200)]):
+                with open(os.path.join(tmpdir,"stdlog.12.{}.txt".format(process)),"w") as fp:
+                    fp.write("\n".join(log).format(process,mb1,process,mb2))
+            with open(os.path.join(tmpdir,"stdlog.12.2.txt"),"w") as fp:
+                fp.write("000 (012.002.000) 01/01 11:59:00 Job submitted from host\n")
+            self.assertEqual(subjob_memory_usage_mb(tmpdir),{0:950,1:1300})
+    def test_estimate(self):
+        model = dose_grid_cost(dict(self.true_ram),1250.,16000.,self.true_time)
+        beams = [("proton",2000,10),("proton",1000,20)]
+        est = model.estimate("ct",1000000,2000000,beams)
+        ram1 = 1200+36+20
+        ram2 = 1250 # minimum
+        self.assertAlmostEqual(est["RAM per subjob [MB]"],ram1)
+        self.assertAlmostEqual(est["RAM of all subjobs [MB]"],10*ram1+20*ram2)
+        self.assertEqual(est["number of subjobs"],30)
+        self.assertAlmostEqual(est["post processing time [s]"],2*(20+2)+1e-7*2e6*30)
+        self.assertAlmostEqual(model.ram_per_subjob_mb("carbon","phantom",1e9,0),16000.)
+        self.assertIn("30 subjobs",cost_summary(est))
+        # a coarser grid is cheaper to post process
+        coarse = model.estimate("ct",1000000//8,2000000,beams)
+        self.assertLess(coarse["post processing time [s]"],est["post processing time [s]"])
+        with self.assertRaises(RuntimeError):
+            evaluate_linear_fit(dict(offset=1.,voxels=2.),dosegrid=3)
+
+# vim: set et softtabstop=4 sw=4 smartindent:
@@ -8,7 +8,12 @@
 import time
 import logging
 import os
+import json
+import socket
+import resource
+import threading
 import configparser
+from contextlib import contextmanager
 from filelock import Timeout, SoftFileLock
 
 def timestamp():
@@ -165,6 +170,335 @@ def get_last_log_ID():
     except Timeout:
         print("failed to acquire lock file {} for 3 seconds".format(lockfile))
         
-    return ID 
-    
-    
+    return ID
+
+###############################################################################################
+# TIMING SPANS
+###############################################################################################
+
+# The stages of a job, in the order in which they run. The job control
+# daemon ("DAEMON") runs in parallel with GATE, it is not on the critical path.
+job_stages = ("SUBMIT","PRE","GATE","POST")
+
+# default name of the span file, in the job work directory (next to the pre/postprocessor logs)
+span_file_name = "spans.jsonl"
+
+_span_file = None
+_span_stage = ""
+_span_stack = threading.local()
+
+def set_span_file(path,stage=""):
+    """
+    Spans (see `span`) are appended to the JSONL file `path`, each span is
+    labeled with the `stage` of the job (e.g. "PRE" or "POST"). With an empty
+    path the spans are only logged (debug level).
+    """
+    global _span_file, _span_stage
+    _span_file = os.path.abspath(path) if path else None
+    _span_stage = stage
+
+def _rss_mb():
+    try:
+        with open("/proc/self/statm","r") as f:
+            return int(f.read().split()[1])*resource.getpagesize()/1024.**2
+    except (OSError,IndexError,ValueError):
+        return None
+
+def _peak_rss_mb():
+    # ru_maxrss is given in kilobytes (on Linux)
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024.
+
+def _stack():
+    if not hasattr(_span_stack,"spans"):
+        _span_stack.spans = list()
+    return _span_stack.spans
+
+def write_span(record,path=None):
+    """
+    Appends one span record (a dictionary) as one line to the span file. A
+    single short write in append mode, so that several processes can write
+    to the same file.
+    """
+    logger = logging.getLogger(__name__)
+    path = path or _span_file
+    logger.debug("span {} took {:.3f} s wall time, {:.3f} s CPU time".format(record["path"],record["wall_s"],record["cpu_s"] or 0.))
+    if not path:
+        return
+    try:
+        with open(path,"a") as fp:
+            fp.write(json.dumps(record)+"\n")
+    except OSError as e:
+        logger.warning("failed to write span {} to {}: {}".format(record["path"],path,e))
+
+class _open_span:
+    def __init__(self,name,path,stage,step,attrs):
+        parent = _stack()[-1] if _stack() else None
+        self.name = name
+        self.path = path or (parent.path if parent else None)
+        self.stage = stage or (parent.stage if parent else _span_stage)
+        self.fullname = parent.fullname+"/"+name if parent else name
+        self.depth = parent.depth+1 if parent else 0
+        self.step = step
+        self.attrs = attrs
+        self.rss0 = _rss_mb()
+        self.peak0 = _peak_rss_mb()
+        self.cpu0 = time.process_time()
+        self.t0 = time.time()
+    def close(self,error=None):
+        t1 = time.time()
+        rss = _rss_mb()
+        # the kernel updates the peak lazily
+        peak = max(_peak_rss_mb(),rss or 0.)
+        record = dict(name=self.name,path=self.fullname,stage=self.stage,depth=self.depth,
+                      start=self.t0,end=t1,wall_s=t1-self.t0,cpu_s=time.process_time()-self.cpu0,
+                      rss_start_mb=self.rss0,rss_end_mb=rss,
+                      peak_rss_mb=peak,peak_rss_growth_mb=peak-self.peak0,
+                      pid=os.getpid(),host=socket.gethostname(),
+                      status="ok" if error is None else "error")
+        if error is not None:
+            record["error"] = str(error)
+        record.update(self.attrs)
+        write_span(record,self.path)
+
+def _close_step(error=None):
+    stack = _stack()
+    if stack and stack[-1].step:
+        stack.pop().close(error)
+
+@contextmanager
+def span(name,path=None,stage=None,**attrs):
+    """
+    Context manager (or function decorator) that records the wall time, the
+    CPU time (of the whole process) and the memory usage of the enclosed code
+    as a "span". Spans can be nested, the `path` of a span in the output is
+    the slash separated list of the names of the enclosing spans.
+
+    The resident memory is recorded at the start and at the end; the peak
+    resident memory is the peak of the process so far, so the growth of the
+    peak during the span is a lower bound of the extra memory that it needed.
+
+    Spans are written to the file `path` (default: the file configured with
+    `set_span_file`, or the file of the enclosing span). Extra keyword
+    arguments (e.g. the beam name) are added to the span record.
+    """
+    s = _open_span(name,path,stage,False,attrs)
+    _stack().append(s)
+    error = None
+    try:
+        yield s
+    except BaseException as e:
+        error = e
+        raise
+    finally:
+        _close_step(error)
+        _stack().remove(s)
+        s.close(error)
+
+def span_step(name,**attrs):
+    """
+    Starts a new step within the innermost open span: the previous step (if
+    any) ends here, the last step ends with the enclosing span. This is meant
+    for long functions with several successive stages, without re-indenting
+    each stage as a `with span(...)` block. Does nothing outside of a span.
+    """
+    _close_step()
+    if _stack():
+        _stack().append(_open_span(name,None,None,True,attrs))
+
+def record_span(name,start,end,cpu_s=None,path=None,stage=None,**attrs):
+    """
+    Writes a span for something that was timed elsewhere (e.g. the GATE
+    subjobs, from their stat actor output), as a top level span.
+    """
+    record = dict(name=name,path=name,stage=stage or _span_stage,depth=0,
+                  start=start,end=end,wall_s=end-start,cpu_s=cpu_s,
+                  pid=os.getpid(),host=socket.gethostname(),status="ok")
+    record.update(attrs)
+    write_span(record,os.path.abspath(path) if path else None)
+
+def read_spans(paths):
+    """
+    Reads span records from JSONL files, or from the span files in the given
+    job work directories. Each record gets a "job" entry, the directory of
+    the span file.
+    """
+    records = list()
+    for path in paths:
+        if os.path.isdir(path):
+            path = os.path.join(path,span_file_name)
+        job = os.path.dirname(os.path.abspath(path))
+        with open(path,"r") as fp:
+            for line in fp:
+                line = line.strip()
+                if line:
+                    record = json.loads(line)
+                    record["job"] = job
+                    records.append(record)
+    return records
+
+def summarize_spans(records):
+    """
+    Per job: the wall time of each stage (from the start of its first to the
+    end of its last top level span), the time spent on each top level span
+    and its direct children, and the critical path (the sum of the stages in
+    `job_stages`). The rest of the elapsed time was spent waiting, e.g. in the
+    HTCondor queue.
+    """
+    summary = dict()
+    for job in sorted(set([r["job"] for r in records])):
+        jrecords = [r for r in records if r["job"] == job]
+        stages = dict()
+        for stage in sorted(set([r["stage"] for r in jrecords]),key=lambda s: min([r["start"] for r in jrecords if r["stage"]==s])):
+            srecords = [r for r in jrecords if r["stage"] == stage]
+            top = [r for r in srecords if r["depth"] == 0]
+            if not top:
+                continue
+            parts = dict()
+            for r in srecords:
+                if r["depth"] > 1:
+                    continue
+                part = parts.setdefault(r["path"],dict(count=0,wall_s=0.,cpu_s=0.,peak_rss_mb=0.))
+                part["count"] += 1
+                part["wall_s"] += r["wall_s"]
+                part["cpu_s"] += r["cpu_s"] or 0.
+                part["peak_rss_mb"] = max(part["peak_rss_mb"],r.get("peak_rss_mb") or 0.)
+            stages[stage] = dict(start=min([r["start"] for r in top]),end=max([r["end"] for r in top]),
+                                 cpu_s=sum([r["cpu_s"] or 0. for r in top]),
+                                 errors=len([r for r in srecords if r["status"] != "ok"]),
+                                 parts=parts)
+            stages[stage]["wall_s"] = stages[stage]["end"]-stages[stage]["start"]
+        critical = sum([s["wall_s"] for name,s in stages.items() if name in job_stages])
+        elapsed = max([s["end"] for s in stages.values()])-min([s["start"] for s in stages.values()]) if stages else 0.
+        summary[job] = dict(stages=stages,critical_path_s=critical,elapsed_s=elapsed,waiting_s=max(0.,elapsed-critical))
+    return summary
+
+def format_span_summary(summary):
+    lines = list()
+    for job,js in summary.items():
+        lines.append("job {}".format(job))
+        lines.append("  elapsed {:.1f} s, critical path {:.1f} s, waiting {:.1f} s".format(js["elapsed_s"],js["critical_path_s"],js["waiting_s"]))
+        for stage,s in js["stages"].items():
+            pct = 100.*s["wall_s"]/js["critical_path_s"] if stage in job_stages and js["critical_path_s"] > 0 else None
+            lines.append("  {:8s} {:10.2f} s wall {:10.2f} s CPU {}{}".format(
+                stage,s["wall_s"],s["cpu_s"],
+                "{:5.1f}% of critical path".format(pct) if pct is not None else "(not on critical path)",
+                ", {} FAILED".format(s["errors"]) if s["errors"] else ""))
+            for path,part in sorted(s["parts"].items(),key=lambda kv: -kv[1]["wall_s"]):
+                lines.append("    {:50s} {:5d}x {:10.2f} s wall {:10.2f} s CPU {:8.1f} MB peak RSS".format(
+                    path,part["count"],part["wall_s"],part["cpu_s"],part["peak_rss_mb"]))
+    return "\n".join(lines)
+
+###############################################################################################
+# UNIT TESTING
+###############################################################################################
+
+import unittest
+import tempfile
+
+class test_spans(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name,span_file_name)
+        set_span_file(self.path,stage="POST")
+    def tearDown(self):
+        set_span_file(None)
+        self.tmpdir.cleanup()
+    def test_nesting(self):
+        with span("outer",beam="B1"):
+            span_step("first")
+            with span("inner"):
+                sum(range(100000))
+            span_step("second")
+            buf = bytearray(50*1024**2)
+            buf[::4096] = b"x"*len(buf[::4096])
+        span_step("ignored")
+        records = read_spans([self.tmpdir.name])
+        self.assertEqual([r["path"] for r in records],["outer/first/inner","outer/first","outer/second","outer"])
+        self.assertEqual([r["depth"] for r in records],[2,1,1,0])
+        outer = records[-1]
+        self.assertEqual(outer["beam"],"B1")
+        self.assertEqual(outer["stage"],"POST")
+        self.assertEqual(outer["status"],"ok")
+        self.assertEqual(outer["job"],self.tmpdir.name)
+        self.assertGreaterEqual(outer["wall_s"],records[1]["wall_s"]+records[2]["wall_s"]-1e-3)
+        self.assertGreater(outer["cpu_s"],0.)
+        self.assertGreater(outer["rss_end_mb"],0.)
+        self.assertGreaterEqual(outer["peak_rss_mb"],outer["rss_end_mb"])
+    def test_error(self):
+        with self.assertRaises(ValueError):
+            with span("failing"):
+                span_step("step")
+                raise ValueError("oops")
+        records = read_spans([self.path])
+        self.assertEqual([r["status"] for r in records],["error","error"])
+        self.assertEqual(records[-1]["error"],"oops")
+        # the stack is clean again
+        with span("next"):
+            pass
+        self.assertEqual(read_spans([self.path])[-1]["path"],"next")
+    def test_decorator_and_explicit_path(self):
+        other = os.path.join(self.tmpdir.name,"other.jsonl")
+        @span("decorated")
+        def f(x):
+            return 2*x
+        self.assertEqual(f(3),6)
+        with span("elsewhere",path=other,stage="SUBMIT"):
+            pass
+        self.assertEqual([r["path"] for r in read_spans([self.path])],["decorated"])
+        self.assertEqual([(r["path"],r["stage"]) for r in read_spans([other])],[("elsewhere","SUBMIT")])
+    def test_summary(self):
+        t0 = time.time()-1000.
+        record_span("preprocessing",t0,t0+50.,cpu_s=45.,stage="PRE")
+        record_span("GATE subjobs",t0+100.,t0+700.,cpu_s=6000.,stage="GATE",njobs=10)
+        record_span("dose_collector.add",t0+200.,t0+201.,cpu_s=1.,stage="DAEMON")
+        record_span("post_processing",t0+710.,t0+750.,cpu_s=39.,stage="POST")
+        summary = summarize_spans(read_spans([self.path]))[self.tmpdir.name]
+        self.assertEqual(list(summary["stages"].keys()),["PRE","GATE","DAEMON","POST"])
+        self.assertAlmostEqual(summary["critical_path_s"],690.)
+        self.assertAlmostEqual(summary["elapsed_s"],750.)
+        self.assertAlmostEqual(summary["waiting_s"],60.)
+        self.assertAlmostEqual(summary["stages"]["GATE"]["cpu_s"],6000.)
+        self.assertIn("not on critical path",format_span_summary({"job":summary}))
+
+class test_post_processing_spans(unittest.TestCase):
+    """
+    Runs the post processing (bin/postprocess_dose_results.py) of a synthetic job.
+    """
+    def test_post_processing(self):
+        from benchmarks.synthetic import write_job_directory
+        from benchmarks.suite import import_post_processing
+        with tempfile.TemporaryDirectory() as workdir:
+            write_job_directory(workdir,(8,24,32),njobs=3)
+            ppdr = import_post_processing(workdir)
+            parser = configparser.ConfigParser()
+            with open(os.path.join(workdir,"postprocessor.cfg"),"r") as fp:
+                parser.read_file(fp)
+            cwd = os.getcwd()
+            os.chdir(workdir)
+            try:
+                set_span_file(span_file_name,stage="POST")
+                cfg = ppdr.post_proc_config(parser,"B1")
+                with span("post_processing",beam=cfg.origname):
+                    self.assertTrue(ppdr.post_processing(cfg,dict(),list()))
+            finally:
+                set_span_file(None)
+                os.chdir(cwd)
+            records = read_spans([workdir])
+        post = [r for r in records if r["stage"] == "POST"]
+        gate = [r for r in records if r["stage"] == "GATE"]
+        self.assertEqual(post[-1]["path"],"post_processing")
+        self.assertEqual(post[-1]["beam"],"B1")
+        steps = [r["name"] for r in post if r["depth"] == 1]
+        self.assertEqual(steps,["sum subjob doses","scale","resample","mask","write"])
+        self.assertAlmostEqual(sum([r["wall_s"] for r in post if r["depth"] == 1]),post[-1]["wall_s"],delta=0.01)
+        for r in post:
+            self.assertEqual(r["status"],"ok")
+            self.assertGreaterEqual(r["wall_s"],0.)
+            self.assertLessEqual(r["start"],r["end"])
+        self.assertEqual(len(gate),1)
+        self.assertEqual(gate[0]["njobs"],3)
+        self.assertEqual(gate[0]["beam"],"B1")
+        summary = summarize_spans(records)[workdir]
+        self.assertEqual(set(summary["stages"].keys()),{"GATE","POST"})
+
+# vim: set et softtabstop=4 sw=4 smartindent:
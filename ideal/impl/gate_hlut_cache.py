@@ -8,7 +8,11 @@
 import os,stat
 import hashlib
 import shutil
+import tempfile
+import subprocess
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from filelock import FileLock
 import logging
 from impl.system_configuration import system_configuration
 logger=logging.getLogger(__name__)
@@ -23,59 +27,250 @@ def hlut_hash(density,composition):
                 h4sh.update(bytes(line,encoding='utf-8'))
     return h4sh.hexdigest()
 
-def hlut_cache_dir(density,composition,HUtol,create=False):
+def hlut_cache_root():
     syscfg = system_configuration.getInstance()
+    return os.path.join(syscfg['CT'],'cache')
+
+def hlut_cache_dir(density,composition,HUtol,create=False,cache_root=None):
+    if cache_root is None:
+        cache_root = hlut_cache_root()
     h4sh = hlut_hash(density,composition)
-    cache_dir = os.path.join(syscfg['CT'],'cache',h4sh,str(HUtol))
+    cache_dir = os.path.join(cache_root,h4sh,str(HUtol))
     if os.path.isdir(cache_dir):
         return cache_dir
     elif create:
         os.makedirs(cache_dir,exist_ok=True)
-        # store original density and composition files
-        cache_parent = os.path.dirname(cache_dir)
-        # copying the input files so that you know to which protocol this cache dir corresponds
-        shutil.copy(density,os.path.join(cache_parent,os.path.basename(density)))
-        shutil.copy(composition,os.path.join(cache_parent,os.path.basename(composition)))
+        _store_hlut_files(density,composition,os.path.dirname(cache_dir))
         return cache_dir
     # TODO: alternatively, throw something...
     return None
 
-def generate_hlut_cache(density,composition,HUtol,db=None):
-    syscfg = system_configuration.getInstance()
-    cache_dir = hlut_cache_dir(density,composition,HUtol,create=True)
-    if db is None:
-        materialsdb = os.path.join(syscfg['commissioning'],syscfg['materials database'])
-    else:
-        materialsdb = db
-    hlut_gen_cache_mac = os.path.join(syscfg['config dir'],'hlut_gen_cache.mac')
-    humatdb = os.path.join(cache_dir,'patient-HUmaterials.db')
-    hu2mattxt = os.path.join(cache_dir,'patient-HU2mat.txt')
-    adict = dict([("MATERIALS_DB",              materialsdb),
+def _store_hlut_files(density,composition,cache_parent):
+    # copying the input files so that you know to which protocol this cache dir corresponds
+    os.makedirs(cache_parent,exist_ok=True)
+    for f in [density,composition]:
+        dest = os.path.join(cache_parent,os.path.basename(f))
+        if not os.path.exists(dest):
+            shutil.copy(f,dest)
+
+def hlut_cache_lock(density,composition,HUtol,cache_root=None):
+    """
+    Lock for one cache directory, i.e. one particular pair of Schneider tables and one
+    density tolerance value. Whoever holds it, is allowed to generate that cache directory;
+    everyone else waits. The lock is an OS level file lock, which is released when the
+    process that holds it dies, so a killed job never leaves a stale lock behind.
+    """
+    if cache_root is None:
+        cache_root = hlut_cache_root()
+    os.makedirs(cache_root,exist_ok=True)
+    return FileLock(os.path.join(cache_root,"{}.{}.lock".format(hlut_hash(density,composition),HUtol)))
+
+def generate_hlut_cache(density,composition,HUtol,db=None,cache_root=None,gate_env=None,gate_exe="Gate",
+                        hlut_gen_cache_mac=None,logdir=None,lock_timeout=-1):
+    """
+    Run Gate to generate the interpolated materials database and the HU-to-material table
+    for a given Schneider density/composition pair and density tolerance.
+
+    Gate runs in a private temporary directory next to the final cache directory, which
+    is renamed into place only after Gate succeeded. So the cache directory either does
+    not exist or it is complete. Concurrent callers for the same tables wait on a lock
+    (with timeout `lock_timeout` seconds, negative means: wait forever) and then find
+    the cache generated by whoever was first, instead of running Gate again.
+
+    The keyword arguments with default `None` are taken from the system configuration,
+    they can be specified explicitly for testing.
+
+    Returns the success flag and the cache directory.
+    """
+    if cache_root is None:
+        cache_root = hlut_cache_root()
+    h4sh = hlut_hash(density,composition)
+    cache_dir = os.path.join(cache_root,h4sh,str(HUtol))
+    lock = hlut_cache_lock(density,composition,HUtol,cache_root)
+    tstart = datetime.now()
+    with lock.acquire(timeout=lock_timeout):
+        twait = (datetime.now()-tstart).total_seconds()
+        if twait > 1:
+            logger.info("waited {} seconds for the HLUT cache lock for {}".format(twait,cache_dir))
+        if os.path.isdir(cache_dir):
+            logger.info("HLUT cache {} was generated by someone else in the mean time".format(cache_dir))
+            return True, cache_dir
+        return _run_gate_hlut_cache(density,composition,HUtol,cache_dir,db,gate_env,gate_exe,hlut_gen_cache_mac,logdir)
+
+def _run_gate_hlut_cache(density,composition,HUtol,cache_dir,db,gate_env,gate_exe,hlut_gen_cache_mac,logdir):
+    # only call this while holding the HLUT cache lock
+    if None in [db,gate_env,hlut_gen_cache_mac,logdir]:
+        syscfg = system_configuration.getInstance()
+        if db is None:
+            db = os.path.join(syscfg['commissioning'],syscfg['materials database'])
+        if gate_env is None:
+            gate_env = syscfg['gate_env.sh']
+        if hlut_gen_cache_mac is None:
+            hlut_gen_cache_mac = os.path.join(syscfg['config dir'],'hlut_gen_cache.mac')
+        if logdir is None:
+            logdir = syscfg['logging']
+    cache_parent = os.path.dirname(cache_dir)
+    _store_hlut_files(density,composition,cache_parent)
+    tmp_dir = tempfile.mkdtemp(prefix=".{}.tmp.".format(os.path.basename(cache_dir)),dir=cache_parent)
+    humatdb = os.path.join(tmp_dir,'patient-HUmaterials.db')
+    hu2mattxt = os.path.join(tmp_dir,'patient-HU2mat.txt')
+    adict = dict([("MATERIALS_DB",              db),
                   ("SCHNEIDER_COMPOSITION_FILE",composition),
                   ("SCHNEIDER_DENSITY_FILE",    density),
                   ("DENSITY_TOLERANCE",         HUtol),
                   ("MATERIALS_INTERPOLATED",    humatdb),
                   ("HU2MAT_TABLE",              hu2mattxt)])
     aliases = "".join(["[{},{}]".format(name,val) for name,val in adict.items()])
-    gensh = os.path.join("/tmp","hlut_gen_cache.sh")
+    gensh = os.path.join(tmp_dir,"hlut_gen_cache.sh")
     tstart = datetime.now()
-    gate_log = os.path.join(syscfg['logging'],tstart.strftime("hlut_gen_cache_%y_%m_%d_%H_%M_%S.log"))
+    gate_log = os.path.join(logdir,tstart.strftime("hlut_gen_cache_%y_%m_%d_%H_%M_%S_")+os.path.basename(tmp_dir)[1:]+".log")
     with open(gensh,"w") as gensh_fh:
         gensh_fh.write("#!/usr/bin/env bash\n")
         gensh_fh.write("set -e\n")
         gensh_fh.write("set -x\n")
-        gensh_fh.write("source {}\n".format(syscfg['gate_env.sh']))
-        gensh_fh.write("time Gate -a{} {} >& {}\n".format(aliases,hlut_gen_cache_mac,gate_log))
+        if gate_env:
+            gensh_fh.write("source {}\n".format(gate_env))
+        gensh_fh.write("time {} -a{} {} >& {}\n".format(gate_exe,aliases,hlut_gen_cache_mac,gate_log))
     os.chmod(gensh,stat.S_IREAD|stat.S_IRWXU)
     logger.info("generating cache for {} and {} with density tolerance {} g/cm3".format(density,composition,HUtol))
-    logger.info("cache dir: {}".format(cache_dir))
-    #ret=os.system( gensh + " >& " + gate_log )
-    ret=os.system( gensh )
+    logger.info("cache dir: {} (temporary: {})".format(cache_dir,tmp_dir))
+    ret = subprocess.run([gensh],cwd=tmp_dir,stdout=subprocess.DEVNULL,stderr=subprocess.DEVNULL).returncode
     tend=datetime.now()
     dbl_chk = os.path.exists(humatdb) and os.path.exists(hu2mattxt)
     logger.info("return code: {}, job took {} seconds, new HLUT cache files {} exist.".format(ret,(tend-tstart).total_seconds(),("DO" if dbl_chk else "DO NOT")))
     logger.info("logs are in: {}".format(gate_log))
     success = (ret==0) and dbl_chk
+    if success:
+        os.remove(gensh)
+        os.rename(tmp_dir,cache_dir)
+    else:
+        shutil.rmtree(tmp_dir,ignore_errors=True)
     return success, cache_dir
 
+def warm_hlut_caches(tables,nthreads=4,**kwargs):
+    """
+    Generate the missing HLUT caches for a list of (density, composition, HUtol) triplets,
+    in parallel. Triplets with identical tables (same hash) are generated only once.
+    The keyword arguments are passed on to `generate_hlut_cache`.
+    Returns a dictionary with the cache directories as keys and success flags as values.
+    """
+    cache_root = kwargs.get("cache_root",None)
+    todo = dict()
+    for density,composition,HUtol in tables:
+        key = (hlut_hash(density,composition),str(HUtol))
+        if key in todo:
+            continue
+        if hlut_cache_dir(density,composition,HUtol,cache_root=cache_root) is not None:
+            logger.debug("HLUT cache for {} with tolerance {} already exists".format(key[0],HUtol))
+            continue
+        todo[key] = (density,composition,HUtol)
+    logger.info("going to generate {} HLUT cache(s) with {} thread(s)".format(len(todo),nthreads))
+    results = dict()
+    if not todo:
+        return results
+    with ThreadPoolExecutor(max(1,min(nthreads,len(todo)))) as pool:
+        futures = [pool.submit(generate_hlut_cache,d,c,t,**kwargs) for d,c,t in todo.values()]
+        for f in futures:
+            ok,cache_dir = f.result()
+            results[cache_dir] = ok
+            if not ok:
+                logger.error("failed to generate HLUT cache {}".format(cache_dir))
+    return results
+
+#######################################################################
+# TESTING
+#######################################################################
+import sys
+import unittest
+from filelock import Timeout
+
+STUB_GATE = """#!/usr/bin/env python3
+# fake Gate: parse the aliases and write fake materials files
+import sys, re, time
+aliases = dict(re.findall(r"\\[([^,\\]]+),([^\\]]*)\\]", sys.argv[1][2:]))
+with open(aliases["MATERIALS_INTERPOLATED"],"w") as f:
+    f.write("[Materials]\\nfake_material: d=1.0 g/cm3; n=1\\n")
+time.sleep(0.2)
+with open(aliases["HU2MAT_TABLE"],"w") as f:
+    f.write("-1024 3000 fake_material\\n")
+with open(sys.argv[2]+".count","a") as f:
+    f.write("x")
+"""
+
+class test_hlut_cache(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        d = self.tmpdir.name
+        self.gate = os.path.join(d,"Gate")
+        with open(self.gate,"w") as f:
+            f.write(STUB_GATE)
+        os.chmod(self.gate,stat.S_IRWXU)
+        self.mac = os.path.join(d,"hlut_gen_cache.mac")
+        with open(self.mac,"w") as f:
+            f.write("# fake macro\n")
+        self.density = os.path.join(d,"density.txt")
+        self.composition = os.path.join(d,"composition.txt")
+        with open(self.density,"w") as f:
+            f.write("-1000 0.00121\n3000 2.0\n")
+        with open(self.composition,"w") as f:
+            f.write("-1000 0.00121 H 0 O 100\n")
+        self.kwargs = dict(db=os.path.join(d,"GateMaterials.db"),cache_root=os.path.join(d,"cache"),gate_env="",
+                           gate_exe=self.gate,hlut_gen_cache_mac=self.mac,logdir=d)
+    def tearDown(self):
+        self.tmpdir.cleanup()
+    def ngate_runs(self):
+        with open(self.mac+".count") as f:
+            return len(f.read())
+    def test_generate(self):
+        ok,cache_dir = generate_hlut_cache(self.density,self.composition,0.01,**self.kwargs)
+        self.assertTrue(ok)
+        self.assertEqual(cache_dir,hlut_cache_dir(self.density,self.composition,0.01,cache_root=self.kwargs["cache_root"]))
+        self.assertEqual(sorted(os.listdir(cache_dir)),['patient-HU2mat.txt','patient-HUmaterials.db'])
+        # no temporary directories left behind
+        self.assertEqual(sorted(os.listdir(os.path.dirname(cache_dir))),['0.01','composition.txt','density.txt'])
+        ok,cache_dir = generate_hlut_cache(self.density,self.composition,0.01,**self.kwargs)
+        self.assertTrue(ok)
+        self.assertEqual(self.ngate_runs(),1)
+    def test_concurrent_generate(self):
+        with ThreadPoolExecutor(4) as pool:
+            results = list(pool.map(lambda i: generate_hlut_cache(self.density,self.composition,0.01,**self.kwargs),range(4)))
+        self.assertTrue(all([ok for ok,_ in results]))
+        self.assertEqual(len(set([d for _,d in results])),1)
+        self.assertEqual(self.ngate_runs(),1)
+    def test_warm(self):
+        tables = [(self.density,self.composition,t) for t in [0.01,0.1,0.01]]
+        results = warm_hlut_caches(tables,nthreads=2,**self.kwargs)
+        self.assertEqual(len(results),2)
+        self.assertTrue(all(results.values()))
+        self.assertEqual(self.ngate_runs(),2)
+        self.assertEqual(warm_hlut_caches(tables,nthreads=2,**self.kwargs),dict())
+    def test_lock_per_tolerance(self):
+        # while one tolerance is being generated, another one is not blocked
+        with hlut_cache_lock(self.density,self.composition,0.01,self.kwargs["cache_root"]):
+            ok,cache_dir = generate_hlut_cache(self.density,self.composition,0.1,lock_timeout=5,**self.kwargs)
+            self.assertTrue(ok)
+            with self.assertRaises(Timeout):
+                generate_hlut_cache(self.density,self.composition,0.01,lock_timeout=0.1,**self.kwargs)
+    def test_killed_lock_holder(self):
+        # a process that dies while holding the lock does not leave a stale lock behind
+        script = "import sys,os,time\nfrom filelock import FileLock\nlock = FileLock(sys.argv[1])\nlock.acquire()\nprint('locked',flush=True)\ntime.sleep(60)\n"
+        lockfile = hlut_cache_lock(self.density,self.composition,0.01,self.kwargs["cache_root"]).lock_file
+        proc = subprocess.Popen([sys.executable,"-c",script,lockfile],stdout=subprocess.PIPE,text=True)
+        try:
+            self.assertEqual(proc.stdout.readline().strip(),"locked")
+            with self.assertRaises(Timeout):
+                generate_hlut_cache(self.density,self.composition,0.01,lock_timeout=0.1,**self.kwargs)
+        finally:
+            proc.kill()
+            proc.wait()
+            proc.stdout.close()
+        ok,cache_dir = generate_hlut_cache(self.density,self.composition,0.01,lock_timeout=5,**self.kwargs)
+        self.assertTrue(ok)
+    def test_failure(self):
+        self.kwargs["gate_exe"] = "false"
+        ok,cache_dir = generate_hlut_cache(self.density,self.composition,0.01,**self.kwargs)
+        self.assertFalse(ok)
+        self.assertFalse(os.path.exists(cache_dir))
+        self.assertEqual(sorted(os.listdir(os.path.dirname(cache_dir))),['composition.txt','density.txt'])
+
 # vim: set et softtabstop=4 sw=4 smartindent:
@@ -21,6 +21,7 @@ import logging
 logger=logging.getLogger(__name__)
 from impl.idc_details import MCStatType
 from impl.system_configuration import system_configuration
+from utils.dose_snapshot import publish_snapshot_sh, manifest_path
 import numpy as np
 
 def roman_year():
@@ -42,7 +43,7 @@ def check(ct=True,**kwargs):
     undefined = list()
     mandatory = [ "beamset", "uid", "spotfile", "physicslist",
                   "isoC", "beamline", "beamnr", "beamname", "radtype",
-                  "rsids", "rmids", "dose_nvoxels" ]
+                  "rsids", "rmids", "dose_nvoxels", "snapshot_schedule" ]
     if ct:
         mandatory += ["ct_mhd", "ct_bb", "mod_patient_angle", "gantry_angle",
                       "HU2mat", "HUmaterials", "dose_center", "dose_size"]
@@ -129,7 +130,17 @@ def write_gate_macro_file(ct=True,**kwargs):
     kwargs["dosemhd"]=dosemhd
     kwargs["dosedosemhd"]=dosedose+".mhd"
     kwargs["dosedoseraw"]=dosedose+".raw"
-    kwargs["stop_on_script_every_n_seconds"] = syscfg["stop on script actor time interval [s]"]
+    schedule = kwargs["snapshot_schedule"] # see impl.snapshot_cadence
+    logger.debug(str(schedule))
+    kwargs["stop_on_script_every_n_seconds"] = schedule.check_interval
+    kwargs["stat_every_n_seconds"] = schedule.stat_interval
+    # see utils.dose_snapshot: the sparse format is made by a python script, the full MHD copy by a shell function
+    if syscfg["snapshot format"] == "sparse":
+        kwargs["publish_snapshot"] = "publish_dose_snapshot.py"
+        kwargs["publish_snapshot_sh"] = ""
+    else:
+        kwargs["publish_snapshot"] = "publish_snapshot"
+        kwargs["publish_snapshot_sh"] = publish_snapshot_sh
     dose_nvoxels=kwargs["dose_nvoxels"]
     kwargs["dnx"]=dose_nvoxels[0]
     kwargs["dny"]=dose_nvoxels[1]
@@ -290,7 +301,7 @@ def write_gate_macro_file(ct=True,**kwargs):
 #=====================================================
 
 /gate/actor/addActor SimulationStatisticActor stat
-/gate/actor/stat/saveEveryNSeconds       120
+/gate/actor/stat/saveEveryNSeconds       {stat_every_n_seconds}
 /gate/actor/stat/save {{OUTPUTDIR}}/statActor-{label}.txt
 
 #=====================================================
@@ -346,10 +357,15 @@ ls -lrt $d
 ls -ld tmp/$d
 ls -lrt tmp/$d
 ls "$d/{dosedosemhd}" "$d/{dosedoseraw}" "$d/statActor-{label}.txt"
-type locked_copy.py
-locked_copy.py -v -d tmp/$d/ -l tmp/$d/{dosedosemhd}.lock "$d/{dosedosemhd}" "$d/{dosedoseraw}" "$d/statActor-{label}.txt"
+{publish_snapshot_sh}
+{publish_due_sh}
+if publish_due "$d/statActor-{label}.txt" "{manifest}" ; then
+    {publish_snapshot} "$d/{dosedosemhd}" "$d/statActor-{label}.txt" tmp/$d
+else
+    echo "not yet publishing a new snapshot of {dosedosemhd}"
+fi
 exit 0
-""".format(**kwargs))
+""".format(publish_due_sh=schedule.publish_due_sh(),manifest=manifest_path("tmp/$d/"+kwargs["dosedosemhd"]),**kwargs))
     output_section += """
 /control/strif {{RUNMAC}} == mac/run_all.mac {}
 /control/strif {{RUNMAC}} == mac/run_qt.mac {}
@@ -510,4 +526,118 @@ exit 0
     logger.debug("DONE: wrote all mac files")
     return main_fname,dosemhd
 
+#######################################################################
+# TESTING
+#######################################################################
+import unittest
+import tempfile
+import subprocess
+from types import SimpleNamespace
+from impl.snapshot_cadence import snapshot_cadence
+from utils.dose_snapshot import read_manifest
+
+class test_snapshot_cadence_macros(unittest.TestCase):
+    """
+    The stat actor and stop-on-script intervals in the main macro and the
+    snapshot publication in the flag script, for several cadences.
+    """
+    @classmethod
+    def setUpClass(cls):
+        try:
+            syscfg = system_configuration.getInstance()
+        except RuntimeError:
+            syscfg = system_configuration({"materials database":"GateMaterials.db","username":"tester","snapshot format":"sparse"})
+        try:
+            syscfg["materials database"], syscfg["username"], syscfg["snapshot format"]
+        except KeyError:
+            raise unittest.SkipTest("system configuration was initialized without the settings for the macros")
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.cwd = os.getcwd()
+        os.chdir(self.tmpdir.name)
+        for d in ["mac","data","tmp/output.1.0","output.1.0"]:
+            os.makedirs(d)
+    def tearDown(self):
+        os.chdir(self.cwd)
+        self.tmpdir.cleanup()
+    def _write(self,schedule):
+        beamline = SimpleNamespace(name="TESTBL",beamline_details_mac_file="",source_properties_file=lambda radtype: "/some/where/{}_source.txt".format(radtype))
+        phantom = SimpleNamespace(dose_to_water=False,label="water_box")
+        main_macfile,dosemhd = write_gate_macro_file(ct=False,beamset="BS",uid="1.2.3",spotfile="data/spots.txt",physicslist="QBBC_EMZ",
+                                                     isoC=np.zeros(3),beamline=beamline,beamnr=1,beamname="B1",radtype="proton",
+                                                     rsids=[],rmids=[],dose_nvoxels=[100,100,100],phantom=phantom,snapshot_schedule=schedule)
+        with open(main_macfile,"r") as fp:
+            mac = fp.read()
+        label = dosemhd[len("idc-"):-len(".mhd")]
+        with open("mac/stop_on_script_{}.mac".format(label),"r") as fp:
+            sosmac = fp.read()
+        return mac,sosmac,"mac/check_the_flags_{}.sh".format(label),label
+    def _env(self):
+        # what bin/IDEAL_env.sh does in the GATE job script
+        ideal = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        bindir = os.path.join(os.path.dirname(ideal),"bin")
+        return dict(os.environ,clusterid="1",procid="0",
+                    PATH=bindir+os.pathsep+os.environ.get("PATH",""),
+                    PYTHONPATH=ideal+os.pathsep+os.environ.get("PYTHONPATH",""))
+    def _run_flags(self,flags,label,nevents,elapsed=60.):
+        # what GATE does at a stop-on-script check: save the dose and the statistics, run the flag script
+        d = "output.1.0"
+        dosedose = "idc-{}-Dose".format(label)
+        with open(os.path.join(d,dosedose+".raw"),"wb") as fp:
+            fp.write(bytes(16))
+        with open(os.path.join(d,dosedose+".mhd"),"w") as fp:
+            fp.write("ObjectType = Image\nNDims = 1\nDimSize = 4\nElementType = MET_FLOAT\nElementDataFile = {}.raw\n".format(dosedose))
+        with open(os.path.join(d,"statActor-{}.txt".format(label)),"w") as fp:
+            fp.write("# NumberOfEvents = {}\n# ElapsedTime           = {}\n".format(nevents,elapsed))
+        ret = subprocess.run(["sh",flags],env=self._env(),capture_output=True)
+        self.assertEqual(ret.returncode,0,msg=ret.stdout.decode()+ret.stderr.decode())
+        snapshot = read_manifest(os.path.join("tmp",d,dosedose+".mhd.snapshot"))
+        self.assertEqual(snapshot["format"],system_configuration.getInstance()["snapshot format"])
+        return snapshot["nevents"]
+    def _age_snapshot(self,label,seconds):
+        # pretend that the last publication was some time ago
+        manifest = os.path.join("tmp","output.1.0","idc-{}-Dose.mhd.snapshot".format(label))
+        generation = read_manifest(manifest)["generation"]
+        with open(manifest,"r") as fp:
+            text = fp.read()
+        with open(manifest,"w") as fp:
+            fp.write(text.replace(generation,str(int(generation)-int(seconds*1e9))))
+    def test_fixed(self):
+        mac,sosmac,flags,label = self._write(snapshot_cadence("fixed",fixed_interval=300).schedule(3600,100**3))
+        self.assertIn("/gate/actor/stat/saveEveryNSeconds       120\n",mac)
+        self.assertIn("/gate/actor/stopWhenReady/saveEveryNSeconds 300\n",sosmac)
+        # every check is published
+        self.assertEqual(self._run_flags(flags,label,1000),1000)
+        self.assertEqual(self._run_flags(flags,label,2000),2000)
+    def test_adaptive_short_job(self):
+        mac,sosmac,flags,label = self._write(snapshot_cadence("adaptive",min_interval=30,max_interval=600).schedule(300,100**3))
+        self.assertIn("/gate/actor/stat/saveEveryNSeconds       30\n",mac)
+        self.assertIn("/gate/actor/stopWhenReady/saveEveryNSeconds 30\n",sosmac)
+        self.assertEqual(self._run_flags(flags,label,1000,elapsed=240.),1000)
+        # close to the predicted end, every check is published
+        self._age_snapshot(label,30.)
+        self.assertEqual(self._run_flags(flags,label,2000,elapsed=270.),2000)
+    def test_adaptive_long_job(self):
+        mac,sosmac,flags,label = self._write(snapshot_cadence("adaptive",min_interval=30,max_interval=600).schedule(7200,100**3))
+        self.assertIn("/gate/actor/stat/saveEveryNSeconds       360\n",mac)
+        self.assertIn("/gate/actor/stopWhenReady/saveEveryNSeconds 360\n",sosmac)
+        self.assertEqual(self._run_flags(flags,label,1000,elapsed=360.),1000)
+        # early in a long job, the next check is not published...
+        self._age_snapshot(label,360.)
+        self.assertEqual(self._run_flags(flags,label,2000,elapsed=720.),1000)
+        # ... but close to the predicted end every check is published
+        self._age_snapshot(label,720.)
+        self.assertEqual(self._run_flags(flags,label,3000,elapsed=6840.),3000)
+        self._age_snapshot(label,360.)
+        self.assertEqual(self._run_flags(flags,label,4000,elapsed=7200.),4000)
+    def test_large_grid(self):
+        mac,sosmac,flags,label = self._write(snapshot_cadence("adaptive",min_interval=30,max_interval=600,write_budget_mb_per_s=1.).schedule(300,512*512*300))
+        self.assertIn("/gate/actor/stopWhenReady/saveEveryNSeconds 315\n",sosmac)
+    def test_stop_flag(self):
+        mac,sosmac,flags,label = self._write(snapshot_cadence("fixed").schedule(0,0))
+        with open("STOP_idc-{}-Dose.mhd".format(label),"w") as fp:
+            fp.write("stop\n")
+        ret = subprocess.run(["sh",flags],env=self._env(),capture_output=True)
+        self.assertEqual(ret.returncode,1)
+
 # vim: set et softtabstop=4 sw=4 smartindent:
@@ -50,10 +50,9 @@ multiple results, an exception is thrown and the user should try again.
 """
 
 from impl.system_configuration import system_configuration
-from impl.gate_hlut_cache import generate_hlut_cache, hlut_cache_dir
+from impl.gate_hlut_cache import generate_hlut_cache, hlut_cache_dir, warm_hlut_caches
 import os
 import configparser
-import pydicom
 import logging
 import hashlib
 logger=logging.getLogger(__name__)
@@ -69,6 +68,7 @@ class hlut:
     coded by the commissioning physicist.
     """
     def __init__(self,name,prsr_section,hutol=None):
+        from pydicom.datadict import keyword_dict
         syscfg = system_configuration.getInstance()
         self.name = name
         self.cache_dir = None
@@ -124,7 +124,7 @@ class hlut:
             if k in non_dicom_keys:
                 continue
             dk = str(k).replace(" ","")
-            if dk in pydicom.datadict.keyword_dict.keys():
+            if dk in keyword_dict.keys():
                 m = str(v).strip()
                 if m == "":
                     raise ValueError("DICOM match criterion cannot be empty or only white space")
@@ -327,6 +327,22 @@ class hlut_conf:
             matchtxt="\n".join(matches)
             raise KeyError(f"Failed to find unique match for CT protocol, please check and fix 'hlut.conf'! These protocols all match: {matchtxt}")
         return matches[0]
+    def warm_caches(self,nthreads=4,hutols=None):
+        """
+        Generate the HU-to-material caches for all Schneider type CT protocols
+        that do not have one yet, so that no user job has to wait for Gate to
+        do this the first time a CT protocol is used. By default the density
+        tolerance of each protocol is used, `hutols` can be a list of extra
+        density tolerance values to generate caches for. The caches are
+        generated in parallel, `nthreads` at a time.
+        """
+        tables = list()
+        for name,h in self.__all_hluts.items():
+            if h.type != "Schneider":
+                continue
+            for hutol in [h.hutol] + list(hutols or []):
+                tables.append((h.density,h.composition,hutol))
+        return warm_hlut_caches(tables,nthreads=nthreads)
 
 
 #######################################################################
@@ -339,6 +355,7 @@ from impl.system_configuration import get_sysconfig
 
 class test_good_hlut_conf(unittest.TestCase):
     def setUp(self):
+        import pydicom
         # bunch of test CT files (each from a different imaginary image series...)
         syscfg = get_sysconfig(filepath='./cfg/unit_test_system.cfg',username="foobar_admin",want_logfile="")
         self.ct1 = pydicom.Dataset()
@@ -12,21 +12,25 @@ import os, sys
 import re
 import numpy as np
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 from impl.dual_logging import timestamp
 from impl.idc_enum_types import MCStatType, MCPriorityType
 from impl.gate_hlut_cache import generate_hlut_cache, hlut_cache_dir
 from impl.system_configuration import system_configuration
 from impl.hlut_conf import hlut_conf
-from utils.bounding_box import bounding_box
-from utils.roi_utils import region_of_interest, list_roinames
+from utils.bounding_box import bounding_box, union_of_boxes
+from utils.roi_utils import list_roinames, get_structure_set_contours
 from utils.ct_dicom_to_img import ct_image_from_dicom
 from utils.beamset_info import beamset_info
 from utils.crop import crop_image
 from impl.dicom_dose_template import write_dicom_dose_template
+from impl.dose_grid_cost import dose_grid_cost, evaluate_linear_fit
 import logging
 logger=logging.getLogger(__name__)
 
 class IDC_details:
+    # the stages of LoadPlanFile, as reported to the progress callback
+    load_stages = ("plan","plan dose","structure set","CT","ROIs")
     def __init__(self,guimain=None):
         self._gui_main = guimain
         self.NA = "NA"
@@ -59,6 +63,7 @@ class IDC_details:
         #self.mc_stat_q = MCStatType.Nions_per_beam
         #self.mc_stat_thr = 1000000
         self.mc_stat_thr = list(MCStatType.default_values)
+        self._preview_backup = None
         self.dosegrid_spacing = np.ones(3,dtype=float)
         self.dosegrid_nvoxels = np.ones(3,dtype=int)
         self.dosegrid_size = np.ones(3,dtype=float)
@@ -109,9 +114,21 @@ class IDC_details:
     @property
     def ctprotocol_name(self):
         return self._ctprotocol_name
-    def SetPlanFilePath(self,rpfilepath):
+    def SetPlanFilePath(self,rpfilepath,progress=None):
         if not bool(rpfilepath):
             return
+        self.LoadPlanFile(rpfilepath,progress)
+        self.PublishPlan()
+    def LoadPlanFile(self,rpfilepath,progress=None):
+        """
+        Read the plan, plan dose, structure set and CT for plan file `rpfilepath`.
+        The CT is read in a separate thread while the ROIs are parsed.
+        This does not update any widgets, so the GUI can run it in a worker
+        thread and call `PublishPlan` afterwards, on the main thread.
+        The optional `progress` callback is called with the name of each
+        finished stage (see `load_stages`), possibly from different threads.
+        """
+        report = progress if progress else (lambda stage: None)
         if not os.path.exists(rpfilepath):
             logger.error("got non-existing RP DICOM file path {}".format(rpfilepath))
         self.Reset()
@@ -128,6 +145,7 @@ class IDC_details:
             logger.error("OOPSIE: {}".format(fnfe))
             self.Reset()
             raise
+        report("plan")
         # try to get CT image
         rpdir = os.path.dirname(self.rp_filepath)
         try:
@@ -141,6 +159,7 @@ class IDC_details:
             logger.debug("getting plan dose info")
             self.rd_plan_info = self.bs_info.plan_dose
             logger.debug("got plan dose info")
+            report("plan dose")
             ss_ref_uid = self.rp_dataset.ReferencedStructureSetSequence[0].ReferencedSOPInstanceUID
             logger.debug("going to try to find the file with structure set with UID '{}'".format(ss_ref_uid))
             nskip=0
@@ -154,7 +173,8 @@ class IDC_details:
                     continue
                 try:
                     logger.debug(s)
-                    ds = pydicom.dcmread(os.path.join(rpdir,s))
+                    # a structure set has no pixel data, and we do not need the CT pixels here
+                    ds = pydicom.dcmread(os.path.join(rpdir,s),stop_before_pixels=True)
                     dcmtype = ds.SOPClassUID.name
                 except:
                     ndcmfail+=1
@@ -172,10 +192,11 @@ class IDC_details:
                     logger.debug("AND/OR because it has the wrong SOP Instance UID: {} != {}".format(ds.SOPInstanceUID,ss_ref_uid))
             if self.structure_set is None:
                 raise RuntimeError("could not find structure set with UID={}; skipped {} with wrong suffix, got {} with 'dcm' suffix but pydicom could not read it, got {} with wrong class UID and/or instance UID. It could well be that this is a commissioning plan without CT and structure set data.".format(ss_ref_uid,nskip,ndcmfail,nwrongtype))
-            self.ct_info = ct_image_from_dicom(rpdir,uid=ct_series_uid)
-            logger.debug("image spacing is {}".format(self.ct_info.img.GetSpacing()))
-            logger.debug("image size is {}".format(self.ct_info.img.GetLargestPossibleRegion().GetSize()))
-            logger.debug("image origin is {}".format(self.ct_info.img.GetOrigin()))
+            report("structure set")
+            # read the CT in the background, while the ROIs are parsed
+            pool = ThreadPoolExecutor(1)
+            ct_future = pool.submit(self._load_ct,rpdir,ct_series_uid,report)
+            pool.shutdown(wait=False)
             # the following code should be encapsulated in a "roi_info" class/object
             logger.debug("checking out structure set with {} ROIs".format(len(self.structure_set.StructureSetROISequence)))
             for i,roi in enumerate(self.structure_set.StructureSetROISequence):
@@ -222,6 +243,8 @@ class IDC_details:
                 except Exception as e:
                     logger.error("something went wrong with {}th ROI in the structure set: {}".format(i,e))
                     logger.error("skipping that for now, keep fingers crossed")
+            report("ROIs")
+            self.ct_info = ct_future.result()
             dose_roinr = str(self.bs_info.target_ROI_number)
             dose_roiname = "NOT FOUND" if dose_roinr not in self.roinumbers else self.roinames[self.roinumbers.index(dose_roinr)]
             self.bs_info.target_ROI_name = dose_roiname
@@ -246,6 +269,17 @@ class IDC_details:
             self._PHANTOM = True
             self._phantom_specs = None
             #self.Reset()
+    def _load_ct(self,rpdir,ct_series_uid,report):
+        ct_info = ct_image_from_dicom(rpdir,uid=ct_series_uid)
+        logger.debug("image spacing is {}".format(ct_info.img.GetSpacing()))
+        logger.debug("image size is {}".format(ct_info.img.GetLargestPossibleRegion().GetSize()))
+        logger.debug("image origin is {}".format(ct_info.img.GetOrigin()))
+        report("CT")
+        return ct_info
+    def PublishPlan(self):
+        """
+        Update all subscribed widgets after `LoadPlanFile`.
+        """
         if self.bs_info is not None:
             for s in self.subscribers:
                 logger.debug("updating widget of type {}".format(type(s)))
@@ -266,26 +300,74 @@ class IDC_details:
             dose_nvoxels = ct_bb_nvoxels
         else:
             dose_nvoxels = np.prod(self.dosegrid_nvoxels)
-        radtype="proton" if "PROTON" == self.bs_info[beamname].RadiationType.upper() else "carbon"
+        radtype=self.radiation_type(beamname)
         logger.debug("going to use memory fit for radtype={} and geo={}".format(radtype,geo))
         mb_fit = syscfg['condor memory fit {} {}'.format(radtype,geo)]
-        mb_guess = 0.
-        for k,v in mb_fit.items():
-            if k=='offset':
-                mb_guess+=v
-            elif k=='dosegrid':
-                mb_guess+=v*dose_nvoxels
-            elif k=='ct':
-                mb_guess+=v*ct_bb_nvoxels
-            elif k=='nspots':
-                mb_guess+=v*self.bs_info[beamname].nspots
-            else:
-                logger.error("don't know with memory fit item key='{}' value='{}'".format(k,v))
+        mb_guess = evaluate_linear_fit(mb_fit,dosegrid=dose_nvoxels,ct=ct_bb_nvoxels if self._CT else 0,nspots=self.bs_info[beamname].nspots)
         #print(f"{mb_guess=}")
         mb_guess = mb_default
         mb = min(mb_max,max(mb_min,mb_guess))
         logger.debug("RAM fit gives guess {} MB for this beam, minmb={} and maxmb={}, so {} is used".format(mb_guess,mb_min,mb_max,mb))
         return mb
+    def radiation_type(self,beamname):
+        """
+        Radiation type as used in the memory fits in the system configuration.
+        """
+        return "proton" if "PROTON" == self.bs_info[beamname].RadiationType.upper() else "carbon"
+    @property
+    def sim_dose_nvoxels(self):
+        """
+        Number of voxels of the simulated dose. With a phantom this is the
+        dose grid. With a CT this is the cropped CT; before the preprocessing
+        config file is written the cropping is not known yet, and the part of
+        the CT that is covered by the dose grid is used as an estimate.
+        """
+        if not self.run_with_CT_geometry:
+            return int(np.prod(self.dosegrid_nvoxels))
+        if self.score_dose_on_full_CT:
+            return int(np.prod(self.ct_info.size))
+        return int(np.prod(np.ceil(self.dosegrid_size/self.ct_info.voxel_size)))
+    def GetCostEstimate(self):
+        """
+        Estimate of the voxel counts, RAM and post processing time of a job
+        with the current dose grid and beam selection, see `impl.dose_grid_cost`.
+        """
+        syscfg = system_configuration.getInstance()
+        model = dose_grid_cost.from_syscfg(syscfg)
+        njobs = syscfg['number of cores'] # same as job_executor
+        beams = [(self.radiation_type(name),self.bs_info[name].nspots,njobs) for name in self.beam_names if self.BeamIsSelected(name)]
+        geo = "ct" if self.run_with_CT_geometry else "phantom"
+        return model.estimate(geo,np.prod(self.dosegrid_nvoxels),self.sim_dose_nvoxels,beams)
+    @property
+    def preview(self):
+        return self._preview_backup is not None
+    def SetPreviewMode(self,on):
+        """
+        A "preview" job runs with a coarser dose grid and fewer primaries
+        (see the `[dose grid cost]` section of the system configuration).
+        Switching the preview mode off restores the previous dose grid and
+        statistics goals.
+        """
+        if bool(on) == self.preview:
+            return
+        if on:
+            syscfg = system_configuration.getInstance()
+            coarsening = syscfg['preview dose grid coarsening']
+            fraction = syscfg['preview primaries fraction']
+            self._preview_backup = (self.dosegrid_nvoxels.copy(),list(self.mc_stat_thr))
+            for idim,n in enumerate(self._preview_backup[0]):
+                self.UpdateDoseGridResolution(idim,max(1,int(np.ceil(n/coarsening))))
+            tmin,nprim,unc = self.mc_stat_thr
+            self.mc_stat_thr[MCStatType.Nminutes_per_job] = int(np.ceil(tmin*fraction))
+            self.mc_stat_thr[MCStatType.Nions_per_beam] = int(np.ceil(nprim*fraction))
+            self.mc_stat_thr[MCStatType.Xpct_unc_in_target] = min(99.,float(unc/np.sqrt(fraction)))
+            logger.debug("preview mode: dose grid {} statistics goals {}".format(self.dosegrid_nvoxels,self.mc_stat_thr))
+        else:
+            nvoxels,self.mc_stat_thr = self._preview_backup
+            self._preview_backup = None
+            for idim,n in enumerate(nvoxels):
+                self.UpdateDoseGridResolution(idim,n)
+            logger.debug("preview mode off: dose grid {} statistics goals {}".format(self.dosegrid_nvoxels,self.mc_stat_thr))
     def DoseGridSticksPartlyOutsideOfCTVolume(self):
         return self._NeedDosePadding
     def set_gui_main(self,guimain):
@@ -426,16 +508,22 @@ class IDC_details:
         logger.debug("bounding box based on {} ROIs in HU override list".format(len(self.HUoverride.keys())))
         syscfg = system_configuration.getInstance()
         dosegrid_air_margin = float(syscfg["air box margin [mm]"])
-        self.roi_bb = bounding_box()
+        # the ROI bounding boxes come straight from the contour points, no need to construct region_of_interest objects
+        contours = get_structure_set_contours(self.structure_set)
+        indices,margins = [],[]
         for roiname in set(list(self.HUoverride.keys())+[self.external_roiname]):
             if roiname == "!HUMAX":
                 logger.debug("ignoring !HUMAX")
                 continue
-            roi_id,margin = (roiname[1:],dose_air_margin) if roiname[0]=="!" else (roiname,0.)
-            roi = region_of_interest(ds=self.structure_set,roi_id=roi_id)
-            logger.debug("merging roi_bb with id={} BB={}, using margin={}".format(roi_id,roi.bb,margin))
-            self.roi_bb.should_contain(roi.bb.mincorner-margin)
-            self.roi_bb.should_contain(roi.bb.maxcorner+margin)
+            roi_id,margin = (roiname[1:],dosegrid_air_margin) if roiname[0]=="!" else (roiname,0.)
+            indices.append(contours.find_roi(roi_id)[0])
+            margins.append(margin)
+        limits = contours.bounding_boxes(indices)
+        limits[:,:,0] -= np.array(margins)[:,np.newaxis]
+        limits[:,:,1] += np.array(margins)[:,np.newaxis]
+        for i,margin,lim in zip(indices,margins,limits):
+            logger.debug("merging roi_bb with id={} BB={}, using margin={}".format(contours.roinames[i],lim.tolist(),margin))
+        self.roi_bb = union_of_boxes(limits)
         logger.debug("ROI bounding box is now {}".format(self.roi_bb))
     def GetCTBoundingBox(self):
         if self.score_dose_on_full_CT:
@@ -461,6 +549,10 @@ class IDC_details:
         parser['dicom'].update({"directory":os.path.dirname(self.rp_filepath)})
         parser['dicom'].update({"RSfile":self.structure_set_filename})
         parser['dicom'].update({"CTuid":self.ct_info.uid})
+        # the parsed contours, so that the preprocessing does not need to parse the DICOM contours again
+        rs_contours = os.path.join(submitdir,"structure_set_contours.npz")
+        get_structure_set_contours(self.structure_set).save(rs_contours)
+        parser['dicom'].update({"RScontours":rs_contours})
         ct_bb = self.GetCTBoundingBox()
         logger.debug("ct bounding box section")
         parser.add_section('ct bounding box')
@@ -528,6 +620,8 @@ class IDC_details:
         parser.optionxform = lambda option : option
         parser['DEFAULT']["run gamma analysis"]       = str(syscfg["run gamma analysis"])
         parser['DEFAULT']["debug"]       = str(syscfg["debug"])
+        parser['DEFAULT']["dose accumulation precision"] = syscfg["dose accumulation precision"]
+        parser['DEFAULT']["resampling memory budget [mb]"] = str(syscfg["resampling memory budget [mb]"])
         parser['DEFAULT']["first output dicom"]       = self.output_job
         parser['DEFAULT']["second output dicom"]      = self.output_job_2nd
         parser['DEFAULT']["nFractions"]               = str(self.bs_info.Nfractions)
@@ -624,6 +718,8 @@ class IDC_details:
         parser['DEFAULT']["TPS dicom plan file path"] = self.rp_filepath
         parser['DEFAULT']["condor submit directory"] = condordir
         parser['DEFAULT']["dose grid resolution"] = " ".join([str(v) for v in self.dosegrid_nvoxels])
+        parser['DEFAULT']["preview"] = "yes (dose grid coarsening {}, primaries fraction {})".format(
+                syscfg['preview dose grid coarsening'],syscfg['preview primaries fraction']) if self.preview else "no"
         parser['DEFAULT']["selected beams"] = " ".join(["'{}'".format(beamname) for beamname,yes in self.beam_selection.items() if yes])
         parser['DEFAULT']["deselected beams"] = " ".join(["'{}'".format(beamname) for beamname,yes in self.beam_selection.items() if not yes])
         parser['DEFAULT']["log file path"] = syscfg["log file path"]
@@ -680,6 +776,11 @@ class IDC_details:
             parser[origname].update(qspec)
             parser[origname]["nTPS"]=str(nTPS)
             parser[origname]["sanitized beam name (e.g. used in name of main mac file)"]=str(beamname)
+            # inputs of the cost model (see impl.dose_grid_cost)
+            parser[origname]["radiation type"]=self.radiation_type(origname)
+            parser[origname]["geometry"]="ct" if self.run_with_CT_geometry else "phantom"
+            parser[origname]["number of spots"]=str(self.bs_info[origname].nspots)
+            parser[origname]["simulated dose voxels"]=str(int(np.prod(self.ct_nvoxels)) if self.run_with_CT_geometry else self.sim_dose_nvoxels)
             def_msw_scaling=syscfg['msw scaling']["default"]
             key = "_".join([self.bs_info[origname].TreatmentMachineName,self.bs_info[origname].RadiationType]).lower()
             parser[origname]['msw scaling'] = " ".join([str(c) for c in syscfg['msw scaling'].get(key,def_msw_scaling)])
@@ -751,6 +852,7 @@ class IDC_details:
         #self.dosegrid_origin[idim] = self.dosegrid_center[idim] - 0.5*(new_nvoxels-1)*newval
     def SetDefaultDoseGridSettings(self):
         logger.debug("going to set default dose grid settings")
+        self.SetPreviewMode(False)
         if self._CT:
             if self.rd_plan_info:
                 self.def_dosegrid_nvoxels = self.rd_plan_info.nvoxels
@@ -73,7 +73,8 @@ from impl.gate_macro import write_gate_macro_file
 from impl.hlut_conf import hlut_conf
 from impl.idc_enum_types import MCStatType
 from impl.system_configuration import system_configuration
-from impl.dual_logging import get_high_level_logfile, get_last_log_ID
+from impl.snapshot_cadence import snapshot_cadence
+from impl.dual_logging import get_high_level_logfile, get_last_log_ID, span, span_step, span_file_name
 
 logger = logging.getLogger(__name__)
 # Get file handler to the high level log file
@@ -93,7 +94,9 @@ class condor_job_executor(job_executor):
         self._mac_files=[]
         self._qspecs={}
         self._generate_RUNGATE_submit_directory()
-        self._populate_RUNGATE_submit_directory()
+        with span("_populate_RUNGATE_submit_directory",stage="SUBMIT",
+                  path=os.path.join(self._RUNGATE_submit_directory,span_file_name)):
+            self._populate_RUNGATE_submit_directory()
         # update general log file
         high_log.info("IdealID: {}".format(str(get_last_log_ID()+1)))
         high_log.info("Working dir: {}".format(str(self._RUNGATE_submit_directory)))
@@ -170,6 +173,19 @@ class condor_job_executor(job_executor):
                                     dose_center =self.details.GetDoseCenter(),
                                     dose_size =self.details.GetDoseSize() )
         
+    def _get_snapshot_schedule(self,dose_nvoxels):
+        """
+        Snapshot intervals for a beam, see `impl.snapshot_cadence`. The
+        predicted duration of the subjobs is the time out set by the user,
+        or else the default time per job of the system configuration.
+        """
+        syscfg = system_configuration.getInstance()
+        minutes = self.details.mc_stat_thr[MCStatType.Nminutes_per_job]
+        if minutes <= 0:
+            minutes = syscfg[MCStatType.cfglabels[MCStatType.Nminutes_per_job]][1]
+        schedule = snapshot_cadence.from_syscfg(syscfg).schedule(60.*minutes,np.prod(dose_nvoxels))
+        logger.debug(str(schedule))
+        return schedule
     def _get_macfile_info_for_beam(self, beam, macfile_beam_settings, macfile_ct_settings ):
         ####################
         syscfg = system_configuration.getInstance()
@@ -218,6 +234,8 @@ class condor_job_executor(job_executor):
             self._summary += msg
         if self.details.dosegrid_changed:
             self._summary += "dose grid resolution changed to {}\n".format(self.details.GetNVoxels())
+        if self.details.preview:
+            self._summary += "PREVIEW: coarse dose grid and reduced statistics goals {}\n".format(self.details.mc_stat_thr)
         #TODO: change api for 'write_gate_macro_file' to take fewer arguments
         macfile_input = dict( beamline=bml,
                               beamnr=beamnr,
@@ -402,6 +420,7 @@ class condor_job_executor(job_executor):
         ####################
         save_cwd = os.getcwd()
         
+        span_step("setting up work directory")
         self._setupWorDir()
         
         ## re-define some variables for shorter code and clean special characters
@@ -409,6 +428,7 @@ class condor_job_executor(job_executor):
         beamset = self.details.bs_info
         beamsetname = re.sub(self._badchars,"_",beamset.name)
         spotfile = os.path.join("data","TreatmentPlan4Gate-{}.txt".format(beamset.name.replace(" ","_")))
+        span_step("writing plan and macro files")
         gate_plan = gate_pbs_plan_file(spotfile,allow0=True)
         gate_plan.import_from(beamset)
         macfile_ct_settings = dict()
@@ -443,6 +463,8 @@ class condor_job_executor(job_executor):
                 continue
             # create macro beam dictionary for each beam
             macfile_input = self._get_macfile_info_for_beam(beam, macfile_beam_settings, macfile_ct_settings )
+            schedule = self._get_snapshot_schedule(macfile_input['dose_nvoxels'])
+            macfile_input.update(snapshot_schedule=schedule)
             beamname = macfile_input['beamname']
             bml = macfile_input['beamline']
             radtype = beam.RadiationType
@@ -461,6 +483,7 @@ class condor_job_executor(job_executor):
                                         origname=beam.Name,
                                         dosecorrfactor=str(dose_corr_factor),
                                         dosemhd=beam_dose_mhd,
+                                        snapshotinterval=str(schedule.check_interval),
                                         macfile=main_macfile,
                                         dose2water=str(use_ct_geo_flag or self.details.PhantomSpecs.dose_to_water),
                                         isocenter=" ".join(["{}".format(v) for v in beam.IsoCenter]))
@@ -474,6 +497,7 @@ class condor_job_executor(job_executor):
         #self._summary + "{} seconds estimated for simulation of whole plan".format(self._ect)
         
         ## write condor files ##
+        span_step("writing condor files")
         rsd=self._RUNGATE_submit_directory
         os.makedirs(os.path.join(rsd,"tmp"),exist_ok=True) # the 'mode' argument is ignored (not only on Windows)
         os.chmod(os.path.join(rsd,"tmp"),mode=0o777)
@@ -482,7 +506,7 @@ class condor_job_executor(job_executor):
         self._write_RunGATEqt_sh(use_ct_geo_flag)
         logger.debug("wrote run debugging shell script with GUI")
         # TODO: write the condor stuff directly in python?
-        input_files = ["RunGATE.sh", "macdata.tar.gz","{}/locked_copy.py".format(syscfg["bindir"])]
+        input_files = ["RunGATE.sh", "macdata.tar.gz"]
         if use_ct_geo_flag:
             input_files.append("ct.tar.gz")
         self._write_RunGATE_submit()
@@ -490,6 +514,7 @@ class condor_job_executor(job_executor):
         self.details.WritePostProcessingConfigFile(self._RUNGATE_submit_directory,self._qspecs,plan_dose_file)
         self._write_dagman(use_ct_geo_flag)
         logger.debug("wrote condor dagman file")
+        span_step("archiving macro and data files")
         with tarfile.open("macdata.tar.gz","w:gz") as tar:
             tar.add("mac")
             tar.add("data")
@@ -5,7 +5,6 @@
 #   See LICENSE for further details
 # -----------------------------------------------------------------------------
 
-import numpy as np
 import os
 import configparser
 import logging
@@ -28,6 +27,9 @@ class phantom_specs:
         self._gui_name=docs["gui name"]
         self._help_text=docs["help text"]
         dosegrid=phantom_parser["dose grid"]
+        # imported here, not at module level: impl.system_configuration imports this module,
+        # and the entry points that only need the system configuration should start fast
+        import numpy as np
         self._grid_size=np.array( ( dosegrid.getfloat("x grid size [mm]"),
                                     dosegrid.getfloat("y grid size [mm]"),
                                     dosegrid.getfloat("z grid size [mm]") ) )
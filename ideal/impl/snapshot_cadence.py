@@ -0,0 +1,201 @@
+# -----------------------------------------------------------------------------
+#   Copyright (C): MedAustron GmbH, ACMIT Gmbh and Medical University Vienna
+#   This software is distributed under the terms
+#   of the GNU Lesser General  Public Licence (LGPL)
+#   See LICENSE for further details
+# -----------------------------------------------------------------------------
+
+"""
+Cadence of the intermediate dose snapshots of the GATE subjobs.
+
+Each subjob periodically saves its dose and statistics ("check"), runs the
+flag script that checks the STOP flag of the job control daemon and, if
+due, publishes the dose snapshot for the daemon (see `utils.dose_snapshot`).
+
+With the "fixed" cadence (the default) every subjob checks with the interval
+``stop on script actor time interval [s]`` of the ``[simulation]`` section and
+publishes at every check, as IDEAL always did.
+
+With the "adaptive" cadence the intervals are computed per job from the
+predicted duration of the job and the size of the dose grid:
+
+* the check interval is a fraction of the predicted duration, so that a job
+  overshoots its statistical goal by at most a few percent of its run time,
+  but not shorter than the time needed to write the dose grid with the
+  configured write rate budget, and within the configured minimum and maximum;
+* the snapshot is published rarely early in the job and more often near the
+  predicted stop: the minimum time between two publications is a fraction of
+  the predicted remaining time, between the check interval and the maximum
+  interval. From the predicted stop onwards every check is published.
+
+The daemon polls with the shortest check interval of all beams of the job.
+"""
+
+import logging
+logger=logging.getLogger(__name__)
+
+class snapshot_schedule:
+    """
+    The snapshot intervals of one beam, see `snapshot_cadence.schedule`.
+    """
+    def __init__(self,adaptive,check_interval,stat_interval,max_gap=0,predicted_seconds=0,ramp=0.):
+        self.adaptive = adaptive
+        self.check_interval = int(check_interval)
+        self.stat_interval = int(stat_interval)
+        self.max_gap = int(max_gap)
+        self.predicted_seconds = int(predicted_seconds)
+        self.ramp = ramp
+    def publish_gap(self,elapsed):
+        """
+        Minimum time in seconds between two publications, `elapsed` seconds after the start of the subjob.
+        """
+        if not self.adaptive:
+            return 0
+        return min(self.max_gap,max(self.check_interval,self.ramp*(self.predicted_seconds-elapsed)))
+    def publish_due(self,elapsed,since_last):
+        """
+        Should the snapshot be published, `elapsed` seconds after the start
+        of the subjob and `since_last` seconds after the previous publication
+        (None if nothing has been published yet)? The checks are not exactly
+        on time, so half a check interval of slack is allowed.
+        """
+        if since_last is None:
+            return True
+        return since_last >= self.publish_gap(elapsed) - 0.5*self.check_interval
+    def publish_due_sh(self):
+        """
+        Shell version of `publish_due`, for the flag script (same logic, but
+        with the elapsed time from the stat actor file and the time of the
+        previous publication from the generation in the snapshot manifest).
+        Usage: publish_due <stat actor file> <snapshot manifest>
+        """
+        if not self.adaptive:
+            return "\npublish_due () {\n    return 0\n}\n"
+        return r"""
+publish_due () {
+    local elapsed=$(sed -n 's/^# ElapsedTime *= *//p' "$1")
+    local last=""
+    if [ -r "$2" ] ; then
+        last=$(sed -n 's/^generation = *//p' "$2")
+    fi
+    if [ -z "$last" ] ; then
+        return 0
+    fi
+    awk -v t="${elapsed:-0}" -v last="$last" -v now="$(date +%s)" 'BEGIN { gap = RAMP*(PREDICTED-t); if (gap < CHECK) gap = CHECK; if (gap > MAXGAP) gap = MAXGAP; exit !(now - last/1e9 >= gap - 0.5*CHECK) }'
+}
+""".replace("RAMP",repr(self.ramp)).replace("PREDICTED",str(self.predicted_seconds)).replace("MAXGAP",str(self.max_gap)).replace("CHECK",str(self.check_interval))
+    def __repr__(self):
+        if self.adaptive:
+            return "adaptive snapshot schedule: check every {} s, publish at most every {} s, predicted duration {} s".format(self.check_interval,self.max_gap,self.predicted_seconds)
+        return "fixed snapshot schedule: check and publish every {} s".format(self.check_interval)
+
+class snapshot_cadence:
+    modes = ("fixed","adaptive")
+    # adaptive: number of checks during the predicted duration of a job
+    checks_per_job = 20
+    # adaptive: minimum time between publications, as a fraction of the predicted remaining time
+    ramp = 0.5
+    # the stat actor interval that IDEAL always used with the fixed cadence
+    fixed_stat_interval = 120
+    def __init__(self,mode="fixed",fixed_interval=300,min_interval=30,max_interval=600,write_budget_mb_per_s=2.):
+        if mode not in self.modes:
+            raise ValueError("unknown snapshot cadence '{}', choose from: {}".format(mode,", ".join(self.modes)))
+        if not 0 < min_interval <= max_interval:
+            raise ValueError("snapshot intervals should satisfy 0 < minimum ({}) <= maximum ({})".format(min_interval,max_interval))
+        if write_budget_mb_per_s <= 0:
+            raise ValueError("snapshot write budget should be positive, got {}".format(write_budget_mb_per_s))
+        self.mode = mode
+        self.fixed_interval = fixed_interval
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.write_budget_mb_per_s = write_budget_mb_per_s
+    @classmethod
+    def from_syscfg(cls,syscfg):
+        return cls(syscfg['snapshot cadence'],
+                   syscfg['stop on script actor time interval [s]'],
+                   syscfg['snapshot interval minimum [s]'],
+                   syscfg['snapshot interval maximum [s]'],
+                   syscfg['snapshot write budget [mb/s]'])
+    def schedule(self,predicted_seconds,dose_nvoxels):
+        """
+        The snapshot schedule for a beam with the given predicted duration
+        (in seconds) of the GATE subjobs and number of voxels of the dose actor.
+        """
+        if self.mode == "fixed":
+            return snapshot_schedule(False,self.fixed_interval,self.fixed_stat_interval)
+        # GATE writes the dose as 32 bit floats
+        write_seconds = 4.*dose_nvoxels/(1e6*self.write_budget_mb_per_s)
+        check = min(self.max_interval,max(self.min_interval,write_seconds,predicted_seconds/self.checks_per_job))
+        return snapshot_schedule(True,round(check),round(check),
+                                 max_gap=round(max(check,self.max_interval)),
+                                 predicted_seconds=round(predicted_seconds),
+                                 ramp=self.ramp)
+
+#######################################################################
+# TESTING
+#######################################################################
+import unittest
+import os
+import time
+import tempfile
+import subprocess
+
+class test_snapshot_cadence(unittest.TestCase):
+    def test_fixed(self):
+        s = snapshot_cadence("fixed",fixed_interval=300).schedule(3600,512*512*300)
+        self.assertFalse(s.adaptive)
+        self.assertEqual(s.check_interval,300)
+        self.assertEqual(s.stat_interval,120)
+        self.assertTrue(s.publish_due(10.,1.))
+    def test_short_job(self):
+        # a 5 minute job with a small grid: checks every 30 s (the minimum) instead of every 300 s
+        s = snapshot_cadence("adaptive",min_interval=30,max_interval=600).schedule(300,100*100*100)
+        self.assertEqual(s.check_interval,30)
+        self.assertEqual(s.stat_interval,30)
+    def test_long_job(self):
+        # a 2 hour job: checks every 6 minutes, early publications are 10 minutes apart
+        s = snapshot_cadence("adaptive",min_interval=30,max_interval=600).schedule(7200,100*100*100)
+        self.assertEqual(s.check_interval,360)
+        self.assertEqual(s.publish_gap(0.),600)
+        self.assertEqual(s.publish_gap(7200.-800.),400)
+        self.assertEqual(s.publish_gap(7200.),360)
+        self.assertEqual(s.publish_gap(9000.),360)
+        self.assertFalse(s.publish_due(100.,360.))
+        self.assertTrue(s.publish_due(100.,600.))
+        self.assertTrue(s.publish_due(7100.,360.))
+        self.assertTrue(s.publish_due(100.,None))
+    def test_large_grid(self):
+        # 512*512*300 float voxels = 315 MB, with 2 MB/s not more often than every 157 s
+        c = snapshot_cadence("adaptive",min_interval=30,max_interval=600,write_budget_mb_per_s=2.)
+        self.assertEqual(c.schedule(600,512*512*300).check_interval,157)
+        # but never longer than the maximum
+        self.assertEqual(c.schedule(600,2000*512*300).check_interval,600)
+    def test_bad_settings(self):
+        with self.assertRaises(ValueError):
+            snapshot_cadence("sometimes")
+        with self.assertRaises(ValueError):
+            snapshot_cadence("adaptive",min_interval=100,max_interval=50)
+        with self.assertRaises(ValueError):
+            snapshot_cadence("adaptive",write_budget_mb_per_s=0.)
+    def test_publish_due_sh(self):
+        # the shell version agrees with the python version
+        s = snapshot_cadence("adaptive",min_interval=30,max_interval=600).schedule(7200,100*100*100)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            stat = os.path.join(tmpdir,"statActor.txt")
+            manifest = os.path.join(tmpdir,"dose.mhd.snapshot")
+            def due_sh(elapsed,since_last):
+                with open(stat,"w") as fp:
+                    fp.write("# NumberOfEvents = 1000\n# ElapsedTime           = {}\n# ElapsedTimeWoInit     = 1.0\n".format(elapsed))
+                if since_last is None:
+                    if os.path.exists(manifest):
+                        os.remove(manifest)
+                else:
+                    with open(manifest,"w") as fp:
+                        fp.write("[snapshot]\ngeneration = {}\n".format(int((time.time()-since_last)*1e9)))
+                script = s.publish_due_sh()+'publish_due "{}" "{}"\n'.format(stat,manifest)
+                return subprocess.run(["sh","-c",script]).returncode == 0
+            for elapsed,since_last in [(100.,None),(100.,360.),(100.,700.),(6500.,330.),(6500.,200.),(8000.,200.),(8000.,50.)]:
+                self.assertEqual(due_sh(elapsed,since_last),s.publish_due(elapsed,since_last),msg="elapsed={} since_last={}".format(elapsed,since_last))
+        self.assertEqual(subprocess.run(["sh","-c",snapshot_cadence().schedule(0,0).publish_due_sh()+"publish_due x y"]).returncode,0)
+
+# vim: set et softtabstop=4 sw=4 smartindent:
@@ -11,6 +11,7 @@ import getpass
 import copy
 from impl.idc_enum_types import MCStatType
 from impl.phantom_specs import phantom_specs
+from impl.snapshot_cadence import snapshot_cadence
 from impl.dual_logging import get_dual_logging, create_logger, timestamp, get_logging_n
 import configparser
 from glob import glob
@@ -142,17 +143,64 @@ def get_condor_memory_req_fits(syscfg,sysprsr,logger):
                 key='condor memory fit {} {}'.format(radtype,geo)
                 # e.g.: condor memory fit proton ct = offset 500 ct 1e-4 dosegrid 1e-3 nspots 0.
                 syscfg[key]=dict(offset=syscfg['condor memory request default [MB]'])
-                values=[v.lower() for v in parser.get(key,"").split()]
-                for var in ['offset','dosegrid','ct','nspots']:
-                    if var in values:
-                        i=values.index(var)
-                        values.pop(i)
-                        syscfg[key][var]=float(values.pop(i))
-                if len(values)>0:
-                    logger.error("ERROR: unrecognized entries in condor memory fit:".format(" ".join(values)))
-                    raise RuntimeError("ERROR: unrecognized entries in condor memory fit:".format(" ".join(values)))
+                parse_linear_fit(syscfg[key],parser.get(key,""),['offset','dosegrid','ct','nspots'],logger)
                 logger.debug("{} = {}".format(key,syscfg[key]))
 
+def parse_linear_fit(fit,txt,variables,logger):
+    """
+    Parses the coefficients of a linear fit, e.g. "offset 500 dosegrid 1e-3",
+    into the dictionary `fit`.
+    """
+    values=[v.lower() for v in txt.split()]
+    for var in variables:
+        if var in values:
+            i=values.index(var)
+            values.pop(i)
+            fit[var]=float(values.pop(i))
+    if len(values)>0:
+        logger.error("ERROR: unrecognized entries in linear fit: {}".format(" ".join(values)))
+        raise RuntimeError("ERROR: unrecognized entries in linear fit: {}".format(" ".join(values)))
+
+def get_dose_grid_cost_model(syscfg,sysprsr,logger):
+    # e.g.: post processing time fit = offset 30 dosegrid 1e-6 subjobdose 2e-7
+    # rough defaults, to be replaced by the output of bin/calibrate_cost_model.py
+    key='post processing time fit'
+    syscfg[key]=dict(offset=30.,dosegrid=1e-6,subjobdose=2e-7)
+    syscfg['preview dose grid coarsening']=2
+    syscfg['preview primaries fraction']=0.1
+    if sysprsr.has_section('dose grid cost'):
+        parser = sysprsr['dose grid cost']
+        if key in parser:
+            syscfg[key]=dict()
+            parse_linear_fit(syscfg[key],parser[key],['offset','dosegrid','subjobdose'],logger)
+        syscfg['preview dose grid coarsening']=parser.getint('preview dose grid coarsening',syscfg['preview dose grid coarsening'])
+        syscfg['preview primaries fraction']=parser.getfloat('preview primaries fraction',syscfg['preview primaries fraction'])
+    if syscfg['preview dose grid coarsening'] < 1:
+        raise RuntimeError("preview dose grid coarsening should be a positive integer, got {}".format(syscfg['preview dose grid coarsening']))
+    if not 0 < syscfg['preview primaries fraction'] <= 1:
+        raise RuntimeError("preview primaries fraction should be larger than 0 and at most 1, got {}".format(syscfg['preview primaries fraction']))
+    for k in [key,'preview dose grid coarsening','preview primaries fraction']:
+        logger.debug("{} = {}".format(k,syscfg[k]))
+
+
+def get_job_monitor_settings(syscfg,sysprsr,logger):
+    # the shared job monitoring service (bin/job_monitor_daemon.py), instead of one job control daemon per job
+    syscfg['job monitor service']=False
+    syscfg['job monitor socket']=os.path.join(syscfg['logdir'],'job_monitor.sock')
+    syscfg['job monitor workers']=2
+    syscfg['job monitor memory budget [mb]']=4096.
+    if sysprsr.has_section('job monitor'):
+        parser = sysprsr['job monitor']
+        syscfg['job monitor service']=parser.getboolean('use job monitor service',syscfg['job monitor service'])
+        syscfg['job monitor socket']=parser.get('socket',syscfg['job monitor socket'])
+        syscfg['job monitor workers']=parser.getint('worker threads',syscfg['job monitor workers'])
+        syscfg['job monitor memory budget [mb]']=parser.getfloat('memory budget [mb]',syscfg['job monitor memory budget [mb]'])
+    if syscfg['job monitor workers'] < 1:
+        raise RuntimeError("job monitor worker threads should be a positive integer, got {}".format(syscfg['job monitor workers']))
+    if syscfg['job monitor memory budget [mb]'] <= 0:
+        raise RuntimeError("job monitor memory budget should be positive, got {}".format(syscfg['job monitor memory budget [mb]']))
+    for k in ['job monitor service','job monitor socket','job monitor workers','job monitor memory budget [mb]']:
+        logger.debug("{} = {}".format(k,syscfg[k]))
 
 def get_mc_stats_settings(syscfg,sysprsr,logger):
     mc_stats_config = {
@@ -232,7 +280,14 @@ def get_simulation_install(syscfg,sysprsr,logger):
                           'remove dose outside external',
                           'gamma index parameters dta_mm dd_percent thr_percent def',
                           'stop on script actor time interval [s]',
+                          'snapshot cadence',
+                          'snapshot interval minimum [s]',
+                          'snapshot interval maximum [s]',
+                          'snapshot write budget [mb/s]',
+                          'snapshot format',
                           'htcondor next job start delay [s]',
+                          'dose accumulation precision',
+                          'resampling memory budget [mb]',
                           'run gamma analysis',
                           'write mhd unscaled dose',
                           'write mhd scaled dose',
@@ -258,8 +313,32 @@ def get_simulation_install(syscfg,sysprsr,logger):
     syscfg['remove dose outside external'] = simulation.getboolean('remove dose outside external',False)
     syscfg["gamma index parameters dta_mm dd_percent thr_percent def"] = simulation.get("gamma index parameters dta_mm dd_percent thr_percent def","")
     syscfg['stop on script actor time interval [s]'] = simulation.getint('stop on script actor time interval [s]',300)
+    syscfg['snapshot cadence'] = simulation.get('snapshot cadence','fixed').strip().lower()
+    syscfg['snapshot interval minimum [s]'] = simulation.getint('snapshot interval minimum [s]',30)
+    syscfg['snapshot interval maximum [s]'] = simulation.getint('snapshot interval maximum [s]',600)
+    syscfg['snapshot write budget [mb/s]'] = simulation.getfloat('snapshot write budget [mb/s]',2.)
+    try:
+        snapshot_cadence.from_syscfg(syscfg)
+    except ValueError as e:
+        logger.error(str(e))
+        raise RuntimeError(str(e))
+    syscfg['snapshot format'] = simulation.get('snapshot format','sparse').strip().lower()
+    if syscfg['snapshot format'] not in ('sparse','mhd'):
+        msg="snapshot format should be 'sparse' or 'mhd', got '{}'".format(syscfg['snapshot format'])
+        logger.error(msg)
+        raise RuntimeError(msg)
     syscfg['htcondor next job start delay [s]'] = simulation.getfloat('htcondor next job start delay [s]',1.)
     # TODO: check that SoS actor time interval and next job start delay are not crazy
+    syscfg['dose accumulation precision'] = simulation.get('dose accumulation precision','float64').strip().lower()
+    if syscfg['dose accumulation precision'] not in ('float64','float32'):
+        msg="dose accumulation precision should be 'float64' or 'float32', got '{}'".format(syscfg['dose accumulation precision'])
+        logger.error(msg)
+        raise RuntimeError(msg)
+    syscfg['resampling memory budget [mb]'] = simulation.getfloat('resampling memory budget [mb]',0.)
+    if syscfg['resampling memory budget [mb]'] < 0:
+        msg="resampling memory budget [mb] should be zero (no limit) or positive, got {}".format(syscfg['resampling memory budget [mb]'])
+        logger.error(msg)
+        raise RuntimeError(msg)
     syscfg['run gamma analysis']=simulation.getboolean('run gamma analysis',False)
     syscfg['write mhd unscaled dose']=simulation.getboolean('write mhd unscaled dose',False)
     syscfg['write mhd scaled dose']=simulation.getboolean('write mhd scaled dose',False)
@@ -537,6 +616,8 @@ def get_sysconfig(filepath=None,verbose=False,debug=False,username=None,want_log
     get_mc_stats_settings(syscfg,system_parser,logger)
     get_simulation_install(syscfg,system_parser,logger)
     get_condor_memory_req_fits(syscfg,system_parser,logger)
+    get_dose_grid_cost_model(syscfg,system_parser,logger)
+    get_job_monitor_settings(syscfg,system_parser,logger)
     get_phantoms(syscfg,logger)
     get_materials(syscfg,system_parser,logger)
     get_tmp_correction_factors(syscfg,system_parser,logger)
@@ -150,17 +150,8 @@ class bounding_box(object):
         inclusive/exclusive image indices of the lower/upper corners,
         respectively.
         """
-        # generically, this is what we want to do:
-        bb_img = bounding_box(img=img)
-        spacing = np.array(img.GetSpacing())
-        ibbmin,devmin=np.divmod(self.mincorner-bb_img.mincorner,spacing)
-        ibbmax,devmax=np.divmod(self.maxcorner-bb_img.mincorner,spacing)
-        # but if we are "almost exactly" on a voxel boundary we need to be picky on which side to land
-        below=np.isclose(devmin,spacing,rtol=rtol,atol=atol)
-        above=(devmax>atol)
-        ibbmin[below]+=1 # add one IF on a voxel boundary
-        ibbmax[above]+=1 # add one UNLESS on a voxel boundary
-        return np.int32(ibbmin),np.int32(ibbmax)
+        ibbmin,ibbmax = box_indices_in_image(self.limits[np.newaxis],img,rtol=rtol,atol=atol)
+        return ibbmin[0],ibbmax[0]
     @property
     def xmin(self):
         return self.limits[0,0]
@@ -180,6 +171,101 @@ class bounding_box(object):
     def zmax(self):
         return self.limits[2,1]
 
+#######################################################################
+# BATCHED BOUNDING BOXES
+#######################################################################
+# Many bounding boxes at once are represented by an array of shape (N,3,2):
+# limits[i] has the same layout as the `limits` of a single bounding_box.
+# Empty boxes (e.g. a ROI without contours) have the limits of a reset box,
+# min=+inf and max=-inf.
+
+def box_limits(boxes):
+    """
+    The limits of a sequence of bounding_box objects, as an (N,3,2) array.
+    """
+    return np.array([bb.limits for bb in boxes],dtype=float).reshape(-1,3,2)
+
+def box_volumes(limits):
+    """
+    The volumes of N boxes given by limits of shape (N,3,2); zero for empty boxes.
+    """
+    alimits = np.asarray(limits,dtype=float)
+    finite = np.isfinite(alimits).all(axis=(1,2))
+    volumes = np.zeros(len(alimits))
+    volumes[finite] = np.prod(np.diff(alimits[finite],axis=2)[:,:,0],axis=1)
+    return volumes
+
+def boxes_from_points(points,offsets=None):
+    """
+    The bounding boxes of N groups of points, as an (N,3,2) array of limits.
+    The points are given as one (M,3) array. Group i consists of the points
+    `points[offsets[i]:offsets[i+1]]`, so `offsets` has N+1 elements. Without
+    offsets, all points form one group. Groups without points get empty
+    limits (min=+inf, max=-inf).
+    """
+    apoints = np.asarray(points,dtype=float).reshape(-1,3)
+    aoffsets = np.array([0,len(apoints)] if offsets is None else offsets,dtype=int)
+    limits = np.empty((len(aoffsets)-1,3,2))
+    limits[:,:,0] = np.inf
+    limits[:,:,1] = -np.inf
+    filled = np.diff(aoffsets)>0
+    if filled.any():
+        # empty groups are skipped, so that each reduction only spans the points of one group
+        starts = aoffsets[:-1][filled]
+        apoints = apoints[:aoffsets[-1]]
+        limits[filled,:,0] = np.minimum.reduceat(apoints,starts,axis=0)
+        limits[filled,:,1] = np.maximum.reduceat(apoints,starts,axis=0)
+    return limits
+
+def union_of_boxes(limits):
+    """
+    The smallest bounding box that contains all N boxes given by limits of
+    shape (N,3,2), like calling `should_contain` with the corners of each
+    box. Empty (reset) boxes do not contribute.
+    """
+    alimits = np.asarray(limits,dtype=float).reshape(-1,3,2)
+    bb = bounding_box()
+    if len(alimits)>0:
+        bb.limits[:,0] = np.min(alimits[:,:,0],axis=0)
+        bb.limits[:,1] = np.max(alimits[:,:,1],axis=0)
+    return bb
+
+def intersection_of_boxes(limits):
+    """
+    The intersection of N boxes given by limits of shape (N,3,2). The result
+    is an empty (reset) bounding box if any of the boxes is empty or if the
+    boxes do not overlap.
+    """
+    alimits = np.asarray(limits,dtype=float).reshape(-1,3,2)
+    bb = bounding_box()
+    if len(alimits)==0 or (box_volumes(alimits)==0.).any():
+        return bb
+    lo = np.max(alimits[:,:,0],axis=0)
+    hi = np.min(alimits[:,:,1],axis=0)
+    if (lo<=hi).all():
+        bb.limits[:,0] = lo
+        bb.limits[:,1] = hi
+    return bb
+
+def box_indices_in_image(limits,img,rtol=0.,atol=1e-3):
+    """
+    Vectorized version of `bounding_box.indices_in_image`, for N boxes given
+    by limits of shape (N,3,2). Returns two int32 arrays of shape (N,3), with
+    the inclusive/exclusive image indices of the lower/upper corners.
+    """
+    alimits = np.asarray(limits,dtype=float).reshape(-1,3,2)
+    bb_img = bounding_box(img=img)
+    spacing = np.array(img.GetSpacing())
+    # generically, this is what we want to do:
+    ibbmin,devmin=np.divmod(alimits[:,:,0]-bb_img.mincorner,spacing)
+    ibbmax,devmax=np.divmod(alimits[:,:,1]-bb_img.mincorner,spacing)
+    # but if we are "almost exactly" on a voxel boundary we need to be picky on which side to land
+    below=np.isclose(devmin,spacing,rtol=rtol,atol=atol)
+    above=(devmax>atol)
+    ibbmin[below]+=1 # add one IF on a voxel boundary
+    ibbmax[above]+=1 # add one UNLESS on a voxel boundary
+    return np.int32(ibbmin),np.int32(ibbmax)
+
 #######################################################################
 # TESTING
 #######################################################################
@@ -357,4 +443,95 @@ class test_bounding_box(unittest.TestCase):
         self.assertTrue( (imin==np.array([-2,-3, 1])).all())
         self.assertTrue( (imax==np.array([ 4, 5, 6])).all())
 
+class test_batched_bounding_boxes(unittest.TestCase):
+    """
+    Property tests: the batched functions should agree with the bounding_box
+    methods, for many random boxes.
+    """
+    def _random_limits(self,rng,n,empty_fraction=0.1):
+        lo = rng.uniform(-100.,100.,(n,3))
+        limits = np.stack([lo,lo+rng.uniform(0.,80.,(n,3))],axis=2)
+        # a few flat and a few reset boxes
+        flat = rng.uniform(size=n)<empty_fraction
+        limits[flat,2,1] = limits[flat,2,0]
+        for i in np.flatnonzero(rng.uniform(size=n)<empty_fraction):
+            limits[i,:,0] = np.inf
+            limits[i,:,1] = -np.inf
+        return limits
+    def test_boxes_from_points(self):
+        rng = np.random.default_rng(1)
+        for trial in range(20):
+            counts = rng.integers(0,20,rng.integers(1,30))
+            counts[rng.integers(len(counts))] = 0
+            offsets = np.cumsum(np.r_[0,counts])
+            points = rng.normal(0.,50.,(offsets[-1],3))
+            limits = boxes_from_points(points,offsets)
+            self.assertEqual(limits.shape,(len(counts),3,2))
+            for i in range(len(counts)):
+                bb = bounding_box()
+                if counts[i]>0:
+                    bb.should_contain_all(points[offsets[i]:offsets[i+1]])
+                self.assertTrue((bb.limits==limits[i]).all())
+        self.assertTrue((boxes_from_points(np.arange(12.).reshape(4,3))[0]==[[0,9],[1,10],[2,11]]).all())
+        self.assertTrue((box_volumes(boxes_from_points(np.empty((0,3))))==0.).all())
+    def test_union(self):
+        rng = np.random.default_rng(2)
+        for trial in range(50):
+            limits = self._random_limits(rng,rng.integers(1,40))
+            bb = bounding_box()
+            for lim in limits:
+                if np.isfinite(lim).all():
+                    bb.should_contain(lim[:,0])
+                    bb.should_contain(lim[:,1])
+            bbu = union_of_boxes(limits)
+            self.assertEqual(bb,bbu)
+            for lim in limits:
+                if np.isfinite(lim).all():
+                    self.assertTrue(bbu.contains(lim[:,0]) and bbu.contains(lim[:,1]))
+        self.assertTrue(union_of_boxes(np.empty((0,3,2))).empty)
+    def test_intersection(self):
+        rng = np.random.default_rng(3)
+        for trial in range(200):
+            limits = self._random_limits(rng,rng.integers(1,4),empty_fraction=0.05)
+            bb = bounding_box()
+            bb.limits = np.copy(limits[0])
+            for lim in limits[1:]:
+                other = bounding_box()
+                other.limits = np.copy(lim)
+                bb.intersect(other)
+            self.assertEqual(bb,intersection_of_boxes(limits))
+        bb = intersection_of_boxes(box_limits([bounding_box(xyz=np.arange(1,7)),bounding_box(xyz=np.arange(1,7)+0.5)]))
+        self.assertTrue((bb.limits.flat == np.array([1.5,2,3.5,4,5.5,6])).all())
+    def test_volumes(self):
+        rng = np.random.default_rng(4)
+        limits = self._random_limits(rng,100)
+        volumes = box_volumes(limits)
+        for lim,vol in zip(limits,volumes):
+            bb = bounding_box()
+            bb.limits = np.copy(lim)
+            self.assertAlmostEqual(bb.volume,vol)
+    def test_indices_in_image(self):
+        import itk
+        rng = np.random.default_rng(5)
+        image = itk.image_from_array(np.ones((7,6,5),dtype=np.int16))
+        image.SetOrigin((0.75,0.65,0.55))
+        image.SetSpacing((1.5,1.3,1.1))
+        lo = rng.uniform(-5.,10.,(100,3))
+        limits = np.stack([lo,lo+rng.uniform(0.,10.,(100,3))],axis=2)
+        # some corners exactly on voxel boundaries
+        limits[::3,0,0] = 1.5*rng.integers(-2,6,len(limits[::3]))
+        imin,imax = box_indices_in_image(limits,image)
+        self.assertEqual(imin.shape,(100,3))
+        self.assertEqual(imin.dtype,np.int32)
+        spacing = np.array(image.GetSpacing())
+        corner = bounding_box(img=image).mincorner
+        for lim,i0,i1 in zip(limits,imin,imax):
+            # one box at a time, as in the original implementation of bounding_box.indices_in_image
+            j0,dev0 = np.divmod(lim[:,0]-corner,spacing)
+            j1,dev1 = np.divmod(lim[:,1]-corner,spacing)
+            j0[np.isclose(dev0,spacing,rtol=0.,atol=1e-3)]+=1
+            j1[dev1>1e-3]+=1
+            self.assertTrue((i0==j0).all())
+            self.assertTrue((i1==j1).all())
+
 # vim: set et softtabstop=4 sw=4 smartindent:
@@ -1,8 +1,13 @@
 import subprocess
 import os
+import signal
+import re
+from glob import glob
 import time
 import shutil
 from zipfile import ZipFile
+from utils.job_archiver import archive_directory, default_nthreads
+from utils.daemon_control import find_daemons
 
 def shell_output_ret(shell_command):
     output = subprocess.getstatusoutput(shell_command) # Byte object
@@ -45,28 +50,22 @@ def get_pids(daemon):
     return daemons
 
 def kill_process(pid):
-    ret = os.system("kill -9 {}".format(pid))  
-#    if ret != 0:
-#        # TODO: don't kill, update logs
-#        raise Exception('Could not kill daemon')
-    return ret
-       
-def get_job_daemons(job_daemon):
-    out = shell_output("ps -ef | grep " + job_daemon)
-    lines = out.split("\\n")
-    daemons = dict()
-    for l in lines[:-3]:
-        cont = [p for p in l.split(" ") if p!='']
-        if 'python' in cont or 'python3' in cont:
-            pid = cont[1]
-            if not pid.isnumeric():
-                raise AssertionError("pid is not a number") 
-            wdir = cont[-1]
-            if '/rungate.' not in wdir:
-                raise AssertionError("got wrong or non-existing working directory")
-            daemons[wdir] = pid
-    
-    return daemons
+    try:
+        os.kill(int(pid),signal.SIGKILL)
+    except (ProcessLookupError,PermissionError,ValueError):
+        return 1
+    return 0
+
+def get_job_daemons(jobs_dir):
+    """
+    Returns a dictionary {work directory: pid} of the daemons (job control
+    daemons or the job monitor service) that monitor the jobs in `jobs_dir`
+    (the "tmpdir jobs" directory), found through their pidfiles, see
+    `utils.daemon_control`. Stop them with `daemon_control.stop_daemon`.
+    """
+    if not os.path.isdir(jobs_dir):
+        raise AssertionError("got wrong or non-existing jobs directory")
+    return {wdir:str(info["pid"]) for wdir,info in find_daemons(jobs_dir).items()}
     
 def get_jobs_status():
     jobs_status = dict()
@@ -111,8 +110,38 @@ def condor_id(run_dagmann):
     
     return ret, str(condor_id)
 
+def condor_memory_usage_mb(logfile):
+    """
+    Largest memory usage (in MB) that is reported in the HTCondor log file of
+    a job (the "image size" updates and the resource usage table of the
+    "job terminated" event), or None if there is no memory usage in the log.
+    """
+    usage = None
+    with open(logfile,"r") as log:
+        for line in log:
+            m = re.match(r"\s*(\d+)\s+-\s+MemoryUsage of job \(MB\)",line) or re.match(r"\s*Memory \(MB\)\s*:\s*(\d+)",line)
+            if m:
+                usage = max(usage or 0,int(m.group(1)))
+    return usage
+
+def subjob_memory_usage_mb(logdir):
+    """
+    Memory usage (in MB) of the subjobs, from the HTCondor log files of a job
+    (logs/stdlog.<cluster>.<process>.txt), as a dictionary with the process
+    number as key.
+    """
+    usage = dict()
+    for logfile in glob(os.path.join(logdir,"stdlog.*.*.txt")):
+        process = int(os.path.basename(logfile).split(".")[2])
+        mb = condor_memory_usage_mb(logfile)
+        if mb is not None:
+            usage[process] = max(mb,usage.get(process,0))
+    return usage
+
 def zip_dir_tree(base_name,form,root_dir):
-    shutil.make_archive(base_name,form,root_dir)
+    # explicit archive member names, so this does not depend on the current working directory
+    dest,_,_ = archive_directory(root_dir,base_name=base_name,form=form,arcroot="",nthreads=default_nthreads())
+    return dest
     
 def clean_dir_tree(d):
     shutil.rmtree(d, ignore_errors=True)
@@ -124,8 +153,9 @@ def zip_files(destin_fname,original_file_vec):
     myzipfile.close()       
     
 def zip_and_clean_folder(destin_fname,original_dir,form='zip'):
-    zip_dir_tree(destin_fname,form,original_dir)
+    dest = zip_dir_tree(destin_fname,form,original_dir)
     clean_dir_tree(original_dir)
+    return dest
     
 def change_folder_access_rights(path,gid,recursive=True, new_mode = 0o775):
     # Note: new_mode value is specified in octal notation, where the first digit specifies
@@ -0,0 +1,411 @@
+# -----------------------------------------------------------------------------
+#   Copyright (C): MedAustron GmbH, ACMIT Gmbh and Medical University Vienna
+#   This software is distributed under the terms
+#   of the GNU Lesser General  Public Licence (LGPL)
+#   See LICENSE for further details
+# -----------------------------------------------------------------------------
+
+"""
+Control channel between the IDEAL daemons that monitor jobs (the job control
+daemon of a single job, `bin/job_control_daemon.py`, or the job monitor
+service, `bin/job_monitor_daemon.py`) and the programs that need to find
+and stop them (the API server, the log daemon).
+
+The daemon that monitors a job writes a pidfile (`pidfile_name`) in the work
+directory of the job, with its process ID, its name and the path of the
+Unix domain socket on which it listens. For the job control daemon that is a
+socket in the work directory of the job (see `socket_path_for`), for the job
+monitor service it is the one socket of the service. Whether the daemon is
+alive is checked with `os.kill(pid,0)`, no `ps` output is parsed.
+
+On the socket each request is one JSON object on one line, with a "command"
+(and the "workdir" of the job), and each reply is one JSON object on one line
+with "ok" true or false (and then an "error" message). The commands for a job:
+
+* "status": what the daemon knows about the job;
+* "soft-stop": write the STOP files for the beams that are still running (so
+  that GATE ends the simulations gracefully) and stop monitoring the job;
+* "hard-stop": stop monitoring the job (e.g. after `condor_rm`).
+
+`stop_daemon` sends a stop command and waits until the daemon has released
+the job (removed the pidfile or exited). Only if a single job daemon does not
+answer, it is terminated with a signal; a job monitor service that monitors
+other jobs too is never killed on behalf of one job.
+"""
+
+import os
+import json
+import time
+import glob
+import signal
+import socket
+import hashlib
+import tempfile
+import threading
+import socketserver
+import logging
+logger=logging.getLogger(__name__)
+
+pidfile_name = "job_control_daemon.pid"
+socket_name = "job_control_daemon.sock"
+# the names of the daemons in the pidfiles
+JOB_CONTROL_DAEMON = "job_control_daemon"
+JOB_MONITOR_SERVICE = "job_monitor_daemon"
+
+# the path of a Unix domain socket is limited to 108 bytes (Linux), including the terminating zero
+_max_socket_path = 100
+
+def socket_path_for(workdir):
+    """
+    Path of the control socket of the job control daemon of the job in
+    `workdir`: in the work directory, or, if that path would be too long for
+    a Unix domain socket, in the temporary directory, with a hash of the work
+    directory in the name.
+    """
+    path = os.path.join(os.path.realpath(workdir),socket_name)
+    if len(path.encode()) <= _max_socket_path:
+        return path
+    digest = hashlib.sha1(os.path.realpath(workdir).encode()).hexdigest()[:16]
+    return os.path.join(tempfile.gettempdir(),"ideal-{}.sock".format(digest))
+
+def pid_alive(pid):
+    """
+    True if a process with this PID exists (also if it belongs to another user).
+    """
+    try:
+        os.kill(int(pid),0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+def write_pidfile(workdir,socket_path,name,pid=None):
+    """
+    Announces that the daemon `name` (with process ID `pid`, by default this
+    process) monitors the job in `workdir` and listens on `socket_path`.
+    The pidfile is written to a temporary file first and then renamed, so
+    that readers never see an incomplete pidfile.
+    """
+    info = dict(pid=os.getpid() if pid is None else int(pid),name=name,
+                socket=socket_path,workdir=os.path.realpath(workdir),started=time.time())
+    path = os.path.join(workdir,pidfile_name)
+    tmp = "{}.tmp.{}".format(path,info["pid"])
+    with open(tmp,"w") as fp:
+        json.dump(info,fp)
+    os.replace(tmp,path)
+    return path
+
+def read_pidfile(workdir):
+    """
+    Returns the contents of the pidfile in `workdir` as a dictionary, or None
+    if there is no (readable) pidfile.
+    """
+    try:
+        with open(os.path.join(workdir,pidfile_name),"r") as fp:
+            return json.load(fp)
+    except (OSError,ValueError):
+        return None
+
+def remove_pidfile(workdir,pid=None):
+    """
+    Removes the pidfile in `workdir`, if it belongs to process `pid` (by
+    default this process), e.g. when the daemon stops monitoring the job.
+    """
+    pid = os.getpid() if pid is None else int(pid)
+    info = read_pidfile(workdir)
+    if info is not None and info.get("pid") == pid:
+        try:
+            os.remove(os.path.join(workdir,pidfile_name))
+        except FileNotFoundError:
+            pass
+
+def find_daemon(workdir):
+    """
+    Returns the pidfile contents of the daemon that monitors the job in
+    `workdir`, or None if there is none or if the process is gone.
+    """
+    info = read_pidfile(workdir)
+    if info is None or not pid_alive(info["pid"]):
+        return None
+    return info
+
+def find_daemons(jobs_dir,pattern=os.path.join("*","rungate.*")):
+    """
+    Returns a dictionary {work directory: pidfile contents} of the job daemons
+    that are alive, for the job work directories (matching `pattern`) in
+    `jobs_dir`.
+    """
+    daemons = dict()
+    for path in glob.glob(os.path.join(jobs_dir,pattern,pidfile_name)):
+        workdir = os.path.dirname(path)
+        info = find_daemon(workdir)
+        if info is not None:
+            daemons[workdir] = info
+    return daemons
+
+def check_not_monitored(workdir):
+    """
+    Raises a RuntimeError if another daemon is monitoring the job in `workdir`.
+    """
+    info = find_daemon(workdir)
+    if info is not None and info["pid"] != os.getpid():
+        raise RuntimeError("job {} is already monitored by {} (pid {})".format(workdir,info["name"],info["pid"]))
+
+def request(socket_path,command,timeout=30.,**kwargs):
+    """
+    Sends one request to the daemon listening on `socket_path` and returns the
+    reply (a dictionary). Raises an OSError if the daemon cannot be reached
+    and a RuntimeError if the daemon rejects the request.
+    """
+    message = dict(command=command,**kwargs)
+    with socket.socket(socket.AF_UNIX,socket.SOCK_STREAM) as s:
+        s.settimeout(timeout)
+        s.connect(socket_path)
+        s.sendall((json.dumps(message)+"\n").encode())
+        with s.makefile("r") as fp:
+            line = fp.readline()
+    if not line:
+        raise RuntimeError("no reply from {} to '{}' request".format(socket_path,command))
+    reply = json.loads(line)
+    if not reply.get("ok",False):
+        raise RuntimeError(reply.get("error","unknown error"))
+    return reply
+
+def send(workdir,command,timeout=30.,**kwargs):
+    """
+    Sends a request about the job in `workdir` to the daemon that monitors
+    it. Raises a ProcessLookupError if no daemon is monitoring the job.
+    """
+    info = find_daemon(workdir)
+    if info is None:
+        raise ProcessLookupError("no daemon is monitoring job {}".format(workdir))
+    return request(info["socket"],command,timeout,workdir=os.path.realpath(workdir),**kwargs)
+
+def _released(workdir,info):
+    current = read_pidfile(workdir)
+    if current is None or current.get("pid") != info["pid"] or current.get("started") != info["started"]:
+        return True
+    return not pid_alive(info["pid"])
+
+def stop_daemon(workdir,command="soft-stop",timeout=10.,poll_seconds=0.02):
+    """
+    Asks the daemon that monitors the job in `workdir` to stop monitoring it
+    ("soft-stop" or "hard-stop", see the module documentation) and waits (up
+    to `timeout` seconds) until it has released the job. A job control daemon
+    that cannot be reached or does not release the job in time is terminated
+    with SIGTERM. Returns False if no daemon was monitoring the job.
+    """
+    if command not in ("soft-stop","hard-stop"):
+        raise ValueError("unknown stop command '{}'".format(command))
+    info = find_daemon(workdir)
+    if info is None:
+        return False
+    deadline = time.monotonic()+timeout
+    try:
+        request(info["socket"],command,timeout,workdir=os.path.realpath(workdir))
+    except (OSError,RuntimeError,ValueError) as e:
+        logger.warning("{} (pid {}) did not accept '{}' for job {}: {}".format(info["name"],info["pid"],command,workdir,e))
+        deadline = time.monotonic()
+    while not _released(workdir,info):
+        if time.monotonic() >= deadline:
+            if info["name"] != JOB_CONTROL_DAEMON:
+                raise RuntimeError("{} (pid {}) did not release job {}".format(info["name"],info["pid"],workdir))
+            logger.warning("terminating job control daemon (pid {}) of job {}".format(info["pid"],workdir))
+            try:
+                os.kill(info["pid"],signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+            remove_pidfile(workdir,info["pid"])
+            break
+        time.sleep(poll_seconds)
+    return True
+
+class _request_handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            try:
+                reply = self.server.handler(json.loads(line))
+                reply["ok"] = True
+            except Exception as e:
+                logger.error("control request failed: {}".format(e))
+                reply = dict(ok=False,error=str(e))
+            self.wfile.write((json.dumps(reply)+"\n").encode())
+            self.wfile.flush()
+
+class _server(socketserver.ThreadingMixIn,socketserver.UnixStreamServer):
+    daemon_threads = True
+
+class control_server:
+    """
+    Serves the requests on the Unix domain socket `socket_path` in background
+    threads. `handler` is called with each request (a dictionary) and returns
+    the reply (a dictionary); an exception is reported as a failed request.
+    """
+    def __init__(self,socket_path,handler):
+        self.socket_path = socket_path
+        self.handler = handler
+        self._server = None
+    def start(self):
+        if os.path.exists(self.socket_path):
+            try:
+                request(self.socket_path,"status",timeout=5.)
+            except (OSError,RuntimeError,ValueError):
+                # left over from a daemon that did not shut down cleanly
+                os.remove(self.socket_path)
+            else:
+                raise RuntimeError("another daemon is already listening on {}".format(self.socket_path))
+        self._server = _server(self.socket_path,_request_handler)
+        self._server.handler = self.handler
+        threading.Thread(target=self._server.serve_forever,name="control_socket",daemon=True).start()
+        logger.info("listening on control socket {} (pid {})".format(self.socket_path,os.getpid()))
+        return self
+    def close(self):
+        if self._server is None:
+            return
+        self._server.shutdown()
+        self._server.server_close()
+        self._server = None
+        try:
+            os.remove(self.socket_path)
+        except FileNotFoundError:
+            pass
+    def __enter__(self):
+        return self.start()
+    def __exit__(self,*exc):
+        self.close()
+        return False
+
+class job_control_endpoint(control_server):
+    """
+    The control socket and the pidfile of a daemon that monitors one job (the
+    job in `workdir`), see the module documentation.
+    """
+    def __init__(self,workdir,handler,name=JOB_CONTROL_DAEMON):
+        super().__init__(socket_path_for(workdir),handler)
+        self.workdir = workdir
+        self.name = name
+    def start(self):
+        check_not_monitored(self.workdir)
+        super().start()
+        write_pidfile(self.workdir,self.socket_path,self.name)
+        return self
+    def close(self):
+        remove_pidfile(self.workdir)
+        super().close()
+
+###############################################################################################
+# UNIT TESTING
+###############################################################################################
+
+import unittest
+import subprocess
+import sys
+
+# a job daemon that does nothing but answer the control requests, in a separate process
+_dummy_daemon = """
+import os, sys, threading
+from utils.daemon_control import job_control_endpoint
+workdir = sys.argv[1]
+stopped = threading.Event()
+def handler(request):
+    if request["command"] in ("soft-stop","hard-stop"):
+        with open(os.path.join(workdir,request["command"]),"w") as fp:
+            fp.write(request["workdir"])
+        stopped.set()
+        return dict()
+    if request["command"] == "status":
+        return dict(workdir=workdir,pid=os.getpid())
+    raise RuntimeError("unknown command")
+with job_control_endpoint(workdir,handler,name=sys.argv[2]):
+    stopped.wait(60.)
+"""
+
+class test_daemon_control(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.jobs_dir = self.tmpdir.name
+        self.processes = list()
+        self.env = dict(os.environ,PYTHONPATH=os.pathsep.join([os.path.dirname(os.path.dirname(os.path.abspath(__file__)))]+sys.path))
+    def tearDown(self):
+        for p in self.processes:
+            if p.poll() is None:
+                p.kill()
+            p.wait()
+        self.tmpdir.cleanup()
+    def _workdir(self,i,long_name=False):
+        jobname = "job{}".format(i) + ("_"+"x"*120 if long_name else "")
+        workdir = os.path.join(self.jobs_dir,jobname,"rungate.{}".format(i))
+        os.makedirs(workdir)
+        return workdir
+    def _spawn(self,workdir,name=JOB_CONTROL_DAEMON,code=_dummy_daemon):
+        p = subprocess.Popen([sys.executable,"-c",code,workdir,name],env=self.env)
+        self.processes.append(p)
+        deadline = time.monotonic()+30.
+        while find_daemon(workdir) is None:
+            self.assertIsNone(p.poll(),"dummy daemon died")
+            self.assertLess(time.monotonic(),deadline,"dummy daemon did not start")
+            time.sleep(0.02)
+        return p
+    def test_targeting_and_latency(self):
+        workdirs = [self._workdir(i,long_name=(i==2)) for i in range(3)]
+        procs = [self._spawn(w) for w in workdirs]
+        self.assertGreater(len(workdirs[2]),_max_socket_path)
+        self.assertEqual(set(find_daemons(self.jobs_dir).keys()),set(workdirs))
+        for w,p in zip(workdirs,procs):
+            self.assertEqual(send(w,"status")["pid"],p.pid)
+        # stop the second one: only that one gets the message and stops
+        t0 = time.monotonic()
+        self.assertTrue(stop_daemon(workdirs[1],"soft-stop"))
+        latency = time.monotonic()-t0
+        procs[1].wait(10.)
+        self.assertLess(latency,2.)
+        self.assertTrue(os.path.exists(os.path.join(workdirs[1],"soft-stop")))
+        for i in (0,2):
+            self.assertIsNone(procs[i].poll())
+            self.assertFalse(os.path.exists(os.path.join(workdirs[i],"soft-stop")))
+            self.assertFalse(os.path.exists(os.path.join(workdirs[i],"hard-stop")))
+        self.assertEqual(set(find_daemons(self.jobs_dir).keys()),{workdirs[0],workdirs[2]})
+        self.assertFalse(stop_daemon(workdirs[1]))
+        # hard stop, with the socket in the temporary directory
+        self.assertTrue(stop_daemon(workdirs[2],"hard-stop"))
+        procs[2].wait(10.)
+        self.assertTrue(os.path.exists(os.path.join(workdirs[2],"hard-stop")))
+        self.assertFalse(os.path.exists(socket_path_for(workdirs[2])))
+        self.assertIsNone(procs[0].poll())
+        print("\nstop latency: {:.1f} ms".format(1000*latency))
+    def test_stale_pidfile(self):
+        workdir = self._workdir(0)
+        p = subprocess.Popen([sys.executable,"-c","pass"])
+        p.wait()
+        # the process of the pidfile is gone
+        write_pidfile(workdir,socket_path_for(workdir),JOB_CONTROL_DAEMON,pid=p.pid)
+        self.assertIsNone(find_daemon(workdir))
+        self.assertEqual(find_daemons(self.jobs_dir),dict())
+        self.assertFalse(stop_daemon(workdir))
+        with self.assertRaises(ProcessLookupError):
+            send(workdir,"status")
+    def test_unresponsive(self):
+        # a job control daemon that does not listen (e.g. hanging): terminated
+        hanging = "import sys,time\nfrom utils.daemon_control import write_pidfile,socket_path_for\nwrite_pidfile(sys.argv[1],socket_path_for(sys.argv[1]),sys.argv[2])\ntime.sleep(60)\n"
+        w0,w1 = self._workdir(0),self._workdir(1)
+        p0 = self._spawn(w0,code=hanging)
+        self.assertTrue(stop_daemon(w0,"hard-stop",timeout=1.))
+        self.assertEqual(p0.wait(10.),-signal.SIGTERM)
+        self.assertIsNone(read_pidfile(w0))
+        # but a job monitor service (which monitors other jobs too) is never killed for one job
+        p1 = self._spawn(w1,name=JOB_MONITOR_SERVICE,code=hanging)
+        with self.assertRaises(RuntimeError):
+            stop_daemon(w1,"hard-stop",timeout=1.)
+        self.assertIsNone(p1.poll())
+    def test_one_daemon_per_job(self):
+        workdir = self._workdir(0)
+        self._spawn(workdir)
+        with self.assertRaises(RuntimeError):
+            job_control_endpoint(workdir,lambda request: dict(),name=JOB_MONITOR_SERVICE).start()
+        self.assertEqual(read_pidfile(workdir)["name"],JOB_CONTROL_DAEMON)
+    def test_wrong_input(self):
+        with self.assertRaises(ValueError):
+            stop_daemon(self.jobs_dir,"kill")
+
+# vim: set et softtabstop=4 sw=4 smartindent:
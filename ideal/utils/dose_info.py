@@ -10,9 +10,30 @@ import pydicom
 import itk
 import numpy as np
 import os
+from concurrent.futures import ThreadPoolExecutor
 logger=logging.getLogger(__name__)
 
+# The attributes that are needed to select the dose files and to get the
+# geometry of the dose grid. The discovery reads only these, not the pixel
+# data: the pixel data is read when the dose image is actually needed.
+header_tags = ["SOPClassUID", "SOPInstanceUID", "ReferencedRTPlanSequence",
+               "DoseGridScaling", "DoseUnits", "DoseType", "DoseSummationType",
+               "ImagePositionPatient", "ImageOrientationPatient", "PixelSpacing",
+               "SliceThickness", "GridFrameOffsetVector",
+               "NumberOfFrames", "Rows", "Columns"]
+
+def read_dose_header(fpath):
+    """
+    Reads the `header_tags` attributes of DICOM file `fpath`, stops before the pixel data.
+    """
+    return pydicom.dcmread(fpath,stop_before_pixels=True,specific_tags=header_tags)
+
 class dose_info(object):
+    """
+    Information about a RT Dose file. The dataset `rd` may be a header-only
+    dataset (see `read_dose_header`); the pixel data is then read from
+    `rdfp` only on first use of the `image` property.
+    """
     def __init__(self,rd,rdfp):
         self._rd = rd
         self._rdfp = rdfp
@@ -22,14 +43,26 @@ class dose_info(object):
         except:
             # plan dose
             self._beamnr = None
+        if 'PixelData' in self._rd:
+            self._check_pixels()
+    def _check_pixels(self):
         assert(self._rd.pixel_array.shape == (int(self._rd.NumberOfFrames),int(self._rd.Rows),int(self._rd.Columns)))
     @property
+    def pixels_loaded(self):
+        return 'PixelData' in self._rd
+    def _load_pixels(self):
+        if not self.pixels_loaded:
+            logger.debug("reading pixel data of {}".format(self._rdfp))
+            self._rd = pydicom.dcmread(self._rdfp)
+            self._check_pixels()
+        return self._rd.pixel_array
+    @property
     def filepath(self):
         return self._rdfp
     @property
     def image(self):
         scaling = float(self._rd.DoseGridScaling)
-        img = itk.GetImageFromArray(self._rd.pixel_array*scaling)
+        img = itk.GetImageFromArray(self._load_pixels()*scaling)
         img.SetOrigin(self.origin)
         img.SetSpacing(self.spacing)
         return img
@@ -41,7 +74,7 @@ class dose_info(object):
         return np.array([float(v) for v in self._rd.PixelSpacing[::-1]+[self._rd.SliceThickness]])
     @property
     def nvoxels(self):
-        return np.array(self._rd.pixel_array.shape[::-1])
+        return np.array([int(self._rd.Columns),int(self._rd.Rows),int(self._rd.NumberOfFrames)])
     @property
     def origin(self):
         return np.array([float(v) for v in self._rd.ImagePositionPatient])
@@ -61,17 +94,32 @@ class dose_info(object):
     def refd_beam_number(self):
         return self._beamnr
     @staticmethod
-    def get_dose_files(dirpath,rpuid=None,only_physical=False):
+    def get_dose_files(dirpath,rpuid=None,only_physical=False,nthreads=8):
+        """
+        Find the RT Dose files in directory `dirpath`, optionally only those for
+        the plan with UID `rpuid` and/or only the physical doses. Returns a
+        dictionary with the beam number (or 'PLAN') as key, with a '_RBE' suffix
+        for effective doses, and `dose_info` objects as values.
+        Only the headers are read (in `nthreads` parallel threads), the pixel
+        data of the selected doses are read when they are used.
+        """
         doses = dict()
         #beam_numbers = [str(beam.BeamNumber) for beam in self._rp.IonBeamSequence]
         logger.debug("going to find RD dose files in directory {}".format(dirpath))
         logger.debug("for UID={} PLAN".format(rpuid if rpuid else "any/all"))
+        fnames = list()
         for s in os.listdir(dirpath):
             if not s[-4:].lower() == ".dcm":
                 logger.debug("NOT DICOM (no dcm suffix): {}".format(s))
                 continue # not dicom
-            fpath = os.path.join(dirpath,s)
-            dcm = pydicom.read_file(fpath)
+            fnames.append(s)
+        fpaths = [os.path.join(dirpath,s) for s in fnames]
+        if nthreads > 1 and len(fpaths) > 1:
+            with ThreadPoolExecutor(min(nthreads,len(fpaths))) as pool:
+                headers = list(pool.map(read_dose_header,fpaths))
+        else:
+            headers = [read_dose_header(fpath) for fpath in fpaths]
+        for s,fpath,dcm in zip(fnames,fpaths,headers):
             if 'SOPClassUID' not in dcm:
                 logger.debug("NOT A DOSE FILE (SOPClassUID attribute is missing): {}".format(s))
                 continue # not a RD dose file
@@ -87,8 +135,8 @@ class dose_info(object):
                 logger.warn("Missing attributes: {}".format(", ".join(missing_attrs)))
                 continue # not a RD dose file
             drefrtp0=dcm.ReferencedRTPlanSequence[0]
+            uid = str(drefrtp0.ReferencedSOPInstanceUID)
             if rpuid:
-                uid = str(drefrtp0.ReferencedSOPInstanceUID)
                 if uid != rpuid:
                     logger.debug("UID {} != RP UID {}".format(uid,rpuid))
                     continue # dose file for a different plan
@@ -121,4 +169,114 @@ class dose_info(object):
         # if we arrive here, things are probably fine...
         return doses
 
+###############################################################################################
+# UNIT TESTING
+###############################################################################################
+
+import unittest
+
+def _write_test_file(fpath,sop_class,sop_uid,pixels,**attrs):
+    from pydicom.dataset import Dataset, FileMetaDataset
+    from pydicom.uid import ExplicitVRLittleEndian
+    meta = FileMetaDataset()
+    meta.MediaStorageSOPClassUID = sop_class
+    meta.MediaStorageSOPInstanceUID = sop_uid
+    meta.TransferSyntaxUID = ExplicitVRLittleEndian
+    ds = Dataset()
+    ds.file_meta = meta
+    ds.is_little_endian = True
+    ds.is_implicit_VR = False
+    ds.SOPClassUID = sop_class
+    ds.SOPInstanceUID = sop_uid
+    for k,v in attrs.items():
+        setattr(ds,k,v)
+    ds.Rows,ds.Columns = pixels.shape[-2:]
+    ds.BitsAllocated = ds.BitsStored = 8*pixels.itemsize
+    ds.HighBit = ds.BitsStored - 1
+    ds.PixelRepresentation = 1 if pixels.dtype.kind == 'i' else 0
+    ds.SamplesPerPixel = 1
+    ds.PhotometricInterpretation = "MONOCHROME2"
+    ds.PixelData = pixels.tobytes()
+    ds.save_as(fpath,write_like_original=False)
+
+def _dose_attrs(rpuid,beamnr,dose_type,nframes,scaling):
+    from pydicom.dataset import Dataset
+    from pydicom.sequence import Sequence
+    refbeam = Dataset()
+    refbeam.ReferencedBeamNumber = beamnr
+    reffg = Dataset()
+    reffg.ReferencedBeamSequence = Sequence([refbeam])
+    refrp = Dataset()
+    refrp.ReferencedSOPInstanceUID = rpuid
+    if beamnr is not None:
+        refrp.ReferencedFractionGroupSequence = Sequence([reffg])
+    return dict(ReferencedRTPlanSequence=Sequence([refrp]),
+                DoseGridScaling=scaling, DoseUnits="GY", DoseType=dose_type,
+                DoseSummationType="PLAN" if beamnr is None else "BEAM",
+                NumberOfFrames=nframes, GridFrameOffsetVector=[2.*i for i in range(nframes)],
+                ImagePositionPatient=[-10.,-20.,-30.], ImageOrientationPatient=[1,0,0,0,1,0],
+                PixelSpacing=[3.,2.5], SliceThickness=2.)
+
+class test_get_dose_files(unittest.TestCase):
+    def setUp(self):
+        import tempfile
+        from pydicom.uid import generate_uid
+        self.tmpdir = tempfile.TemporaryDirectory()
+        d = self.tmpdir.name
+        ct_class = pydicom.uid.UID("1.2.840.10008.5.1.4.1.1.2")
+        rd_class = pydicom.uid.UID("1.2.840.10008.5.1.4.1.1.481.2")
+        self.rpuid = generate_uid()
+        ct = np.zeros((256,256),dtype=np.int16)
+        for i in range(400):
+            _write_test_file(os.path.join(d,"CT{:03d}.dcm".format(i)),ct_class,generate_uid(),ct,Modality="CT")
+        rng = np.random.default_rng(1)
+        self.pixels = dict()
+        for label,beamnr,dose_type,rpuid in [("1",1,"PHYSICAL",self.rpuid),("PLAN",None,"PHYSICAL",self.rpuid),
+                                             ("PLAN_RBE",None,"EFFECTIVE",self.rpuid),("other",None,"PHYSICAL",generate_uid())]:
+            self.pixels[label] = rng.integers(0,60000,(50,64,70),dtype=np.uint32)
+            _write_test_file(os.path.join(d,"RD_{}.dcm".format(label)),rd_class,generate_uid(),self.pixels[label],
+                             Modality="RTDOSE",**_dose_attrs(rpuid,beamnr,dose_type,50,1e-4))
+        self.dirsize = sum([os.path.getsize(os.path.join(d,s)) for s in os.listdir(d)])
+        # ITK loads its modules lazily, we do not want to count those bytes
+        itk.GetImageFromArray(np.zeros((2,2,2)))
+    def tearDown(self):
+        self.tmpdir.cleanup()
+    def bytes_read(self):
+        # bytes read by this process, according to the kernel
+        with open("/proc/self/io") as f:
+            return int([line.split()[1] for line in f if line.startswith("rchar:")][0])
+    def test_discovery(self):
+        if not os.path.exists("/proc/self/io"):
+            self.skipTest("needs /proc/self/io to count the bytes read from disk")
+        n0 = self.bytes_read()
+        doses = dose_info.get_dose_files(self.tmpdir.name,self.rpuid)
+        nread = self.bytes_read()-n0
+        self.assertEqual(sorted(doses.keys()),["1","PLAN","PLAN_RBE"])
+        # only the headers were read
+        self.assertLess(nread,0.1*self.dirsize)
+        self.assertFalse(any([d.pixels_loaded for d in doses.values()]))
+        rd = doses["PLAN"]
+        self.assertTrue(rd.is_plan_dose and rd.is_physical)
+        self.assertTrue(doses["1"].is_beam_dose)
+        self.assertEqual(doses["1"].refd_beam_number,"1")
+        self.assertTrue(doses["PLAN_RBE"].is_effective)
+        self.assertEqual(tuple(rd.nvoxels),(70,64,50))
+        self.assertTrue(np.allclose(rd.spacing,(2.5,3.,2.)))
+        self.assertTrue(np.allclose(rd.origin,(-10.,-20.,-30.)))
+        # the pixels of one dose file are read on demand
+        n0 = self.bytes_read()
+        img = rd.image
+        nread = self.bytes_read()-n0
+        self.assertTrue(rd.pixels_loaded)
+        self.assertGreater(nread,self.pixels["PLAN"].nbytes)
+        self.assertLess(nread,2*self.pixels["PLAN"].nbytes)
+        self.assertTrue(np.allclose(itk.GetArrayViewFromImage(img),self.pixels["PLAN"]*1e-4))
+        self.assertTrue(np.allclose(img.GetSpacing(),(2.5,3.,2.)))
+    def test_selection(self):
+        doses = dose_info.get_dose_files(self.tmpdir.name,self.rpuid,only_physical=True,nthreads=1)
+        self.assertEqual(sorted(doses.keys()),["1","PLAN"])
+        with self.assertRaises(RuntimeError):
+            # two physical plan doses for different plans
+            dose_info.get_dose_files(self.tmpdir.name)
+
 # vim: set et softtabstop=4 sw=4 smartindent:
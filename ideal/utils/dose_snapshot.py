@@ -0,0 +1,545 @@
+# -----------------------------------------------------------------------------
+#   Copyright (C): MedAustron GmbH, ACMIT Gmbh and Medical University Vienna
+#   This software is distributed under the terms
+#   of the GNU Lesser General  Public Licence (LGPL)
+#   See LICENSE for further details
+# -----------------------------------------------------------------------------
+
+"""
+Lock free publication of the intermediate dose snapshots of the GATE subjobs.
+
+While GATE runs, the stop-on-script actor periodically saves the dose and
+runs a flag script, which publishes the dose (MHD+raw) in the `tmp/` copy of
+the output directory. The job control daemon reads these snapshots to compute
+the statistical uncertainty. Before, the copy and the read were serialized
+with a soft file lock (`locked_copy.py`, a python startup for each copy), and
+the daemon skipped a subjob whenever it did not get the lock within 3 seconds.
+
+Now the snapshots are published atomically, so readers do not need a lock:
+
+1. each snapshot gets a new "generation" label;
+2. the raw data is copied to a temporary name in the destination directory,
+   synced to disk and renamed to `<base>.<generation>.raw`;
+3. the MHD header, with `ElementDataFile` pointing to that raw file, is
+   written in the same way to `<base>.<generation>.mhd` (so the .raw is
+   always in place before the .mhd that refers to it);
+4. a small manifest `<base>.mhd.snapshot` with the generation, the file names
+   and the number of events (primaries) is written to a temporary name, synced
+   and renamed, which atomically switches the readers to the new snapshot;
+5. older generations are removed, except the previous one (which may still be
+   being read).
+
+Files of a generation are never modified after they have been renamed into
+place, so a reader that follows the manifest always gets a consistent set
+of dose data and event count. A reader that is so slow that its generation
+got removed sees a missing file; it then simply follows the manifest again
+(see `read_snapshot`).
+
+The flag script uses the shell version of the protocol (`publish_snapshot_sh`,
+only coreutils, no python startup); `publish_snapshot` is the python version.
+
+A snapshot is published in one of two formats, recorded in the manifest:
+
+* "mhd": a copy of the full dose MHD/raw pair that GATE saved;
+* "sparse": only the non-zero voxels, in a compressed numpy file
+  `<base>.<generation>.npz` (see `sparse_dose`). Most voxels of a dose grid
+  are zero (air, far away from the beam), so this is typically one or two
+  orders of magnitude fewer bytes to write, sync and read per snapshot.
+  It is made by `publish_sparse_snapshot`, in the flag script via
+  `bin/publish_dose_snapshot.py`.
+
+The snapshots are only for monitoring: the final dose of a subjob is always
+the full MHD file in its output directory.
+"""
+
+import os
+import re
+import io
+import time
+import zlib
+import shutil
+import configparser
+import numpy as np
+import logging
+logger=logging.getLogger(__name__)
+
+# the manifest of the snapshot of dose file "foo.mhd" is "foo.mhd.snapshot"
+manifest_suffix = ".snapshot"
+
+def manifest_path(dose_mhd):
+    """
+    Path of the manifest of the published snapshots of the given dose MHD file.
+    """
+    return dose_mhd + manifest_suffix
+
+def dose_file_from_manifest(manifest):
+    """
+    Path of the dose MHD file for the given manifest path (inverse of `manifest_path`).
+    """
+    if not manifest.endswith(manifest_suffix):
+        raise ValueError("{} is not a snapshot manifest file".format(manifest))
+    return manifest[:-len(manifest_suffix)]
+
+def _sync_and_rename(tmp,final):
+    with open(tmp,"rb+") as fp:
+        os.fsync(fp.fileno())
+    os.replace(tmp,final)
+
+def _count_events(stat_file):
+    with open(stat_file,"r") as sf:
+        for line in sf:
+            pat="# NumberOfEvents ="
+            if line[:len(pat)] == pat:
+                return int(line.strip().split(" = ")[1])
+    raise RuntimeError("no number of events found in stat actor file {}".format(stat_file))
+
+def _generation_files(destdir,base):
+    pattern = re.compile(re.escape(base)+r"\.([0-9]+)\.(mhd|raw|npz)$")
+    for fname in os.listdir(destdir):
+        m = pattern.match(fname)
+        if m:
+            yield fname,m.group(1)
+
+def _remove_old_generations(destdir,base,generation,previous):
+    for fname,gen in _generation_files(destdir,base):
+        if gen not in (generation,previous):
+            os.remove(os.path.join(destdir,fname))
+
+def _write_manifest(manifest,generation,fmt,nevents,**files):
+    tmp = manifest+".tmp."+generation
+    with open(tmp,"w") as fp:
+        fp.write("[snapshot]\ngeneration = {}\nformat = {}\n".format(generation,fmt))
+        for key,fname in files.items():
+            fp.write("{} = {}\n".format(key,fname))
+        fp.write("number of events = {}\n".format(int(nevents)))
+    _sync_and_rename(tmp,manifest)
+
+def _read_mhd_header(mhd):
+    with open(mhd,"r") as fp:
+        return dict([item.strip() for item in line.split("=",1)] for line in fp if "=" in line)
+
+class sparse_dose:
+    """
+    The non-zero voxels of a dose distribution in coordinate (COO) format:
+    the flat indices (C order, so z,y,x like the numpy arrays of ITK images)
+    and float32 values, plus the shape (numpy order), spacing and origin
+    (ITK order) of the full grid.
+    On disk (`save`, `load`) the sorted indices are stored as uint32 steps
+    between consecutive non-zero voxels, which compress much better than the
+    indices themselves. The steps and the values are compressed with zlib
+    after splitting them into byte planes ("shuffle"): the exponent bytes of
+    the dose values compress well, the noisy mantissa bytes hardly at all,
+    so a fast compression level is as good as the default one.
+    """
+    element_types = {"MET_FLOAT":np.float32,"MET_DOUBLE":np.float64}
+    compression_level = 1
+    def __init__(self,shape,spacing,origin,indices,values):
+        self.shape = tuple(int(n) for n in shape)
+        self.spacing = np.array(spacing,dtype=np.float64)
+        self.origin = np.array(origin,dtype=np.float64)
+        self.indices = np.asarray(indices,dtype=np.int64)
+        self.values = np.asarray(values,dtype=np.float32)
+        if self.indices.shape != self.values.shape:
+            raise ValueError("got {} indices but {} values".format(len(self.indices),len(self.values)))
+    @classmethod
+    def from_array(cls,a,spacing,origin):
+        flat = a.ravel()
+        indices = np.flatnonzero(flat)
+        return cls(a.shape,spacing,origin,indices,flat[indices])
+    @classmethod
+    def from_mhd(cls,mhd):
+        """
+        Reads a dose MHD/raw pair as written by GATE, without ITK.
+        """
+        header = _read_mhd_header(mhd)
+        etype = header.get("ElementType","")
+        if etype not in cls.element_types:
+            raise RuntimeError("unsupported element type '{}' in {}".format(etype,mhd))
+        if header.get("ElementByteOrderMSB",header.get("BinaryDataByteOrderMSB","False")) != "False":
+            raise RuntimeError("big endian data in {} is not supported".format(mhd))
+        shape = [int(n) for n in header["DimSize"].split()][::-1]
+        ndim = len(shape)
+        spacing = [float(x) for x in header.get("ElementSpacing"," ".join(["1"]*ndim)).split()]
+        origin = [float(x) for x in header.get("Offset",header.get("Origin"," ".join(["0"]*ndim))).split()]
+        raw = os.path.join(os.path.dirname(mhd),header["ElementDataFile"])
+        a = np.fromfile(raw,dtype=cls.element_types[etype])
+        if a.size != np.prod(shape):
+            raise RuntimeError("expected {} voxels in {}, got {}".format(np.prod(shape),raw,a.size))
+        return cls.from_array(a.reshape(shape),spacing,origin)
+    @property
+    def nnz(self):
+        return len(self.values)
+    def dense(self,dtype=np.float32):
+        a = np.zeros(self.shape,dtype=dtype)
+        a.ravel()[self.indices] = self.values
+        return a
+    def save(self,fp):
+        steps = np.diff(self.indices,prepend=0)
+        if self.nnz and steps.max() > np.iinfo(np.uint32).max:
+            raise RuntimeError("dose grid too large for the sparse snapshot format")
+        np.savez(fp,shape=np.array(self.shape,dtype=np.int64),spacing=self.spacing,origin=self.origin,
+                 steps=_shuffle_compress(steps.astype(np.uint32),self.compression_level),
+                 values=_shuffle_compress(self.values,self.compression_level))
+    @classmethod
+    def load(cls,fname):
+        with np.load(fname) as npz:
+            steps = _shuffle_decompress(npz["steps"],np.uint32)
+            return cls(npz["shape"],npz["spacing"],npz["origin"],np.cumsum(steps,dtype=np.int64),_shuffle_decompress(npz["values"],np.float32))
+
+# (un)shuffling plane by plane is several times faster than a transposed copy
+def _shuffle_compress(a,level):
+    abytes = a.view(np.uint8).reshape(-1,a.itemsize)
+    planes = np.empty(abytes.shape[::-1],dtype=np.uint8)
+    for k in range(a.itemsize):
+        planes[k] = abytes[:,k]
+    return np.frombuffer(zlib.compress(planes,level),dtype=np.uint8)
+
+def _shuffle_decompress(z,dtype):
+    itemsize = np.dtype(dtype).itemsize
+    planes = np.frombuffer(zlib.decompress(z),dtype=np.uint8).reshape(itemsize,-1)
+    abytes = np.empty(planes.shape[::-1],dtype=np.uint8)
+    for k in range(itemsize):
+        abytes[:,k] = planes[k]
+    return abytes.view(dtype).reshape(-1)
+
+def publish_snapshot(mhd,destdir,nevents=None,stat_file=None,generation=None):
+    """
+    Publish a dose snapshot (the MHD file `mhd` and the raw data file it refers
+    to) in directory `destdir`, following the protocol described in the module
+    docstring. The number of events is either given directly or read from the
+    stat actor file. Returns the path of the manifest.
+    """
+    if nevents is None:
+        nevents = _count_events(stat_file)
+    base = os.path.basename(mhd)[:-len(".mhd")]
+    manifest = os.path.join(destdir,base+".mhd"+manifest_suffix)
+    previous = read_manifest(manifest)["generation"] if os.path.exists(manifest) else None
+    generation = str(time.time_ns()) if generation is None else str(generation)
+    with open(mhd,"r") as fp:
+        header = fp.read()
+    m = re.search(r"^ElementDataFile\s*=\s*(.*?)\s*$",header,re.MULTILINE)
+    if m is None:
+        raise RuntimeError("no ElementDataFile in MHD header {}".format(mhd))
+    raw = os.path.join(os.path.dirname(mhd),m.group(1))
+    gen_raw = "{}.{}.raw".format(base,generation)
+    gen_mhd = "{}.{}.mhd".format(base,generation)
+    # first the raw data...
+    tmp = os.path.join(destdir,"."+gen_raw+".tmp")
+    shutil.copyfile(raw,tmp)
+    _sync_and_rename(tmp,os.path.join(destdir,gen_raw))
+    # ... then the header that refers to it...
+    tmp = os.path.join(destdir,"."+gen_mhd+".tmp")
+    with open(tmp,"w") as fp:
+        fp.write(header[:m.start(1)]+gen_raw+header[m.end(1):])
+    _sync_and_rename(tmp,os.path.join(destdir,gen_mhd))
+    # ... and finally the manifest
+    _write_manifest(manifest,generation,"mhd",nevents,mhd=gen_mhd,raw=gen_raw)
+    _remove_old_generations(destdir,base,generation,previous)
+    return manifest
+
+def publish_sparse_snapshot(mhd,destdir,nevents=None,stat_file=None,generation=None):
+    """
+    Same as `publish_snapshot`, but publishes only the non-zero voxels of the
+    dose, in the "sparse" format (see `sparse_dose`).
+    """
+    if nevents is None:
+        nevents = _count_events(stat_file)
+    base = os.path.basename(mhd)[:-len(".mhd")]
+    manifest = os.path.join(destdir,base+".mhd"+manifest_suffix)
+    previous = read_manifest(manifest)["generation"] if os.path.exists(manifest) else None
+    generation = str(time.time_ns()) if generation is None else str(generation)
+    gen_npz = "{}.{}.npz".format(base,generation)
+    # compress in memory, so that the file is written in one go
+    buf = io.BytesIO()
+    sparse_dose.from_mhd(mhd).save(buf)
+    tmp = os.path.join(destdir,"."+gen_npz+".tmp")
+    with open(tmp,"wb") as fp:
+        fp.write(buf.getbuffer())
+    _sync_and_rename(tmp,os.path.join(destdir,gen_npz))
+    _write_manifest(manifest,generation,"sparse",nevents,sparse=gen_npz)
+    _remove_old_generations(destdir,base,generation,previous)
+    return manifest
+
+# the file keys in the manifest for each snapshot format
+snapshot_formats = {"mhd":("mhd","raw"),"sparse":("sparse",)}
+
+def read_manifest(manifest):
+    """
+    Returns the contents of a snapshot manifest as a dictionary with keys
+    "generation", "format", "nevents" and the files of the format, i.e.
+    "mhd" and "raw" or "sparse" (paths in the same directory as the manifest).
+    """
+    parser = configparser.ConfigParser()
+    with open(manifest,"r") as fp:
+        parser.read_file(fp)
+    snapshot = parser["snapshot"]
+    destdir = os.path.dirname(manifest)
+    fmt = snapshot.get("format","mhd")
+    if fmt not in snapshot_formats:
+        raise RuntimeError("unknown snapshot format '{}' in {}".format(fmt,manifest))
+    contents = dict(generation=snapshot["generation"],
+                    format=fmt,
+                    nevents=snapshot.getint("number of events"))
+    for key in snapshot_formats[fmt]:
+        contents[key] = os.path.join(destdir,snapshot[key])
+    return contents
+
+def read_snapshot(dose_mhd,reader,retries=3):
+    """
+    Reads the latest published snapshot of dose file `dose_mhd`. `reader` is
+    a function that reads the MHD file of a snapshot (e.g. `itk.imread`).
+    Returns the result of `reader` (or a `sparse_dose`, for a snapshot in the
+    sparse format) and the number of events. If the files of the generation
+    disappear while reading (the reader was slower than two snapshot cycles),
+    the manifest is followed again, up to `retries` times.
+    """
+    manifest = manifest_path(dose_mhd)
+    for attempt in range(retries):
+        snapshot = read_manifest(manifest)
+        try:
+            if snapshot["format"] == "sparse":
+                return sparse_dose.load(snapshot["sparse"]),snapshot["nevents"]
+            return reader(snapshot["mhd"]),snapshot["nevents"]
+        except (OSError,RuntimeError) as e:
+            if attempt+1 == retries or read_manifest(manifest)["generation"] == snapshot["generation"]:
+                raise
+            logger.debug("snapshot generation {} of {} disappeared while reading ({}), trying again".format(snapshot["generation"],dose_mhd,e))
+
+# Shell version of `publish_snapshot`, for the GATE flag script.
+# Usage: publish_snapshot <dose mhd> <stat actor file> <destination directory>
+publish_snapshot_sh = r"""
+publish_snapshot () {
+    local mhd="$1" stat="$2" dest="$3"
+    local srcdir=$(dirname "$mhd")
+    local base=$(basename "$mhd" .mhd)
+    local manifest="$dest/$base.mhd.snapshot"
+    local gen=$(date +%s%N)
+    local raw=$(sed -n 's/^ElementDataFile *= *//p' "$mhd")
+    local nevents=$(sed -n 's/^# NumberOfEvents = *//p' "$stat")
+    local prev=""
+    if [ -z "$raw" ] || [ -z "$nevents" ] ; then
+        echo "incomplete snapshot of $mhd, not publishing it"
+        return 1
+    fi
+    if [ -r "$manifest" ] ; then
+        prev=$(sed -n 's/^generation = *//p' "$manifest")
+    fi
+    # the raw data first, then the header that refers to it, then the manifest; each via a synced temporary file and an atomic rename
+    cp "$srcdir/$raw" "$dest/.$base.$gen.raw.tmp" && sync "$dest/.$base.$gen.raw.tmp" && mv -f "$dest/.$base.$gen.raw.tmp" "$dest/$base.$gen.raw" || return 1
+    sed "s/^ElementDataFile *=.*/ElementDataFile = $base.$gen.raw/" "$mhd" > "$dest/.$base.$gen.mhd.tmp" && sync "$dest/.$base.$gen.mhd.tmp" && mv -f "$dest/.$base.$gen.mhd.tmp" "$dest/$base.$gen.mhd" || return 1
+    printf "[snapshot]\ngeneration = %s\nformat = mhd\nmhd = %s\nraw = %s\nnumber of events = %s\n" "$gen" "$base.$gen.mhd" "$base.$gen.raw" "$nevents" > "$manifest.tmp.$gen" && sync "$manifest.tmp.$gen" && mv -f "$manifest.tmp.$gen" "$manifest" || return 1
+    # remove the older generations, but keep the previous one, it may still be being read
+    local f g
+    for f in "$dest/$base".*.mhd "$dest/$base".*.raw "$dest/$base".*.npz ; do
+        g=${f#"$dest/$base."}
+        g=${g%.*}
+        case "$g" in
+            *[!0-9]*|"") ;;
+            "$gen"|"$prev") ;;
+            *) rm -f "$f" ;;
+        esac
+    done
+    echo "published snapshot $gen of $base with $nevents events"
+}
+"""
+
+#######################################################################
+# TESTING
+#######################################################################
+import unittest
+import tempfile
+import threading
+import subprocess
+from array import array
+
+def _write_test_dose(srcdir,base,value,nvoxels):
+    """
+    What GATE does: a dose MHD/raw pair (all voxels equal to `value`) and a stat actor file.
+    """
+    with open(os.path.join(srcdir,base+".raw"),"wb") as fp:
+        fp.write((array("f",[value])*nvoxels).tobytes())
+    with open(os.path.join(srcdir,base+".mhd"),"w") as fp:
+        fp.write("ObjectType = Image\nNDims = 1\nDimSize = {}\nElementType = MET_FLOAT\nElementDataFile = {}.raw\n".format(nvoxels,base))
+    with open(os.path.join(srcdir,"statActor-{}.txt".format(base)),"w") as fp:
+        fp.write("# NumberOfRun    = 1\n# NumberOfEvents = {}\n# NumberOfTracks = {}\n".format(int(value),20*int(value)))
+
+def _read_test_dose(mhd):
+    with open(mhd,"r") as fp:
+        header = dict(line.split(" = ",1) for line in fp.read().splitlines())
+    data = array("f")
+    with open(os.path.join(os.path.dirname(mhd),header["ElementDataFile"]),"rb") as fp:
+        data.frombytes(fp.read())
+    if len(data) != int(header["DimSize"]):
+        raise RuntimeError("incomplete raw data for {}".format(mhd))
+    return data
+
+class test_dose_snapshot(unittest.TestCase):
+    nvoxels = 50000
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.src = os.path.join(self.tmpdir.name,"output.1.0")
+        self.dest = os.path.join(self.tmpdir.name,"tmp","output.1.0")
+        os.makedirs(self.src)
+        os.makedirs(self.dest)
+        self.base = "idc-B1-Dose"
+        self.dose_mhd = os.path.join(self.dest,self.base+".mhd")
+    def tearDown(self):
+        self.tmpdir.cleanup()
+    def _publish_py(self,value):
+        _write_test_dose(self.src,self.base,value,self.nvoxels)
+        publish_snapshot(os.path.join(self.src,self.base+".mhd"),self.dest,stat_file=os.path.join(self.src,"statActor-{}.txt".format(self.base)))
+    def _publish_sh(self,values):
+        # one shell process publishes a series of snapshots, as the flag script would do (once per snapshot, GATE runs it with /bin/sh)
+        script = publish_snapshot_sh
+        for value in values:
+            script += "printf 'ObjectType = Image\\nNDims = 1\\nDimSize = {n}\\nElementType = MET_FLOAT\\nElementDataFile = {b}.raw\\n' > {src}/{b}.mhd\n".format(n=self.nvoxels,b=self.base,src=self.src)
+            script += "printf '# NumberOfEvents = {v}\\n' > {src}/stat.txt\n".format(v=value,src=self.src)
+            script += "python3 -c 'import sys,array; sys.stdout.buffer.write((array.array(\"f\",[{v}])*{n}).tobytes())' > {src}/{b}.raw\n".format(v=value,n=self.nvoxels,b=self.base,src=self.src)
+            script += "publish_snapshot {src}/{b}.mhd {src}/stat.txt {dest} > /dev/null || exit 1\n".format(b=self.base,src=self.src,dest=self.dest)
+        subprocess.run(["sh","-c",script],check=True)
+    def _publish_sparse(self,value):
+        _write_test_dose(self.src,self.base,value,self.nvoxels)
+        publish_sparse_snapshot(os.path.join(self.src,self.base+".mhd"),self.dest,stat_file=os.path.join(self.src,"statActor-{}.txt".format(self.base)))
+    def _check_consistent(self):
+        data,nevents = read_snapshot(self.dose_mhd,_read_test_dose)
+        if isinstance(data,sparse_dose):
+            data = array("f",data.dense().tobytes())
+        self.assertEqual(len(data),self.nvoxels)
+        # torn read: dose data from one snapshot, event count from another, or mixed data
+        self.assertEqual(data[0],float(nevents))
+        self.assertEqual(data.count(data[0]),self.nvoxels)
+        return nevents
+    def test_publish(self):
+        self._publish_py(3)
+        self.assertEqual(self._check_consistent(),3)
+        self._publish_py(5)
+        self.assertEqual(self._check_consistent(),5)
+        self._publish_py(7)
+        self.assertEqual(self._check_consistent(),7)
+        # current and previous generation, no temporary files
+        self.assertEqual(len(list(_generation_files(self.dest,self.base))),4)
+        self.assertEqual(sorted(f for f in os.listdir(self.dest) if f.startswith(".") or ".tmp" in f),[])
+        self.assertEqual(dose_file_from_manifest(manifest_path(self.dose_mhd)),self.dose_mhd)
+    def test_publish_sh(self):
+        self._publish_sh([11,12,13])
+        self.assertEqual(self._check_consistent(),13)
+        self.assertEqual(len(list(_generation_files(self.dest,self.base))),4)
+        # the python and shell versions work together
+        self._publish_py(14)
+        self.assertEqual(self._check_consistent(),14)
+        self._publish_sh([15])
+        self.assertEqual(self._check_consistent(),15)
+        self.assertEqual(len(list(_generation_files(self.dest,self.base))),4)
+    def test_publish_sparse(self):
+        self._publish_sparse(3)
+        self.assertEqual(self._check_consistent(),3)
+        self.assertEqual(read_manifest(manifest_path(self.dose_mhd))["format"],"sparse")
+        # switching formats between snapshots is fine, for the readers and for the cleanup
+        self._publish_py(4)
+        self.assertEqual(self._check_consistent(),4)
+        self._publish_sh([5])
+        self._publish_sparse(6)
+        self.assertEqual(self._check_consistent(),6)
+        self._publish_sparse(7)
+        self.assertEqual(self._check_consistent(),7)
+        # only the current and the previous generation are left
+        self.assertEqual([f[-4:] for f,gen in _generation_files(self.dest,self.base)],[".npz",".npz"])
+    def test_sparse_dose(self):
+        # a pencil beam like dose: non-zero in a small part of the grid, with spacing and origin
+        shape = (30,40,50)
+        a = np.zeros(shape,dtype=np.float64)
+        a[10:20,15:25,:] = np.linspace(1e-12,3e-10,10*10*50).reshape(10,10,50)
+        a[0,0,0] = 2.5e-11
+        a[-1,-1,-1] = 4.5e-11
+        raw = os.path.join(self.src,"pencil.raw")
+        mhd = os.path.join(self.src,"pencil.mhd")
+        a.tofile(raw)
+        with open(mhd,"w") as fp:
+            fp.write("ObjectType = Image\nNDims = 3\nBinaryData = True\nBinaryDataByteOrderMSB = False\n"
+                     "Offset = -24.5 -19.5 -14.5\nElementSpacing = 1 1 1\nDimSize = 50 40 30\n"
+                     "ElementType = MET_DOUBLE\nElementDataFile = pencil.raw\n")
+        sd = sparse_dose.from_mhd(mhd)
+        self.assertEqual(sd.shape,shape)
+        self.assertEqual(sd.nnz,np.count_nonzero(a))
+        self.assertEqual(list(sd.origin),[-24.5,-19.5,-14.5])
+        buf = io.BytesIO()
+        sd.save(buf)
+        buf.seek(0)
+        sd2 = sparse_dose.load(buf)
+        self.assertEqual(sd2.shape,shape)
+        self.assertTrue(np.array_equal(sd2.indices,sd.indices))
+        self.assertTrue(np.array_equal(sd2.dense(),a.astype(np.float32)))
+        self.assertEqual(list(sd2.spacing),[1.,1.,1.])
+        # much smaller than the full grid
+        self.assertLess(len(buf.getvalue()),a.size*4/10)
+        # empty dose (no hits yet)
+        sd0 = sparse_dose.from_array(np.zeros(shape,dtype=np.float32),sd.spacing,sd.origin)
+        buf = io.BytesIO()
+        sd0.save(buf)
+        buf.seek(0)
+        self.assertEqual(sparse_dose.load(buf).nnz,0)
+    def _stress(self,publish,values,nreaders=4):
+        """
+        Readers read the snapshots in a loop while the writer publishes new ones.
+        """
+        self._publish_py(1)
+        done = threading.Event()
+        errors = list()
+        nreads = list()
+        def read_loop():
+            n = 0
+            last = 0
+            try:
+                while not done.is_set():
+                    nevents = self._check_consistent()
+                    # never back in time
+                    self.assertGreaterEqual(nevents,last)
+                    last = nevents
+                    n += 1
+            except Exception as e:
+                errors.append(e)
+            nreads.append(n)
+        readers = [threading.Thread(target=read_loop) for i in range(nreaders)]
+        for r in readers:
+            r.start()
+        try:
+            publish(values)
+        finally:
+            done.set()
+            for r in readers:
+                r.join()
+        self.assertEqual(errors,[])
+        self.assertTrue(sum(nreads)>0)
+        self.assertEqual(self._check_consistent(),values[-1])
+    def test_concurrent_readers(self):
+        self._stress(lambda values: [self._publish_py(v) for v in values],list(range(2,100)))
+    def test_concurrent_readers_sparse(self):
+        self._stress(lambda values: [self._publish_sparse(v) for v in values],list(range(2,60)))
+    def test_concurrent_readers_sh(self):
+        self._stress(self._publish_sh,list(range(2,60)))
+    def test_concurrent_writers(self):
+        # many subjobs publish at the same time, each in their own directory, while the daemon reads all of them
+        nwriters = 8
+        cases = list()
+        for i in range(nwriters):
+            case = test_dose_snapshot("test_publish")
+            case.setUp()
+            cases.append(case)
+        try:
+            writers = [threading.Thread(target=lambda c=c: [c._publish_py(v) for v in range(1,40)]) for c in cases]
+            cases[0]._publish_py(1)
+            for w in writers:
+                w.start()
+            while any(w.is_alive() for w in writers):
+                for case in cases:
+                    if os.path.exists(manifest_path(case.dose_mhd)):
+                        case._check_consistent()
+            for w in writers:
+                w.join()
+            for case in cases:
+                self.assertEqual(case._check_consistent(),39)
+        finally:
+            for case in cases:
+                case.tearDown()
+
+# vim: set et softtabstop=4 sw=4 smartindent:
@@ -0,0 +1,241 @@
+# -----------------------------------------------------------------------------
+#   Copyright (C): MedAustron GmbH, ACMIT Gmbh and Medical University Vienna
+#   This software is distributed under the terms
+#   of the GNU Lesser General  Public Licence (LGPL)
+#   See LICENSE for further details
+# -----------------------------------------------------------------------------
+
+"""
+A lightweight dose volume: a numpy array with the geometry (origin, spacing,
+direction) of the ITK image it came from or will go to.
+
+The post processing scales, masks and sums dose distributions. With ITK
+images every such step costs two full copies (`array_from_image` and
+`image_from_array`); with a `dose_volume` the arithmetic is done in place
+on the numpy array, and ITK images are only created at the I/O boundaries
+(reading/writing MHD files, resampling, gamma index), as views on the
+array where possible.
+"""
+
+import numpy as np
+import itk
+import logging
+logger=logging.getLogger(__name__)
+
+class dose_volume:
+    """
+    `array` has indices (z,y,x), like the arrays from `itk.array_from_image`,
+    `origin` and `spacing` are given in (x,y,z) order, like in ITK.
+    """
+    def __init__(self,array,origin,spacing,direction=None):
+        self.array = array
+        self.origin = np.array(origin,dtype=float)
+        self.spacing = np.array(spacing,dtype=float)
+        self.direction = np.eye(3) if direction is None else np.array(direction,dtype=float)
+        self._image = None
+    @classmethod
+    def from_image(cls,img,view=False,dtype=np.float32):
+        """
+        With `view=True` the array is a view on the image buffer (the image is
+        kept alive by the dose volume), otherwise a copy.
+        """
+        if view:
+            array = itk.array_view_from_image(img)
+            if array.dtype != dtype:
+                array = array.astype(dtype)
+        else:
+            array = itk.array_from_image(img).astype(dtype,copy=False)
+        dv = cls(array,img.GetOrigin(),img.GetSpacing(),itk.array_from_matrix(img.GetDirection()))
+        if view:
+            dv._image = img
+        return dv
+    @classmethod
+    def read(cls,path,dtype=np.float32):
+        return cls.from_image(itk.imread(path),view=True,dtype=dtype)
+    def to_image(self,view=False):
+        """
+        Returns an ITK image with the dose and the geometry of this volume.
+        With `view=True` the image shares the memory of the array: changes in
+        the array are visible in the image, and vice versa.
+        """
+        if view:
+            img = itk.image_view_from_array(np.ascontiguousarray(self.array))
+        else:
+            img = itk.image_from_array(self.array)
+        img.SetOrigin(self.origin)
+        img.SetSpacing(self.spacing)
+        img.SetDirection(itk.matrix_from_array(self.direction))
+        return img
+    def write(self,path):
+        itk.imwrite(self.to_image(view=True),path)
+    def copy(self):
+        return dose_volume(self.array.copy(),self.origin,self.spacing,self.direction)
+    @property
+    def shape(self):
+        return self.array.shape
+    @property
+    def size(self):
+        """
+        Number of voxels per dimension, in (x,y,z) order.
+        """
+        return np.array(self.array.shape[::-1])
+    def same_geometry(self,other):
+        return (self.array.shape == other.array.shape and
+                np.allclose(self.origin,other.origin) and
+                np.allclose(self.spacing,other.spacing) and
+                np.allclose(self.direction,other.direction))
+    def __iadd__(self,other):
+        if isinstance(other,dose_volume):
+            if not self.same_geometry(other):
+                raise RuntimeError("cannot add dose volumes with different geometries: shape {}/{} origin {}/{} spacing {}/{}".format(
+                    self.shape,other.shape,self.origin,other.origin,self.spacing,other.spacing))
+            self.array += other.array
+        else:
+            self.array += other
+        return self
+    def __imul__(self,factor):
+        # a scale factor, or e.g. a mask array
+        self.array *= factor.array if isinstance(factor,dose_volume) else factor
+        return self
+    def max(self):
+        return np.max(self.array)
+
+###############################################################################################
+# UNIT TESTING
+###############################################################################################
+
+import unittest
+
+class test_dose_volume(unittest.TestCase):
+    def setUp(self):
+        self.adose = np.random.default_rng(5).random((4,5,6),dtype=np.float32)
+        self.img = itk.image_from_array(self.adose)
+        self.img.SetOrigin((1.,2.,3.))
+        self.img.SetSpacing((0.5,1.5,2.5))
+    def test_roundtrip(self):
+        for view in (False,True):
+            dv = dose_volume.from_image(self.img,view=view)
+            self.assertTrue(np.array_equal(dv.array,self.adose))
+            self.assertTrue(np.allclose(dv.origin,(1.,2.,3.)))
+            self.assertTrue(np.allclose(dv.spacing,(0.5,1.5,2.5)))
+            self.assertEqual(tuple(dv.size),(6,5,4))
+            img = dv.to_image(view=view)
+            self.assertTrue(np.array_equal(itk.array_view_from_image(img),self.adose))
+            self.assertTrue(np.allclose(img.GetOrigin(),(1.,2.,3.)))
+            self.assertTrue(np.allclose(img.GetSpacing(),(0.5,1.5,2.5)))
+    def test_copy_and_view(self):
+        dv = dose_volume.from_image(self.img,view=False)
+        dv *= 2.
+        self.assertTrue(np.array_equal(itk.array_view_from_image(self.img),self.adose))
+        img = dv.to_image(view=True)
+        dv *= 2.
+        self.assertTrue(np.allclose(itk.array_view_from_image(img),4*self.adose))
+        dv2 = dv.copy()
+        dv2 *= 0.
+        self.assertTrue(np.allclose(dv.array,4*self.adose))
+    def test_add(self):
+        dv = dose_volume.from_image(self.img)
+        dv += dose_volume.from_image(self.img,view=True)
+        self.assertTrue(np.allclose(dv.array,2*self.adose))
+        other = dose_volume(self.adose.copy(),(0.,0.,0.),(0.5,1.5,2.5))
+        with self.assertRaises(RuntimeError):
+            dv += other
+    def test_mask(self):
+        dv = dose_volume.from_image(self.img)
+        mask = self.adose>0.5
+        dv *= mask
+        self.assertTrue(np.array_equal(dv.array,self.adose*mask))
+    def test_io(self):
+        import tempfile, os
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir,"dose.mhd")
+            dose_volume.from_image(self.img).write(path)
+            dv = dose_volume.read(path)
+            self.assertTrue(np.array_equal(dv.array,self.adose))
+            self.assertTrue(np.allclose(dv.origin,(1.,2.,3.)))
+
+###############################################################################################
+# BENCHMARK
+###############################################################################################
+
+def _plan_dose_with_images(beam_doses,rbe=1.1):
+    """
+    The previous pattern: every scaling/masking/summing step goes through
+    array_from_image and image_from_array.
+    """
+    pdd = dict()
+    def update(label,img):
+        if label in pdd:
+            a = itk.array_from_image(pdd[label])
+            a += itk.array_view_from_image(img)
+            new = itk.image_from_array(a)
+            new.CopyInformation(pdd[label])
+            pdd[label] = new
+        else:
+            new = itk.image_from_array(itk.array_from_image(img))
+            new.CopyInformation(img)
+            pdd[label] = new
+    for adose,mask in beam_doses:
+        img = itk.image_from_array(adose)
+        a = itk.array_from_image(img)
+        a *= 30.
+        rescaled = itk.image_from_array(np.float32(a))
+        rescaled.CopyInformation(img)
+        update("unresampled",rescaled)
+        a = itk.array_from_image(rescaled)
+        a *= mask
+        physical = itk.image_from_array(np.float32(a))
+        physical.CopyInformation(rescaled)
+        update("Physical",physical)
+        a *= rbe
+        rbeimg = itk.image_from_array(np.float32(a))
+        rbeimg.CopyInformation(physical)
+        update("RBE",rbeimg)
+    return {k:float(np.sum(itk.array_view_from_image(v))) for k,v in pdd.items()}
+
+def _plan_dose_with_volumes(beam_doses,rbe=1.1):
+    pdd = dict()
+    def update(label,dv):
+        if label in pdd:
+            pdd[label] += dv
+        else:
+            pdd[label] = dv.copy()
+    for adose,mask in beam_doses:
+        dv = dose_volume.from_image(itk.image_from_array(adose),view=True)
+        dv *= 30.
+        update("unresampled",dv)
+        dv *= mask
+        update("Physical",dv)
+        dv *= rbe
+        update("RBE",dv)
+    return {k:float(np.sum(v.array)) for k,v in pdd.items()}
+
+if __name__ == '__main__':
+    import argparse
+    import subprocess
+    import sys
+    import time
+    import resource
+    parser = argparse.ArgumentParser(description='peak memory and wall time of the plan dose computation, with ITK images or with dose volumes')
+    parser.add_argument('-s','--shape',type=int,nargs=3,default=[200,256,256],help='dose grid shape (nz ny nx)')
+    parser.add_argument('-b','--nbeams',type=int,default=6)
+    parser.add_argument('-m','--method',choices=['images','volumes'],default=None,help='run only this method (default: both, each in a fresh process)')
+    args = parser.parse_args()
+    if args.method is None:
+        for m in ['images','volumes']:
+            cmd = [sys.executable,__file__,'-m',m,'-b',str(args.nbeams),'-s']+[str(n) for n in args.shape]
+            subprocess.run(cmd,check=True)
+    else:
+        rng = np.random.default_rng(11)
+        shape = tuple(args.shape)
+        mask = np.ones(shape,dtype=bool)
+        mask[:,:shape[1]//10,:] = False
+        beams = ((rng.random(shape,dtype=np.float32),mask) for i in range(args.nbeams))
+        t0 = time.perf_counter()
+        sums = (_plan_dose_with_images if args.method=='images' else _plan_dose_with_volumes)(beams)
+        t = time.perf_counter()-t0
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024.
+        print("{:8s}: {} beams, shape {}: {:.2f} s, max RSS = {:.1f} MiB, checksums {}".format(
+            args.method,args.nbeams,shape,t,rss," ".join(["{}={:.6g}".format(k,v) for k,v in sums.items()])))
+
+# vim: set et softtabstop=4 sw=4 smartindent:
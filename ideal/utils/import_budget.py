@@ -0,0 +1,166 @@
+# -----------------------------------------------------------------------------
+#   Copyright (C): MedAustron GmbH, ACMIT Gmbh and Medical University Vienna
+#   This software is distributed under the terms
+#   of the GNU Lesser General  Public Licence (LGPL)
+#   See LICENSE for further details
+# -----------------------------------------------------------------------------
+
+"""
+Startup time budget for the IDEAL entry points.
+
+The PRE and POST scripts are started for every node in the DAG, and the
+command line interface is also used for quick queries. Importing itk,
+pydicom, matplotlib or scipy costs (much) more than a second, so these
+entry points should only import what they actually need: the heavy modules
+are imported inside the functions that use them.
+
+Each entry point is started in a fresh python process with ``-X importtime``.
+We check that it starts without errors, that some heavy modules are *not*
+imported and that the total import time is within a budget (in
+milliseconds). The "forbidden modules" check does not depend on the
+hardware, the time budgets do; they can be scaled with the ``--scale``
+option when running this module as a script, or with the environment
+variable ``IDEAL_IMPORT_BUDGET_SCALE`` for the unit tests (e.g. on slow CI
+hosts).
+"""
+
+import os
+import sys
+import re
+import subprocess
+import tempfile
+import logging
+logger=logging.getLogger(__name__)
+
+_idealdir = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+_bindir = os.path.join(os.path.dirname(_idealdir),"bin")
+
+# name: (command line arguments after "python -X importtime", forbidden modules, budget in ms)
+entry_points = {
+    "clidc.py --help"          : ([os.path.join(_bindir,"clidc.py"),"--help"],
+                                  ["numpy","itk","pydicom","matplotlib","scipy","PyQt5"], 500),
+    "clidc.py --version"       : ([os.path.join(_bindir,"clidc.py"),"--version"],
+                                  ["numpy","itk","pydicom","matplotlib","scipy","PyQt5"], 500),
+    "ideal_module"             : (["-c","import ideal_module"],
+                                  ["numpy","itk","pydicom","matplotlib","scipy","PyQt5"], 500),
+    "preprocess_ct_image.py"   : (["-c","import preprocess_ct_image"],
+                                  ["matplotlib","scipy","PyQt5","flask"], 2000),
+    "postprocess_dose_results.py" : (["-c","import postprocess_dose_results"],
+                                  ["pydicom","matplotlib","scipy","PyQt5","flask"], 2000),
+    "api.py"                   : (["-c","import api"],
+                                  ["itk","matplotlib","scipy","PyQt5"], 3000),
+}
+
+_importtime_line = re.compile(r"^import time:\s+(\d+)\s+\|\s+(\d+)\s+\|( *)(\S+)\s*$")
+
+def parse_importtime(stderr):
+    """
+    Parse the output of ``python -X importtime``.
+    Returns the total import time in milliseconds (the sum of the cumulative
+    times of the top level imports) and the set of imported module names.
+    """
+    total_us = 0
+    modules = set()
+    for line in stderr.splitlines():
+        m = _importtime_line.match(line)
+        if m is None:
+            continue
+        cumulative,indent,name = int(m.group(2)),len(m.group(3)),m.group(4)
+        modules.add(name)
+        if indent <= 1:
+            total_us += cumulative
+    return total_us/1000.,modules
+
+def measure_import_time(args,cwd=None):
+    """
+    Run python with the given arguments in a fresh process, with the IDEAL
+    directories in the PYTHONPATH, like ``IDEAL_env.sh`` does.
+    Returns the return code, the total import time in ms, the set of imported
+    modules, the standard output and the standard error output.
+    """
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join([_idealdir,_bindir]+([env["PYTHONPATH"]] if env.get("PYTHONPATH") else []))
+    proc = subprocess.run([sys.executable,"-X","importtime"]+list(args),cwd=cwd,env=env,
+                          stdout=subprocess.PIPE,stderr=subprocess.PIPE,universal_newlines=True)
+    total_ms,modules = parse_importtime(proc.stderr)
+    return proc.returncode,total_ms,modules,proc.stdout,proc.stderr
+
+def check_entry_point(name,scale=1.):
+    """
+    Returns a dictionary with the results for entry point `name`.
+    """
+    args,forbidden,budget_ms = entry_points[name]
+    # the PRE/POST scripts write log files in the current directory
+    with tempfile.TemporaryDirectory() as tmpdir:
+        ret,total_ms,modules,stdout,stderr = measure_import_time(args,cwd=tmpdir)
+    missing = re.findall(r"ModuleNotFoundError: No module named '([^']+)'",stderr)
+    loaded = sorted([m for m in forbidden if m in modules])
+    # the API server reads the system configuration when it is imported (see ideal_module.initialize_sysconfig)
+    no_sysconfig = "Problems getting system configuration" in stdout
+    errors = [line for line in stderr.splitlines() if not line.startswith("import time:")]
+    return dict(name=name,returncode=ret,ms=total_ms,budget_ms=budget_ms*scale,
+                forbidden_loaded=loaded,missing_modules=missing,no_sysconfig=no_sysconfig,
+                stderr="\n".join(errors[-10:]),
+                ok=(ret==0 and total_ms<=budget_ms*scale and not loaded))
+
+###############################################################################################
+# UNIT TESTING
+###############################################################################################
+
+import unittest
+
+class test_import_budget(unittest.TestCase):
+    def test_parse(self):
+        stderr = "\n".join(["import time: self [us] | cumulative | imported package",
+                            "import time:       100 |        100 | _io",
+                            "import time:       200 |        200 |     foo.bar",
+                            "import time:       300 |        500 |   foo",
+                            "import time:      1000 |       1500 | ham"])
+        total_ms,modules = parse_importtime(stderr)
+        self.assertAlmostEqual(total_ms,1.6)
+        self.assertEqual(modules,set(["_io","foo.bar","foo","ham"]))
+    def _check(self,name):
+        result = check_entry_point(name,float(os.environ.get("IDEAL_IMPORT_BUDGET_SCALE","1")))
+        if result["returncode"] != 0:
+            if result["missing_modules"]:
+                self.skipTest("{} cannot be imported here, missing: {}".format(name,", ".join(result["missing_modules"])))
+            if result["no_sysconfig"]:
+                self.skipTest("{} cannot be imported here, no system configuration:\n{}".format(name,result["stderr"]))
+            self.fail("{} failed with return code {}:\n{}".format(name,result["returncode"],result["stderr"]))
+        self.assertEqual(result["forbidden_loaded"],[],"{} imports heavy modules".format(name))
+        self.assertTrue(result["ok"],"{} import time {:.1f} ms over budget ({:.0f} ms)".format(name,result["ms"],result["budget_ms"]))
+    def test_clidc_help(self):
+        self._check("clidc.py --help")
+    def test_clidc_version(self):
+        self._check("clidc.py --version")
+    def test_ideal_module(self):
+        self._check("ideal_module")
+    def test_preprocess(self):
+        self._check("preprocess_ct_image.py")
+    def test_postprocess(self):
+        self._check("postprocess_dose_results.py")
+    def test_api(self):
+        self._check("api.py")
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='measure the import time of the IDEAL entry points and compare with the budget')
+    parser.add_argument('-s','--scale',type=float,default=1.,help='scale factor for the time budgets (e.g. for slow machines)')
+    parser.add_argument('names',nargs='*',default=list(entry_points.keys()),help='entry points to check (default: all)')
+    args = parser.parse_args()
+    all_ok = True
+    for name in args.names:
+        r = check_entry_point(name,args.scale)
+        if r["returncode"] != 0:
+            status = "ERROR (missing: {})".format(", ".join(r["missing_modules"])) if r["missing_modules"] else "ERROR"
+            if r["no_sysconfig"]:
+                status = "ERROR (no system configuration)"
+        elif r["forbidden_loaded"]:
+            status = "HEAVY IMPORTS: " + ", ".join(r["forbidden_loaded"])
+        else:
+            status = "OK" if r["ok"] else "OVER BUDGET"
+        print("{:30s} {:8.1f} ms (budget {:6.0f} ms) {}".format(name,r["ms"],r["budget_ms"],status))
+        all_ok &= r["ok"]
+    sys.exit(0 if all_ok else 1)
+
+# vim: set et softtabstop=4 sw=4 smartindent:
@@ -0,0 +1,400 @@
+# -----------------------------------------------------------------------------
+#   Copyright (C): MedAustron GmbH, ACMIT Gmbh and Medical University Vienna
+#   This software is distributed under the terms
+#   of the GNU Lesser General  Public Licence (LGPL)
+#   See LICENSE for further details
+# -----------------------------------------------------------------------------
+
+"""
+Archiving of job data (GATE output directories, work directories of old jobs).
+
+The archives are built with `tarfile` (or `zipfile`) using explicit archive
+member names, so we never need to change the current working directory. That
+makes it safe to archive several directories concurrently from a thread pool.
+
+For the tar archives the compression is done in parallel:
+* "zstd": multithreaded zstandard compression, if the `zstandard` module is available;
+* "gz": the tar stream is cut into blocks that are compressed as separate gzip
+  members by a thread pool (zlib releases the GIL), the same trick as pigz.
+  The result is a valid (multi-member) gzip file that can be read with
+  `tar xzf`, `gunzip`, `pigz -d` and python's `tarfile`/`gzip` modules.
+The "bztar" and "xztar" formats (as in `shutil.make_archive`) are compressed
+by `tarfile` itself, in a single thread.
+"""
+
+import os
+import io
+import gzip
+import shutil
+import tarfile
+import zipfile
+import threading
+from time import time
+from concurrent.futures import ThreadPoolExecutor
+import logging
+logger=logging.getLogger(__name__)
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# archive formats and the suffix of the files they produce
+archive_suffixes = { "gztar":".tar.gz", "zstdtar":".tar.zst", "bztar":".tar.bz2", "xztar":".tar.xz", "tar":".tar", "zip":".zip" }
+
+# tar stream modes of the formats that are compressed by `tarfile` itself
+_tar_modes = { "bztar":"w|bz2", "xztar":"w|xz", "tar":"w|" }
+
+def have_zstd():
+    return zstandard is not None
+
+def default_nthreads():
+    return max(1,min(8,os.cpu_count() or 1))
+
+class parallel_gzip_writer(io.RawIOBase):
+    """
+    Write-only file object that compresses the data that is written to it in
+    blocks of `blocksize` bytes, each block is a separate gzip member. The
+    blocks are compressed by `nthreads` worker threads, and written to the
+    output file object in the original order. With `nthreads=1` the data are
+    compressed in the calling thread.
+    """
+    def __init__(self,fileobj,nthreads=1,blocksize=1<<20,compresslevel=6):
+        super().__init__()
+        self._fileobj = fileobj
+        self._blocksize = int(blocksize)
+        self._level = int(compresslevel)
+        self._nthreads = max(1,int(nthreads))
+        self._buffer = bytearray()
+        self._pending = []
+        self._pool = ThreadPoolExecutor(self._nthreads) if self._nthreads > 1 else None
+    def writable(self):
+        return True
+    def _compress(self,block):
+        # mtime=0 makes the output reproducible
+        return gzip.compress(block,compresslevel=self._level,mtime=0)
+    def _submit(self,block):
+        if self._pool is None:
+            self._fileobj.write(self._compress(block))
+            return
+        self._pending.append(self._pool.submit(self._compress,block))
+        # keep the memory usage bounded: at most two blocks in flight per thread
+        while len(self._pending) > 2*self._nthreads:
+            self._fileobj.write(self._pending.pop(0).result())
+    def write(self,data):
+        self._buffer += data
+        while len(self._buffer) >= self._blocksize:
+            self._submit(bytes(self._buffer[:self._blocksize]))
+            del self._buffer[:self._blocksize]
+        return len(data)
+    def close(self):
+        if self.closed:
+            return
+        try:
+            if self._buffer:
+                self._submit(bytes(self._buffer))
+                self._buffer = bytearray()
+            for f in self._pending:
+                self._fileobj.write(f.result())
+            self._pending = []
+        finally:
+            if self._pool is not None:
+                self._pool.shutdown()
+            super().close()
+
+def _dir_size(src):
+    return sum([os.path.getsize(os.path.join(d,f)) for d,_,files in os.walk(src) for f in files])
+
+def _zip_directory(src,dest,arcroot):
+    # like `shutil.make_archive`, the directories get their own entries, so empty directories are kept
+    with zipfile.ZipFile(dest,"w",compression=zipfile.ZIP_DEFLATED) as zf:
+        for d,dirs,files in os.walk(src):
+            dirs.sort()
+            reldir = os.path.relpath(d,src)
+            arcdir = arcroot if reldir == os.curdir else os.path.join(arcroot,reldir)
+            if arcdir:
+                zf.write(d,arcname=arcdir)
+            for f in sorted(files):
+                path = os.path.join(d,f)
+                zf.write(path,arcname=os.path.join(arcroot,os.path.relpath(path,src)))
+
+def archive_directory(src,base_name=None,form="gztar",nthreads=1,arcroot=None,remove=False):
+    """
+    Create an archive of directory `src`, with path `base_name` + suffix
+    (default: `src` + suffix, i.e. next to the directory). The suffix depends
+    on the archive format `form`, see `archive_suffixes`.
+
+    The members in the archive get names relative to `src`, prefixed with
+    `arcroot`. The default `arcroot` is the basename of `src`, like `tar czf
+    d.tar.gz d` would do; with `arcroot=""` only the contents of `src` are
+    archived, like `shutil.make_archive` does.
+
+    If `remove` is True then `src` is deleted after the archive was
+    successfully written. The archive is first written under a temporary name
+    and then renamed, so an archive file with the final name is always complete.
+
+    Returns the archive path and the (approximate) sizes of the directory and archive.
+    """
+    if form not in archive_suffixes:
+        raise ValueError("unknown archive format '{}', choose from {}".format(form,", ".join(archive_suffixes.keys())))
+    if form == "zstdtar" and zstandard is None:
+        raise RuntimeError("archive format 'zstdtar' requested, but the zstandard module is not available")
+    src = os.path.realpath(src)
+    if not os.path.isdir(src):
+        raise RuntimeError("cannot archive {}: not a directory".format(src))
+    if base_name is None:
+        base_name = src
+    if arcroot is None:
+        arcroot = os.path.basename(src)
+    dest = base_name + archive_suffixes[form]
+    tmp_dest = "{}.{}.{}.tmp".format(dest,os.getpid(),threading.get_ident())
+    dir_size = _dir_size(src)
+    try:
+        if form == "zip":
+            _zip_directory(src,tmp_dest,arcroot)
+        else:
+            with open(tmp_dest,"wb") as fh:
+                if form == "gztar":
+                    stream = parallel_gzip_writer(fh,nthreads=nthreads)
+                elif form == "zstdtar":
+                    stream = zstandard.ZstdCompressor(level=3,threads=nthreads if nthreads>1 else 0).stream_writer(fh,closefd=False)
+                else:
+                    stream = None
+                try:
+                    with tarfile.open(fileobj=stream or fh,mode=_tar_modes.get(form,"w|")) as tar:
+                        if arcroot:
+                            tar.add(src,arcname=arcroot)
+                        else:
+                            for name in sorted(os.listdir(src)):
+                                tar.add(os.path.join(src,name),arcname=name)
+                finally:
+                    if stream is not None:
+                        stream.close()
+        os.replace(tmp_dest,dest)
+    except:
+        if os.path.exists(tmp_dest):
+            os.remove(tmp_dest)
+        raise
+    arc_size = os.path.getsize(dest)
+    if remove:
+        shutil.rmtree(src)
+    logger.debug("archived {} ({} bytes) as {} ({} bytes)".format(src,dir_size,dest,arc_size))
+    return dest,dir_size,arc_size
+
+class job_archiver:
+    """
+    Archive many directories concurrently. Each call to `submit` schedules one
+    directory, `wait` blocks until all submitted directories are done and
+    returns the list of results (see `archive_directory`); failures are logged,
+    reported as `None` and collected in `errors`, as (directory, exception)
+    tuples. Failures of the removals scheduled with `submit_removal` are
+    collected separately, in `removal_errors`. The archiver can be used as a
+    context manager, in which case `wait` is called on exit.
+
+    The `nthreads` threads are spread over the directories (outer parallelism)
+    and the compression of each archive (inner parallelism): with many small
+    directories the outer parallelism is what matters.
+    """
+    def __init__(self,nthreads=None,form="gztar",remove=False):
+        if form == "zstdtar" and zstandard is None:
+            logger.warning("zstandard module not available, falling back to parallel gzip")
+            form = "gztar"
+        self.form = form
+        self.remove = remove
+        self.nthreads = default_nthreads() if nthreads is None else max(1,int(nthreads))
+        self._pool = ThreadPoolExecutor(self.nthreads,thread_name_prefix="archiver")
+        self._futures = []
+        self.errors = []
+        self.removal_errors = []
+        self.narchives = 0
+    def submit(self,src,base_name=None,arcroot=None,nthreads=1):
+        f = self._pool.submit(archive_directory,src,base_name,self.form,nthreads,arcroot,self.remove)
+        self._futures.append((src,f,False))
+        self.narchives += 1
+        return f
+    def submit_removal(self,src):
+        """
+        Schedule the removal of a directory that does not need to be archived
+        (the result of this task is `None`).
+        """
+        f = self._pool.submit(shutil.rmtree,src)
+        self._futures.append((src,f,True))
+        return f
+    def wait(self):
+        results = []
+        for src,f,removal in self._futures:
+            try:
+                results.append(f.result())
+            except Exception as e:
+                if removal:
+                    logger.error("failed to remove {}: '{}'".format(src,e))
+                    self.removal_errors.append((src,e))
+                else:
+                    logger.error("failed to archive {}: '{}'".format(src,e))
+                    self.errors.append((src,e))
+                results.append(None)
+        self._futures = []
+        return results
+    def shutdown(self):
+        results = self.wait()
+        self._pool.shutdown()
+        return results
+    def __enter__(self):
+        return self
+    def __exit__(self,*args):
+        self.shutdown()
+
+def archive_directories(dirs,nthreads=None,form="gztar",remove=False):
+    """
+    Archive all directories in `dirs`, each next to the original one, and wait for the result.
+    """
+    with job_archiver(nthreads,form,remove) as archiver:
+        for d in dirs:
+            archiver.submit(d)
+        return archiver.wait()
+
+###############################################################################################
+# BENCHMARK
+###############################################################################################
+
+def _make_synthetic_output_dir(path,nfiles=4,nbytes=200000):
+    """
+    Create a fake GATE output directory with a few partially compressible files
+    (a mix of repetitive text and random bytes, a bit like dose files + logs).
+    """
+    os.makedirs(path)
+    for i in range(nfiles):
+        with open(os.path.join(path,"file{}.raw".format(i)),"wb") as f:
+            f.write(os.urandom(nbytes//4))
+            f.write(b"Gate statistics actor output line\n"*(3*nbytes//4//34))
+
+def benchmark(ndirs=500,threads=(1,4,8),form="gztar",workdir=None):
+    """
+    Compress `ndirs` synthetic output directories with the given numbers of
+    threads, and print the wall clock times.
+    """
+    import tempfile
+    results = dict()
+    with tempfile.TemporaryDirectory(dir=workdir) as tmpdir:
+        for n in threads:
+            root = os.path.join(tmpdir,"threads{}".format(n))
+            dirs = [os.path.join(root,"output.{}".format(i)) for i in range(ndirs)]
+            for d in dirs:
+                _make_synthetic_output_dir(d)
+            t0 = time()
+            archive_directories(dirs,nthreads=n,form=form,remove=True)
+            results[n] = time()-t0
+            print("{} directories, format {}, {} thread(s): {:.2f} seconds".format(ndirs,form,n,results[n]))
+            shutil.rmtree(root)
+    return results
+
+###############################################################################################
+# UNIT TESTING
+###############################################################################################
+
+import unittest
+
+class test_job_archiver(unittest.TestCase):
+    def setUp(self):
+        import tempfile
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.dirs = [os.path.join(self.tmpdir.name,"output.{}".format(i)) for i in range(5)]
+        for d in self.dirs:
+            _make_synthetic_output_dir(d,nfiles=3,nbytes=30000)
+            os.makedirs(os.path.join(d,"sub"))
+            with open(os.path.join(d,"sub","stat.txt"),"w") as f:
+                f.write("NumberOfEvents = 1000\n")
+    def tearDown(self):
+        self.tmpdir.cleanup()
+    def _expected_names(self,d,arcroot):
+        names = [os.path.join(arcroot,os.path.relpath(os.path.join(p,f),d)) for p,_,files in os.walk(d) for f in files]
+        return sorted(names)
+    def test_parallel_gzip_roundtrip(self):
+        data = os.urandom(100000) + b"abc"*100000
+        buf = io.BytesIO()
+        with parallel_gzip_writer(buf,nthreads=4,blocksize=10000) as w:
+            w.write(data)
+        self.assertEqual(gzip.decompress(buf.getvalue()),data)
+    def test_gztar_no_chdir(self):
+        cwd = os.getcwd()
+        expected = self._expected_names(self.dirs[0],"output.0")
+        dest,dsize,asize = archive_directory(self.dirs[0],form="gztar",nthreads=3,remove=True)
+        self.assertEqual(os.getcwd(),cwd)
+        self.assertEqual(dest,os.path.realpath(self.dirs[0])+".tar.gz")
+        self.assertFalse(os.path.exists(self.dirs[0]))
+        self.assertTrue(asize < dsize)
+        with tarfile.open(dest,"r:gz") as tar:
+            names = sorted([m.name for m in tar.getmembers() if m.isfile()])
+        self.assertEqual(names,expected)
+    def test_zip_contents_only(self):
+        expected = self._expected_names(self.dirs[1],"")
+        dest,_,_ = archive_directory(self.dirs[1],base_name=os.path.join(self.tmpdir.name,"job1"),form="zip",arcroot="")
+        self.assertTrue(os.path.isdir(self.dirs[1]))
+        with zipfile.ZipFile(dest) as zf:
+            self.assertEqual(sorted([i.filename for i in zf.infolist() if not i.is_dir()]),expected)
+    def test_empty_directories(self):
+        os.makedirs(os.path.join(self.dirs[3],"empty","deeper"))
+        for form in ("zip","gztar"):
+            dest,_,_ = archive_directory(self.dirs[3],base_name=os.path.join(self.tmpdir.name,"job3"),form=form)
+            if form == "zip":
+                with zipfile.ZipFile(dest) as zf:
+                    dirs = [i.filename.rstrip("/") for i in zf.infolist() if i.is_dir()]
+            else:
+                with tarfile.open(dest,"r:gz") as tar:
+                    dirs = [m.name for m in tar.getmembers() if m.isdir()]
+            self.assertIn("output.3/empty",dirs)
+            self.assertIn("output.3/empty/deeper",dirs)
+        # the zip archive is the same as the one of shutil
+        ref = shutil.make_archive(os.path.join(self.tmpdir.name,"ref"),"zip",self.dirs[3])
+        dest,_,_ = archive_directory(self.dirs[3],base_name=os.path.join(self.tmpdir.name,"job3"),form="zip",arcroot="")
+        with zipfile.ZipFile(ref) as zref, zipfile.ZipFile(dest) as zf:
+            self.assertEqual(sorted(zref.namelist()),sorted(zf.namelist()))
+    def test_bztar_xztar(self):
+        for form,mode in (("bztar","r:bz2"),("xztar","r:xz")):
+            dest,_,_ = archive_directory(self.dirs[4],base_name=os.path.join(self.tmpdir.name,"job4"),form=form)
+            self.assertTrue(dest.endswith(archive_suffixes[form]))
+            with tarfile.open(dest,mode) as tar:
+                names = sorted([m.name for m in tar.getmembers() if m.isfile()])
+            self.assertEqual(names,self._expected_names(self.dirs[4],"output.4"))
+    def test_many_directories(self):
+        results = archive_directories(self.dirs,nthreads=4,remove=True)
+        self.assertEqual(len(results),len(self.dirs))
+        for d,r in zip(self.dirs,results):
+            self.assertIsNotNone(r)
+            self.assertTrue(os.path.exists(d+".tar.gz"))
+            self.assertFalse(os.path.exists(d))
+    def test_failure_is_reported(self):
+        results = archive_directories([os.path.join(self.tmpdir.name,"nonexisting")],nthreads=2)
+        self.assertEqual(results,[None])
+        with job_archiver(nthreads=2) as archiver:
+            archiver.submit_removal(self.dirs[0])
+            archiver.submit(os.path.join(self.tmpdir.name,"nonexisting"))
+            archiver.submit(self.dirs[1])
+            archiver.submit_removal(os.path.join(self.tmpdir.name,"nonexisting2"))
+            results = archiver.wait()
+        self.assertEqual(results[:2],[None,None])
+        self.assertIsNotNone(results[2])
+        self.assertEqual(archiver.narchives,2)
+        # failed archives and failed removals are reported separately
+        self.assertEqual([src for src,e in archiver.errors],[os.path.join(self.tmpdir.name,"nonexisting")])
+        self.assertEqual([src for src,e in archiver.removal_errors],[os.path.join(self.tmpdir.name,"nonexisting2")])
+    @unittest.skipIf(zstandard is None,"zstandard module not available")
+    def test_zstd(self):
+        dest,_,_ = archive_directory(self.dirs[2],form="zstdtar",nthreads=2)
+        with open(dest,"rb") as fh:
+            with zstandard.ZstdDecompressor().stream_reader(fh) as r:
+                with tarfile.open(fileobj=r,mode="r|") as tar:
+                    names = sorted([m.name for m in tar if m.isfile()])
+        self.assertEqual(names,self._expected_names(self.dirs[2],"output.2"))
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='benchmark the parallel archiving of job output directories')
+    parser.add_argument('-n','--ndirs',type=int,default=500,help='number of synthetic output directories')
+    parser.add_argument('-t','--threads',type=int,nargs='+',default=[1,4,8],help='numbers of threads to try')
+    parser.add_argument('-f','--format',default='gztar',choices=list(archive_suffixes.keys()))
+    parser.add_argument('-w','--workdir',default=None,help='directory in which to create the synthetic data')
+    args = parser.parse_args()
+    benchmark(args.ndirs,args.threads,args.format,args.workdir)
+
+# vim: set et softtabstop=4 sw=4 smartindent:
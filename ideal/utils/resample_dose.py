@@ -18,6 +18,11 @@ and the volumes V_i_j of each pair of input voxel i and output voxel j:
     w_i_j = V_i_j * M_i
     N_j = Sum_i w_i_j
 
+For very large images (e.g. a CT with 0.5 mm voxels and dose scoring on the
+full CT) `mass_weighted_resampling_chunked` computes the same result slab by
+slab, reading the input dose and mass from memory mapped MHD/raw files, with
+a peak memory use that is limited by a given byte budget.
+
 If you choose to run the multithreaded version, then it is your own
 responsibility to make wise choice for the number of threads, based on (e.g.)
 the number of physical cores, the available RAM and the current workload on the
@@ -32,14 +37,16 @@ machine.
 # -----------------------------------------------------------------------------
 
 
+import os
 import numpy as np
 import itk
 from datetime import datetime
 from utils.bounding_box import bounding_box
+from utils.dose_snapshot import _read_mhd_header
 import logging
 logger=logging.getLogger(__name__)
 
-def mass_weighted_resampling(dose,mass,newgrid):
+def mass_weighted_resampling(dose,mass,newgrid,copy=True):
     """
     This function computes a dose distribution using the geometry (origin,
     size, spacing) of the `newgrid` image, using the energy deposition and mass
@@ -48,23 +55,40 @@ def mass_weighted_resampling(dose,mass,newgrid):
     and then we want to resample this dose distribution to the geometry of the
     new grid, e.g. from the dose distribution computed by a TPS.
 
-    This implementation relies on a bit of numpy magic (np.tensordot,
+    The geometries are first inspected by `resampling_plan`. If they are
+    identical then no resampling is needed; with `copy=False` the input dose
+    image itself is returned instead of a copy. If the new grid is an exact
+    integer coarsening of (a subregion of) the input grid, then every input
+    voxel contributes with the same volume to exactly one output voxel and the
+    dose is computed with a reshape-and-sum (see `_integer_downsampling`).
+    Only for all other geometries the general overlap computation is used.
+
+    The general implementation relies on a bit of numpy magic (np.tensordot,
     repeatedly).  A intuitively more clear but in practice much slower
     implementation is given by `_mwr_wit_loops(dose,mass,newgrid)`; the unit
     tests are verifying that these two implementation indeed yield the same
     result. 
     """
     assert(equal_geometry(dose,mass))
-    if equal_geometry(dose,newgrid):
+    plan = resampling_plan(dose,newgrid)
+    if plan.kind == "identity":
         # If input and output geometry are equal, then we don't need to do anything, just copy the input dose.
+        if not copy:
+            return dose
         newdose=itk.image_from_array(itk.array_from_image(dose))
         newdose.CopyInformation(dose)
         return newdose
-    if not enclosing_geometry(dose,newgrid):
+    if plan.kind == "outside":
         # In a later release we may provide some smart code to deal with dose resampling outside of the input geometry.
         raise RuntimeError("new grid must be inside the old one")
     # start the timer
     t0=datetime.now()
+    if plan.kind == "downsampling":
+        newdose = _integer_downsampling(dose,mass,newgrid,plan)
+        t1=datetime.now()
+        dt=(t1-t0).total_seconds()
+        logger.debug(f"resampling using integer downsampling with factors {plan.factors} took {dt:.3f} seconds")
+        return newdose
     xol,yol,zol = [ _overlaps(*xyz) for xyz in zip(dose.GetOrigin(),
                                                    dose.GetSpacing(),
                                                    dose.GetLargestPossibleRegion().GetSize(),
@@ -93,6 +117,132 @@ def mass_weighted_resampling(dose,mass,newgrid):
     return newdose
 
 
+def mass_weighted_resampling_chunked(dose,mass,newgrid,budget_bytes=512*1024**2):
+    """
+    Out-of-core version of `mass_weighted_resampling`, for input images that
+    are too large to process in one go. The `dose` and `mass` can be given as
+    ITK images or as file names of MHD/raw files (uncompressed), which are
+    then memory mapped. The new grid is processed in slabs of z-slices: for
+    each slab only the input slices that overlap with it are read (and only
+    the part of those slices that overlaps with the new grid), converted to
+    double precision and resampled, then the slab is stored in the single
+    precision output image. The slab thickness is chosen such that the
+    estimated memory use, including the output image, stays below
+    `budget_bytes`. If the budget is too small for even a single slice, then
+    a warning is given and the resampling is done slice by slice.
+
+    The result is the same as that of `mass_weighted_resampling`, except that
+    it is single precision (float32) and never a view of the input.
+    """
+    sdose = _image_slabs(dose)
+    smass = _image_slabs(mass)
+    assert(equal_geometry(sdose.geometry,smass.geometry))
+    plan = resampling_plan(sdose.geometry,newgrid)
+    if plan.kind == "outside":
+        raise RuntimeError("new grid must be inside the old one")
+    t0=datetime.now()
+    xol,yol,zol = [ _overlaps(*xyz) for xyz in zip(sdose.geometry.GetOrigin(),
+                                                   sdose.geometry.GetSpacing(),
+                                                   sdose.geometry.GetLargestPossibleRegion().GetSize(),
+                                                   newgrid.GetOrigin(),
+                                                   newgrid.GetSpacing(),
+                                                   newgrid.GetLargestPossibleRegion().GetSize()) ]
+    # only the input rows and columns that overlap with the new grid are read
+    iy0,iy1 = _nonzero_range(yol)
+    ix0,ix1 = _nonzero_range(xol)
+    xol = xol[ix0:ix1]
+    yol = yol[iy0:iy1]
+    mzyx = tuple(np.array(newgrid.GetLargestPossibleRegion().GetSize())[::-1])
+    anew = np.zeros(mzyx,dtype=np.float32)
+    ratio = float(newgrid.GetSpacing()[2])/float(sdose.geometry.GetSpacing()[2])
+    nslab = _slab_thickness(budget_bytes,sdose,smass,(iy1-iy0,ix1-ix0),mzyx,ratio,anew.nbytes+xol.nbytes+yol.nbytes+zol.nbytes)
+    logger.debug(f"resampling {sdose.shape} to {mzyx} in slabs of {nslab} slices with a budget of {budget_bytes} bytes")
+    for jz0 in range(0,mzyx[0],nslab):
+        jz1 = min(mzyx[0],jz0+nslab)
+        iz0,iz1 = _nonzero_range(zol[:,jz0:jz1])
+        if iz0 == iz1:
+            continue
+        if plan.kind == "identity":
+            # same voxels: copy the dose without mass weighting, like `mass_weighted_resampling`
+            anew[jz0:jz1] = sdose.read(iz0,iz1,iy0,iy1,ix0,ix1)
+            continue
+        amass = smass.read(iz0,iz1,iy0,iy1,ix0,ix1)
+        aedep = sdose.read(iz0,iz1,iy0,iy1,ix0,ix1)
+        aedep *= amass
+        if plan.kind == "downsampling":
+            # the input slabs are aligned with the output voxels
+            shape = (jz1-jz0,)+mzyx[1:]
+            assert(aedep.shape==tuple(n*f for n,f in zip(shape,plan.factors)))
+            enew,wsum = _block_sums(aedep,amass,plan.factors)
+            del aedep
+        else:
+            zslab = zol[iz0:iz1,jz0:jz1]
+            enew = np.tensordot(zslab,np.tensordot(yol,np.tensordot(xol,aedep,axes=(0,2)),axes=(0,2)),axes=(0,2))
+            del aedep
+            wsum = np.tensordot(zslab,np.tensordot(yol,np.tensordot(xol,amass,axes=(0,2)),axes=(0,2)),axes=(0,2))
+        del amass
+        # dose=edep/mass, but only if mass>0
+        mask=(wsum>0)
+        enew[mask]/=wsum[mask]
+        anew[jz0:jz1]=enew
+        del enew,wsum,mask
+    newdose=itk.image_view_from_array(anew)
+    newdose.CopyInformation(newgrid)
+    t1=datetime.now()
+    dt=(t1-t0).total_seconds()
+    logger.debug(f"chunked resampling in slabs of {nslab} slices took {dt:.3f} seconds")
+    return newdose
+
+
+class resampling_plan:
+    """
+    Classification of the relation between the geometry of an input dose
+    image and the geometry of the new grid, used by `mass_weighted_resampling`
+    to pick the cheapest correct implementation:
+
+    * "identity": same voxels, nothing to compute.
+    * "downsampling": along each axis the new spacing is an integer multiple
+      (`factors`, in zyx order) of the input spacing and the new voxel edges
+      coincide with input voxel edges, starting at input voxel `offsets` (zyx).
+      A factor of 1 with a nonzero offset is a plain crop.
+    * "general": anything else that is enclosed by the input geometry.
+    * "outside": the new grid is not enclosed by the input geometry.
+    """
+    def __init__(self,img,newgrid):
+        self.factors = None
+        self.offsets = None
+        if equal_geometry(img,newgrid):
+            self.kind = "identity"
+        elif not enclosing_geometry(img,newgrid):
+            self.kind = "outside"
+        elif self._integer_coarsening(img,newgrid):
+            self.kind = "downsampling"
+        else:
+            self.kind = "general"
+    def _integer_coarsening(self,img,newgrid):
+        s1=np.array(itk.spacing(img),dtype=float)
+        s2=np.array(itk.spacing(newgrid),dtype=float)
+        n1=np.array(itk.size(img),dtype=int)
+        n2=np.array(itk.size(newgrid),dtype=int)
+        lower1=np.array(itk.origin(img),dtype=float)-0.5*s1
+        lower2=np.array(itk.origin(newgrid),dtype=float)-0.5*s2
+        ratio = s2/s1
+        factors = np.rint(ratio).astype(int)
+        if (factors<1).any() or not np.allclose(ratio,factors):
+            return False
+        shift = (lower2-lower1)/s1
+        offsets = np.rint(shift).astype(int)
+        if (offsets<0).any() or not np.allclose(shift,offsets,atol=1e-5):
+            return False
+        if (offsets+n2*factors>n1).any():
+            return False
+        self.factors = tuple(factors[::-1].tolist())
+        self.offsets = tuple(offsets[::-1].tolist())
+        return True
+    def __repr__(self):
+        return f"resampling_plan({self.kind},factors={self.factors},offsets={self.offsets})"
+
+
 def equal_geometry(img1,img2):
     """
     Do img1 and img2 have the same geometry (same voxels)?
@@ -215,6 +365,139 @@ def _mwr_with_loops(dose,mass,newgrid):
     return newdose
     
 
+def _integer_downsampling(dose,mass,newgrid,plan):
+    """
+    Mass weighted resampling for a new grid that is an integer coarsening of
+    the input grid (see `resampling_plan`). All pairs of overlapping voxels
+    have the same intersection volume (the input voxel volume), so the weights
+    are just the masses. Each output voxel is the sum over a block of
+    `factors` input voxels, which is computed with a reshape: O(N) and without
+    any overlap matrices.
+
+    This is an auxiliary function for `mass_weighted_resampling`.
+    """
+    mzyx = tuple(np.array(newgrid.GetLargestPossibleRegion().GetSize())[::-1])
+    region = tuple(slice(o,o+m*f) for o,m,f in zip(plan.offsets,mzyx,plan.factors))
+    amass = itk.array_view_from_image(mass)[region].astype(float)
+    aedep = itk.array_view_from_image(dose)[region]*amass
+    anew,wsum = _block_sums(aedep,amass,plan.factors)
+    del aedep,amass
+    # dose=edep/mass, but only if mass>0
+    mask=(wsum>0)
+    anew[mask]/=wsum[mask]
+    newdose=itk.image_from_array(anew)
+    newdose.CopyInformation(newgrid)
+    return newdose
+
+def _block_sums(aedep,amass,factors):
+    """
+    Sums of the energy deposition and of the mass over blocks of `factors`
+    (zyx) voxels. The shapes of the arrays should be multiples of the factors.
+
+    This is an auxiliary function for `mass_weighted_resampling`.
+    """
+    mz,my,mx = [n//f for n,f in zip(amass.shape,factors)]
+    blocks = (mz,factors[0],my,factors[1],mx,factors[2])
+    return aedep.reshape(blocks).sum(axis=(1,3,5)),amass.reshape(blocks).sum(axis=(1,3,5))
+
+def _nonzero_range(ol):
+    """
+    First and last+1 index of the rows of the overlap matrix `ol` that have
+    any nonzero overlap (0,0 if there are none).
+
+    This is an auxiliary function for `mass_weighted_resampling_chunked`.
+    """
+    rows = np.flatnonzero(ol.any(axis=1))
+    if len(rows) == 0:
+        return 0,0
+    return int(rows[0]),int(rows[-1])+1
+
+def _slab_thickness(budget_bytes,sdose,smass,nyx,mzyx,ratio,fixed_bytes):
+    """
+    Number of output slices per slab such that the estimated memory use of
+    `mass_weighted_resampling_chunked` stays within the budget. Per input
+    slice: the mapped slices of the dose and mass files, the double
+    precision copies of the overlapping part, a copy made by np.tensordot
+    and the intermediate tensordot results (with copies). Per output slice:
+    the double precision sums and the mask. The `ratio` is the number of
+    input slices per output slice.
+
+    This is an auxiliary function for `mass_weighted_resampling_chunked`.
+    """
+    ny,nx = nyx
+    mz,my,mx = mzyx
+    per_input_slice = sdose.slice_nbytes + smass.slice_nbytes + 8*(3*ny*nx + 2*mx*ny + 2*my*mx)
+    per_output_slice = 8*3*my*mx
+    available = budget_bytes - fixed_bytes - 2*per_input_slice
+    nslab = int(available//(ratio*per_input_slice+per_output_slice)) if available > 0 else 0
+    if nslab < 1:
+        logger.warning(f"memory budget of {budget_bytes} bytes is too small for resampling to a grid of {mzyx} voxels, going slice by slice")
+        return 1
+    return min(nslab,mz)
+
+class _image_slabs:
+    """
+    Read access to z-slabs of a 3D image, which is either an ITK image or an
+    uncompressed MHD/raw file. The raw file is memory mapped for each read
+    and unmapped again afterwards, so that the mapped pages do not keep
+    adding up to the resident memory of the process. The `geometry` is an
+    image with the same origin, spacing and size, without any pixel buffer.
+
+    This is an auxiliary class for `mass_weighted_resampling_chunked`.
+    """
+    element_types = {"MET_FLOAT":np.float32,"MET_DOUBLE":np.float64,
+                     "MET_CHAR":np.int8,"MET_UCHAR":np.uint8,
+                     "MET_SHORT":np.int16,"MET_USHORT":np.uint16,
+                     "MET_INT":np.int32,"MET_UINT":np.uint32}
+    def __init__(self,img):
+        if isinstance(img,(str,os.PathLike)):
+            self.array = None
+            self._open_mhd(os.fspath(img))
+        else:
+            self.array = itk.array_view_from_image(img)
+            self.shape = self.array.shape
+            self.geometry = img
+        self.slice_nbytes = int(np.prod(self.shape[1:]))*(self.array.itemsize if self.array is not None else self.dtype.itemsize)
+    def _open_mhd(self,mhd):
+        header = _read_mhd_header(mhd)
+        if header.get("CompressedData","False") != "False":
+            raise RuntimeError(f"cannot memory map compressed data in {mhd}")
+        etype = header.get("ElementType","")
+        if etype not in self.element_types:
+            raise RuntimeError(f"unsupported element type '{etype}' in {mhd}")
+        self.dtype = np.dtype(self.element_types[etype])
+        if header.get("ElementByteOrderMSB",header.get("BinaryDataByteOrderMSB","False")) != "False":
+            self.dtype = self.dtype.newbyteorder(">")
+        nxyz = [int(n) for n in header["DimSize"].split()]
+        if len(nxyz) != 3:
+            raise RuntimeError(f"expected a 3D image in {mhd}, got DimSize={nxyz}")
+        self.shape = tuple(nxyz[::-1])
+        if header.get("ElementDataFile","LOCAL") == "LOCAL":
+            raise RuntimeError(f"cannot memory map the data in {mhd}, it needs to be in a separate raw file")
+        self.raw = os.path.join(os.path.dirname(mhd),header["ElementDataFile"])
+        nbytes = int(np.prod(self.shape))*self.dtype.itemsize
+        self.offset = int(header.get("HeaderSize","0"))
+        if self.offset < 0:
+            self.offset = os.path.getsize(self.raw)-nbytes
+        if os.path.getsize(self.raw) < self.offset+nbytes:
+            raise RuntimeError(f"expected {nbytes} bytes of data in {self.raw}, got {os.path.getsize(self.raw)-self.offset}")
+        spacing = [float(x) for x in header.get("ElementSpacing","1 1 1").split()]
+        origin = [float(x) for x in header.get("Offset",header.get("Origin","0 0 0")).split()]
+        self.geometry = itk.Image[itk.F,3].New()
+        self.geometry.SetRegions(nxyz)
+        self.geometry.SetSpacing(spacing)
+        self.geometry.SetOrigin(origin)
+    def read(self,iz0,iz1,iy0,iy1,ix0,ix1):
+        """
+        Double precision copy of the voxels [iz0:iz1,iy0:iy1,ix0:ix1].
+        """
+        if self.array is not None:
+            return self.array[iz0:iz1,iy0:iy1,ix0:ix1].astype(float)
+        mm = np.memmap(self.raw,dtype=self.dtype,mode="r",offset=self.offset+iz0*self.slice_nbytes,shape=(iz1-iz0,)+self.shape[1:])
+        a = mm[:,iy0:iy1,ix0:ix1].astype(float)
+        del mm
+        return a
+
 def _overlaps(a0,da,na,b0,db,nb,label="",center=True):
     """
     This function returns an (na,nb) array with the length of the overlaps in
@@ -443,4 +726,133 @@ class dose_resampling_tests(LoggedTestCase):
         self.assertAlmostEqual(expval,value1,places=5)
         self.assertAlmostEqual(expval,value2,places=5)
 
+class resampling_plan_tests(LoggedTestCase):
+    def setUp(self):
+        # source grid: 24x20x18 voxels, spacing 0.5x0.75x1.0, with a nonuniform mass
+        self.dims = (24,20,18)
+        self.spacing = (0.5,0.75,1.0)
+        self.origin = (-3.25,7.0,-2.5)
+        self.adose = np.random.normal(1.,0.05,self.dims[::-1]).astype(np.float32)
+        self.amass = np.random.uniform(0.5,1.5,self.dims[::-1]).astype(np.float32)
+        self.amass[0,:,:]=0.
+        self.dose = itk.image_from_array(self.adose)
+        self.mass = itk.image_from_array(self.amass)
+        for img in [self.dose,self.mass]:
+            img.SetSpacing(self.spacing)
+            img.SetOrigin(self.origin)
+    def newgrid(self,factors,offsets,dims):
+        # factors, offsets and dims in xyz order
+        spacing = np.array(self.spacing)*np.array(factors)
+        lower = np.array(self.origin)-0.5*np.array(self.spacing)+np.array(offsets)*np.array(self.spacing)
+        grid = itk.image_from_array(np.zeros(dims[::-1],dtype=np.float32))
+        grid.SetSpacing(spacing.tolist())
+        grid.SetOrigin((lower+0.5*spacing).tolist())
+        return grid
+    def compare(self,newgrid,kind):
+        plan=resampling_plan(self.dose,newgrid)
+        self.assertEqual(plan.kind,kind)
+        resampled_loops=_mwr_with_loops(self.dose,self.mass,newgrid)
+        resampled=mass_weighted_resampling(self.dose,self.mass,newgrid)
+        self.assertTrue(equal_geometry(resampled,newgrid))
+        ar0=itk.array_from_image(resampled_loops)
+        ar1=itk.array_from_image(resampled)
+        self.assertEqual(ar0.shape,ar1.shape)
+        self.assertTrue(np.allclose(ar0,ar1))
+        return plan
+    def test_identity(self):
+        grid=self.newgrid((1,1,1),(0,0,0),self.dims)
+        self.compare(grid,"identity")
+        view=mass_weighted_resampling(self.dose,self.mass,grid,copy=False)
+        self.assertTrue(np.shares_memory(itk.array_view_from_image(view),itk.array_view_from_image(self.dose)))
+        copied=mass_weighted_resampling(self.dose,self.mass,grid)
+        self.assertFalse(np.shares_memory(itk.array_view_from_image(copied),itk.array_view_from_image(self.dose)))
+    def test_integer_downsampling(self):
+        plan=self.compare(self.newgrid((2,4,3),(0,0,0),(12,5,6)),"downsampling")
+        self.assertEqual(plan.factors,(3,4,2))
+        self.assertEqual(plan.offsets,(0,0,0))
+        # subregion with different factors per axis
+        plan=self.compare(self.newgrid((3,2,1),(2,1,3),(7,9,10)),"downsampling")
+        self.assertEqual(plan.factors,(1,2,3))
+        self.assertEqual(plan.offsets,(3,1,2))
+        # all mass zero in the first slices: dose should be zero there
+        resampled=mass_weighted_resampling(self.dose,self.mass,self.newgrid((2,2,1),(0,0,0),(12,10,18)))
+        self.assertTrue(np.all(itk.array_view_from_image(resampled)[0]==0.))
+    def test_crop(self):
+        plan=self.compare(self.newgrid((1,1,1),(3,4,5),(10,8,6)),"downsampling")
+        self.assertEqual(plan.factors,(1,1,1))
+    def test_fallback(self):
+        # new voxel edges do not coincide with the old ones
+        grid=self.newgrid((2,2,2),(0.5,0,0),(10,8,6))
+        self.compare(grid,"general")
+        # non-integer ratio of the spacings
+        grid=self.newgrid((1.5,2,2),(0,0,0),(10,8,6))
+        self.compare(grid,"general")
+        # finer grid
+        grid=self.newgrid((0.5,1,1),(0,0,0),(10,8,6))
+        self.compare(grid,"general")
+    def test_outside(self):
+        grid=self.newgrid((2,2,2),(-1,0,0),(5,5,5))
+        self.assertEqual(resampling_plan(self.dose,grid).kind,"outside")
+        with self.assertRaises(RuntimeError):
+            mass_weighted_resampling(self.dose,self.mass,grid)
+
+class chunked_resampling_tests(LoggedTestCase):
+    def setUp(self):
+        import tempfile
+        self.tmpdir = tempfile.TemporaryDirectory(prefix="test_chunked_resampling_")
+        self.dims = (60,50,40)
+        self.spacing = (0.6,0.5,0.4)
+        self.origin = (-4.4,5.5,-6.6)
+        adose = np.random.normal(1.,0.05,self.dims[::-1]).astype(np.float32)
+        amass = np.random.uniform(0.5,1.5,self.dims[::-1]).astype(np.float32)
+        amass[:,:3,:]=0.
+        self.dose = itk.image_from_array(adose)
+        self.mass = itk.image_from_array(amass)
+        for img in [self.dose,self.mass]:
+            img.SetSpacing(self.spacing)
+            img.SetOrigin(self.origin)
+        self.dose_mhd = os.path.join(self.tmpdir.name,"dose.mhd")
+        self.mass_mhd = os.path.join(self.tmpdir.name,"mass.mhd")
+        itk.imwrite(self.dose,self.dose_mhd)
+        itk.imwrite(self.mass,self.mass_mhd)
+    def tearDown(self):
+        self.tmpdir.cleanup()
+    def newgrid(self,dims,spacing,origin):
+        grid = itk.image_from_array(np.zeros(dims[::-1],dtype=np.float32))
+        grid.SetSpacing(spacing)
+        grid.SetOrigin(origin)
+        return grid
+    def compare(self,newgrid,kind,budget_bytes):
+        self.assertEqual(resampling_plan(self.dose,newgrid).kind,kind)
+        expected = itk.array_from_image(mass_weighted_resampling(self.dose,self.mass,newgrid))
+        for dose,mass in [(self.dose_mhd,self.mass_mhd),(self.dose,self.mass),(self.dose_mhd,self.mass)]:
+            resampled = mass_weighted_resampling_chunked(dose,mass,newgrid,budget_bytes=budget_bytes)
+            self.assertTrue(equal_geometry(resampled,newgrid))
+            ar = itk.array_from_image(resampled)
+            self.assertEqual(ar.dtype,np.float32)
+            self.assertTrue(np.allclose(ar,expected,rtol=1e-6,atol=1e-6))
+    def test_general(self):
+        grid = self.newgrid((30,25,12),(0.7,0.55,1.1),(-3.9,6.1,-5.9))
+        # everything in one slab, a few slabs, and slice by slice
+        self.compare(grid,"general",2**30)
+        self.compare(grid,"general",1024**2)
+        with self.assertLogs(logger,level="WARNING"):
+            self.compare(grid,"general",1024)
+    def test_downsampling(self):
+        lower = np.array(self.origin)-0.5*np.array(self.spacing)
+        spacing = 2*np.array(self.spacing)
+        grid = self.newgrid((28,24,19),spacing.tolist(),(lower+np.array(self.spacing)+0.5*spacing).tolist())
+        self.compare(grid,"downsampling",2**30)
+        self.compare(grid,"downsampling",2*1024**2)
+        identity = self.newgrid(self.dims,self.spacing,self.origin)
+        self.compare(identity,"identity",2*1024**2)
+    def test_wrong_input(self):
+        grid = self.newgrid((30,25,12),(0.7,0.55,1.1),(-30.,6.1,-5.9))
+        with self.assertRaises(RuntimeError):
+            mass_weighted_resampling_chunked(self.dose_mhd,self.mass_mhd,grid)
+        compressed = os.path.join(self.tmpdir.name,"compressed.mhd")
+        itk.imwrite(self.dose,compressed,compression=True)
+        with self.assertRaises(RuntimeError):
+            mass_weighted_resampling_chunked(compressed,self.mass_mhd,self.newgrid((30,25,12),(0.7,0.55,1.1),(-3.9,6.1,-5.9)))
+
 # vim: set et softtabstop=4 sw=4 smartindent:
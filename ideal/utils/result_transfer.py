@@ -0,0 +1,419 @@
+# -----------------------------------------------------------------------------
+#   Copyright (C): MedAustron GmbH, ACMIT Gmbh and Medical University Vienna
+#   This software is distributed under the terms
+#   of the GNU Lesser General  Public Licence (LGPL)
+#   See LICENSE for further details
+# -----------------------------------------------------------------------------
+
+"""
+Background transfer of job results (plan dose DICOM and user log cfg file)
+to the receiving API, for the IDEAL API server.
+
+The `result_transfer_manager` uploads in worker threads, so that the HTTP
+request handler can return immediately. It uses one persistent
+`requests.Session` (connection pool), caches the authentication token
+until it expires, streams the files in chunks (the files are never read
+completely into memory) and retries with exponential backoff after
+connection errors, time outs and 5xx responses. The progress of each
+transfer is recorded in a `transfer_state` object.
+"""
+
+import os
+import time
+import uuid
+import threading
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urljoin
+import requests
+from requests.adapters import HTTPAdapter
+logger=logging.getLogger(__name__)
+
+# transfer status values
+QUEUED = 'queued'
+UPLOADING = 'uploading'
+RETRYING = 'retrying'
+DONE = 'done'
+FAILED = 'failed'
+
+def find_result_files(outputdir):
+    """
+    Returns the paths of the plan dose DICOM file and the user log cfg file
+    in the output directory (None if not found).
+    """
+    dicom,cfg = None,None
+    for fname in sorted(os.listdir(outputdir)):
+        # for now we pass only the dcm with the simulated full plan and the report .cfg
+        if 'PLAN' in fname and '.dcm' in fname:
+            dicom = os.path.join(outputdir,fname)
+        if '.cfg' in fname:
+            cfg = os.path.join(outputdir,fname)
+    return dicom,cfg
+
+class multipart_stream:
+    """
+    A multipart/form-data request body that reads the files in chunks while
+    it is being sent. The total length is known in advance, so the request
+    is sent with a Content-Length header (not with chunked encoding).
+    `fields` is a list of (field name, file path) tuples; a file path None
+    gives an empty file part.
+    """
+    def __init__(self,fields,chunk_size=1<<20,callback=None):
+        self.boundary = uuid.uuid4().hex
+        self.chunk_size = chunk_size
+        self.callback = callback
+        self.parts = []
+        for name,path in fields:
+            filename = name if path is None else os.path.basename(path)
+            header = '--{}\r\nContent-Disposition: form-data; name="{}"; filename="{}"\r\nContent-Type: application/octet-stream\r\n\r\n'.format(
+                    self.boundary,name,filename).encode()
+            size = 0 if path is None else os.path.getsize(path)
+            self.parts.append((header,path,size))
+        self.trailer = '--{}--\r\n'.format(self.boundary).encode()
+    @property
+    def content_type(self):
+        return 'multipart/form-data; boundary={}'.format(self.boundary)
+    def __len__(self):
+        return sum([len(header)+size+2 for header,path,size in self.parts]) + len(self.trailer)
+    def __iter__(self):
+        for header,path,size in self.parts:
+            yield header
+            if path is not None:
+                with open(path,'rb') as f:
+                    while True:
+                        chunk = f.read(self.chunk_size)
+                        if not chunk:
+                            break
+                        yield chunk
+                        if self.callback:
+                            self.callback(len(chunk))
+            yield b'\r\n'
+        yield self.trailer
+
+class token_cache:
+    """
+    Authentication token for the receiving API, renewed when it expires.
+    If the receiver does not say how long the token is valid ('expiresIn',
+    in seconds), then `lifetime_seconds` is assumed.
+    """
+    def __init__(self,session,auth_url,login_data,lifetime_seconds=600.,verify=False,timeout=30.):
+        self.session = session
+        self.auth_url = auth_url
+        self.login_data = dict(login_data)
+        self.lifetime_seconds = lifetime_seconds
+        self.verify = verify
+        self.timeout = timeout
+        self._token = None
+        self._expires = 0.
+        self._lock = threading.Lock()
+        self.nauth = 0
+    def get(self):
+        with self._lock:
+            if self._token is None or time.monotonic() >= self._expires:
+                r = self.session.get(self.auth_url,headers=self.login_data,verify=self.verify,timeout=self.timeout)
+                r.raise_for_status()
+                data = r.json()
+                self._token = data['authToken']
+                lifetime = float(data.get('expiresIn',self.lifetime_seconds))
+                # renew a bit before the receiver would reject it
+                self._expires = time.monotonic() + 0.9*lifetime
+                self.nauth += 1
+            return self._token
+    def invalidate(self):
+        with self._lock:
+            self._token = None
+
+class transfer_state:
+    """
+    Progress of the transfer of the results of one job.
+    """
+    def __init__(self,jobId):
+        self.jobId = jobId
+        self.status = QUEUED
+        self.attempts = 0
+        self.bytes_sent = 0
+        self.bytes_total = 0
+        self.http_status = None
+        self.error = ""
+        self.t_submit = time.time()
+        self.t_done = None
+        self._lock = threading.Lock()
+    def update(self,**kwargs):
+        with self._lock:
+            for k,v in kwargs.items():
+                setattr(self,k,v)
+    def add_bytes(self,n):
+        with self._lock:
+            self.bytes_sent += n
+    @property
+    def active(self):
+        return self.status in (QUEUED,UPLOADING,RETRYING)
+    def as_dict(self):
+        with self._lock:
+            return dict(jobId=self.jobId,status=self.status,attempts=self.attempts,
+                        bytesSent=self.bytes_sent,bytesTotal=self.bytes_total,
+                        httpStatus=self.http_status,error=self.error)
+
+class result_transfer_manager:
+    """
+    Uploads job results to the receiver configured in the [receiver] section
+    of the API configuration, in background threads.
+    """
+    def __init__(self,api_cfg,nthreads=2,max_retries=None,backoff_seconds=None,max_backoff_seconds=60.,
+                 chunk_size=1<<20,timeout=(10.,300.),verify=False):
+        receiver = api_cfg['receiver']
+        self.url = receiver['url to send result']
+        self.auth_url = receiver['url authentication']
+        self.max_retries = receiver.getint('transfer retries',fallback=5) if max_retries is None else max_retries
+        self.backoff_seconds = receiver.getfloat('transfer backoff [s]',fallback=2.) if backoff_seconds is None else backoff_seconds
+        self.max_backoff_seconds = max_backoff_seconds
+        self.chunk_size = chunk_size
+        self.timeout = timeout
+        self.verify = verify
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=nthreads,pool_maxsize=nthreads)
+        self.session.mount('http://',adapter)
+        self.session.mount('https://',adapter)
+        self._tokens = dict()
+        self._states = dict()
+        self._futures = dict()
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=nthreads,thread_name_prefix="result_transfer")
+    def _token_cache(self,login_data):
+        key = tuple(sorted(login_data.items()))
+        with self._lock:
+            if key not in self._tokens:
+                self._tokens[key] = token_cache(self.session,self.auth_url,login_data,verify=self.verify,timeout=self.timeout)
+            return self._tokens[key]
+    def submit(self,jobId,outputdir,login_data):
+        """
+        Start the transfer of the results in `outputdir` and return its state
+        object. If a transfer for this job is still going on, then the state
+        of that transfer is returned and no new transfer is started.
+        """
+        with self._lock:
+            state = self._states.get(jobId)
+            if state is not None and state.active:
+                return state
+            state = transfer_state(jobId)
+            self._states[jobId] = state
+            self._futures[jobId] = self._executor.submit(self._transfer,state,outputdir,login_data)
+        return state
+    def state(self,jobId):
+        with self._lock:
+            return self._states.get(jobId)
+    def wait(self,jobId,timeout=None):
+        with self._lock:
+            future = self._futures.get(jobId)
+        if future is not None:
+            future.result(timeout)
+        return self.state(jobId)
+    def shutdown(self,wait=True):
+        self._executor.shutdown(wait=wait)
+        self.session.close()
+    def _transfer(self,state,outputdir,login_data):
+        try:
+            dicom,cfg = find_result_files(outputdir)
+            if cfg is None:
+                raise RuntimeError("no user log file found in {}".format(outputdir))
+            if dicom is None:
+                logger.warning("no plan dose DICOM file found in {}, sending only the user log file".format(outputdir))
+            fields = [('monteCarloDoseDicom',dicom),('logFile',cfg)]
+            url = urljoin(self.url,state.jobId)
+            tokens = self._token_cache(login_data)
+        except Exception as e:
+            logger.error("transfer of results for job {} failed: {}".format(state.jobId,e))
+            state.update(status=FAILED,error=str(e),t_done=time.time())
+            return
+        try:
+            for attempt in range(self.max_retries+1):
+                if attempt > 0:
+                    delay = min(self.max_backoff_seconds,self.backoff_seconds*2**(attempt-1))
+                    state.update(status=RETRYING)
+                    logger.info("transfer of results for job {}: retry {} in {} seconds".format(state.jobId,attempt,delay))
+                    time.sleep(delay)
+                body = multipart_stream(fields,self.chunk_size,callback=state.add_bytes)
+                state.update(status=UPLOADING,attempts=attempt+1,bytes_sent=0,bytes_total=len(body))
+                try:
+                    token = tokens.get()
+                    r = self.session.post(url,data=body,verify=self.verify,timeout=self.timeout,
+                                          headers={'Authorization':"Bearer " + token,'Content-Type':body.content_type})
+                except requests.HTTPError as e:
+                    # the authentication request failed
+                    code = e.response.status_code
+                    state.update(http_status=code,error="authentication failed: {}".format(e))
+                    if code < 500:
+                        break
+                    continue
+                except (requests.ConnectionError,requests.Timeout) as e:
+                    state.update(error=str(e))
+                    continue
+                except Exception as e:
+                    # e.g. a malformed authentication reply, or a result file that cannot be read: retrying does not help
+                    state.update(error="{}: {}".format(type(e).__name__,e))
+                    break
+                state.update(http_status=r.status_code)
+                if r.ok:
+                    logger.info("transfer of results for job {} done after {} attempt(s)".format(state.jobId,attempt+1))
+                    state.update(status=DONE,error="",t_done=time.time())
+                    return
+                state.update(error="{} {}".format(r.status_code,r.text[:200]))
+                if r.status_code == 401:
+                    # token expired or rejected: authenticate again
+                    tokens.invalidate()
+                elif r.status_code < 500 and r.status_code != 429:
+                    break
+        except Exception as e:
+            state.update(error="{}: {}".format(type(e).__name__,e))
+        finally:
+            # whatever happened, the transfer ends as DONE or FAILED, so that it can be submitted again
+            if state.active:
+                logger.error("transfer of results for job {} failed: {}".format(state.jobId,state.error))
+                state.update(status=FAILED,t_done=time.time())
+
+###############################################################################################
+# UNIT TESTING
+###############################################################################################
+
+import unittest
+
+class test_result_transfer(unittest.TestCase):
+    """
+    Transfers to a local stand-in receiver (Flask app in a thread), which
+    can simulate transient server errors, expired tokens and slow links.
+    """
+    def setUp(self):
+        try:
+            from flask import Flask, request, jsonify
+            from werkzeug.serving import make_server
+        except ImportError as e:
+            self.skipTest("flask not available: {}".format(e))
+        import tempfile
+        import configparser
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.outputdir = os.path.join(self.tmpdir.name,"job_123")
+        os.mkdir(self.outputdir)
+        self.dicom_data = os.urandom(300000)
+        self.cfg_data = b"[DEFAULT]\nstatus = FINISHED\n"
+        with open(os.path.join(self.outputdir,"idc-PLAN-PhysicalDose.dcm"),"wb") as f:
+            f.write(self.dicom_data)
+        with open(os.path.join(self.outputdir,"job_123.cfg"),"wb") as f:
+            f.write(self.cfg_data)
+        logging.getLogger('werkzeug').setLevel(logging.ERROR)
+        self.receiver = dict(nauth=0,npost=0,fail=0,reject=0,badauth=0,delay=0.,received=dict())
+        rcv = self.receiver
+        app = Flask("stand_in_receiver")
+        @app.route("/auth",methods=['GET'])
+        def authentication():
+            rcv['nauth'] += 1
+            if rcv['badauth'] > 0:
+                rcv['badauth'] -= 1
+                return "<html>proxy error</html>", 200
+            return jsonify({'authToken':"token{}".format(rcv['nauth'])}), 201
+        @app.route("/api/results/<jobId>",methods=['POST'])
+        def receive(jobId):
+            rcv['npost'] += 1
+            if rcv['delay'] > 0:
+                # slow link: read the request in small pieces
+                raw = b""
+                while True:
+                    chunk = request.stream.read(16384)
+                    if not chunk:
+                        break
+                    raw += chunk
+                    time.sleep(rcv['delay'])
+                rcv['received'][jobId] = raw
+                return "ok"
+            if rcv['reject'] > 0:
+                rcv['reject'] -= 1
+                return "invalid token", 401
+            if rcv['fail'] > 0:
+                rcv['fail'] -= 1
+                return "temporarily unavailable", 503
+            if request.headers.get('Authorization') != "Bearer token{}".format(rcv['nauth']):
+                return "invalid token", 401
+            rcv['received'][jobId] = {k:(f.filename,f.read()) for k,f in request.files.items()}
+            return "ok"
+        self.server = make_server("127.0.0.1",0,app,threaded=True)
+        self.thread = threading.Thread(target=self.server.serve_forever,daemon=True)
+        self.thread.start()
+        base = "http://127.0.0.1:{}".format(self.server.server_port)
+        self.api_cfg = configparser.ConfigParser()
+        self.api_cfg['receiver'] = {'url to send result': base + "/api/results/",
+                                    'url authentication': base + "/auth",
+                                    'transfer retries': '3',
+                                    'transfer backoff [s]': '0.01'}
+        self.login = {'account-login':'YWRtaW4=','account-pwd':'secret'}
+        self.manager = result_transfer_manager(self.api_cfg,chunk_size=65536)
+    def tearDown(self):
+        self.manager.shutdown()
+        self.server.shutdown()
+        self.tmpdir.cleanup()
+    def check_received(self):
+        files = self.receiver['received']['job_123']
+        self.assertEqual(files['monteCarloDoseDicom'],("idc-PLAN-PhysicalDose.dcm",self.dicom_data))
+        self.assertEqual(files['logFile'],("job_123.cfg",self.cfg_data))
+    def test_transfer(self):
+        state = self.manager.wait(self.manager.submit("job_123",self.outputdir,self.login).jobId,timeout=30)
+        self.assertEqual(state.status,DONE)
+        self.assertEqual(state.attempts,1)
+        self.assertEqual(state.bytes_sent,len(self.dicom_data)+len(self.cfg_data))
+        self.check_received()
+        # second transfer reuses the token
+        self.receiver['received'].clear()
+        self.manager.wait(self.manager.submit("job_123",self.outputdir,self.login).jobId,timeout=30)
+        self.check_received()
+        self.assertEqual(self.receiver['nauth'],1)
+    def test_transient_errors(self):
+        self.receiver['fail'] = 2
+        state = self.manager.wait(self.manager.submit("job_123",self.outputdir,self.login).jobId,timeout=30)
+        self.assertEqual(state.status,DONE)
+        self.assertEqual(state.attempts,3)
+        self.assertEqual(self.receiver['nauth'],1)
+        self.check_received()
+    def test_expired_token(self):
+        self.receiver['reject'] = 1
+        state = self.manager.wait(self.manager.submit("job_123",self.outputdir,self.login).jobId,timeout=30)
+        self.assertEqual(state.status,DONE)
+        self.assertEqual(self.receiver['nauth'],2)
+        self.check_received()
+    def test_give_up(self):
+        self.receiver['fail'] = 100
+        state = self.manager.wait(self.manager.submit("job_123",self.outputdir,self.login).jobId,timeout=30)
+        self.assertEqual(state.status,FAILED)
+        self.assertEqual(state.attempts,4)
+        self.assertEqual(state.http_status,503)
+    def test_slow_link(self):
+        self.receiver['delay'] = 0.02
+        t0 = time.time()
+        state = self.manager.submit("job_123",self.outputdir,self.login)
+        # submit returns immediately, the upload takes at least 18*0.02 seconds
+        self.assertLess(time.time()-t0,0.1)
+        self.assertTrue(state.active)
+        # a second submit during the transfer does not start a new one
+        self.assertIs(self.manager.submit("job_123",self.outputdir,self.login),state)
+        self.manager.wait("job_123",timeout=30)
+        self.assertEqual(state.status,DONE)
+        self.assertEqual(self.receiver['npost'],1)
+        raw = self.receiver['received']['job_123']
+        self.assertEqual(len(raw),state.bytes_total)
+        self.assertIn(self.dicom_data,raw)
+        self.assertIn(self.cfg_data,raw)
+    def test_malformed_auth_reply(self):
+        self.receiver['badauth'] = 1
+        state = self.manager.wait(self.manager.submit("job_123",self.outputdir,self.login).jobId,timeout=30)
+        self.assertEqual(state.status,FAILED)
+        self.assertEqual(state.attempts,1)
+        self.assertEqual(self.receiver['npost'],0)
+        self.assertIn("JSONDecodeError",state.error)
+        # the transfer is not stuck: it can be submitted again
+        state = self.manager.wait(self.manager.submit("job_123",self.outputdir,self.login).jobId,timeout=30)
+        self.assertEqual(state.status,DONE)
+        self.check_received()
+    def test_missing_cfg(self):
+        os.remove(os.path.join(self.outputdir,"job_123.cfg"))
+        state = self.manager.wait(self.manager.submit("job_123",self.outputdir,self.login).jobId,timeout=30)
+        self.assertEqual(state.status,FAILED)
+        self.assertEqual(self.receiver['npost'],0)
+
+# vim: set et softtabstop=4 sw=4 smartindent:
@@ -13,16 +13,15 @@ other clinics as well).
 Authors: David Boersma and Pierre Granger
 """
 
-from utils.bounding_box import bounding_box
+from utils.bounding_box import bounding_box, boxes_from_points
 import logging
 logger=logging.getLogger(__name__)
 
 #import SimpleITK as sitk
 import itk
 import numpy as np
-logging.disable(logging.INFO) # avoid matplotlib noise
-import matplotlib.path # for useful Path class, not for plotting...
-logging.disable(logging.NOTSET)
+import sys
+import os
 #The shapely module is needed for intersecting ROIs with each other.
 #from shapely.geometry import Polygon
 
@@ -34,6 +33,8 @@ def list_roinames(ds):
     """
     Return the names of the ROIs in a given dicom structure set as a list of strings.
     """
+    if isinstance(ds,structure_set_contours):
+        return list(ds.roinames)
     assert(hasattr(ds,"StructureSetROISequence"))
     assert(hasattr(ds,"ROIContourSequence"))
     #these sequences are actually not always equally long
@@ -45,6 +46,8 @@ def list_roinumbers(ds):
     """
     Return the names of the ROIs in a given dicom structure set as a list of strings.
     """
+    if isinstance(ds,structure_set_contours):
+        return [int(nr) for nr in ds.roinumbers]
     assert(hasattr(ds,"StructureSetROISequence"))
     assert(hasattr(ds,"ROIContourSequence"))
     #these sequences are actually not always equally long
@@ -52,6 +55,17 @@ def list_roinumbers(ds):
     #assert(len(ds.ROIContourSequence)==len(ds.StructureSetROISequence))
     return [int(ssroi.ROINumber) for ssroi in ds.StructureSetROISequence]
 
+def _mpl_path(vertices):
+    """
+    We use the Path class from matplotlib (not for plotting...). Importing
+    matplotlib is slow, so we do that only when we actually need it.
+    """
+    if "matplotlib.path" not in sys.modules:
+        logging.disable(logging.INFO) # avoid matplotlib noise
+        import matplotlib.path
+        logging.disable(logging.NOTSET)
+    return sys.modules["matplotlib.path"].Path(vertices)
+
 def scrutinize_contour(points):
     """
     Test that `points` is a (n,3) array suitable for contour definition.
@@ -103,32 +117,12 @@ def sum_of_angles(points,name="unspecified",rounded=True,scrutinize=False):
             return sum_of_angles(points[nonzerodp0],name=name,rounded=rounded,scrutinize=True)
     # if the previous works as intended, then the following assert should always pass
     assert(nonzerodp0.all())
-    # now do ordinary vector calculus: cross product, dot product and norms
+    # now do ordinary vector calculus: cross product and dot product
     kross = dp0[:,0]*dp1[:,1] - dp0[:,1]*dp1[:,0]
     dots  = dp0[:,0]*dp1[:,0] + dp0[:,1]*dp1[:,1]
-    norms = np.sqrt(np.sum(dp0**2,axis=1)*np.sum(dp1**2,axis=1))
-    # this assert is maybe paranoid and superfluous
-    assert((norms>0).all())
-    sinphi = kross/norms
-    # guard against anomalies due to rounding errors
-    sinphi[sinphi>1]=1
-    sinphi[sinphi<-1]=-1
-    # which Quadrant are we in?
-    # Q1: less or equal pi/2 to the left
-    # Q2: more than pi/2 to the left
-    # Q3: more than pi/2 to the right
-    # Q4: less or equal pi/2 to the right
-    maskQ23=(dots<0)
-    maskQ2=maskQ23*(sinphi>0)
-    maskQ3=maskQ23*(sinphi<0)
-    maskBAD=maskQ23*(sinphi==0)
-    phi=np.arcsin(sinphi)
-    # arcsin returns phi in range -pi .. +pi
-    # Q2 (phi>0): phi -> +pi - phi
-    # Q3 (phi<0): phi -> -pi - phi
-    phi[maskQ23]*=-1
-    phi[maskQ2]+=np.pi
-    phi[maskQ3]-=np.pi
+    # the angle between successive segments, positive to the left, in range -pi .. +pi
+    phi=np.arctan2(kross,dots)
+    maskBAD=(dots<0)*(kross==0)
     if maskBAD.any():
         logger.warn("{} contains {} points where the contour retreats 180 degrees on itself".format(name,np.sum(maskBAD)))
         logger.warn("this is fixable (remove one or two points) but I did not implement that fix yet.")
@@ -147,22 +141,26 @@ def sum_of_angles(points,name="unspecified",rounded=True,scrutinize=False):
     else:
         return sum_phi_deg
 
-# "Borrowed" from http://stackoverflow.com/questions/22678990/how-can-i-calculate-the-area-within-a-contour-in-python-using-the-matplotlib
-# Use Green's theorem to compute the area
-# enclosed by the given contour.
+# Use Green's theorem (the "shoelace formula") to compute the area
+# enclosed by the given contour: positive for counterclockwise contours,
+# negative for clockwise contours. The contour is implicitly closed, the
+# last point does not need to be equal to the first point.
 def enclosed_area(vs):
-    logger.debug("vs has shape {}".format(vs.shape))
-    a = 0
-    x0,y0 = vs[0]
-    logger.debug("x0={} y0={}".format(x0,y0))
-    for [x1,y1] in vs[1:]:
-        dx = x1-x0
-        dy = y1-y0
-        a += 0.5*(y0*dx - x0*dy)
-        logger.debug("x0={} y0={} x1={} y1={} a={}".format(x0,y0,x1,y1,a))
-        x0 = x1
-        y0 = y1
-    return -a
+    # shift to the first point to avoid losing precision with large coordinates
+    x = vs[:,0] - vs[0,0]
+    y = vs[:,1] - vs[0,1]
+    # sum of x[i]*y[i+1]-x[i+1]*y[i], with i+1 wrapping around (like np.roll, but cheaper for short arrays)
+    return 0.5*(np.dot(x[:-1],y[1:]) - np.dot(x[1:],y[:-1]) + x[-1]*y[0] - x[0]*y[-1])
+
+def _xy_extent(vs):
+    """
+    (xmin,ymin,xmax,ymax) of the contour with vertices `vs`.
+    """
+    return np.concatenate([np.min(vs[:,:2],axis=0),np.max(vs[:,:2],axis=0)])
+
+def _in_extent(xycoords,extent):
+    return ((xycoords[:,0]>=extent[0]) & (xycoords[:,1]>=extent[1]) &
+            (xycoords[:,0]<=extent[2]) & (xycoords[:,1]<=extent[3]))
 
 def test_enclosed_area():
     vs = np.zeros((4,2),dtype=float)
@@ -183,6 +181,9 @@ class contour_layer(object):
     used to for inclusion, the ones with negative orientation (sum of angles is
     -360 degrees) will be used for exclusion. All points of an exclusion
     contour should be included by an inclusion contour.
+    The area and the xy extent of each contour are computed once, when the
+    contour is added; the extents are used to test only the points that can be
+    inside a contour.
     """
     def __init__(self,points=None,ref=None,name="notset", z=None, ignore_orientation=True ):
         self.name = name
@@ -190,6 +191,10 @@ class contour_layer(object):
         self.ref = ref
         self.inclusion = []
         self.exclusion = []
+        self.inclusion_areas = []
+        self.exclusion_areas = []
+        self.inclusion_extents = []
+        self.exclusion_extents = []
         if points is None:
             self.z = z
         else:
@@ -205,11 +210,15 @@ class contour_layer(object):
         elif not ref is None:
             assert(ref==self.ref)
         orientation = 360. if self.inc_always else sum_of_angles(points,name=self.name)
-        path = matplotlib.path.Path(points[:,:2])
+        path = _mpl_path(points[:,:2])
         if np.around(orientation) == 360:
             self.inclusion.append(path)
+            self.inclusion_areas.append(enclosed_area(path.vertices))
+            self.inclusion_extents.append(_xy_extent(path.vertices))
         elif np.around(orientation) == -360:
             self.exclusion.append(path)
+            self.exclusion_areas.append(enclosed_area(path.vertices))
+            self.exclusion_extents.append(_xy_extent(path.vertices))
         else:
             logger.error("({}) got a very weird contour a sum of angles equal to {}; z={} ref={}".format(self.name,orientation,len(points),self.z))
         n_inc_points = sum([len(pts) for pts in self.inclusion])
@@ -232,11 +241,13 @@ class contour_layer(object):
     def contains_points(self,xycoords):
         Ncoords = len(xycoords)
         assert(xycoords.shape == (Ncoords,2))
-        flatmask = np.zeros(len(xycoords),dtype=bool)          
-        for q in self.inclusion:
-            flatmask |= q.contains_points(xycoords)
-        for p in self.exclusion:
-            flatmask &= np.logical_not(p.contains_points(xycoords))
+        flatmask = np.zeros(len(xycoords),dtype=bool)
+        for q,extent in zip(self.inclusion,self.inclusion_extents):
+            candidates = _in_extent(xycoords,extent)
+            flatmask[candidates] |= q.contains_points(xycoords[candidates])
+        for p,extent in zip(self.exclusion,self.exclusion_extents):
+            candidates = _in_extent(xycoords,extent) & flatmask
+            flatmask[candidates] &= np.logical_not(p.contains_points(xycoords[candidates]))
         return flatmask
 
     def correct_mask(self,xymesh,mask, spacing):
@@ -315,13 +326,11 @@ class contour_layer(object):
         logger.debug("({}) layer {} check OK".format(self.name,self.z))
     def get_area(self):
         a = 0.
-        for q in self.inclusion:
-            qa = enclosed_area(q.vertices)
+        for qa in self.inclusion_areas:
             assert(qa>=0)
             logger.debug("{} z={}: adding {} mm2 from inclusion".format(self.name,self.z,qa))
             a += qa
-        for p in self.exclusion:
-            pa = enclosed_area(p.vertices)
+        for pa in self.exclusion_areas:
             logger.debug("{} z={}: subtracting {} mm2 from exclusion".format(self.name,self.z,-pa))
             assert(pa<=0)
             a += pa
@@ -343,15 +352,160 @@ def check_roi(ds,roi_id):
     logger.error("ROI with id {} not found; structure set contains: ".format(roi_id) + ", ".join(list_roinames(ds)))
     raise ValueError("ROI with id {} not found".format(roi_id))
 
+def _contour_data(contour):
+    """
+    The ContourData of a contour item as a flat float array. If pydicom did
+    not convert the value yet, we parse the raw DS string ourselves: that is
+    much faster than letting pydicom create a DSfloat for every coordinate.
+    """
+    elem = contour.get_item(0x30060050)
+    if isinstance(elem.value,bytes):
+        return np.array(elem.value.split(b"\\"),dtype=float)
+    return np.array(contour.ContourData,dtype=float)
+
+class structure_set_contours(object):
+    """
+    All contours of a structure set, parsed once into numpy arrays: for each ROI
+    the points of all its contours (an (N,3) array), the offsets of the
+    contours in that array and the SOP instance UIDs of the referenced images.
+    Use `get_structure_set_contours` to get the instance for a structure set
+    dataset: the contours are cached per SOPInstanceUID, for the lifetime of
+    the process. With `save` and `load` the parsed contours can be stored as
+    a compact `.npz` file, e.g. in the job directory, so that later steps of
+    the job do not need to parse the DICOM contours again.
+    """
+    def __init__(self,ds=None):
+        self.uid = None
+        self.roinames = []
+        self.roinumbers = []
+        self.points = []
+        self.offsets = []
+        self.refs = []
+        if ds is not None:
+            self._parse(ds)
+    @staticmethod
+    def _roi_contours(ds):
+        """
+        For each ROI in the StructureSetROISequence the number, the name and
+        the ROIContourSequence item (None if the ROI has no contours).
+        """
+        # Beware: the three sequences for structureset (name,nr), observation (type), contoursets (actual contours) are NOT necessarily synchronous.
+        contours = dict([(str(roi.ReferencedROINumber),roi) for roi in ds.ROIContourSequence])
+        return [(str(ssroi.ROINumber),str(ssroi.ROIName),contours.get(str(ssroi.ROINumber),None)) for ssroi in ds.StructureSetROISequence]
+    def matches(self,ds):
+        """
+        Cheap consistency check (ROI numbers, names and numbers of contours)
+        with a structure set dataset with the same SOPInstanceUID.
+        """
+        return (self.uid == str(ds.SOPInstanceUID) and
+                [(nr,name,len(refs)) for nr,name,refs in zip(self.roinumbers,self.roinames,self.refs)] ==
+                [(nr,name,len(getattr(roi,"ContourSequence",[]))) for nr,name,roi in self._roi_contours(ds)])
+    def _parse(self,ds):
+        self.uid = str(ds.SOPInstanceUID)
+        for roinumber,roiname,roi in self._roi_contours(ds):
+            self.roinames.append(roiname)
+            self.roinumbers.append(roinumber)
+            points = []
+            refs = []
+            for contour in getattr(roi,"ContourSequence",[]):
+                npoints = int(contour.NumberOfContourPoints)
+                data = _contour_data(contour)
+                # check assumption on number of contour coordinates
+                assert(len(data)==3*npoints)
+                points.append(data.reshape(npoints,3))
+                refs.append(str(contour.ContourImageSequence[0].ReferencedSOPInstanceUID) if "ContourImageSequence" in contour else "")
+            self.points.append(np.concatenate(points) if points else np.empty((0,3)))
+            self.offsets.append(np.cumsum([0]+[len(p) for p in points]))
+            self.refs.append(refs)
+        logger.debug("parsed {} contours in {} ROIs of structure set {}".format(sum([len(r) for r in self.refs]),len(self.roinames),self.uid))
+    def find_roi(self,roi_id):
+        """
+        Index, number and name of the ROI with name or number `roi_id`.
+        """
+        for i,(roinumber,roiname) in enumerate(zip(self.roinumbers,self.roinames)):
+            if str(roi_id) in (roinumber,roiname):
+                return i,roinumber,roiname
+        logger.error("ROI with id {} not found; structure set contains: ".format(roi_id) + ", ".join(self.roinames))
+        raise ValueError("ROI with id {} not found".format(roi_id))
+    def contours(self,index):
+        """
+        Iterate over the (points,ref) of the contours of ROI number `index`.
+        """
+        points,offsets = self.points[index],self.offsets[index]
+        for j,ref in enumerate(self.refs[index]):
+            yield points[offsets[j]:offsets[j+1]],ref
+    def bounding_boxes(self,indices=None):
+        """
+        The bounding boxes of the ROIs with the given indices (default: all
+        ROIs), directly from the contour points, as an (N,3,2) array of
+        limits (see `utils.bounding_box`). ROIs without contours get empty
+        limits. Same result as the `bb` of a `region_of_interest`, without
+        building the contour layers.
+        """
+        if indices is None:
+            indices = range(len(self.points))
+        points = [self.points[i] for i in indices]
+        offsets = np.cumsum([0]+[len(p) for p in points])
+        return boxes_from_points(np.concatenate(points) if points else np.empty((0,3)),offsets)
+    def save(self,path):
+        arrays = dict(uid=np.array(self.uid),roinames=np.array(self.roinames,dtype=str),roinumbers=np.array(self.roinumbers,dtype=str))
+        for i,(points,offsets,refs) in enumerate(zip(self.points,self.offsets,self.refs)):
+            arrays["points{}".format(i)] = points
+            arrays["offsets{}".format(i)] = offsets
+            arrays["refs{}".format(i)] = np.array(refs,dtype=str)
+        np.savez_compressed(path,**arrays)
+        logger.debug("saved contours of structure set {} to {}".format(self.uid,path))
+    @classmethod
+    def load(cls,path):
+        """
+        Reads contours saved with `save`, and adds them to the cache.
+        """
+        ssc = cls()
+        with np.load(path,allow_pickle=False) as npz:
+            ssc.uid = str(npz["uid"])
+            ssc.roinames = [str(name) for name in npz["roinames"]]
+            ssc.roinumbers = [str(nr) for nr in npz["roinumbers"]]
+            for i in range(len(ssc.roinames)):
+                ssc.points.append(npz["points{}".format(i)])
+                ssc.offsets.append(npz["offsets{}".format(i)])
+                ssc.refs.append([str(ref) for ref in npz["refs{}".format(i)]])
+        _structure_set_cache[ssc.uid] = ssc
+        logger.debug("loaded contours of structure set {} from {}".format(ssc.uid,path))
+        return ssc
+
+# process-wide cache of parsed structure sets, keyed by SOPInstanceUID
+_structure_set_cache = dict()
+
+def get_structure_set_contours(ds):
+    """
+    The parsed contours for the structure set `ds`, either a pydicom dataset
+    or a `structure_set_contours` object. Each structure set is parsed only
+    once per process.
+    """
+    if isinstance(ds,structure_set_contours):
+        return ds
+    uid = str(ds.SOPInstanceUID)
+    if uid in _structure_set_cache and not _structure_set_cache[uid].matches(ds):
+        logger.warning("structure set {} differs from the cached structure set with the same SOPInstanceUID, parsing it again".format(uid))
+        del _structure_set_cache[uid]
+    if uid not in _structure_set_cache:
+        _structure_set_cache[uid] = structure_set_contours(ds)
+    return _structure_set_cache[uid]
+
+def clear_structure_set_cache():
+    _structure_set_cache.clear()
+
 class region_of_interest(object):
     def __init__(self,ds=None,roi_id=None,verbose=False, contours_list = None):
         if contours_list is not None:
             self.from_contours(contours_list)
             return
         #assert(len(ds.ROIContourSequence)==len(ds.StructureSetROISequence))
-        roi,self.roinr,self.roiname = check_roi(ds,roi_id)
-        self.ncontours = len(roi.ContourSequence)
-        self.npoints_total = sum([len(c.ContourData) for c in roi.ContourSequence])
+        # the contours are parsed only once per structure set (`ds` may also be a `structure_set_contours`)
+        contours = get_structure_set_contours(ds)
+        index,self.roinr,self.roiname = contours.find_roi(roi_id)
+        self.ncontours = len(contours.refs[index])
+        self.npoints_total = 3*len(contours.points[index])
         self.bb = bounding_box()
         # we are sort the contours by depth-coordinate
         self.contour_layers=[]
@@ -361,23 +515,20 @@ class region_of_interest(object):
         self.maskparameters = []
         self.masklist = []
         #self.contour_refs=[]
-        for contour in roi.ContourSequence:
-            ref = contour.ContourImageSequence[0].ReferencedSOPInstanceUID
-            npoints = int(contour.NumberOfContourPoints)
-            # check assumption on number of contour coordinates
-            assert(len(contour.ContourData)==3*npoints)
-            points = np.array([float(coord) for coord in contour.ContourData]).reshape(npoints,3)
-            zvalues = set(points[:,2])
+        corners = []
+        for points,ref in contours.contours(index):
             # check assumption that all points are in the same xy plane (constant z)
-            assert(len(zvalues)==1)
-            zvalue = round(zvalues.pop(), self.z_precision)
+            assert(np.all(points[:,2]==points[0,2]))
+            zvalue = round(points[0,2], self.z_precision)
             if zvalue in self.zlist:
                 ic = self.zlist.index(zvalue)
                 self.contour_layers[ic].add_contour(points,ref)
             else:
                 self.contour_layers.append(contour_layer(points,ref))
                 self.zlist.append(zvalue)
-            self.bb.should_contain_all(points)
+            corners += [np.min(points,axis=0),np.max(points,axis=0)]
+        if corners:
+            self.bb.should_contain_all(corners)
         if verbose:
             logger.info("roi {}={} has {} points on {} contours with z range [{},{}]".format(
                     self.roinr,self.roiname,self.npoints_total,self.ncontours,self.bb.zmin,self.bb.zmax))
@@ -394,15 +545,23 @@ class region_of_interest(object):
                 logger.warn("{} not one single z step: {}".format(self.roiname,", ".join([str(d) for d in dz])))
                 self.dz = 0.
 
-    def get_mask_from_parameters(self, img_params):           
-        if(img_params in self.maskparameters):
-            return self.masklist[self.maskparameters.index(img_params)]
-        else:
-            return None
+    def get_mask_from_parameters(self, img_params):
+        """
+        Returns the mask that was computed earlier for the image geometry and
+        options in `img_params` (origin, spacing, size, zrange, corrected),
+        or None.
+        """
+        for params,mask in zip(self.maskparameters,self.masklist):
+            if len(params)==len(img_params) and all([(a is None and b is None) or
+                                                     (a is not None and b is not None and np.allclose(a,b))
+                                                     for a,b in zip(params,img_params)]):
+                return mask
+        return None
 
     def from_contours(self, contours_list):
         self.roiname = "Arficial roi created from scratch"
         self.roinr = 1337
+        self.z_precision = 3
         self.ncontours = len(contours_list)
         self.npoints_total = 0
         self.bb = bounding_box()
@@ -497,7 +656,7 @@ class region_of_interest(object):
             logger.warn("WARNING: no overlap in z ranges")
             logger.warn("WARNING: img z range [{}-{}], roi z range [{}-{}]".format(zmin,zmax,self.bb.zmin,self.bb.zmax))
             return roimask
-        img_params = [orig, space, dims, zrange]
+        img_params = [orig, space, dims, zrange, corrected]
         if zrange is None:
             zrange=(zmin,zmax)
         else:
@@ -529,38 +688,25 @@ class region_of_interest(object):
                 logger.debug("got {} points inside".format(np.sum(flatmask)))
                 if corrected:
                     flatmask = flatmask.astype(float)
-                    flatmask = self.contour_layers[icz].correct_mask(xymesh, flatmask, space)
-                    for iflat,b in enumerate(flatmask):
-                        if not b:
-                            continue
-                        ix = iflat % dims[0]
-                        iy = iflat // dims[0]
-                        #x = orig[0]+space[0]*ix # x coordinate in image/mask
-                        #y = orig[1]+space[1]*iy # y coordinate in image/mask
-                        #assert(self.contour_layers[icz].contains_point(point=(x,y)))
-                        try:
-                            roimask[ix,iy,iz]=b
-                        except IndexError as inderr:
-                            logger.error("iflat={} ix={} iy={} iz={}, error={}".format(iflat,ix,iy,iz,inderr))
-                            raise
+                    flatmask = np.array(self.contour_layers[icz].correct_mask(xymesh, flatmask, space))
                 else:
                     flatmask = flatmask.astype(int)
-                    aroimask[iz,:,:] = flatmask.reshape(dims[1],dims[0])[:,:]
+                # the array has (z,y,x) index order, flatmask has x running fastest
+                aroimask[iz,:,:] = flatmask.reshape(dims[1],dims[0])[:,:]
             elif icz<0:
                 logger.debug("BELOWroi: z index mask/image iz={} (z={}) layer index icz={} (z0={} dz={})".format(iz,z,icz,z0,self.dz))
             else:
                 logger.debug("ABOVE roi: z index mask/image iz={} (z={}) layer index icz={} (z0={} dz={} nlayer={})".format(iz,z,icz,z0,self.dz,len(self.contour_layers)))
         logger.debug("got mask with {} enabled voxels out of {}".format(np.sum(aroimask>0),np.prod(aroimask.shape)))
-        if not corrected:
-            roimask = itk.GetImageFromArray(aroimask)
-            roimask.CopyInformation(img)
-            #achk = sitk.GetArrayFromImage(roimask)
-            #ndiff = np.sum(achk!=aroimask)
-            #nsame = np.sum(achk==aroimask)
-            #nboth = np.sum((achk>0)*(aroimask>0))
-            #nachk = np.sum(achk>0)
-            #naroi = np.sum(aroimask>0)
-            #logger.debug("N(chk)={} N(aroi)={} ndiff={} nsame={} nboth={}".format(nachk,naroi,ndiff,nsame,nboth))
+        roimask = itk.GetImageFromArray(aroimask)
+        roimask.CopyInformation(img)
+        #achk = sitk.GetArrayFromImage(roimask)
+        #ndiff = np.sum(achk!=aroimask)
+        #nsame = np.sum(achk==aroimask)
+        #nboth = np.sum((achk>0)*(aroimask>0))
+        #nachk = np.sum(achk>0)
+        #naroi = np.sum(aroimask>0)
+        #logger.debug("N(chk)={} N(aroi)={} ndiff={} nsame={} nboth={}".format(nachk,naroi,ndiff,nsame,nboth))
         self.maskparameters.append(img_params)
         self.masklist.append(roimask)
         logger.debug("returning mask")
@@ -574,7 +720,7 @@ class region_of_interest(object):
         logger.debug("got size = {}".format(dims.tolist()))
         aimg = itk.GetArrayFromImage(img)
         logger.debug("got array with shape {}".format(list(aimg.shape)))
-        img_params = [img.GetOrigin(), img.GetSpacing(), np.array(img.GetLargestPossibleRegion().GetSize()), zrange]
+        img_params = [img.GetOrigin(), img.GetSpacing(), np.array(img.GetLargestPossibleRegion().GetSize()), zrange, True]
         itkmask = self.get_mask_from_parameters(img_params)
         if(itkmask):
             logger.debug("Using already computed mask for these dimensions")
@@ -597,13 +743,13 @@ class region_of_interest(object):
         if nb_negative:
             logger.warning("There are {} negative voxels in the mask !! OK because below {}".format(nb_negative, nb_negative_tol))
     
-        dhist,dedges = np.histogram(a,bins=nbins,range=(dmin,dmax), weights=amask[np.nonzero(amask)])
+        dhist,dedges = np.histogram(a,bins=nbins,range=(dmin,dmax), weights=amask[np.nonzero(amask)].astype(float))
         logger.debug("got histogram with {} edges for {} bins".format(len(dedges),nbins))
         adhist=np.array(dhist,dtype=float)
         adedges=np.array(dedges,dtype=float)
         dsum=0.5*np.sum(adhist*adedges[:-1]+adhist*adedges[1:])
         dhistsum=np.sum(adhist)
-        amasksum=np.sum(amask)
+        amasksum=np.sum(amask,dtype=float)
         adchist=np.cumsum(adhist)
         logger.debug("dhistsum={} amasksum={} adchist[-1]={}".format(dhistsum,amasksum,adchist[-1]))
         assert(round(amasksum, 7)==round(dhistsum,7))
@@ -666,14 +812,143 @@ class region_of_interest(object):
     #    roi_intsc = region_of_interest(contours_list=contour_layers_intsc)
     #    return roi_intsc
 
+def _dose_bins(d,dmin,dmax,nbins):
+    """
+    Histogram bin index of each dose value in `d`, with the same bins as
+    `np.histogram` (the last bin includes dmax), and a boolean array that
+    is False for doses outside [dmin,dmax] (these are not counted).
+    Small negative doses are set to zero, as in `region_of_interest.get_dvh`.
+    """
+    nb_negative = np.sum(d<0)
+    if nb_negative > nb_negative_tol or np.any(d<-negative_tol):
+        raise RuntimeError("{} voxels with negative dose (min {}) inside the masks".format(nb_negative,np.min(d)))
+    if nb_negative:
+        logger.warning("There are {} negative voxels in the masks !! OK because below {}".format(nb_negative, nb_negative_tol))
+        d[d<0] = 0.
+    inrange = (d>=dmin)&(d<=dmax)
+    dbin = np.minimum(((d-dmin)*(nbins/(dmax-dmin))).astype(np.intp),nbins-1)
+    dbin[~inrange] = 0
+    return dbin,inrange
+
+def get_dvhs_from_masks(adose,masks,percentiles=(2,50,98),doses=(),nbins=100,dmin=None,dmax=None):
+    """
+    Cumulative DVHs and D/V metrics for many masks on the same dose array. The
+    masks are numpy arrays with the same shape as the dose array `adose`:
+    binary (any nonzero value counts as inside) or partial volume weights in
+    [0,1] (float masks, e.g. 'corrected' ROI masks).
+
+    The binary masks are combined into a bitset volume, with one bit per mask
+    (64 masks per bitset). The distinct bitset values inside the masks are
+    found in one sorted pass (`np.unique`), and a single `np.bincount` over
+    (bitset value, dose bin) then gives the histograms of all these masks at
+    once. Weighted masks get one weighted `np.bincount` each.
+
+    Returns a list with for each mask a dictionary with:
+    * 'edges': the nbins+1 dose bin edges
+    * 'dvh': fraction of the volume with dose >= edge, for each edge
+    * 'volume': the (weighted) number of voxels in the mask
+    * 'dsum': the (weighted) sum of the dose in the mask
+    * 'D': for each percentage p in `percentiles` the minimum dose received by
+      p percent of the volume (so D[98] is the "near minimum" dose)
+    * 'V': for each dose in `doses` the fraction of the volume receiving at
+      least that dose.
+    For empty masks 'dvh' is all zero and the D values are None.
+    """
+    if dmin is None:
+        dmin=np.min(adose)
+    if dmax is None:
+        dmax=np.max(adose)
+    if dmax <= dmin:
+        dmax = dmin + 1.
+    edges = np.linspace(dmin,dmax,nbins+1)
+    flatdose = adose.reshape(-1)
+    flatmasks = [np.asarray(m).reshape(-1) for m in masks]
+    for m in flatmasks:
+        if m.shape != flatdose.shape:
+            raise RuntimeError("mask with {} voxels does not match dose array with shape {}".format(m.size,adose.shape))
+    weighted = [np.issubdtype(m.dtype,np.floating) and bool(np.any((m>0)&(m<1))) for m in flatmasks]
+    hists = np.zeros((len(flatmasks),nbins))
+    dsums = np.zeros(len(flatmasks))
+    binary = [i for i,w in enumerate(weighted) if not w]
+    for first in range(0,len(binary),64):
+        group = binary[first:first+64]
+        bitset = np.zeros(flatdose.shape,dtype=np.uint64)
+        for bit,i in enumerate(group):
+            np.bitwise_or(bitset,np.uint64(1<<bit),out=bitset,where=(flatmasks[i]!=0))
+        index = np.flatnonzero(bitset)
+        bitset = bitset[index]
+        d = flatdose[index].astype(float)
+        del index
+        dbin,inrange = _dose_bins(d,dmin,dmax,nbins)
+        bitset[~inrange] = 0
+        combos,combo = np.unique(bitset,return_inverse=True)
+        del bitset
+        counts = np.bincount(combo*nbins+dbin,minlength=len(combos)*nbins).reshape(len(combos),nbins)
+        combodsums = np.bincount(combo,weights=d,minlength=len(combos))
+        # member[i,j] is 1 if bitset value j has the bit of mask i
+        member = ((combos[np.newaxis,:] >> np.arange(len(group),dtype=np.uint64)[:,np.newaxis]) & np.uint64(1)).astype(float)
+        hists[group] = member @ counts
+        dsums[group] = member @ combodsums
+    for i in np.flatnonzero(weighted):
+        index = np.flatnonzero(flatmasks[i])
+        w = flatmasks[i][index].astype(float)
+        d = flatdose[index].astype(float)
+        dbin,inrange = _dose_bins(d,dmin,dmax,nbins)
+        w[~inrange] = 0.
+        hists[i] = np.bincount(dbin,weights=w,minlength=nbins)
+        dsums[i] = np.sum(w*d)
+    results = list()
+    for hist,dsum in zip(hists,dsums):
+        volume = np.sum(hist)
+        if volume>0:
+            # fraction of the volume with a dose of at least the lower edge of each bin
+            dvh = np.append(np.cumsum(hist[::-1])[::-1],0.)/volume
+            # dvh is decreasing, np.interp needs increasing x values
+            dvals = {p:float(np.interp(0.01*p,dvh[::-1],edges[::-1])) for p in percentiles}
+            vvals = {dv:float(np.interp(dv,edges,dvh)) for dv in doses}
+        else:
+            dvh = np.zeros(nbins+1)
+            dvals = {p:None for p in percentiles}
+            vvals = {dv:0. for dv in doses}
+        results.append(dict(edges=edges,dvh=dvh,volume=volume,dsum=dsum,D=dvals,V=vvals))
+    return results
+
+def get_dvhs(roilist,img,percentiles=(2,50,98),doses=(),nbins=100,dmin=None,dmax=None,zrange=None,corrected=False):
+    """
+    Batch version of `region_of_interest.get_dvh`: DVHs and D/V metrics (see
+    `get_dvhs_from_masks`) of all ROIs in `roilist` for the dose image `img`.
+    Each ROI mask is computed (or taken from the mask cache of the ROI) only
+    once. With `corrected=True` the masks have partial volume weights.
+    Returns a dictionary with the ROI names as keys, ROIs for which no mask can
+    be computed are left out.
+    """
+    aimg = itk.array_view_from_image(img)
+    img_params = [img.GetOrigin(), img.GetSpacing(), np.array(img.GetLargestPossibleRegion().GetSize()), zrange, corrected]
+    names = list()
+    masks = list()
+    for roi in roilist:
+        itkmask = roi.get_mask_from_parameters(img_params)
+        if itkmask is None:
+            itkmask = roi.get_mask(img,zrange,corrected=corrected)
+        if itkmask is None:
+            logger.warning("no mask for ROI {}, skipping its DVH".format(roi.roiname))
+            continue
+        names.append(roi.roiname)
+        masks.append(itk.array_view_from_image(itkmask))
+    results = get_dvhs_from_masks(aimg,masks,percentiles,doses,nbins,dmin,dmax)
+    for name,result in zip(names,results):
+        logger.debug("{}: {}".format(name," ".join(["D{:02g}={}".format(p,dp) for p,dp in result["D"].items()])))
+    return dict(zip(names,results))
+
 def get_intersection_volume(roilist,xvoxel=1.,yvoxel=1.):
     # There is probably a clever way to compute this by constructing
     # an "intersection contour" for each layer: for each contour, keep only
     # points that are inside all other contours in the list. But is tough to then
     # put those points in the right order.
-    # Instead we'll just make a grid of points and get the volume of the combined mask.
-    # With xvoxel and yvoxel the caller can tweak the voxel size of the mask in x and y.
-    # In z the voxel size is given by the incoming ROIs.
+    # Instead we'll just make a grid of points in each layer and count the points
+    # that are inside all ROIs. With xvoxel and yvoxel the caller can tweak the
+    # grid spacing in x and y. In z the layers of the ROI with the smallest z step
+    # are used, each layer represents a slab with that thickness.
     dz = min([r.dz for r in roilist])
     assert(dz>0)
     assert(xvoxel>0)
@@ -684,17 +959,27 @@ def get_intersection_volume(roilist,xvoxel=1.,yvoxel=1.):
     if bb.empty:
         # too bad
         return 0.
-    spacing = np.array([xvoxel,yvoxel,dz],dtype=float)
-    bb.add_margins(2*spacing)
-    dimsize = np.array(np.round((bb.maxcorner-bb.mincorner)/spacing),dtype=int)
-    #img = sitk.Image(dimsize,sitk.sitkUInt8)
-    img = itk.GetImageFromArray(np.zeros(dimsize[::-2],dtype=np.uint8))
-    img.SetOrigin(bb.mincorner)
-    img.SetSpacing(spacing)
-    itkmask = itk.GetArrayFromImage(roilist[0].get_mask(img))
-    for roi in roilist[1:]:
-        itkmask *= itk.GetArrayFromImage(roi.get_mask(img))
-    return np.sum(itkmask)*np.prod(spacing)
+    # grid points at the centers of the grid cells, only in the common bounding box
+    xpoints = np.arange(bb.xmin+0.5*xvoxel,bb.xmax,xvoxel)
+    ypoints = np.arange(bb.ymin+0.5*yvoxel,bb.ymax,yvoxel)
+    xymesh = np.meshgrid(xpoints,ypoints)
+    xyflat = np.stack([xymesh[0].ravel(),xymesh[1].ravel()],axis=1)
+    thinnest = [r for r in roilist if r.dz==dz][0]
+    eps = 0.001*dz
+    npoints = 0
+    for z in thinnest.zlist:
+        if z<bb.zmin-eps or z>bb.zmax+eps:
+            continue
+        inside = np.ones(len(xyflat),dtype=bool)
+        for roi in roilist:
+            icz = int(np.round((z-roi.zlist[0])/roi.dz)) # layer index
+            if icz<0 or icz>=len(roi.contour_layers):
+                inside[:] = False
+                break
+            candidates = np.flatnonzero(inside)
+            inside[candidates] = roi.contour_layers[icz].contains_points(xyflat[candidates])
+        npoints += np.sum(inside)
+    return npoints*xvoxel*yvoxel*dz
 
 def intersect_segments(S1, S2, eps = 1e-10):
     perp = lambda u,v: (u[0]*v[1]-v[0]*u[1])
@@ -715,4 +1000,255 @@ def intersect_segments(S1, S2, eps = 1e-10):
         return np.array([])
     return(S1[0] + sI * u)
 
+###############################################################################################
+# BENCHMARK
+###############################################################################################
+
+def _spherical_masks(shape,nrois,seed=7):
+    """
+    `nrois` overlapping spherical binary masks with random centers and radii.
+    """
+    rng = np.random.default_rng(seed)
+    grid = np.ogrid[tuple(slice(0,n) for n in shape)]
+    masks = list()
+    for i in range(nrois):
+        center = rng.uniform(0.2,0.8,3)*shape
+        radius = rng.uniform(0.05,0.3)*min(shape)
+        r2 = sum([(g-c)**2 for g,c in zip(grid,center)])
+        masks.append((r2<radius**2).astype(np.uint8))
+    return masks
+
+def _dvhs_one_by_one(adose,masks,nbins=100):
+    """
+    The way `region_of_interest.get_dvh` works: one histogram per mask.
+    """
+    dmin,dmax = np.min(adose),np.max(adose)
+    results = list()
+    for amask in masks:
+        nz = np.nonzero(amask)
+        dhist,dedges = np.histogram(adose[nz],bins=nbins,range=(dmin,dmax),weights=amask[nz])
+        results.append(np.cumsum(dhist))
+    return results
+
+def benchmark(shape=(300,300,300),nrois=40,nbins=100):
+    """
+    Wall time of the DVHs of `nrois` masks on a dose grid with the given shape,
+    one mask at a time and all masks in one pass.
+    """
+    import time
+    rng = np.random.default_rng(42)
+    adose = rng.gamma(2.,1.,shape).astype(np.float32)
+    masks = _spherical_masks(shape,nrois)
+    t0 = time.perf_counter()
+    _dvhs_one_by_one(adose,masks,nbins)
+    t1 = time.perf_counter()
+    get_dvhs_from_masks(adose,masks,nbins=nbins)
+    t2 = time.perf_counter()
+    return t1-t0,t2-t1
+
+###############################################################################################
+# UNIT TESTING
+###############################################################################################
+
+import unittest
+
+class test_dvhs(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(1)
+        self.adose = rng.gamma(3.,1.,(30,40,50))
+        self.masks = _spherical_masks(self.adose.shape,5)
+        self.masks.append(np.zeros(self.adose.shape,dtype=np.uint8))
+        self.weights = np.clip(rng.random(self.adose.shape)*2-0.5,0,1).astype(np.float32)
+    def test_binary_masks(self):
+        results = get_dvhs_from_masks(self.adose,self.masks,percentiles=(2,50,98),doses=(1.,3.),nbins=2000)
+        dvhs = _dvhs_one_by_one(self.adose,self.masks,nbins=2000)
+        for amask,cdvh,result in zip(self.masks,dvhs,results):
+            a = self.adose[amask>0]
+            self.assertEqual(result["volume"],a.size)
+            if a.size==0:
+                self.assertIsNone(result["D"][50])
+                continue
+            self.assertTrue(np.allclose(result["dvh"][1:],1.-cdvh/a.size))
+            self.assertAlmostEqual(result["dsum"],np.sum(a))
+            # bin width is less than 0.01, and the small masks have large gaps between the sorted doses
+            for p in (2,50,98):
+                q = 1-0.01*p
+                self.assertGreaterEqual(result["D"][p],np.quantile(a,max(0.,q-1./a.size))-0.01)
+                self.assertLessEqual(result["D"][p],np.quantile(a,min(1.,q+1./a.size))+0.01)
+            for d in (1.,3.):
+                self.assertAlmostEqual(result["V"][d],np.mean(a>=d),delta=0.01)
+    def test_weighted_masks(self):
+        results = get_dvhs_from_masks(self.adose,[self.weights,self.weights>0],nbins=50)
+        nz = np.nonzero(self.weights)
+        dhist,dedges = np.histogram(self.adose[nz],bins=50,range=(np.min(self.adose),np.max(self.adose)),weights=self.weights[nz].astype(float))
+        self.assertTrue(np.allclose(results[0]["edges"],dedges))
+        self.assertAlmostEqual(results[0]["volume"],np.sum(self.weights,dtype=float))
+        self.assertTrue(np.allclose(results[0]["dvh"][1:],1.-np.cumsum(dhist)/np.sum(dhist)))
+        self.assertAlmostEqual(results[0]["dsum"],np.sum(self.weights*self.adose))
+        self.assertEqual(results[1]["volume"],len(nz[0]))
+    def test_negative_dose(self):
+        adose = self.adose.copy()
+        adose[self.masks[0]>0] -= 1.
+        with self.assertRaises(RuntimeError):
+            get_dvhs_from_masks(adose,self.masks)
+
+def _sum_of_angles_reference(points):
+    """
+    The previous implementation of the angle sum in `sum_of_angles`, with
+    arcsin and quadrant corrections, for comparison.
+    """
+    dp0 = np.diff(np.append(points[:,:2],points[:1,:2],axis=0),axis=0)
+    dp1 = np.roll(dp0,-1,axis=0)
+    kross = dp0[:,0]*dp1[:,1] - dp0[:,1]*dp1[:,0]
+    dots  = dp0[:,0]*dp1[:,0] + dp0[:,1]*dp1[:,1]
+    norms = np.sqrt(np.sum(dp0**2,axis=1)*np.sum(dp1**2,axis=1))
+    sinphi = np.clip(kross/norms,-1,1)
+    maskQ23=(dots<0)
+    phi=np.arcsin(sinphi)
+    phi[maskQ23]*=-1
+    phi[maskQ23*(sinphi>0)]+=np.pi
+    phi[maskQ23*(sinphi<0)]-=np.pi
+    return np.sum(phi)*180/np.pi
+
+def _enclosed_area_reference(vs):
+    """
+    The previous implementation of `enclosed_area`, one segment at a time. It
+    does not close the contour, so the first point should be appended to `vs`.
+    """
+    a = 0
+    x0,y0 = vs[0]
+    for [x1,y1] in vs[1:]:
+        a += 0.5*(y0*(x1-x0) - x0*(y1-y0))
+        x0,y0 = x1,y1
+    return -a
+
+def _random_polygon(rng,npoints,center=(0.,0.),rmax=50.,z=0.):
+    """
+    Random simple (star shaped) polygon, counterclockwise.
+    """
+    phi = np.sort(rng.uniform(0,2*np.pi,npoints))
+    r = rng.uniform(0.2*rmax,rmax,npoints)
+    return np.stack([center[0]+r*np.cos(phi),center[1]+r*np.sin(phi),np.full(npoints,z)],axis=1)
+
+class test_contour_geometry(unittest.TestCase):
+    def setUp(self):
+        self.rng = np.random.default_rng(17)
+        self.polygons = [_random_polygon(self.rng,n,self.rng.uniform(-300,300,2)) for n in self.rng.integers(3,300,50)]
+    def test_enclosed_area(self):
+        for points in self.polygons:
+            vs = points[:,:2]
+            ref = _enclosed_area_reference(np.append(vs,vs[:1],axis=0))
+            self.assertGreater(enclosed_area(vs),0)
+            self.assertAlmostEqual(enclosed_area(vs),ref,delta=1e-9*abs(ref))
+            self.assertAlmostEqual(enclosed_area(vs[::-1]),-ref,delta=1e-9*abs(ref))
+        square = np.array([[0.,0.],[1.,0.],[1.,1.],[0.,1.]])
+        self.assertAlmostEqual(enclosed_area(square),1.)
+    def test_sum_of_angles(self):
+        for points in self.polygons:
+            self.assertEqual(sum_of_angles(points),360)
+            self.assertEqual(sum_of_angles(points[::-1]),-360)
+            self.assertAlmostEqual(sum_of_angles(points,rounded=False),_sum_of_angles_reference(points))
+            self.assertAlmostEqual(sum_of_angles(points[::-1],rounded=False),_sum_of_angles_reference(points[::-1]))
+    def test_contains_points(self):
+        xy = self.rng.uniform(-400,400,(2000,2))
+        for points in self.polygons:
+            layer = contour_layer(points)
+            self.assertTrue(np.array_equal(layer.contains_points(xy),_mpl_path(points[:,:2]).contains_points(xy)))
+            self.assertAlmostEqual(layer.get_area(),enclosed_area(points[:,:2]))
+        # a contour with a hole
+        layer = contour_layer(_random_polygon(self.rng,100,rmax=100.),ignore_orientation=False)
+        hole = _random_polygon(self.rng,50,rmax=10.)[::-1]
+        layer.add_contour(hole)
+        expected = _mpl_path(layer.inclusion[0].vertices).contains_points(xy) & ~_mpl_path(hole[:,:2]).contains_points(xy)
+        self.assertTrue(np.array_equal(layer.contains_points(xy),expected))
+        self.assertAlmostEqual(layer.get_area(),enclosed_area(layer.inclusion[0].vertices)+enclosed_area(hole[:,:2]))
+    def test_intersection_volume(self):
+        dz = 2.
+        layers1 = [contour_layer(_ellipse_points(0.,0.,30.,20.,z),z=z) for z in np.arange(0.,40.,dz)]
+        layers2 = [contour_layer(_ellipse_points(15.,5.,20.,20.,z),z=z) for z in np.arange(10.,60.,dz)]
+        roi1 = region_of_interest(contours_list=layers1)
+        roi2 = region_of_interest(contours_list=layers2)
+        vol = get_intersection_volume([roi1,roi2],0.5,0.5)
+        # the previous implementation: multiply the masks on an image covering the common bounding box
+        bb = bounding_box(bb=roi1.bb)
+        bb.intersect(roi2.bb)
+        spacing = np.array([0.5,0.5,dz])
+        bb.add_margins(2*spacing)
+        dimsize = np.array(np.round((bb.maxcorner-bb.mincorner)/spacing),dtype=int)
+        img = itk.GetImageFromArray(np.zeros(dimsize[::-1],dtype=np.uint8))
+        img.SetOrigin(bb.mincorner)
+        img.SetSpacing(spacing)
+        amask = itk.GetArrayFromImage(roi1.get_mask(img,corrected=False))*itk.GetArrayFromImage(roi2.get_mask(img,corrected=False))
+        self.assertAlmostEqual(vol,np.sum(amask)*np.prod(spacing),delta=0.01*vol)
+        self.assertEqual(get_intersection_volume([roi1,region_of_interest(contours_list=[contour_layer(_ellipse_points(200.,0.,5.,5.,z),z=z) for z in (0.,2.)])]),0.)
+
+class test_structure_set_cache(unittest.TestCase):
+    def setUp(self):
+        import tempfile
+        from benchmarks import synthetic
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.ct = synthetic.ct_image((10,32,40),(2.,2.,3.))
+        self.rspath = os.path.join(self.tmpdir.name,"RS.dcm")
+        self.ds = synthetic.write_structure_set(self.rspath,self.ct,norgans=2)
+        clear_structure_set_cache()
+    def tearDown(self):
+        clear_structure_set_cache()
+        self.tmpdir.cleanup()
+    def assertSameROI(self,roi1,roi2):
+        self.assertEqual((roi1.roinr,roi1.roiname,roi1.ncontours,roi1.npoints_total),(roi2.roinr,roi2.roiname,roi2.ncontours,roi2.npoints_total))
+        self.assertEqual(roi1.zlist,roi2.zlist)
+        self.assertTrue(np.allclose(roi1.bb.limits,roi2.bb.limits))
+        self.assertAlmostEqual(roi1.get_volume(),roi2.get_volume())
+        mask1 = itk.array_from_image(roi1.get_mask(self.ct,corrected=False))
+        mask2 = itk.array_from_image(roi2.get_mask(self.ct,corrected=False))
+        self.assertTrue(np.array_equal(mask1,mask2))
+    def test_cache(self):
+        import pydicom
+        roi = region_of_interest(ds=self.ds,roi_id="PTV")
+        contours = get_structure_set_contours(self.ds)
+        self.assertIs(_structure_set_cache[str(self.ds.SOPInstanceUID)],contours)
+        self.assertEqual(list_roinames(contours),["External","PTV","Spine","Organ1","Organ2"])
+        self.assertEqual(list_roinumbers(contours),[1,2,3,4,5])
+        # from file: the raw contour data are parsed directly
+        clear_structure_set_cache()
+        self.assertSameROI(region_of_interest(ds=pydicom.dcmread(self.rspath),roi_id="2"),roi)
+        self.assertEqual(region_of_interest(ds=self.ds,roi_id="Spine").roiname,"Spine")
+        with self.assertRaises(ValueError):
+            region_of_interest(ds=self.ds,roi_id="Liver")
+    def test_npz(self):
+        npzpath = os.path.join(self.tmpdir.name,"contours.npz")
+        get_structure_set_contours(self.ds).save(npzpath)
+        clear_structure_set_cache()
+        contours = structure_set_contours.load(npzpath)
+        self.assertIs(get_structure_set_contours(self.ds),contours)
+        for name in list_roinames(self.ds):
+            self.assertSameROI(region_of_interest(ds=contours,roi_id=name),region_of_interest(ds=structure_set_contours(self.ds),roi_id=name))
+    def test_bounding_boxes(self):
+        contours = get_structure_set_contours(self.ds)
+        limits = contours.bounding_boxes()
+        self.assertEqual(limits.shape,(len(contours.roinames),3,2))
+        for i,name in enumerate(contours.roinames):
+            self.assertTrue(np.array_equal(limits[i],region_of_interest(ds=contours,roi_id=name).bb.limits))
+        self.assertTrue(np.array_equal(contours.bounding_boxes([3,1]),limits[[3,1]]))
+    def test_changed_dataset(self):
+        region_of_interest(ds=self.ds,roi_id="PTV")
+        # same SOPInstanceUID, but different contours
+        del self.ds.ROIContourSequence[1].ContourSequence[0]
+        roi = region_of_interest(ds=self.ds,roi_id="PTV")
+        self.assertEqual(roi.ncontours,len(self.ds.ROIContourSequence[1].ContourSequence))
+
+def _ellipse_points(cx,cy,ax,ay,z,npoints=100):
+    phi = np.linspace(0.,2*np.pi,npoints,endpoint=False)
+    return np.stack([cx+ax*np.cos(phi),cy+ay*np.sin(phi),np.full(npoints,z)],axis=1)
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='wall time of the DVH computation for many ROIs, one by one and in one pass')
+    parser.add_argument('-s','--shape',type=int,nargs=3,default=[300,300,300],help='dose grid shape (nz ny nx)')
+    parser.add_argument('-n','--nrois',type=int,default=40)
+    parser.add_argument('-b','--nbins',type=int,default=100)
+    args = parser.parse_args()
+    t_single,t_batch = benchmark(tuple(args.shape),args.nrois,args.nbins)
+    print("{} ROIs on a {} grid: one by one {:.2f} s, in one pass {:.2f} s".format(args.nrois,"x".join([str(n) for n in args.shape]),t_single,t_batch))
+
 # vim: set et softtabstop=4 sw=4 smartindent:
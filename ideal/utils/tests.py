@@ -34,12 +34,12 @@ class TestGetDaemons(unittest.TestCase):
 
     def test_input(self):
         with self.assertRaises(AssertionError):
-            # function must be called only with the name of the job control daemon script
-            daemons = get_job_daemons("python") 
+            # function must be called with the jobs directory
+            daemons = get_job_daemons("job_control_daemon.py") 
             
     def test_basic_function(self):
-        daemons = get_job_daemons("job_control_daemon.py")
-        print(daemons)
+        daemons = get_job_daemons(os.path.dirname(os.path.abspath(__file__)))
+        self.assertEqual(daemons,dict())
 
 class TestGetJobs(unittest.TestCase):
 
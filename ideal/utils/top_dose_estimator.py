@@ -0,0 +1,221 @@
+# -----------------------------------------------------------------------------
+#   Copyright (C): MedAustron GmbH, ACMIT Gmbh and Medical University Vienna
+#   This software is distributed under the terms
+#   of the GNU Lesser General  Public Licence (LGPL)
+#   See LICENSE for further details
+# -----------------------------------------------------------------------------
+
+"""
+The "mean uncertainty" that the job control daemon compares with the
+uncertainty goal is the average relative standard deviation of the mean dose
+over the voxels that have a mean dose larger than `toppct` percent of the
+"max dose", where the "max dose" is the average of the `ntop` largest mean
+dose values.
+
+The straightforward implementation (`mean_uncertainty_pct_full`) computes
+the mean, the variance and the relative uncertainty for the full volume, and
+uses a partition of the full volume to find the `ntop` largest values.  For
+large dose grids this is slow and it needs several full volume temporary
+arrays, on every poll.
+
+The `top_dose_estimator` keeps a compact integer index set of the voxels
+that are (at least) close to the threshold. This set only changes slowly
+between polls (the mean dose per primary converges), so it is only
+recomputed if the "max dose" changes significantly or if the set turns out
+to be incomplete. On a normal poll the only full volume operation is a
+maximum over the voxels outside the set, which does not allocate memory.
+"""
+
+import numpy as np
+import logging
+logger=logging.getLogger(__name__)
+
+def mean_uncertainty_pct_full(dosesum,dose2sum,weightsum,n,ntop,toppct):
+    """
+    Reference implementation, computed on the full volume.
+    Returns the mean uncertainty in percent, the "max dose" and the number of
+    voxels above the threshold.
+    """
+    amean = dosesum/weightsum
+    amean2 = dose2sum/weightsum
+    avariance = amean2 - amean**2
+    avariance[avariance<0] = 0.
+    amean[amean<0] = 0.
+    m0 = amean>0
+    std_pct = np.full_like(avariance,100.)
+    std_pct[m0] = np.sqrt(avariance[m0]/n)*100./amean[m0]
+    dmax = np.mean(np.partition(amean.flat,-ntop)[-ntop:])
+    dthr = dmax * toppct / 100.0
+    mask = (amean>dthr)
+    nthr = int(np.sum(mask))
+    return (np.mean(std_pct[mask]) if nthr>0 else np.nan),dmax,nthr
+
+class top_dose_estimator:
+    """
+    Streaming version of `mean_uncertainty_pct_full`, to be used for
+    repeated estimates on (growing) dose sums with the same shape. The
+    candidate set includes all voxels with a mean dose larger than
+    `(1-margin)` times the threshold at the time the set was computed.
+    """
+    def __init__(self,ntop,toppct,margin=0.2):
+        self.ntop = int(ntop)
+        self.toppct = float(toppct)
+        self.margin = float(margin)
+        self.indices = None
+        self.shape = None
+        self.dmax_at_refresh = None
+        self.nrefresh = 0
+        self.dmax = None
+        self.nthr = 0
+    def _refresh(self,flat,weightsum):
+        # full volume partition, only done when the candidate set is invalid
+        ntop = min(self.ntop,flat.size)
+        itop = np.argpartition(flat,-ntop)[-ntop:]
+        dmax = np.mean(np.maximum(flat[itop],0.)/weightsum)
+        lower = (1.-self.margin) * dmax * self.toppct / 100.0
+        self.indices = np.union1d(np.flatnonzero(flat>lower*weightsum),itop)
+        self.dmax_at_refresh = dmax
+        self.nrefresh += 1
+        logger.debug("refreshed candidate set for top dose threshold: {} voxels".format(len(self.indices)))
+    def _estimate_threshold(self,flat,weightsum):
+        """
+        Returns the mean dose values on the candidate set and the threshold,
+        or None if the candidate set is not valid anymore.
+        """
+        if self.indices is None or len(self.indices) < min(self.ntop,flat.size):
+            return None
+        vals = flat[self.indices]
+        amean = np.maximum(vals/weightsum,0.)
+        ntop = min(self.ntop,len(amean))
+        top = np.partition(amean,-ntop)[-ntop:]
+        dmax = np.mean(top)
+        if dmax > (1.+self.margin)*self.dmax_at_refresh or dmax < (1.-self.margin)*self.dmax_at_refresh:
+            return None
+        dthr = dmax * self.toppct / 100.0
+        # maximum outside of the candidate set, without allocating a full volume mask
+        flat[self.indices] = -np.inf
+        try:
+            vmax_outside = np.max(flat)
+        finally:
+            flat[self.indices] = vals
+        amax_outside = max(vmax_outside/weightsum,0.)
+        if amax_outside > dthr or amax_outside > np.min(top):
+            return None
+        return amean,dmax,dthr
+    def estimate(self,dosesum,dose2sum,weightsum,n):
+        """
+        Returns the mean uncertainty in percent for the given sums of doses
+        and squared doses (see `dose_collector`), with `weightsum` the total
+        number of primaries and `n` the number of subjobs.
+        The dose sum should be a writeable contiguous array: the values on
+        the candidate set are temporarily overwritten.
+        """
+        flat = dosesum.reshape(-1)
+        flat2 = dose2sum.reshape(-1)
+        if self.shape != dosesum.shape:
+            self.shape = dosesum.shape
+            self.indices = None
+        result = self._estimate_threshold(flat,weightsum)
+        if result is None:
+            self._refresh(flat,weightsum)
+            result = self._estimate_threshold(flat,weightsum)
+        if result is None:
+            # should only happen in pathological cases, e.g. all dose values equal to zero
+            logger.warning("top dose estimator: candidate set not valid after refresh, using full volume estimate")
+            mean_unc_pct,self.dmax,self.nthr = mean_uncertainty_pct_full(dosesum,dose2sum,weightsum,n,self.ntop,self.toppct)
+            self.indices = None
+            return mean_unc_pct
+        amean,self.dmax,dthr = result
+        sel = amean>dthr
+        self.nthr = int(np.sum(sel))
+        if self.nthr == 0:
+            return np.nan
+        amean = amean[sel]
+        amean2 = flat2[self.indices[sel]]/weightsum
+        avariance = np.maximum(amean2 - amean**2,0.)
+        std_pct = np.sqrt(avariance/n)*100./amean
+        return np.mean(std_pct)
+
+###############################################################################################
+# UNIT TESTING
+###############################################################################################
+
+import unittest
+
+class test_top_dose_estimator(unittest.TestCase):
+    def make_sums(self,shape,njobs,rng):
+        # a smooth "dose" peak with noisy subjobs
+        z,y,x = np.meshgrid(*[np.linspace(-1,1,s) for s in shape],indexing='ij')
+        peak = np.exp(-(x**2+y**2+z**2)/0.2)
+        dosesum = np.zeros(shape)
+        dose2sum = np.zeros(shape)
+        weightsum = 0
+        for j in range(njobs):
+            nprim = int(rng.integers(1000,2000))
+            dose = nprim*peak*rng.gamma(25.,0.04,shape)
+            dosesum += dose
+            dose2sum += dose**2/nprim
+            weightsum += nprim
+            yield dosesum,dose2sum,weightsum,j+1
+    def compare(self,shape,ntop,toppct,njobs=10):
+        rng = np.random.default_rng(2023)
+        est = top_dose_estimator(ntop,toppct)
+        for dosesum,dose2sum,weightsum,n in self.make_sums(shape,njobs,rng):
+            if n<2:
+                continue
+            backup = dosesum.copy()
+            ref,dmax,nthr = mean_uncertainty_pct_full(dosesum,dose2sum,weightsum,n,ntop,toppct)
+            unc = est.estimate(dosesum,dose2sum,weightsum,n)
+            self.assertTrue(np.array_equal(backup,dosesum))
+            self.assertAlmostEqual(unc/ref,1.,places=10)
+            self.assertAlmostEqual(est.dmax/dmax,1.,places=10)
+            self.assertEqual(est.nthr,nthr)
+        return est
+    def test_random(self):
+        est = self.compare((20,30,40),100,50.)
+        # the set should not be recomputed on every poll
+        self.assertLess(est.nrefresh,5)
+        self.assertLess(len(est.indices),20*30*40)
+    def test_small_top(self):
+        self.compare((10,11,12),5,80.)
+    def test_zero_dose(self):
+        est = top_dose_estimator(10,50.)
+        unc = est.estimate(np.zeros((5,6,7)),np.zeros((5,6,7)),1000,3)
+        self.assertTrue(np.isnan(unc))
+
+if __name__ == '__main__':
+    import argparse
+    import time
+    parser = argparse.ArgumentParser(description='per-poll time of the full and streaming mean uncertainty estimates')
+    parser.add_argument('-s','--shape',type=int,nargs=3,default=[300,300,300],help='dose grid shape (nz ny nx)')
+    parser.add_argument('-p','--npolls',type=int,default=6)
+    parser.add_argument('-n','--ntop',type=int,default=100)
+    parser.add_argument('-t','--toppct',type=float,default=50.)
+    args = parser.parse_args()
+    shape = tuple(args.shape)
+    rng = np.random.default_rng(1)
+    z,y,x = np.meshgrid(*[np.linspace(-1,1,s,dtype=np.float32) for s in shape],indexing='ij',sparse=True)
+    peak = np.exp(-(x**2+y**2+z**2)/0.1)
+    dosesum = np.zeros(shape)
+    dose2sum = np.zeros(shape)
+    est = top_dose_estimator(args.ntop,args.toppct)
+    tfull,tstream = [],[]
+    for poll in range(1,args.npolls+1):
+        # one subjob with 10% noise per poll
+        dose = 1000*peak*rng.gamma(100.,0.01,shape).astype(np.float32)
+        dosesum += dose
+        dose2sum += dose**2/1000
+        del dose
+        if poll<2:
+            continue
+        t0 = time.perf_counter()
+        ref = mean_uncertainty_pct_full(dosesum,dose2sum,1000*poll,poll,args.ntop,args.toppct)[0]
+        t1 = time.perf_counter()
+        unc = est.estimate(dosesum,dose2sum,1000*poll,poll)
+        t2 = time.perf_counter()
+        tfull.append(t1-t0)
+        tstream.append(t2-t1)
+        print("poll {}: full {:.3f} s, streaming {:.3f} s, unc = {:.4f}/{:.4f} pct, {} candidates".format(poll,t1-t0,t2-t1,ref,unc,len(est.indices)))
+    print("shape {}: median per-poll time full {:.3f} s, streaming {:.3f} s ({} refreshes)".format(shape,np.median(tfull),np.median(tstream),est.nrefresh))
+
+# vim: set et softtabstop=4 sw=4 smartindent: